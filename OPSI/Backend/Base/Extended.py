@@ -2770,6 +2770,42 @@ into the IDs of these depots are to be found in the list behind \
 			)
 		)
 
+	def auditSoftwareOnClient_replaceInventory(self, clientId, auditSoftwareOnClients, auditSoftwares=None):
+		"""
+		Replace the complete software inventory of a client.
+
+		Entries of the client missing in `auditSoftwareOnClients` are
+		removed, all others are created or updated.
+		The given `auditSoftwares` are created or updated beforehand.
+		"""
+		clientId = forceHostId(clientId)
+		auditSoftwareOnClients = forceObjectClassList(auditSoftwareOnClients, AuditSoftwareOnClient)
+		auditSoftwares = forceObjectClassList(auditSoftwares or [], AuditSoftware)
+
+		if hasattr(self._backend, "auditSoftwareOnClient_replaceInventory"):
+			# Using optimized version
+			return self._backend.auditSoftwareOnClient_replaceInventory(clientId, auditSoftwareOnClients, auditSoftwares)
+
+		if auditSoftwares:
+			self.auditSoftware_updateObjects(auditSoftwares)
+
+		existing = {
+			auditSoftwareOnClient.getIdent(returnType="tuple"): auditSoftwareOnClient
+			for auditSoftwareOnClient in self._backend.auditSoftwareOnClient_getObjects(clientId=clientId)
+		}
+		for auditSoftwareOnClient in auditSoftwareOnClients:
+			if auditSoftwareOnClient.clientId != clientId:
+				raise BackendBadValueError(f"{auditSoftwareOnClient} does not belong to client '{clientId}'")
+
+			if existing.pop(auditSoftwareOnClient.getIdent(returnType="tuple"), None):
+				self._backend.auditSoftwareOnClient_updateObject(auditSoftwareOnClient)
+			else:
+				self._backend.auditSoftwareOnClient_insertObject(auditSoftwareOnClient)
+
+		if existing:
+			self._backend.auditSoftwareOnClient_deleteObjects(list(existing.values()))
+		return None
+
 	def auditSoftwareOnClient_setObsolete(self, clientId):
 		if hasattr(self._backend, "auditSoftwareOnClient_setObsolete"):
 			# Using optimized version
@@ -2832,24 +2868,13 @@ into the IDs of these depots are to be found in the list behind \
 		return []
 
 	def auditHardwareOnHost_updateObjects(self, auditHardwareOnHosts):
-		def getNoneAsListOrValue(value):
-			if value is None:
-				return [None]
-			return value
-
+		auditHardwareOnHostsByHost = {}
 		for auditHardwareOnHost in forceObjectClassList(auditHardwareOnHosts, AuditHardwareOnHost):
-			_filter = {
-				attribute: getNoneAsListOrValue(value)
-				for (attribute, value) in auditHardwareOnHost.toHash().items()
-				if attribute not in ("firstseen", "lastseen", "state")
-			}
+			auditHardwareOnHostsByHost.setdefault(auditHardwareOnHost.hostId, []).append(auditHardwareOnHost)
 
-			if self.auditHardwareOnHost_getObjects(attributes=["hostId"], **_filter):  # pylint: disable=no-member
-				logger.trace("Updating existing AuditHardwareOnHost %s", auditHardwareOnHost)
-				self.auditHardwareOnHost_updateObject(auditHardwareOnHost)
-			else:
-				logger.info("AuditHardwareOnHost %s does not exist, creating", auditHardwareOnHost)
-				self._backend.auditHardwareOnHost_insertObject(auditHardwareOnHost)
+		for (hostId, hostAuditHardwareOnHosts) in auditHardwareOnHostsByHost.items():
+			logger.info("Updating %d auditHardwareOnHosts of host %s", len(hostAuditHardwareOnHosts), hostId)
+			self.auditHardwareOnHost_replaceInventory(hostId, hostAuditHardwareOnHosts, update=True)
 
 		return []
 
@@ -2884,6 +2909,74 @@ into the IDs of these depots are to be found in the list behind \
 			)
 		)
 
+	@staticmethod
+	def _getAuditHardwareOnHostKey(auditHardwareOnHost):
+		# Unset attributes are left out to match hashes with and without them
+		return tuple(
+			sorted(
+				(attribute, str(value))
+				for (attribute, value) in auditHardwareOnHost.toHash().items()
+				if value is not None and attribute not in ("firstseen", "lastseen", "state")
+			)
+		)
+
+	def auditHardwareOnHost_replaceInventory(self, hostId, auditHardwareOnHosts, update=False):
+		"""
+		Replace the hardware inventory of a host.
+
+		Entries already present are marked as seen, missing entries are
+		created and all other entries of the host are set obsolete.
+
+		With `update` the entries are updated like \
+`auditHardwareOnHost_updateObjects` does instead: state, lastseen and \
+firstseen of the objects are written, unset state and lastseen \
+default to 1 and now. Other entries of the host are kept.
+		"""
+		hostId = forceHostId(hostId)
+		auditHardwareOnHosts = forceObjectClassList(auditHardwareOnHosts, AuditHardwareOnHost)
+		update = forceBool(update)
+
+		if hasattr(self._backend, "auditHardwareOnHost_replaceInventory"):
+			# Using optimized version
+			return self._backend.auditHardwareOnHost_replaceInventory(hostId, auditHardwareOnHosts, update)
+
+		existing = {}
+		for auditHardwareOnHost in self._backend.auditHardwareOnHost_getObjects(hostId=hostId):
+			existing.setdefault(self._getAuditHardwareOnHostKey(auditHardwareOnHost), []).append(auditHardwareOnHost)
+
+		now = timestamp()
+		for auditHardwareOnHost in auditHardwareOnHosts:
+			if auditHardwareOnHost.hostId != hostId:
+				raise BackendBadValueError(f"{auditHardwareOnHost} does not belong to host '{hostId}'")
+
+			key = self._getAuditHardwareOnHostKey(auditHardwareOnHost)
+			if key not in existing:
+				logger.info("AuditHardwareOnHost %s does not exist, creating", auditHardwareOnHost)
+				self._backend.auditHardwareOnHost_insertObject(auditHardwareOnHost)
+				existing[key] = []
+				continue
+
+			for existingAuditHardwareOnHost in existing.pop(key):
+				if update:
+					state = auditHardwareOnHost.getState()
+					existingAuditHardwareOnHost.setState(1 if state is None else state)
+					existingAuditHardwareOnHost.setLastseen(auditHardwareOnHost.getLastseen() or now)
+					if auditHardwareOnHost.getFirstseen():
+						existingAuditHardwareOnHost.setFirstseen(auditHardwareOnHost.getFirstseen())
+				else:
+					existingAuditHardwareOnHost.setLastseen(now)
+					existingAuditHardwareOnHost.setState(1)
+				self._backend.auditHardwareOnHost_updateObject(existingAuditHardwareOnHost)
+			existing[key] = []
+
+		if not update:
+			for existingAuditHardwareOnHosts in existing.values():
+				for existingAuditHardwareOnHost in existingAuditHardwareOnHosts:
+					if existingAuditHardwareOnHost.getState() != 0:
+						existingAuditHardwareOnHost.setState(0)
+						self._backend.auditHardwareOnHost_updateObject(existingAuditHardwareOnHost)
+		return None
+
 	def auditHardwareOnHost_setObsolete(self, hostId):
 		if hasattr(self._backend, "auditHardwareOnHost_setObsolete"):
 			# Using optimized version
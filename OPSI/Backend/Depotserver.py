@@ -7,6 +7,7 @@ Depotserver backend.
 """
 
 import os
+import threading
 from contextlib import contextmanager
 from pathlib import Path
 from typing import Any, Dict, Generator, List, Union
@@ -31,6 +32,7 @@ from OPSI.Types import forceBool, forceDict, forceFilename, forceHostId
 from OPSI.Types import forceProductId as forceProductIdFunc
 from OPSI.Types import forceUnicode, forceUnicodeLower
 from OPSI.Util import compareVersions, findFiles, getfqdn, md5sum, removeDirectory
+from OPSI.Util.Checksum import getChecksumCache
 from OPSI.Util.File import ZsyncFile
 from OPSI.Util.Product import (
 	PackageContentFile,
@@ -69,11 +71,13 @@ class DepotserverBackend(ExtendedBackend):
 		"""
 		This method calculates the md5-sum of a file.
 		:param filename: File to compute checksum for.
-		:param forceCalculation: if this is True, always calculate, otherwise use <filename>.md5 if available.
+		:param forceCalculation: if this is True, always calculate, otherwise use <filename>.md5 \
+or the checksum cache if available.
 		"""
 		checksum = None
 		try:
-			if not forceBool(forceCalculation):
+			forceCalculation = forceBool(forceCalculation)
+			if not forceCalculation:
 				hashFile = filename + '.md5'
 
 				try:
@@ -85,7 +89,11 @@ class DepotserverBackend(ExtendedBackend):
 					pass
 
 			if not checksum:
-				checksum = md5sum(filename)
+				if forceCalculation:
+					checksum = md5sum(filename)
+				else:
+					with getChecksumCache() as checksumCache:
+						checksum = checksumCache.md5sum(filename)
 
 			logger.info("MD5sum of file '%s' is '%s'", filename, checksum)
 			return checksum
@@ -122,6 +130,56 @@ class DepotserverBackend(ExtendedBackend):
 		except Exception as err:
 			raise BackendIOError(f"Failed to create librsync delta file: {err}") from err
 
+	def depot_librsyncSignatureManifest(self, directory: str) -> Dict[str, Dict[str, Any]]:  # pylint: disable=invalid-name
+		"""
+		Get the librsync signatures of all files below `directory`.
+
+		The result is passed to `depot_librsyncDeltaFiles` of the depot \
+holding the new files.
+		"""
+		from OPSI.Util.Sync import (  # pylint: disable=import-outside-toplevel
+			librsyncSignatureManifest,
+		)
+
+		try:
+			return librsyncSignatureManifest(directory)
+		except Exception as err:
+			raise BackendIOError(f"Failed to get librsync signature manifest: {err}") from err
+
+	def depot_librsyncDeltaFiles(  # pylint: disable=invalid-name
+		self, directory: str, manifest: Dict[str, Dict[str, Any]], deltaDirectory: str
+	) -> Dict[str, Any]:
+		"""
+		Create the delta files needed to update a copy of `directory` \
+described by `manifest` in `deltaDirectory`.
+
+		:returns: The delta files by relative path in _deltas_ and the \
+relative paths of the files to delete in _removed_.
+		"""
+		from OPSI.Util.Sync import (  # pylint: disable=import-outside-toplevel
+			librsyncDeltaFiles,
+		)
+
+		try:
+			return librsyncDeltaFiles(directory, forceDict(manifest), deltaDirectory)
+		except Exception as err:
+			raise BackendIOError(f"Failed to create librsync delta files: {err}") from err
+
+	def depot_librsyncPatchFiles(  # pylint: disable=invalid-name
+		self, directory: str, deltas: Dict[str, str], removed: List[str] = None
+	) -> None:
+		"""
+		Update `directory` with the result of `depot_librsyncDeltaFiles`.
+		"""
+		from OPSI.Util.Sync import (  # pylint: disable=import-outside-toplevel
+			librsyncPatchFiles,
+		)
+
+		try:
+			librsyncPatchFiles(directory, forceDict(deltas), removed)
+		except Exception as err:
+			raise BackendIOError(f"Failed to patch files: {err}") from err
+
 	def depot_getDiskSpaceUsage(self, path: str) -> Dict[str, Any]:  # pylint: disable=invalid-name
 		if os.name != 'posix':
 			raise NotImplementedError("Not implemented for non-posix os")
@@ -265,6 +323,9 @@ class DepotserverPackageManager:
 				f"got {depotBackend.__class__.__name__}"
 			)
 		self._depotBackend = depotBackend
+		# Packages can be installed concurrently, the backend is only
+		# accessed by one installation at a time.
+		self._backendLock = threading.RLock()
 
 	def installPackage(  # pylint: disable=too-many-arguments,too-many-locals,too-many-branches,too-many-statements
 		self,
@@ -280,7 +341,8 @@ class DepotserverPackageManager:
 		@contextmanager
 		def productPackageFile(filename: str, tempDir: str, depotId: str) -> Generator[ProductPackageFile, None, None]:
 			try:
-				depots = self._depotBackend._context.host_getObjects(id=depotId)  # pylint: disable=protected-access
+				with self._backendLock:
+					depots = self._depotBackend._context.host_getObjects(id=depotId)  # pylint: disable=protected-access
 				depot = depots[0]
 				del depots
 			except IndexError as err:
@@ -309,30 +371,31 @@ class DepotserverPackageManager:
 		@contextmanager
 		def lockProduct(backend: Backend, product: str, depotId: str, forceInstallation: bool) -> ProductOnDepot:
 			productId = product.getId()
-			logger.debug("Checking for locked product '%s' on depot '%s'", productId, depotId)
-			productOnDepots = backend.productOnDepot_getObjects(depotId=depotId, productId=productId)
-			try:
-				if productOnDepots[0].getLocked():
-					logger.notice("Product '%s' currently locked on depot '%s'", productId, depotId)
-					if not forceInstallation:
-						raise BackendTemporaryError(
-							f"Product '{productId}' currently locked on depot '{depotId}', use argument 'force' to ignore"
-						)
-					logger.warning("Installation of locked product forced")
-			except IndexError:
-				pass
+			with self._backendLock:
+				logger.debug("Checking for locked product '%s' on depot '%s'", productId, depotId)
+				productOnDepots = backend.productOnDepot_getObjects(depotId=depotId, productId=productId)
+				try:
+					if productOnDepots[0].getLocked():
+						logger.notice("Product '%s' currently locked on depot '%s'", productId, depotId)
+						if not forceInstallation:
+							raise BackendTemporaryError(
+								f"Product '{productId}' currently locked on depot '{depotId}', use argument 'force' to ignore"
+							)
+						logger.warning("Installation of locked product forced")
+				except IndexError:
+					pass
 
-			logger.notice("Locking product '%s' on depot '%s'", productId, depotId)
-			productOnDepot = ProductOnDepot(
-				productId=productId,
-				productType=product.getType(),
-				productVersion=product.getProductVersion(),
-				packageVersion=product.getPackageVersion(),
-				depotId=depotId,
-				locked=True
-			)
-			logger.info("Creating product on depot %s", productOnDepot)
-			backend.productOnDepot_createObjects(productOnDepot)
+				logger.notice("Locking product '%s' on depot '%s'", productId, depotId)
+				productOnDepot = ProductOnDepot(
+					productId=productId,
+					productType=product.getType(),
+					productVersion=product.getProductVersion(),
+					packageVersion=product.getPackageVersion(),
+					depotId=depotId,
+					locked=True
+				)
+				logger.info("Creating product on depot %s", productOnDepot)
+				backend.productOnDepot_createObjects(productOnDepot)
 
 			try:
 				yield productOnDepot
@@ -348,7 +411,8 @@ class DepotserverPackageManager:
 				depotId
 			)
 			productOnDepot.setLocked(False)
-			backend.productOnDepot_updateObject(productOnDepot)
+			with self._backendLock:
+				backend.productOnDepot_updateObject(productOnDepot)
 
 		@contextmanager
 		def runPackageScripts(productPackageFile: ProductPackageFile, env: Dict[str, Any] = None) -> Generator[None, None, None]:
@@ -485,15 +549,16 @@ class DepotserverPackageManager:
 					productId = product.getId()
 					old_product_version = ""
 					old_package_version = ""
-					try:
-						product_on_depot = dataBackend.productOnDepot_getObjects(depotId=depotId, productId=productId)[0]
-						old_product_version = product_on_depot.getProductVersion()
-						old_package_version = product_on_depot.getPackageVersion()
-					except Exception as err:  # pylint: disable=broad-except
-						logger.debug(err)
+					with self._backendLock:
+						try:
+							product_on_depot = dataBackend.productOnDepot_getObjects(depotId=depotId, productId=productId)[0]
+							old_product_version = product_on_depot.getProductVersion()
+							old_package_version = product_on_depot.getPackageVersion()
+						except Exception as err:  # pylint: disable=broad-except
+							logger.debug(err)
 
-					logger.info("Creating product in backend")
-					dataBackend.product_createObjects(product)
+						logger.info("Creating product in backend")
+						dataBackend.product_createObjects(product)
 
 					with lockProduct(dataBackend, product, depotId, force) as productOnDepot:
 						logger.info("Checking package dependencies")
@@ -511,126 +576,128 @@ class DepotserverPackageManager:
 							logger.info("Unpacking package files")
 							ppf.extractData()
 
-							logger.info("Updating product dependencies of product %s", product)
-							currentProductDependencies = {}
-							for productDependency in dataBackend.productDependency_getObjects(
-								productId=productId,
-								productVersion=product.getProductVersion(),
-								packageVersion=product.getPackageVersion()
-							):
-								ident = productDependency.getIdent(returnType='unicode')
-								currentProductDependencies[ident] = productDependency
-
-							productDependencies = []
-							for productDependency in ppf.packageControlFile.getProductDependencies():
-								if forceProductId:
-									productDependency.productId = productId
-
-								ident = productDependency.getIdent(returnType='unicode')
-								try:
-									del currentProductDependencies[ident]
-								except KeyError:
-									pass  # Dependency does currently not exist.
-								productDependencies.append(productDependency)
-
-							dataBackend.productDependency_createObjects(productDependencies)
-							if currentProductDependencies:
-								dataBackend.productDependency_deleteObjects(
-									list(currentProductDependencies.values())
-								)
-
-							logger.info("Updating product properties of product %s", product)
-							currentProductProperties = {}
-							productProperties = []
-							for productProperty in dataBackend.productProperty_getObjects(
-								productId=productId,
-								productVersion=product.getProductVersion(),
-								packageVersion=product.getPackageVersion()
-							):
-								ident = productProperty.getIdent(returnType='unicode')
-								currentProductProperties[ident] = productProperty
-
-							for productProperty in ppf.packageControlFile.getProductProperties():
-								if forceProductId:
-									productProperty.productId = productId
-
-								ident = productProperty.getIdent(returnType='unicode')
-								try:
-									del currentProductProperties[ident]
-								except KeyError:
-									pass  # Property not found - everyhing okay
-								productProperties.append(productProperty)
-							dataBackend.productProperty_createObjects(productProperties)
-
-							for productProperty in productProperties:
-								# Adjust property default values
-								if productProperty.editable or not productProperty.possibleValues:
-									continue
+							with self._backendLock:
+								logger.info("Updating product dependencies of product %s", product)
+								currentProductDependencies = {}
+								for productDependency in dataBackend.productDependency_getObjects(
+									productId=productId,
+									productVersion=product.getProductVersion(),
+									packageVersion=product.getPackageVersion()
+								):
+									ident = productDependency.getIdent(returnType='unicode')
+									currentProductDependencies[ident] = productDependency
+
+								productDependencies = []
+								for productDependency in ppf.packageControlFile.getProductDependencies():
+									if forceProductId:
+										productDependency.productId = productId
+
+									ident = productDependency.getIdent(returnType='unicode')
+									try:
+										del currentProductDependencies[ident]
+									except KeyError:
+										pass  # Dependency does currently not exist.
+									productDependencies.append(productDependency)
+
+								dataBackend.productDependency_createObjects(productDependencies)
+								if currentProductDependencies:
+									dataBackend.productDependency_deleteObjects(
+										list(currentProductDependencies.values())
+									)
+
+								logger.info("Updating product properties of product %s", product)
+								currentProductProperties = {}
+								productProperties = []
+								for productProperty in dataBackend.productProperty_getObjects(
+									productId=productId,
+									productVersion=product.getProductVersion(),
+									packageVersion=product.getPackageVersion()
+								):
+									ident = productProperty.getIdent(returnType='unicode')
+									currentProductProperties[ident] = productProperty
 
-								newValues = [
-									value
-									for value in propertyDefaultValues.get(productProperty.propertyId, [])
-									if value in productProperty.possibleValues
-								]
-								if not newValues and productProperty.defaultValues:
-									newValues = productProperty.defaultValues
-								propertyDefaultValues[productProperty.propertyId] = newValues
+								for productProperty in ppf.packageControlFile.getProductProperties():
+									if forceProductId:
+										productProperty.productId = productId
 
-							if currentProductProperties:
-								dataBackend.productProperty_deleteObjects(
-									list(currentProductProperties.values())
+									ident = productProperty.getIdent(returnType='unicode')
+									try:
+										del currentProductProperties[ident]
+									except KeyError:
+										pass  # Property not found - everyhing okay
+									productProperties.append(productProperty)
+								dataBackend.productProperty_createObjects(productProperties)
+
+								for productProperty in productProperties:
+									# Adjust property default values
+									if productProperty.editable or not productProperty.possibleValues:
+										continue
+
+									newValues = [
+										value
+										for value in propertyDefaultValues.get(productProperty.propertyId, [])
+										if value in productProperty.possibleValues
+									]
+									if not newValues and productProperty.defaultValues:
+										newValues = productProperty.defaultValues
+									propertyDefaultValues[productProperty.propertyId] = newValues
+
+								if currentProductProperties:
+									dataBackend.productProperty_deleteObjects(
+										list(currentProductProperties.values())
+									)
+
+								logger.info("Deleting product property states of product %s on depot '%s'", productId, depotId)
+								dataBackend.productPropertyState_deleteObjects(
+									dataBackend.productPropertyState_getObjects(
+										productId=productId,
+										objectId=depotId
+									)
 								)
 
-							logger.info("Deleting product property states of product %s on depot '%s'", productId, depotId)
-							dataBackend.productPropertyState_deleteObjects(
-								dataBackend.productPropertyState_getObjects(
-									productId=productId,
-									objectId=depotId
-								)
-							)
+								logger.info("Deleting not needed property states of product %s", productId)
+								productPropertyStates = dataBackend.productPropertyState_getObjects(productId=productId)
+								baseProperties = dataBackend.productProperty_getObjects(productId=productId)
+
+								productPropertyIds = None
+								productPropertyStatesToDelete = None
+								productPropertyIds = [productProperty.propertyId for productProperty in baseProperties]
+								productPropertyStatesToDelete = [ppState for ppState in productPropertyStates if ppState.propertyId not in productPropertyIds]
+								logger.debug("Following productPropertyStates are marked to delete: '%s'", productPropertyStatesToDelete)
+								if productPropertyStatesToDelete:
+									dataBackend.productPropertyState_deleteObjects(productPropertyStatesToDelete)
+
+								logger.info("Setting product property states in backend")
+								productPropertyStates = [
+									ProductPropertyState(
+										productId=productId,
+										propertyId=productProperty.propertyId,
+										objectId=depotId,
+										values=productProperty.defaultValues
+									) for productProperty in productProperties
+								]
 
-							logger.info("Deleting not needed property states of product %s", productId)
-							productPropertyStates = dataBackend.productPropertyState_getObjects(productId=productId)
-							baseProperties = dataBackend.productProperty_getObjects(productId=productId)
-
-							productPropertyIds = None
-							productPropertyStatesToDelete = None
-							productPropertyIds = [productProperty.propertyId for productProperty in baseProperties]
-							productPropertyStatesToDelete = [ppState for ppState in productPropertyStates if ppState.propertyId not in productPropertyIds]
-							logger.debug("Following productPropertyStates are marked to delete: '%s'", productPropertyStatesToDelete)
-							if productPropertyStatesToDelete:
-								dataBackend.productPropertyState_deleteObjects(productPropertyStatesToDelete)
-
-							logger.info("Setting product property states in backend")
-							productPropertyStates = [
-								ProductPropertyState(
-									productId=productId,
-									propertyId=productProperty.propertyId,
-									objectId=depotId,
-									values=productProperty.defaultValues
-								) for productProperty in productProperties
-							]
-
-							for productPropertyState in productPropertyStates:
-								if productPropertyState.propertyId in propertyDefaultValues:
-									try:
-										productPropertyState.setValues(propertyDefaultValues[productPropertyState.propertyId])
-									except Exception as installationError:  # pylint: disable=broad-except
-										logger.error(
-											"Failed to set default values to %s for productPropertyState %s: %s",
-											propertyDefaultValues[productPropertyState.propertyId],
-											productPropertyState,
-											installationError
-										)
-							dataBackend.productPropertyState_createObjects(productPropertyStates)
+								for productPropertyState in productPropertyStates:
+									if productPropertyState.propertyId in propertyDefaultValues:
+										try:
+											productPropertyState.setValues(propertyDefaultValues[productPropertyState.propertyId])
+										except Exception as installationError:  # pylint: disable=broad-except
+											logger.error(
+												"Failed to set default values to %s for productPropertyState %s: %s",
+												propertyDefaultValues[productPropertyState.propertyId],
+												productPropertyState,
+												installationError
+											)
+								dataBackend.productPropertyState_createObjects(productPropertyStates)
 
 						if not suppressPackageContentFileGeneration:
 							ppf.createPackageContentFile()
 						else:
 							logger.debug("Suppressed generation of package content file.")
 
-				cleanUpProducts(dataBackend, productOnDepot.productId)
-				cleanUpProductPropertyStates(dataBackend, productProperties, depotId, productOnDepot)
+				with self._backendLock:
+					cleanUpProducts(dataBackend, productOnDepot.productId)
+					cleanUpProductPropertyStates(dataBackend, productProperties, depotId, productOnDepot)
 			except Exception as installingPackageError:
 				logger.debug("Failed to install the package %s", filename)
 				logger.debug(installingPackageError, exc_info=True)
@@ -736,9 +803,10 @@ class DepotserverPackageManager:
 
 	def checkDependencies(self, productPackageFile: ProductPackageFile) -> None:
 		for dependency in productPackageFile.packageControlFile.getPackageDependencies():
-			productOnDepots = self._depotBackend._context.productOnDepot_getObjects(  # pylint: disable=protected-access
-				depotId=self._depotBackend._depotId, productId=dependency['package']  # pylint: disable=protected-access
-			)
+			with self._backendLock:
+				productOnDepots = self._depotBackend._context.productOnDepot_getObjects(  # pylint: disable=protected-access
+					depotId=self._depotBackend._depotId, productId=dependency['package']  # pylint: disable=protected-access
+				)
 			if not productOnDepots:
 				raise BackendUnaccomplishableError(f"Dependent package '{dependency['package']}' not installed")
 
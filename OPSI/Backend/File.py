@@ -34,6 +34,7 @@ from OPSI.Types import (
 	forceBool,
 	forceFilename,
 	forceHostId,
+	forceHostIdList,
 	forceList,
 	forceObjectClass,
 	forceObjectClassList,
@@ -41,7 +42,7 @@ from OPSI.Types import (
 	forceUnicode,
 	forceUnicodeList,
 )
-from OPSI.Util import fromJson, getfqdn, toJson
+from OPSI.Util import fromJson, getfqdn, timestamp, toJson
 from OPSI.Util.File import IniFile, LockableFile
 from OPSI.Util.File.Opsi import HostKeyFile, PackageControlFile
 
@@ -1951,6 +1952,77 @@ class FileBackend(ConfigDataBackend):  # pylint: disable=too-many-instance-attri
 					ini.remove_section(section)
 				iniFile.generate(ini)
 
+	def auditSoftwareOnClient_replaceInventory(
+		self, clientId: str, auditSoftwareOnClients: List[AuditSoftwareOnClient], auditSoftwares: List[AuditSoftware] = None
+	) -> None:
+		"""
+		Replace the software inventory of a client.
+
+		Every audit file involved is parsed and written only once.
+		"""
+		clientId = forceHostId(clientId)
+		auditSoftwareOnClients = forceObjectClassList(auditSoftwareOnClients, AuditSoftwareOnClient)
+		auditSoftwares = forceObjectClassList(auditSoftwares or [], AuditSoftware)
+
+		for auditSoftwareOnClient in auditSoftwareOnClients:
+			if auditSoftwareOnClient.clientId != clientId:
+				raise BackendBadValueError("%s does not belong to client '%s'" % (auditSoftwareOnClient, clientId))
+
+		if auditSoftwares:
+			logger.debug("Replacing auditSoftwares ...")
+			filename = self._getConfigFile('AuditSoftware', {}, 'sw')
+			if not os.path.exists(filename):
+				self._touch(filename)
+			self.__mergeAuditSoftwareSections(filename, auditSoftwares, removeMissing=False)
+
+		logger.debug("Replacing auditSoftwareOnClients of client '%s' ...", clientId)
+		filename = self._getConfigFile('AuditSoftwareOnClient', {"clientId": clientId}, 'sw')
+		if not os.path.exists(filename):
+			self._touch(filename)
+		self.__mergeAuditSoftwareSections(filename, auditSoftwareOnClients, removeMissing=True)
+
+	def __mergeAuditSoftwareSections(
+		self, filename: str, objects: List[Union[AuditSoftware, AuditSoftwareOnClient]], removeMissing: bool
+	) -> None:
+		identAttributes = ('name', 'version', 'subVersion', 'language', 'architecture')
+
+		iniFile = IniFile(filename=filename)
+		ini = iniFile.parse()
+
+		sections = {}
+		newNum = 0
+		for section in ini.sections():
+			newNum = max(newNum, int(section.split('_')[-1]) + 1)
+			ident = tuple(
+				self.__unescape(ini.get(section, attribute.lower())) if ini.has_option(section, attribute.lower()) else None
+				for attribute in identAttributes
+			)
+			sections[ident] = section
+
+		usedSections = set()
+		for obj in objects:
+			ident = tuple(getattr(obj, attribute) for attribute in identAttributes)
+			section = sections.get(ident)
+			if not section:
+				obj.setDefaults()
+				section = 'software_%d' % newNum
+				newNum += 1
+				ini.add_section(section)
+				sections[ident] = section
+			usedSections.add(section)
+
+			for (attribute, value) in obj.toHash().items():
+				if value is None or attribute == 'type':
+					continue
+				ini.set(section, attribute, self.__escape(value))
+
+		if removeMissing:
+			for section in ini.sections():
+				if section not in usedSections:
+					ini.remove_section(section)
+
+		iniFile.generate(ini)
+
 	# AuditHardwares
 	def auditHardware_insertObject(self, auditHardware: AuditHardware) -> None:
 		auditHardware = forceObjectClass(auditHardware, AuditHardware)
@@ -2056,6 +2128,139 @@ class FileBackend(ConfigDataBackend):  # pylint: disable=too-many-instance-attri
 		for auditHardwareOnHost in forceObjectClassList(auditHardwareOnHosts, AuditHardwareOnHost):
 			self.__doAuditHardwareObj(auditHardwareOnHost, mode='delete')
 
+	def auditHardwareOnHost_replaceInventory(
+		self, hostId: str, auditHardwareOnHosts: List[AuditHardwareOnHost], update: bool = False
+	) -> None:
+		"""
+		Replace the hardware inventory of a host.
+
+		The audit files are parsed and written only once.
+		Entries of the host missing in `auditHardwareOnHosts` are set
+		obsolete. With `update` state, lastseen and firstseen of the
+		objects are written instead and other entries are kept.
+		"""
+		hostId = forceHostId(hostId)
+		auditHardwareOnHosts = forceObjectClassList(auditHardwareOnHosts, AuditHardwareOnHost)
+
+		now = timestamp()
+		seenValues = []
+		for auditHardwareOnHost in auditHardwareOnHosts:
+			if auditHardwareOnHost.hostId != hostId:
+				raise BackendBadValueError("%s does not belong to host '%s'" % (auditHardwareOnHost, hostId))
+			values = {'lastseen': now, 'state': 1}
+			if update:
+				if auditHardwareOnHost.getState() is not None:
+					values['state'] = auditHardwareOnHost.getState()
+				if auditHardwareOnHost.getLastseen():
+					values['lastseen'] = auditHardwareOnHost.getLastseen()
+				if auditHardwareOnHost.getFirstseen():
+					values['firstseen'] = auditHardwareOnHost.getFirstseen()
+			seenValues.append(values)
+			auditHardwareOnHost.setDefaults()
+			self._checkHardwareClass(auditHardwareOnHost)
+
+		if auditHardwareOnHosts:
+			logger.debug("Inserting missing auditHardwares ...")
+			filename = self._getConfigFile('AuditHardware', {}, 'hw')
+			self._touch(filename)
+			self.__mergeAuditHardwareSections(
+				filename,
+				[AuditHardware.fromHash(auditHardwareOnHost.toHash()) for auditHardwareOnHost in auditHardwareOnHosts],
+				setObsolete=False
+			)
+
+		logger.debug("Replacing auditHardwareOnHosts of host '%s' ...", hostId)
+		filename = self._getConfigFile('AuditHardwareOnHost', {"hostId": hostId}, 'hw')
+		self._touch(filename)
+		self.__mergeAuditHardwareSections(filename, auditHardwareOnHosts, setObsolete=not update, seenValues=seenValues)
+
+	def auditHardwareOnHost_setObsolete(self, hostId: List[str]) -> None:
+		if hostId is None:
+			hostId = []
+		hostIds = forceHostIdList(hostId)
+
+		if hostIds:
+			filenames = [self._getConfigFile('AuditHardwareOnHost', {'hostId': host}, 'hw') for host in hostIds]
+		else:
+			filenames = [
+				os.path.join(self.__auditDir, entry) for entry in os.listdir(self.__auditDir)
+				if entry.lower().endswith('.hw') and entry.lower() != 'global.hw'
+			]
+
+		for filename in filenames:
+			if os.path.exists(filename):
+				self.__mergeAuditHardwareSections(filename, [], setObsolete=True)
+
+	def __auditHardwareObjToHash(self, auditHardwareObj: Union[AuditHardware, AuditHardwareOnHost]) -> Dict[str, str]:  # pylint: disable=no-self-use
+		objHash = {}
+		for (attribute, value) in auditHardwareObj.toHash().items():
+			if attribute.lower() in ('hostid', 'type'):
+				continue
+
+			if value is None:
+				objHash[attribute.lower()] = ''
+			else:
+				objHash[attribute.lower()] = forceUnicode(value)
+		return objHash
+
+	def __mergeAuditHardwareSections(
+		self, filename: str, objects: List[Union[AuditHardware, AuditHardwareOnHost]], setObsolete: bool,
+		seenValues: List[Dict[str, Any]] = None
+	) -> None:
+		"""
+		Merge `objects` into the sections of the audit file `filename`.
+
+		Missing entries are added. Existing entries get the values at the
+		same index of `seenValues`, if given.
+		"""
+		iniFile = IniFile(filename=filename)
+		ini = iniFile.parse()
+
+		nums = set()
+		sectionsByClass = {}
+		for section in ini.sections():
+			nums.add(int(section[section.rfind('_') + 1:]))
+			values = {option: self.__unescape(ini.get(section, option)) for option in ini.options(section)}
+			sectionsByClass.setdefault(values.get('hardwareclass'), []).append((section, values))
+
+		usedSections = set()
+		num = 0
+		for (obj, values) in zip(objects, seenValues or [None] * len(objects)):
+			objHash = self.__auditHardwareObjToHash(obj)
+			identHash = {
+				attribute: value for (attribute, value) in objHash.items()
+				if attribute not in ('firstseen', 'lastseen', 'state')
+			}
+			candidates = sectionsByClass.setdefault(objHash.get('hardwareclass'), [])
+			sectionFound = None
+			for (section, values) in candidates:
+				if all(values.get(attribute) == value for (attribute, value) in identHash.items()):
+					sectionFound = section
+					break
+
+			if sectionFound:
+				usedSections.add(sectionFound)
+				for (attribute, value) in (values or {}).items():
+					ini.set(sectionFound, attribute, self.__escape(forceUnicode(value)))
+				continue
+
+			while num in nums:
+				num += 1
+			nums.add(num)
+			sectionFound = 'hardware_%d' % num
+			ini.add_section(sectionFound)
+			for (attribute, value) in objHash.items():
+				ini.set(sectionFound, attribute, self.__escape(value))
+			candidates.append((sectionFound, objHash))
+			usedSections.add(sectionFound)
+
+		if setObsolete:
+			for section in ini.sections():
+				if section not in usedSections and ini.has_option(section, 'state') and ini.get(section, 'state') != '0':
+					ini.set(section, 'state', '0')
+
+		iniFile.generate(ini)
+
 	def __doAuditHardwareObj(self, auditHardwareObj: Union[AuditHardware, AuditHardwareOnHost], mode: str) -> None:  # pylint: disable=too-many-branches,too-many-statements
 		if mode not in ('insert', 'update', 'delete'):
 			raise ValueError("Unknown mode: %s" % mode)
@@ -2069,15 +2274,7 @@ class FileBackend(ConfigDataBackend):  # pylint: disable=too-many-instance-attri
 		iniFile = IniFile(filename=filename)
 		ini = iniFile.parse()
 
-		objHash = {}
-		for (attribute, value) in auditHardwareObj.toHash().items():
-			if attribute.lower() in ('hostid', 'type'):
-				continue
-
-			if value is None:
-				objHash[attribute.lower()] = ''
-			else:
-				objHash[attribute.lower()] = forceUnicode(value)
+		objHash = self.__auditHardwareObjToHash(auditHardwareObj)
 
 		sectionFound = None
 		for section in ini.sections():
@@ -8,12 +8,15 @@ HostControl backend.
 This backend can be used to control hosts.
 """
 
+import errno
 import ipaddress
+import selectors
 import socket
-import struct
 import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import closing
-from typing import Any, Dict, List
+from typing import Any, Dict, Generator, List, Tuple
 
 from opsicommon.client.jsonrpc import JSONRPCClient
 from opsicommon.logging import get_logger
@@ -134,7 +137,10 @@ class HostControlBackend(ExtendedBackend):
 		self._hostReachableTimeout = 3
 		self._resolveHostAddress = False
 		self._maxConnections = 50
+		# Seconds between two Wake-on-LAN packets to the same broadcast address
+		self._wakeOnLanInterval = 0.0
 		self._broadcastAddresses = {}
+		self._broadcastNetworks = {}
 
 		broadcastAddresses = {"0.0.0.0/0": {"255.255.255.255": [7, 9, 12287]}}
 
@@ -150,6 +156,9 @@ class HostControlBackend(ExtendedBackend):
 				self._resolveHostAddress = forceBool(value)
 			elif option == "maxconnections":
 				self._maxConnections = max(forceInt(value), 1)
+			elif option == "wakeonlaninterval":
+				# Milliseconds
+				self._wakeOnLanInterval = max(forceInt(value), 0) / 1000
 			elif option == "broadcastaddresses" and value:
 				broadcastAddresses = value
 
@@ -183,6 +192,15 @@ class HostControlBackend(ExtendedBackend):
 				brd = ipaddress.ip_address(broadcast_address)
 				self._broadcastAddresses[net][brd] = tuple(forceInt(port) for port in ports)
 
+		# Networks by prefix length, longest prefix first, to find the
+		# best matching network of a host with one lookup per prefix length.
+		networksByPrefix = {}
+		for net in self._broadcastAddresses:
+			networksByPrefix.setdefault(net.version, {}).setdefault(net.prefixlen, {})[int(net.network_address)] = net
+		self._broadcastNetworks = {
+			version: sorted(networks.items(), key=lambda item: item[0], reverse=True) for version, networks in networksByPrefix.items()
+		}
+
 		if old_format:
 			logger.warning(
 				"Your hostcontrol backend configuration uses an old format for broadcast addresses. "
@@ -209,9 +227,64 @@ class HostControlBackend(ExtendedBackend):
 			raise BackendUnaccomplishableError(f"Failed to get ip address for host '{host.id}'")
 		return address
 
-	def _opsiclientdRpc(
+	def _getOpsiclientdPorts(self, hostIds: List[str]) -> Dict[str, int]:
+		"""
+		Get the custom opsiclientd ports of `hostIds` with a single query.
+		"""
+		ports = {}
+		try:
+			for configState in self._context.configState_getObjects(  # pylint: disable=maybe-no-member
+				configId="opsiclientd.control_server.port", objectId=hostIds
+			):
+				if not configState.values:
+					continue
+				try:
+					ports[configState.objectId] = int(configState.values[0])
+					logger.info("Using port %s for opsiclientd at %s", ports[configState.objectId], configState.objectId)
+				except (TypeError, ValueError) as err:
+					logger.warning("Failed to read custom opsiclientd port for %s: %s", configState.objectId, err)
+		except Exception as err:  # pylint: disable=broad-except
+			logger.warning("Failed to read custom opsiclientd ports: %s", err)
+		return ports
+
+	def _executeOpsiclientdRpc(  # pylint: disable=too-many-arguments
+		self, host: Host, port: int, method: str, params: List, timeout: int
+	) -> Any:
+		address = self._getHostAddress(host)
+		if ":" in address:
+			# IPv6
+			address = f"[{address}]"
+		logger.debug("Starting rpc to host %s using address '%s'", host.id, address)
+		jsonrpc = JSONRPCClient(
+			address=f"https://{address}:{port or self._opsiclientdPort}/opsiclientd",
+			username="",
+			password=host.opsiHostKey,
+			connect_timeout=max(self._hostRpcTimeout, 0),
+			read_timeout=max(timeout, 0),
+			connect_on_init=False,
+			create_methods=False,
+			retry=0,
+		)
+		try:
+			return jsonrpc.execute_rpc(method, params)
+		finally:
+			try:
+				jsonrpc.disconnect()
+			except Exception as err:  # pylint: disable=broad-except
+				logger.warning("Failed to clean up jsonrpc connection: %s", err, exc_info=True)
+
+	def _opsiclientdRpcResults(  # pylint: disable=too-many-locals
 		self, hostIds: List[str], method: str, params: List = None, timeout: int = None
-	):  # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+	) -> Generator[Tuple[str, Dict[str, Any]], None, None]:
+		"""
+		Execute the rpc on the opsiclientd of `hostIds`.
+
+		The rpcs are executed by a pool of at most `maxConnections` threads. \
+Custom opsiclientd ports are read with a single backend query and host \
+addresses are resolved in the pool.
+
+		:returns: Tuples of host id and result in the order the rpcs finish.
+		"""
 		if not hostIds:
 			raise BackendMissingDataError("No matching host ids found")
 		hostIds = forceHostIdList(hostIds)
@@ -221,137 +294,232 @@ class HostControlBackend(ExtendedBackend):
 			timeout = self._hostRpcTimeout
 		timeout = forceInt(timeout)
 
-		result = {}
-		rpcts = []
-		for host in self._context.host_getObjects(id=hostIds):  # pylint: disable=maybe-no-member
-			try:
-				port = None
-				try:
-					configState = self._context.configState_getObjects(configId="opsiclientd.control_server.port", objectId=host.id)
-					port = int(configState[0].values[0])
-					logger.info("Using port %s for opsiclientd at %s", port, host.id)
-				except IndexError:
-					pass  # No values found
-				except Exception as err:  # pylint: disable=broad-except
-					logger.warning("Failed to read custom opsiclientd port for %s: %s", host.id, err)
-
-				address = self._getHostAddress(host)
-				if ":" in address:
-					# IPv6
-					address = f"[{address}]"
-				logger.debug("Using address '%s' for host '%s'", address, host)
-				rpcts.append(
-					RpcThread(
-						hostControlBackend=self,
-						hostId=host.id,
-						hostPort=port,
-						address=address,
-						username="",
-						password=host.opsiHostKey,
-						method=method,
-						params=params,
-					)
-				)
-			except Exception as err:  # pylint: disable=broad-except
-				result[host.id] = {"result": None, "error": str(err)}
+		hosts = self._context.host_getObjects(id=hostIds)  # pylint: disable=maybe-no-member
+		if not hosts:
+			return
+		ports = self._getOpsiclientdPorts([host.id for host in hosts])
+		started = {}
 
-		runningThreads = 0
-		while rpcts:  # pylint: disable=too-many-nested-blocks
-			newRpcts = []
-			for rpct in rpcts:
-				if rpct.ended:
-					if rpct.error:
-						logger.info("Rpc to host %s failed, error: %s", rpct.hostId, rpct.error)
-						result[rpct.hostId] = {"result": None, "error": rpct.error}
-					else:
-						logger.info("Rpc to host %s successful, result: %s", rpct.hostId, rpct.result)
-						result[rpct.hostId] = {"result": rpct.result, "error": None}
-					runningThreads -= 1
-					continue
+		def execute(host):
+			started[host.id] = time.monotonic()
+			return self._executeOpsiclientdRpc(host, ports.get(host.id), method, params, timeout)
 
-				if not rpct.started:
-					if runningThreads < self._maxConnections:
-						logger.debug("Starting rpc to host %s", rpct.hostId)
-						rpct.start()
-						runningThreads += 1
-				else:
-					timeRunning = time.time() - rpct.started
+		executor = ThreadPoolExecutor(max_workers=min(self._maxConnections, len(hosts)), thread_name_prefix="hostcontrol")
+		try:
+			futures = {executor.submit(execute, host): host.id for host in hosts}
+			while futures:
+				done, _notDone = wait(futures, timeout=1, return_when=FIRST_COMPLETED)
+				for future in done:
+					hostId = futures.pop(future)
+					try:
+						result = future.result()
+						logger.info("Rpc to host %s successful, result: %s", hostId, result)
+						yield hostId, {"result": result, "error": None}
+					except Exception as err:  # pylint: disable=broad-except
+						logger.info("Rpc to host %s failed, error: %s", hostId, err)
+						yield hostId, {"result": None, "error": str(err)}
+
+				now = time.monotonic()
+				for future, hostId in list(futures.items()):
+					timeRunning = now - started.get(hostId, now)
 					if timeRunning >= timeout + 5:
-						# thread still alive 5 seconds after timeout => kill
-						logger.info(
-							"Rpc to host %s (address: %s) timed out after %0.2f seconds, terminating",
-							rpct.hostId,
-							rpct.address,
-							timeRunning,
-						)
-						result[rpct.hostId] = {"result": None, "error": f"timed out after {timeRunning:0.2f} seconds"}
-						if not rpct.ended:
-							try:
-								rpct.terminate()
-							except Exception as err:  # pylint: disable=broad-except
-								logger.error("Failed to terminate rpc thread: %s", err)
-						runningThreads -= 1
+						# The connection timeouts did not apply, give up on the host.
+						logger.info("Rpc to host %s timed out after %0.2f seconds", hostId, timeRunning)
+						del futures[future]
+						yield hostId, {"result": None, "error": f"timed out after {timeRunning:0.2f} seconds"}
+		finally:
+			executor.shutdown(wait=False, cancel_futures=True)
+
+	def _opsiclientdRpc(self, hostIds: List[str], method: str, params: List = None, timeout: int = None) -> Dict[str, Any]:
+		return dict(self._opsiclientdRpcResults(hostIds, method, params, timeout))
+
+	def _reachableResults(  # pylint: disable=too-many-locals,too-many-branches
+		self, addresses: Dict[str, str], timeout: int
+	) -> Generator[Tuple[str, bool], None, None]:
+		"""
+		Check if the opsiclientd port of the hosts can be connected.
+
+		The connections are made with non-blocking sockets from the \
+calling thread. At most `maxConnections` connects are pending at \
+the same time. A host whose socket can not be created or connected, \
+for example because too many files are open, is not reachable.
+
+		:param addresses: The address by host id.
+		:returns: Tuples of host id and result in the order the checks finish.
+		"""
+		selector = selectors.DefaultSelector()
+		deadlines = {}
+		pending = iter(addresses.items())
+
+		def close(sock, reachable):
+			selector.unregister(sock)
+			del deadlines[sock]
+			try:
+				if reachable:
+					sock.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+			sock.close()
+
+		try:
+			while True:
+				for hostId, address in pending:
+					logger.info("Trying connection to '%s:%d'", address, self._opsiclientdPort)
+					sock = None
+					try:
+						sock = socket.socket(socket.AF_INET6 if ":" in address else socket.AF_INET, socket.SOCK_STREAM)
+						sock.setblocking(False)
+						res = sock.connect_ex((address, self._opsiclientdPort))
+					except OSError as err:
+						logger.info("Connection to '%s' failed: %s", address, err)
+						if sock:
+							sock.close()
+						yield hostId, False
+						continue
+					if res not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+						logger.info("Connection to '%s' failed: %s", address, errno.errorcode.get(res, res))
+						sock.close()
+						yield hostId, False
 						continue
-				newRpcts.append(rpct)
-			rpcts = newRpcts
-			time.sleep(0.1)
+					selector.register(sock, selectors.EVENT_WRITE, hostId)
+					deadlines[sock] = time.monotonic() + timeout
+					if len(deadlines) >= self._maxConnections:
+						break
+
+				if not deadlines:
+					break
+
+				for key, _events in selector.select(timeout=max(min(deadlines.values()) - time.monotonic(), 0)):
+					reachable = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+					close(key.fileobj, reachable)
+					yield key.data, reachable
+
+				now = time.monotonic()
+				for sock, deadline in list(deadlines.items()):
+					if deadline <= now:
+						hostId = selector.get_key(sock).data
+						logger.info("Connection to host %s timed out", hostId)
+						close(sock, False)
+						yield hostId, False
+		finally:
+			for sock in list(deadlines):
+				close(sock, False)
+			selector.close()
 
-		return result
+	def _get_broadcast_network(self, ip_address: ipaddress.IPv4Address) -> Any:
+		"""
+		Get the configured network with the longest prefix containing `ip_address`.
+
+		:returns: The network or `None` if no network matches.
+		"""
+		for prefixlen, networks in self._broadcastNetworks.get(ip_address.version, []):
+			shift = ip_address.max_prefixlen - prefixlen
+			network = networks.get(int(ip_address) >> shift << shift)
+			if network:
+				return network
+		return None
 
 	def _get_broadcast_addresses_for_host(self, host: Host) -> Any:  # pylint: disable=inconsistent-return-statements
 		if not self._broadcastAddresses:
 			return []
 
-		networks = []
+		networks = list(self._broadcastAddresses)
 		if host.ipAddress:
 			ip_address = ipaddress.ip_address(host.ipAddress)
-			for ip_network in self._broadcastAddresses:
-				if ip_address and ip_address in ip_network:
-					networks.append(ip_network)
-
-			if len(networks) > 1:
-				# Take bets matching network by prefix length
-				networks = [sorted(networks, key=lambda x: x.prefixlen, reverse=True)[0]]
-			elif not networks:
+			network = self._get_broadcast_network(ip_address)
+			if network:
+				networks = [network]
+			else:
 				logger.debug("No matching ip network found for host address '%s', using all broadcasts", ip_address.compressed)
-				networks = list(self._broadcastAddresses)
-		else:
-			networks = list(self._broadcastAddresses)
 
 		for network in networks:
 			for broadcast, ports in self._broadcastAddresses[network].items():
 				yield (broadcast.compressed, ports)
 
+	@staticmethod
+	def _getMagicPacket(hardwareAddress: str) -> bytes:
+		"""
+		Get the Wake-on-LAN packet: 6 bytes 0xff followed by the hardware address 16 times.
+		"""
+		try:
+			mac = bytes.fromhex(hardwareAddress.replace(":", "").replace("-", ""))
+		except ValueError:
+			mac = b""
+		if len(mac) != 6:
+			raise ValueError(f"Invalid hardware address '{hardwareAddress}'")
+		return b"\xff" * 6 + mac * 16
+
+	def _sendMagicPackets(self, packets: Dict[str, Tuple[bytes, List[Tuple[str, Tuple[int]]]]]) -> Dict[str, Dict[str, Any]]:
+		"""
+		Send Wake-on-LAN packets through a single non-blocking socket.
+
+		Packets to the different broadcast addresses are sent in turns. \
+Packets to the same broadcast address are sent at least \
+`wakeOnLanInterval` apart.
+
+		:param packets: The packet and the broadcast addresses with \
+ports to send it to by host id.
+		:returns: The result by host id.
+		"""
+		queues = {}
+		for hostId, (payload, targets) in packets.items():
+			for broadcast_address, target_ports in targets:
+				queues.setdefault(broadcast_address, deque()).append((hostId, payload, target_ports))
+		nextSend = dict.fromkeys(queues, 0.0)
+		errors = {}
+
+		with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)) as sock, selectors.DefaultSelector() as selector:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
+			sock.setblocking(False)
+			selector.register(sock, selectors.EVENT_WRITE)
+
+			def send(payload, address):
+				while True:
+					try:
+						sock.sendto(payload, address)
+						return
+					except BlockingIOError:
+						if not selector.select(timeout=self._hostReachableTimeout):
+							raise TimeoutError("Timed out waiting for socket") from None
+
+			while queues:
+				now = time.monotonic()
+				for broadcast_address in [addr for addr in queues if nextSend[addr] <= now]:
+					hostId, payload, target_ports = queues[broadcast_address].popleft()
+					logger.debug("Sending Wake-on-LAN packet for %s to %s %s", hostId, broadcast_address, target_ports)
+					for port in target_ports:
+						try:
+							send(payload, (broadcast_address, port))
+						except Exception as err:  # pylint: disable=broad-except
+							logger.debug(err, exc_info=True)
+							errors.setdefault(hostId, str(err))
+					if queues[broadcast_address]:
+						nextSend[broadcast_address] = now + self._wakeOnLanInterval
+					else:
+						del queues[broadcast_address]
+
+				if queues and self._wakeOnLanInterval:
+					time.sleep(max(min(nextSend[addr] for addr in queues) - time.monotonic(), 0))
+
+		return {
+			hostId: {"result": None, "error": errors[hostId]} if hostId in errors else {"result": "sent", "error": None} for hostId in packets
+		}
+
 	def hostControl_start(self, hostIds: List[str] = None) -> Dict[str, Any]:
 		"""Switches on remote computers using WOL."""
 		hosts = self._context.host_getObjects(attributes=["hardwareAddress", "ipAddress"], id=hostIds or [])  # pylint: disable=maybe-no-member
 		result = {}
+		packets = {}
 		for host in hosts:
 			try:
 				if not host.hardwareAddress:
 					raise BackendMissingDataError(f"Failed to get hardware address for host '{host.id}'")
-
-				mac = host.hardwareAddress.replace(":", "")
-				data = b"".join([b"FFFFFFFFFFFF", mac.encode("ascii") * 16])  # Pad the synchronization stream.
-
-				# Split up the hex values and pack.
-				payload = b""
-				for i in range(0, len(data), 2):
-					payload = b"".join([payload, struct.pack("B", int(data[i : i + 2], 16))])
-
-				for broadcast_address, target_ports in self._get_broadcast_addresses_for_host(host):
-					logger.debug("Sending data to network broadcast %s %s [%s]", broadcast_address, target_ports, data)
-
-					for port in target_ports:
-						logger.debug("Broadcasting to port %s", port)
-						with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)) as sock:
-							sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
-							sock.sendto(payload, (broadcast_address, port))
-
-				result[host.id] = {"result": "sent", "error": None}
+				packets[host.id] = (self._getMagicPacket(host.hardwareAddress), list(self._get_broadcast_addresses_for_host(host)))
 			except Exception as err:  # pylint: disable=broad-except
 				logger.debug(err, exc_info=True)
 				result[host.id] = {"result": None, "error": str(err)}
+
+		result.update(self._sendMagicPackets(packets))
 		return result
 
 	def hostControl_shutdown(self, hostIds: List[str] = None) -> Dict[str, Any]:
@@ -420,50 +588,19 @@ class HostControlBackend(ExtendedBackend):
 		timeout = forceInt(timeout)
 
 		result = {}
-		threads = []
-		for host in self._context.host_getObjects(id=hostIds):  # pylint: disable=maybe-no-member
-			try:
-				address = self._getHostAddress(host)
-				threads.append(ConnectionThread(hostControlBackend=self, hostId=host.id, address=address))
-			except Exception as err:  # pylint: disable=broad-except
-				logger.debug("Problem found: '%s'", err)
-				result[host.id] = False
-
-		runningThreads = 0
-		while threads:  # pylint: disable=too-many-nested-blocks
-			newThreads = []
-			for thread in threads:
-				if thread.ended:
-					result[thread.hostId] = thread.result
-					runningThreads -= 1
-					continue
-
-				if not thread.started:
-					if runningThreads < self._maxConnections:
-						logger.debug("Trying to check host reachable %s", thread.hostId)
-						thread.start()
-						runningThreads += 1
-				else:
-					timeRunning = time.time() - thread.started
-					if timeRunning >= timeout + 5:
-						# thread still alive 5 seconds after timeout => kill
-						logger.error(
-							"Reachable check to host %s address %s timed out after %0.2f seconds, terminating",
-							thread.hostId,
-							thread.address,
-							timeRunning,
-						)
-						result[thread.hostId] = False
-						if not thread.ended:
-							try:
-								thread.terminate()
-							except Exception as err:  # pylint: disable=broad-except
-								logger.error("Failed to terminate reachable thread: %s", err)
-						runningThreads -= 1
-						continue
-				newThreads.append(thread)
-			threads = newThreads
-			time.sleep(0.1)
+		addresses = {}
+		hosts = self._context.host_getObjects(id=hostIds)  # pylint: disable=maybe-no-member
+		if hosts:
+			# Lookups of host names can block, resolve them in parallel
+			with ThreadPoolExecutor(max_workers=min(self._maxConnections, len(hosts)), thread_name_prefix="hostcontrol") as executor:
+				for host, future in [(host, executor.submit(self._getHostAddress, host)) for host in hosts]:
+					try:
+						addresses[host.id] = forceIpAddress(future.result())
+					except Exception as err:  # pylint: disable=broad-except
+						logger.debug("Problem found: '%s'", err)
+						result[host.id] = False
+
+		result.update(self._reachableResults(addresses, max(timeout, 0)))
 		return result
 
 	def hostControl_execute(  # pylint: disable=too-many-arguments
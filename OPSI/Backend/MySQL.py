@@ -183,6 +183,10 @@ class MySQL(SQL):  # pylint: disable=too-many-instance-attributes
 	def insert(self, session: scoped_session, table: str, valueHash: Any) -> Any:
 		return super().insert(session, table, valueHash)
 
+	@retry_on_deadlock
+	def insertMany(self, session: scoped_session, table: str, valueHashes: List[Dict[str, Any]]) -> Any:
+		return super().insertMany(session, table, valueHashes)
+
 	@retry_on_deadlock
 	def update(self, session: scoped_session, table: str, where: str, valueHash: Any, updateWhereNone: bool = False) -> Any:  # pylint: disable=too-many-arguments
 		return super().update(session, table, where, valueHash, updateWhereNone)
@@ -191,6 +195,10 @@ class MySQL(SQL):  # pylint: disable=too-many-instance-attributes
 	def delete(self, session: scoped_session, table: str, where: str) -> Any:
 		return super().delete(session, table, where)
 
+	def collationKey(self, string: str) -> str:
+		# utf8_general_ci ignores case and trailing spaces
+		return string.rstrip(" ").lower()
+
 	def getTables(self, session: scoped_session) -> Dict[str, Any]:
 		"""
 		Get what tables are present in the database (do not return views).
@@ -409,6 +417,10 @@ class MySQLBackend(SQLBackend):
 				params={"clientIds": clientId}
 			)
 
+	def _setAuditHardwareOnHostsObsolete(self, session: scoped_session, hardwareClass: str, where: str) -> None:
+		# Obsolete entries are not kept in MySQL
+		self._sql.delete(session, f"HARDWARE_CONFIG_{hardwareClass}", where)
+
 	def auditHardwareOnHost_setObsolete(self, hostId: str) -> None:
 		if not hostId:
 			return
@@ -13,10 +13,12 @@ import json
 
 # pylint: disable=too-many-lines
 import re
+import threading
 import time
+from collections import OrderedDict
 from contextlib import contextmanager
 from datetime import datetime
-from typing import Any, Dict, Generator, List, Tuple
+from typing import Any, Dict, Generator, Iterable, List, Optional, Set, Tuple
 
 from OPSI.Backend.Base import Backend, BackendModificationListener, ConfigDataBackend
 from OPSI.Exceptions import (
@@ -57,13 +59,16 @@ from OPSI.Object import (
 from OPSI.Types import (
 	forceBool,
 	forceDict,
+	forceHostId,
+	forceHostIdList,
+	forceInt,
 	forceList,
 	forceObjectClassList,
 	forceOpsiTimestamp,
 	forceUnicodeList,
 	forceUnicodeLower,
 )
-from OPSI.Util import timestamp
+from OPSI.Util import chunk, timestamp
 from opsicommon.logging import get_logger
 
 __all__ = ("timeQuery", "onlyAllowSelect", "SQL", "SQLBackend", "SQLBackendObjectModificationTracker")
@@ -201,6 +206,22 @@ class SQL:  # pylint: disable=too-many-public-methods
 		result = session.execute(query, valueHash)  # pylint: disable=no-member
 		return result.lastrowid
 
+	def insertMany(self, session: Any, table: str, valueHashes: List[Dict[str, Any]]) -> int:  # pylint: disable=no-self-use
+		"""
+		Insert multiple rows with a single statement.
+
+		All value hashes must have the same keys.
+		"""
+		if not valueHashes:
+			raise BackendBadValueError("No values given")
+
+		col_names = [f"`{col_name}`" for col_name in list(valueHashes[0])]
+		bind_names = [f":{col_name}" for col_name in list(valueHashes[0])]
+		query = f"INSERT INTO `{table}` ({','.join(col_names)}) VALUES ({','.join(bind_names)})"
+		logger.trace("insertMany: %s - %d rows", query, len(valueHashes))
+		session.execute(query, valueHashes)  # pylint: disable=no-member
+		return len(valueHashes)
+
 	def update(self, session: Any, table: str, where: str, valueHash: Any, updateWhereNone: bool = False) -> int:  # pylint: disable=no-self-use,too-many-arguments
 		if not valueHash:
 			raise BackendBadValueError("No values given")
@@ -229,6 +250,12 @@ class SQL:  # pylint: disable=too-many-public-methods
 	def getTableCreationOptions(self, table: str) -> str:  # pylint: disable=unused-argument,no-self-use
 		return ""
 
+	def collationKey(self, string: str) -> str:  # pylint: disable=no-self-use
+		"""
+		Key for comparing strings in Python like the database does.
+		"""
+		return string
+
 	def escapeBackslash(self, string: str) -> str:
 		return string.replace("\\", self.ESCAPED_BACKSLASH)
 
@@ -339,11 +366,17 @@ class SQLBackend(ConfigDataBackend):  # pylint: disable=too-many-public-methods
 		self._sql = None
 		self._auditHardwareConfig = {}
 		self.unique_hardware_addresses = True
+		# Maps device fingerprints to their hardware ids
+		self._hardwareIdCache = OrderedDict()
+		self._hardwareIdCacheSize = 10000
+		self._hardwareIdCacheLock = threading.Lock()
 		self._setAuditHardwareConfig(self.auditHardware_getConfig())
 		# Parse arguments
 		for (option, value) in kwargs.items():
 			if option == "unique_hardware_addresses":
 				self.unique_hardware_addresses = forceBool(value)
+			elif option == "hardware_id_cache_size":
+				self._hardwareIdCacheSize = forceInt(value)
 
 	def _setAuditHardwareConfig(self, config: Dict[str, Dict[str, Any]]) -> None:
 		self._auditHardwareConfig = {}
@@ -353,6 +386,40 @@ class SQLBackend(ConfigDataBackend):  # pylint: disable=too-many-public-methods
 			for value in conf["Values"]:
 				self._auditHardwareConfig[hwClass][value["Opsi"]] = {"Type": value["Type"], "Scope": value["Scope"]}
 
+		# Templates with all attributes of a class set to None,
+		# used to complete the rows returned by the database.
+		self._auditHardwareTemplates = {}
+		self._auditHardwareOnHostTemplates = {}
+		for (hwClass, values) in self._auditHardwareConfig.items():
+			self._auditHardwareTemplates[hwClass] = {
+				attribute: None for (attribute, valueInfo) in values.items() if valueInfo.get("Scope") != "i"
+			}
+			self._auditHardwareOnHostTemplates[hwClass] = dict.fromkeys(values)
+
+	def _getAuditHardwareClasses(self, hardwareClass: Any, attributes: List[str]) -> List[str]:
+		"""
+		Get the hardware classes matching `hardwareClass` that know all `attributes`.
+
+		:param hardwareClass: Hardware class filter, may contain wildcards.
+		:param attributes: Attributes used in the filter, host specific \
+attributes like `hostId` are ignored.
+		"""
+		if hardwareClass in ([], None):
+			hardwareClasses = list(self._auditHardwareConfig)
+		else:
+			patterns = [re.compile(f"^{hwc.replace('*', '.*')}$") for hwc in forceUnicodeList(hardwareClass)]
+			hardwareClasses = [hwc for hwc in self._auditHardwareConfig if any(pattern.search(hwc) for pattern in patterns)]
+
+		attributes = [attribute for attribute in attributes if attribute not in ("hostId", "state", "firstseen", "lastseen")]
+		result = []
+		for hwc in hardwareClasses:
+			missing = [attribute for attribute in attributes if attribute not in self._auditHardwareConfig[hwc]]
+			if missing:
+				logger.debug("Skipping hardwareClass '%s', because of missing info for attributes %s", hwc, missing)
+				continue
+			result.append(hwc)
+		return result
+
 	def _filterToSql(self, filter: Dict[str, Any] = None, table: str = None) -> str:  # pylint: disable=redefined-builtin
 		"""
 		Creates a SQL condition out of the given filter.
@@ -593,6 +660,7 @@ class SQLBackend(ConfigDataBackend):  # pylint: disable=too-many-public-methods
 
 	def backend_deleteBase(self) -> None:
 		ConfigDataBackend.backend_deleteBase(self)
+		self._clearHardwareIdCache()
 
 		# Drop database
 		with self._sql.session() as session:
@@ -2238,6 +2306,111 @@ class SQLBackend(ConfigDataBackend):  # pylint: disable=too-many-public-methods
 				where = self._uniqueCondition(auditSoftwareOnClient)
 				self._sql.delete(session, "SOFTWARE_CONFIG", where)
 
+	def _auditSoftwareKey(self, values: Dict[str, Any]) -> Tuple[str, ...]:
+		return tuple(
+			self._sql.collationKey(values[attribute]) for attribute in ("name", "version", "subVersion", "language", "architecture")
+		)
+
+	@staticmethod
+	def _getChangedValues(row: Dict[str, Any], data: Dict[str, Any]) -> Dict[str, Any]:
+		changed = {}
+		for (attribute, value) in data.items():
+			if value is None:
+				continue
+
+			dbValue = row.get(attribute)
+			if isinstance(dbValue, datetime):
+				dbValue = dbValue.strftime("%Y-%m-%d %H:%M:%S")
+			if isinstance(value, bool):
+				value = int(value)
+			if isinstance(dbValue, bool):
+				dbValue = int(dbValue)
+
+			if dbValue != value:
+				changed[attribute] = value
+		return changed
+
+	def _replaceAuditSoftwares(self, session: Any, auditSoftwares: List[AuditSoftware]) -> None:
+		names = list({auditSoftware.name for auditSoftware in auditSoftwares})
+		existing = {
+			self._auditSoftwareKey(row): row
+			for row in self._sql.getSet(session, f"select * from `SOFTWARE` where {self._filterToSql({'name': names})}")
+		}
+
+		inserts = {}
+		for auditSoftware in auditSoftwares:
+			data = self._objectToDatabaseHash(auditSoftware)
+			key = self._auditSoftwareKey(data)
+			row = existing.get(key)
+			if row is None:
+				auditSoftware.setDefaults()
+				inserts[key] = self._objectToDatabaseHash(auditSoftware)
+				continue
+
+			changed = self._getChangedValues(row, data)
+			if changed:
+				self._sql.update(session, "SOFTWARE", self._uniqueCondition(auditSoftware), changed)
+				row.update(changed)
+
+		if inserts:
+			logger.info("Inserting %d auditSoftwares", len(inserts))
+			self._sql.insertMany(session, "SOFTWARE", list(inserts.values()))
+
+	def auditSoftwareOnClient_replaceInventory(
+		self, clientId: str, auditSoftwareOnClients: List[AuditSoftwareOnClient], auditSoftwares: List[AuditSoftware] = None
+	) -> None:
+		"""
+		Replace the software inventory of a client in a single transaction.
+
+		Existing rows are read with one query per table and diffed against
+		the given objects. New rows are inserted in bulk, changed rows are
+		updated grouped by their changed values and rows of software no
+		longer present are deleted at once.
+		"""
+		clientId = forceHostId(clientId)
+		auditSoftwareOnClients = forceObjectClassList(auditSoftwareOnClients, AuditSoftwareOnClient)
+		auditSoftwares = forceObjectClassList(auditSoftwares or [], AuditSoftware)
+
+		with self._sql.session() as session:
+			if auditSoftwares:
+				self._replaceAuditSoftwares(session, auditSoftwares)
+
+			existing = {
+				self._auditSoftwareKey(row): row
+				for row in self._sql.getSet(session, f"select * from `SOFTWARE_CONFIG` where {self._filterToSql({'clientId': clientId})}")
+			}
+
+			inserts = {}
+			updates = {}
+			for auditSoftwareOnClient in auditSoftwareOnClients:
+				if auditSoftwareOnClient.clientId != clientId:
+					raise BackendBadValueError(f"{auditSoftwareOnClient} does not belong to client '{clientId}'")
+
+				data = self._objectToDatabaseHash(auditSoftwareOnClient)
+				key = self._auditSoftwareKey(data)
+				row = existing.pop(key, None)
+				if row is None:
+					auditSoftwareOnClient.setDefaults()
+					inserts[key] = self._objectToDatabaseHash(auditSoftwareOnClient)
+					continue
+
+				changed = self._getChangedValues(row, data)
+				if changed:
+					updates.setdefault(tuple(sorted(changed.items())), []).append(row["config_id"])
+
+			if existing:
+				logger.info("Deleting %d obsolete auditSoftwareOnClients of client %s", len(existing), clientId)
+				configIds = ",".join(str(row["config_id"]) for row in existing.values())
+				self._sql.delete(session, "SOFTWARE_CONFIG", f"`config_id` in ({configIds})")
+
+			for (changed, configIds) in updates.items():
+				configIds = ",".join(str(configId) for configId in configIds)
+				self._sql.update(session, "SOFTWARE_CONFIG", f"`config_id` in ({configIds})", dict(changed))
+
+			if inserts:
+				logger.info("Inserting %d auditSoftwareOnClients of client %s", len(inserts), clientId)
+				self._sql.insertMany(session, "SOFTWARE_CONFIG", list(inserts.values()))
+
 	# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 	# -   AuditHardwares
 	# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -2280,6 +2453,148 @@ class SQLBackend(ConfigDataBackend):  # pylint: disable=too-many-public-methods
 		logger.debug("Found hardware ids: %s", hardwareIds)
 		return hardwareIds
 
+	def _normalizeHardwareValue(self, value: Any) -> Optional[str]:
+		if value is None:
+			return None
+		if isinstance(value, bool):
+			value = int(value)
+		return self._sql.collationKey(str(value))
+
+	def _hardwareFingerprint(self, hardwareClass: str, values: Dict[str, Any], scope: str = "g") -> Tuple[Optional[str], ...]:
+		"""
+		Fingerprint of the values of a device (scope `g`) or of the \
+host specific values of a device (scope `i`).
+		"""
+		return tuple(
+			self._normalizeHardwareValue(values.get(attribute))
+			for (attribute, valueInfo) in self._auditHardwareConfig[hardwareClass].items()
+			if valueInfo.get("Scope") == scope
+		)
+
+	def _clearHardwareIdCache(self) -> None:
+		with self._hardwareIdCacheLock:
+			self._hardwareIdCache.clear()
+
+	def _getCachedHardwareIds(self, cacheKey: Tuple[Any, ...]) -> Optional[Tuple[int, ...]]:
+		with self._hardwareIdCacheLock:
+			hardwareIds = self._hardwareIdCache.get(cacheKey)
+			if hardwareIds is not None:
+				self._hardwareIdCache.move_to_end(cacheKey)
+			return hardwareIds
+
+	def _uncacheHardwareIds(self, cacheKey: Tuple[Any, ...]) -> None:
+		with self._hardwareIdCacheLock:
+			self._hardwareIdCache.pop(cacheKey, None)
+
+	def _getExistingHardwareIds(self, session: Any, hardwareClass: str, hardwareIds: Iterable[int]) -> Set[int]:
+		"""
+		Get the `hardwareIds` still present in the device table.
+
+		Cached ids may have been deleted by another worker or process.
+		"""
+		existing = set()
+		for hardwareIdsChunk in chunk(hardwareIds, 1000):
+			where = f"`hardware_id` in ({','.join(str(hardwareId) for hardwareId in hardwareIdsChunk)})"
+			for row in self._sql.getSet(session, f"select `hardware_id` from `HARDWARE_DEVICE_{hardwareClass}` where {where}"):
+				existing.add(row["hardware_id"])
+		return existing
+
+	def _cacheHardwareIds(self, cacheKey: Tuple[Any, ...], hardwareIds: List[int]) -> None:
+		if self._hardwareIdCacheSize <= 0 or not hardwareIds:
+			return
+
+		with self._hardwareIdCacheLock:
+			self._hardwareIdCache[cacheKey] = tuple(hardwareIds)
+			self._hardwareIdCache.move_to_end(cacheKey)
+			while len(self._hardwareIdCache) > self._hardwareIdCacheSize:
+				self._hardwareIdCache.popitem(last=False)
+
+	def _getDeviceHardwareIds(self, auditHardware: Dict[str, Any]) -> List[int]:
+		"""
+		Get the hardware ids of the device described by `auditHardware`.
+
+		Results for completely described devices are kept in a bounded
+		LRU cache so that repeated writes of the same device only check
+		the cached ids by primary key instead of searching the device table.
+		"""
+		hardwareClass = auditHardware["hardwareClass"]
+		if any(
+			attribute not in auditHardware
+			for (attribute, valueInfo) in self._auditHardwareConfig[hardwareClass].items()
+			if valueInfo.get("Scope") == "g"
+		):
+			# Missing attributes act as wildcards
+			return self._getHardwareIds(dict(auditHardware))
+
+		cacheKey = (hardwareClass, self._hardwareFingerprint(hardwareClass, auditHardware))
+		hardwareIds = self._getCachedHardwareIds(cacheKey)
+		if hardwareIds is not None:
+			with self._sql.session() as session:
+				if self._getExistingHardwareIds(session, hardwareClass, hardwareIds) == set(hardwareIds):
+					return list(hardwareIds)
+			self._uncacheHardwareIds(cacheKey)
+
+		hardwareIds = self._getHardwareIds(dict(auditHardware))
+		self._cacheHardwareIds(cacheKey, hardwareIds)
+		return hardwareIds
+
+	def _resolveHardwareIds(  # pylint: disable=too-many-locals
+		self, session: Any, hardwareClass: str, auditHardwares: List[Dict[str, Any]], staged: Dict[Tuple[Any, ...], Tuple[int, ...]]
+	) -> List[Tuple[int, ...]]:
+		"""
+		Get the hardware ids of many devices of one class at once.
+
+		Devices missing in the cache are searched with one query per
+		chunk of devices. Devices not found are created. All queries use
+		`session`, so devices created earlier in the transaction are found.
+
+		The resolved ids are added to `staged` instead of the cache. The
+		caller caches them after the transaction has been committed, ids
+		of devices inserted in a transaction rolled back never get cached.
+
+		:returns: The hardware ids in the order of `auditHardwares`.
+		"""
+		cacheKeys = [(hardwareClass, self._hardwareFingerprint(hardwareClass, auditHardware)) for auditHardware in auditHardwares]
+		devices = dict(zip(cacheKeys, auditHardwares))
+		resolved = {}
+		missing = {}
+		for (cacheKey, auditHardware) in devices.items():
+			hardwareIds = staged.get(cacheKey) or self._getCachedHardwareIds(cacheKey)
+			if hardwareIds is None:
+				missing[cacheKey] = auditHardware
+			else:
+				resolved[cacheKey] = hardwareIds
+
+		if resolved:
+			existing = self._getExistingHardwareIds(session, hardwareClass, {hardwareId for ids in resolved.values() for hardwareId in ids})
+			for (cacheKey, hardwareIds) in list(resolved.items()):
+				if not existing.issuperset(hardwareIds):
+					self._uncacheHardwareIds(cacheKey)
+					del resolved[cacheKey]
+					missing[cacheKey] = devices[cacheKey]
+
+		table = f"HARDWARE_DEVICE_{hardwareClass}"
+		for cacheKeysChunk in chunk(list(missing), 100):
+			where = " or ".join(f"({self._uniqueAuditHardwareCondition(missing[cacheKey])})" for cacheKey in cacheKeysChunk)
+			for row in self._sql.getSet(session, f"select * from `{table}` where {where}"):
+				cacheKey = (hardwareClass, self._hardwareFingerprint(hardwareClass, row))
+				if cacheKey in missing:
+					resolved[cacheKey] = resolved.get(cacheKey, ()) + (row["hardware_id"],)
+
+		for (cacheKey, auditHardware) in missing.items():
+			if cacheKey not in resolved:
+				# The database may compare values differently, ask it before creating a new device.
+				where = self._uniqueAuditHardwareCondition(auditHardware)
+				hardwareIds = [row["hardware_id"] for row in self._sql.getSet(session, f"select `hardware_id` from `{table}` where {where}")]
+				if not hardwareIds:
+					data = {attribute: value for (attribute, value) in auditHardware.items() if attribute not in ("hardwareClass", "type")}
+					logger.debug("Creating hardware device %s", data)
+					hardwareIds = [self._sql.insert(session, table, data)]
+				resolved[cacheKey] = tuple(hardwareIds)
+			staged[cacheKey] = resolved[cacheKey]
+
+		return [resolved[cacheKey] for cacheKey in cacheKeys]
+
 	def auditHardware_insertObject(self, auditHardware: AuditHardware) -> None:
 		ConfigDataBackend.auditHardware_insertObject(self, auditHardware)
 
@@ -2326,95 +2641,54 @@ class SQLBackend(ConfigDataBackend):  # pylint: disable=too-many-public-methods
 	def auditHardware_getHashes(self, attributes: List[str] = None, **filter) -> List[Dict[str, Any]]:  # pylint: disable=redefined-builtin
 		return self._auditHardware_search(returnHardwareIds=False, attributes=attributes or [], **filter)
 
-	def _auditHardware_search(  # pylint: disable=redefined-builtin,too-many-branches,too-many-locals,too-many-statements
+	def _auditHardware_search(  # pylint: disable=redefined-builtin,too-many-locals
 		self, returnHardwareIds: bool = False, attributes: List[str] = None, **filter
 	):
-		attributes = attributes or []
-		hardwareClasses = set()
-		hardwareClass = filter.get("hardwareClass")
-		if hardwareClass not in ([], None):
-			for hwc in forceUnicodeList(hardwareClass):
-				regex = re.compile(f"^{hwc.replace('*', '.*')}$")
-				for key in self._auditHardwareConfig:
-					if regex.search(key):
-						hardwareClasses.add(key)
-
-			if not hardwareClasses:
-				return []
-
-		if not hardwareClasses:
-			hardwareClasses = set(self._auditHardwareConfig)
-
-		for unwanted_key in ("hardwareClass", "type"):
-			try:
-				del filter[unwanted_key]
-			except KeyError:
-				pass  # not there - everything okay.
-
-		try:
-			attributes.remove("hardwareClass")
-		except ValueError:
-			pass
+		attributes = [attribute for attribute in attributes or [] if attribute != "hardwareClass"]
+		hardwareClassFilter = filter.pop("hardwareClass", None)
+		filter.pop("type", None)
 
 		for attribute in attributes:
 			if attribute not in filter:
 				filter[attribute] = None
 
-		if returnHardwareIds and attributes and "hardware_id" not in attributes:
-			attributes.append("hardware_id")
+		if returnHardwareIds:
+			attributes = ["hardware_id"]
 
 		results = []
 		with self._sql.session() as session:
-			for hardwareClass in hardwareClasses:  # pylint: disable=too-many-nested-blocks
+			for hardwareClass in self._getAuditHardwareClasses(hardwareClassFilter, list(filter)):
 				classFilter = {}
 				for (attribute, value) in filter.items():
-					valueInfo = self._auditHardwareConfig[hardwareClass].get(attribute)
-					if not valueInfo:
-						logger.debug("Skipping hardwareClass '%s', because of missing info for attribute '%s'", hardwareClass, attribute)
-						break
-
-					try:
-						if valueInfo["Scope"] != "g":
-							continue
-					except KeyError:
-						pass
+					if self._auditHardwareConfig[hardwareClass].get(attribute, {}).get("Scope") == "i":
+						continue
 
 					if value is not None:
 						value = forceList(value)
 					classFilter[attribute] = value
-				else:
-					if not classFilter and filter:
-						continue
 
-					logger.debug("Getting auditHardwares, hardwareClass '%s', filter: %s", hardwareClass, classFilter)
-					query = self._createQuery("HARDWARE_DEVICE_" + hardwareClass, attributes, classFilter)
-					for res in self._sql.getSet(session, query):
-						if returnHardwareIds:
-							results.append(res["hardware_id"])
-							continue
-
-						try:
-							del res["hardware_id"]
-						except KeyError:
-							pass
-
-						res["hardwareClass"] = hardwareClass
-						for (attribute, valueInfo) in self._auditHardwareConfig[hardwareClass].items():
-							try:
-								if valueInfo["Scope"] == "i":
-									continue
-							except KeyError:
-								pass
+				if not classFilter and filter:
+					continue
 
-							if attribute not in res:
-								res[attribute] = None
+				logger.debug("Getting auditHardwares, hardwareClass '%s', filter: %s", hardwareClass, classFilter)
+				query = self._createQuery("HARDWARE_DEVICE_" + hardwareClass, attributes, classFilter)
+				if returnHardwareIds:
+					results.extend(res["hardware_id"] for res in self._sql.getSet(session, query))
+					continue
 
-						results.append(res)
+				template = self._auditHardwareTemplates[hardwareClass]
+				for res in self._sql.getSet(session, query):
+					res.pop("hardware_id", None)
+					data = dict(template)
+					data.update(res)
+					data["hardwareClass"] = hardwareClass
+					results.append(data)
 
 		return results
 
 	def auditHardware_deleteObjects(self, auditHardwares: AuditHardware) -> None:
 		ConfigDataBackend.auditHardware_deleteObjects(self, auditHardwares)
+		self._clearHardwareIdCache()
 		with self._sql.session() as session:
 			for auditHardware in forceObjectClassList(auditHardwares, AuditHardware):
 				logger.info("Deleting auditHardware: %s", auditHardware)
@@ -2479,7 +2753,7 @@ class SQLBackend(ConfigDataBackend):  # pylint: disable=too-many-public-methods
 
 		where = self._filterToSql(hardwareFilter)
 
-		hwIdswhere = " or ".join([f"`hardware_id` = {hardwareId}" for hardwareId in self._getHardwareIds(auditHardware)])
+		hwIdswhere = " or ".join([f"`hardware_id` = {hardwareId}" for hardwareId in self._getDeviceHardwareIds(auditHardware)])
 
 		if not hwIdswhere:
 			logger.error("Building unique AuditHardwareOnHost constraint impossible!")
@@ -2492,10 +2766,7 @@ class SQLBackend(ConfigDataBackend):  # pylint: disable=too-many-public-methods
 
 		data = {attribute: value for attribute, value in auditHardwareOnHost.items() if attribute not in ("hardwareClass", "type")}
 
-		for (key, value) in auditHardware.items():
-			if value is None:
-				auditHardware[key] = [None]
-		hardwareIds = self._getHardwareIds(auditHardware)
+		hardwareIds = self._getDeviceHardwareIds(auditHardware)
 		if not hardwareIds:
 			raise BackendReferentialIntegrityError(f"Hardware device {auditHardware} not found")
 		data["hardware_id"] = hardwareIds[0]
@@ -2533,30 +2804,19 @@ class SQLBackend(ConfigDataBackend):  # pylint: disable=too-many-public-methods
 			with self._sql.session() as session:
 				self._sql.update(session, f"HARDWARE_CONFIG_{auditHardwareOnHost.hardwareClass}", where, update)
 
-	def auditHardwareOnHost_getHashes(  # pylint: disable=redefined-builtin,too-many-branches,too-many-locals,too-many-statements
+	def auditHardwareOnHost_getHashes(  # pylint: disable=redefined-builtin,too-many-locals
 		self, attributes: List[str] = None, **filter
 	) -> List[Dict[str, Any]]:
+		"""
+		Get the hashes of AuditHardwareOnHosts.
+
+		Classes not matching the filter are skipped without querying.
+		Every remaining class is read with one query joining the
+		host specific and the device table.
+		"""
 		attributes = attributes or []
-		hardwareClasses = set()
-		hardwareClass = filter.get("hardwareClass")
-		if hardwareClass not in ([], None):
-			for hwc in forceUnicodeList(hardwareClass):
-				regex = re.compile(f"^{hwc.replace('*', '.*')}$")
-				keys = (key for key in self._auditHardwareConfig if regex.search(key))
-				for key in keys:
-					hardwareClasses.add(key)
-
-			if not hardwareClasses:
-				return []
-
-		if not hardwareClasses:
-			hardwareClasses = set(self._auditHardwareConfig)
-
-		for unwanted_key in ("hardwareClass", "type"):
-			try:
-				del filter[unwanted_key]
-			except KeyError:
-				pass  # not there - everything okay.
+		hardwareClassFilter = filter.pop("hardwareClass", None)
+		filter.pop("type", None)
 
 		for attribute in attributes:
 			if attribute not in filter:
@@ -2564,72 +2824,51 @@ class SQLBackend(ConfigDataBackend):  # pylint: disable=too-many-public-methods
 
 		hashes = []
 		with self._sql.session() as session:
-			for hardwareClass in hardwareClasses:
-				auditHardwareFilter = {}
-				classFilter = {}
-				skipHardwareClass = False
-				for attribute, value in filter.items():
-					valueInfo = None
-					if attribute not in ("hostId", "state", "firstseen", "lastseen"):
-						valueInfo = self._auditHardwareConfig[hardwareClass].get(attribute)
-						if not valueInfo:
-							logger.debug(
-								"Skipping hardwareClass '%s', because of missing info for attribute '%s'", hardwareClass, attribute
-							)
-							skipHardwareClass = True
-							break
-
-						scope = valueInfo.get("Scope", "")
-						if scope == "g":
-							auditHardwareFilter[attribute] = value
-							continue
-						if scope != "i":
-							continue
+			for hardwareClass in self._getAuditHardwareClasses(hardwareClassFilter, list(filter)):
+				deviceTable = f"HARDWARE_DEVICE_{hardwareClass}"
+				configTable = f"HARDWARE_CONFIG_{hardwareClass}"
+				valueInfos = self._auditHardwareConfig[hardwareClass]
 
-					if value is not None:
-						value = forceList(value)
-
-					classFilter[attribute] = value
-
-				if skipHardwareClass:
-					continue
-
-				hardwareIds = []
-				if auditHardwareFilter:
-					auditHardwareFilter["hardwareClass"] = hardwareClass
-					hardwareIds = self._getHardwareIds(auditHardwareFilter)
-					logger.trace("Filtered matching hardware ids: %s", hardwareIds)
-					if not hardwareIds:
-						continue
-				classFilter["hardware_id"] = hardwareIds
-
-				if attributes and "hardware_id" not in attributes:
-					attributes.append("hardware_id")
-
-				logger.debug(
-					"Getting auditHardwareOnHosts, hardwareClass '%s', hardwareIds: %s, filter: %s", hardwareClass, hardwareIds, classFilter
+				deviceFilter = {}
+				configFilter = {}
+				for (attribute, value) in filter.items():
+					if attribute in ("hostId", "state", "firstseen", "lastseen"):
+						scope = "i"
+					else:
+						scope = valueInfos[attribute].get("Scope", "")
+
+					if scope == "g":
+						if isinstance(value, str):
+							value = self._sql.escapeAsterisk(value)
+						deviceFilter[attribute] = value
+					elif scope == "i":
+						configFilter[attribute] = value
+
+				configColumns = ["hostId", "state", "firstseen", "lastseen"]
+				configColumns.extend(attribute for (attribute, valueInfo) in valueInfos.items() if valueInfo.get("Scope") == "i")
+				if attributes:
+					configColumns = [column for column in configColumns if column in attributes]
+				select = ",".join([f"`{deviceTable}`.*"] + [f"`{configTable}`.`{column}`" for column in configColumns])
+
+				conditions = [
+					condition
+					for condition in (self._filterToSql(configFilter, table=configTable), self._filterToSql(deviceFilter, table=deviceTable))
+					if condition
+				]
+				query = (
+					f"select {select} from `{configTable}` join `{deviceTable}` "
+					f"on `{configTable}`.`hardware_id` = `{deviceTable}`.`hardware_id`"
 				)
-				for res in self._sql.getSet(session, self._createQuery(f"HARDWARE_CONFIG_{hardwareClass}", attributes, classFilter)):
-					data = self._sql.getSet(
-						session, f"SELECT * from `HARDWARE_DEVICE_{hardwareClass}` where `hardware_id` = {res['hardware_id']}"
-					)
-
-					if not data:
-						logger.error("Hardware device of class '%s' with hardware_id '%s' not found", hardwareClass, res["hardware_id"])
-						continue
-
-					data = data[0]
+				if conditions:
+					query = f"{query} where {' and '.join(conditions)}"
+
+				logger.debug("Getting auditHardwareOnHosts, hardwareClass '%s', query: %s", hardwareClass, query)
+				template = self._auditHardwareOnHostTemplates[hardwareClass]
+				for res in self._sql.getSet(session, query):
+					res.pop("hardware_id", None)
+					data = dict(template)
 					data.update(res)
 					data["hardwareClass"] = hardwareClass
-					del data["hardware_id"]
-					try:
-						del data["config_id"]
-					except KeyError:
-						pass  # not there - everything okay
-
-					for attribute in self._auditHardwareConfig[hardwareClass]:
-						if attribute not in data:
-							data[attribute] = None
 					hashes.append(data)
 
 		return hashes
@@ -2649,6 +2888,117 @@ class SQLBackend(ConfigDataBackend):  # pylint: disable=too-many-public-methods
 				where = self._uniqueAuditHardwareOnHostCondition(auditHardwareOnHost)
 				self._sql.delete(session, f"HARDWARE_CONFIG_{auditHardwareOnHost.getHardwareClass()}", where)
 
+	def _setAuditHardwareOnHostsObsolete(self, session: Any, hardwareClass: str, where: str) -> None:
+		self._sql.update(session, f"HARDWARE_CONFIG_{hardwareClass}", where, {"state": 0})
+
+	def auditHardwareOnHost_setObsolete(self, hostId: List[str]) -> None:
+		if hostId is None:
+			hostId = []
+		where = self._filterToSql({"hostId": forceHostIdList(hostId)}) or "1 = 1"
+		with self._sql.session() as session:
+			for hardwareClass in self._auditHardwareConfig:
+				self._setAuditHardwareOnHostsObsolete(session, hardwareClass, f"{where} and `state` = 1")
+
+	def auditHardwareOnHost_replaceInventory(  # pylint: disable=too-many-locals,too-many-branches
+		self, hostId: str, auditHardwareOnHosts: List[AuditHardwareOnHost], update: bool = False
+	) -> None:
+		"""
+		Replace the hardware inventory of a host in a single transaction.
+
+		Hardware ids are resolved for all devices of a class at once and
+		the existing entries of the host are read once per class.
+		Entries already present are marked as seen, new entries are
+		inserted in bulk and all other entries of the host are set obsolete.
+		With `update` state, lastseen and firstseen of the objects are
+		written instead and other entries of the host are kept.
+		"""
+		hostId = forceHostId(hostId)
+		auditHardwareOnHosts = forceObjectClassList(auditHardwareOnHosts, AuditHardwareOnHost)
+
+		now = timestamp()
+		byClass = {}
+		for auditHardwareOnHost in auditHardwareOnHosts:
+			if auditHardwareOnHost.hostId != hostId:
+				raise BackendBadValueError(f"{auditHardwareOnHost} does not belong to host '{hostId}'")
+			values = {"lastseen": now, "state": 1}
+			if update:
+				if auditHardwareOnHost.getState() is not None:
+					values["state"] = auditHardwareOnHost.getState()
+				if auditHardwareOnHost.getLastseen():
+					values["lastseen"] = auditHardwareOnHost.getLastseen()
+				if auditHardwareOnHost.getFirstseen():
+					values["firstseen"] = auditHardwareOnHost.getFirstseen()
+			auditHardwareOnHost.setDefaults()
+			self._checkHardwareClass(auditHardwareOnHost)
+			byClass.setdefault(auditHardwareOnHost.getHardwareClass(), []).append((auditHardwareOnHost, values))
+
+		hostCondition = self._filterToSql({"hostId": hostId})
+		stagedHardwareIds = {}
+		with self._sql.session() as session:
+			for hardwareClass in self._auditHardwareConfig:
+				table = f"HARDWARE_CONFIG_{hardwareClass}"
+				if hardwareClass not in byClass:
+					if not update:
+						self._setAuditHardwareOnHostsObsolete(session, hardwareClass, f"{hostCondition} and `state` = 1")
+					continue
+
+				extracted = []
+				for (auditHardwareOnHost, _values) in byClass[hardwareClass]:
+					(auditHardware, auditHardwareOnHost) = self._extractAuditHardwareHash(auditHardwareOnHost)
+					for (attribute, valueInfo) in self._auditHardwareConfig[hardwareClass].items():
+						# Unset attributes are stored as NULL
+						(auditHardware if valueInfo.get("Scope") == "g" else auditHardwareOnHost).setdefault(attribute, None)
+					extracted.append((auditHardware, auditHardwareOnHost))
+				hardwareIds = self._resolveHardwareIds(
+					session, hardwareClass, [auditHardware for (auditHardware, _ahoh) in extracted], stagedHardwareIds
+				)
+
+				existing = {}
+				for row in self._sql.getSet(session, f"select * from `{table}` where {hostCondition}"):
+					key = (row["hardware_id"], self._hardwareFingerprint(hardwareClass, row, scope="i"))
+					existing.setdefault(key, []).append(row)
+
+				# Config ids of existing entries by the values to set
+				seen = {}
+				inserts = {}
+				for ((_auditHardware, auditHardwareOnHost), (_ahoh, values), deviceHardwareIds) in zip(
+					extracted, byClass[hardwareClass], hardwareIds
+				):
+					instanceFingerprint = self._hardwareFingerprint(hardwareClass, auditHardwareOnHost, scope="i")
+					rows = []
+					for hardwareId in deviceHardwareIds:
+						rows.extend(existing.pop((hardwareId, instanceFingerprint), []))
+
+					if rows:
+						seen.setdefault(tuple(sorted(values.items())), []).extend(row["config_id"] for row in rows)
+						continue
+
+					key = (deviceHardwareIds[0], instanceFingerprint)
+					if key not in inserts:
+						data = {attribute: value for (attribute, value) in auditHardwareOnHost.items() if attribute != "hardwareClass"}
+						data["hardware_id"] = deviceHardwareIds[0]
+						inserts[key] = data
+
+				for (values, seenConfigIds) in seen.items():
+					for configIds in chunk(seenConfigIds, 1000):
+						where = f"`config_id` in ({','.join(str(configId) for configId in configIds)})"
+						self._sql.update(session, table, where, dict(values))
+
+				obsolete = []
+				if not update:
+					obsolete = [row["config_id"] for rows in existing.values() for row in rows if row["state"] != 0]
+				for configIds in chunk(obsolete, 1000):
+					where = f"`config_id` in ({','.join(str(configId) for configId in configIds)})"
+					self._setAuditHardwareOnHostsObsolete(session, hardwareClass, where)
+
+				if inserts:
+					logger.info("Inserting %d auditHardwareOnHosts of class %s for host %s", len(inserts), hardwareClass, hostId)
+					self._sql.insertMany(session, table, list(inserts.values()))
+
+		# Committed now
+		for (cacheKey, hardwareIds) in stagedHardwareIds.items():
+			self._cacheHardwareIds(cacheKey, hardwareIds)
+
 	# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 	# -   Extension for direct connect to db
 	# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) uib GmbH <info@uib.de>
+# License: AGPL-3.0
+"""
+Caching of serialised responses for idempotent read RPCs.
+
+A worker that finds the responses for the same rpcs, issued by a
+client of the same ACL identity class, only has to put the transaction
+ids of the current request into the already encoded responses. If the
+transaction ids are the same as before, the compressed body is sent
+as it is.
+
+Entries expire after a method specific time to live and are dropped
+as soon as the backend reports a modification of an object type
+the method depends on or a modifying rpc has been executed.
+"""
+
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from opsicommon.logging import get_logger
+
+import OPSI.Object
+from OPSI.Backend.Base.ModificationTracking import BackendModificationListener
+from OPSI.Types import forceList
+
+__all__ = ("DEFAULT_CACHEABLE_METHODS", "CachedResponse", "ResponseCache")
+
+logger = get_logger("opsi.general")
+
+# method name -> (time to live in seconds, object types the result depends on)
+DEFAULT_CACHEABLE_METHODS = {
+	"backend_info": (300, ()),
+	"getOpsiCACert": (300, ()),
+	"configState_getClientToDepotserver": (10, ("Config", "ConfigState", "Host", "ProductOnDepot")),
+	"product_getObjects": (10, ("Product",)),
+}
+
+# Methods with these prefixes do not modify objects of the backend.
+READ_ONLY_METHOD_PREFIXES = ("accessControl", "hostControl", "hostControlSafe", "log")
+
+# Stands in for the transaction ids while encoding the responses.
+TID_PLACEHOLDER = f"opsi-response-cache-tid-{uuid.uuid4()}"
+
+
+class CachedResponse:
+	"""
+	The serialised responses of a request, encoded without transaction ids.
+
+	The encoded responses are kept per content type, split at the \
+transaction ids. The last compressed body is kept per content type \
+and content encoding along with the transaction ids it was made for.
+	"""
+
+	def __init__(self, responses):
+		"""
+		:param responses: The serialised responses of the rpcs.
+		:type responses: list
+		"""
+		self._responses = tuple(responses)
+		self._templates = {}
+		self._bodies = {}
+		self._lock = threading.Lock()
+
+	def __repr__(self):
+		return f"<{self.__class__.__name__}(responses={len(self._responses)})>"
+
+	def getBody(self, tids, contentType, contentEncoding, encode, compress):  # pylint: disable=too-many-arguments
+		"""
+		Get the body to send for rpcs with the transaction ids `tids`.
+
+		:param tids: The transaction ids of the requesting rpcs.
+		:param contentType: The content type `encode` creates.
+		:param contentEncoding: The content encoding `compress` applies.
+		:param encode: Function encoding a response to bytes.
+		:param compress: Function compressing the encoded bytes.
+		:rtype: bytes
+		"""
+		tids = tuple(tids)
+		with self._lock:
+			body = self._bodies.get((contentType, contentEncoding))
+			if body and body[0] == tids:
+				return body[1]
+			template = self._templates.get(contentType)
+
+		if template is None:
+			template = self._createTemplate(encode)
+
+		if template:
+			parts = [template[0]]
+			for (tid, part) in zip(tids, template[1:]):
+				parts.append(encode(tid))
+				parts.append(part)
+			data = b"".join(parts)
+		else:
+			data = encode(self._getResponse(tids))
+		data = compress(data)
+
+		with self._lock:
+			self._templates[contentType] = template
+			self._bodies[(contentType, contentEncoding)] = (tids, data)
+		return data
+
+	def _createTemplate(self, encode):
+		"""
+		Encode the responses and split them at the transaction ids.
+
+		:returns: The encoded parts between the transaction ids or an \
+empty list if the transaction ids can not be told apart from the rest.
+		"""
+		data = encode(self._getResponse([TID_PLACEHOLDER] * len(self._responses)))
+		template = data.split(encode(TID_PLACEHOLDER))
+		if len(template) != len(self._responses) + 1:
+			logger.debug("Failed to find transaction ids in encoded responses")
+			return []
+		return template
+
+	def _getResponse(self, tids):
+		responses = [self._setTransactionId(response, tid) for (response, tid) in zip(self._responses, tids)]
+		if len(responses) == 1:
+			return responses[0]
+		return responses
+
+	@staticmethod
+	def _setTransactionId(response, tid):
+		response = dict(response)
+		if "tid" in response:
+			response["tid"] = tid
+		else:
+			response["id"] = tid
+		return response
+
+
+class ResponseCache(BackendModificationListener):
+	"""
+	Thread-safe LRU cache for the responses of rpcs.
+
+	Register the cache as a backend change listener on a
+	`ModificationTrackingBackend` to enable event driven invalidation.
+	"""
+
+	def __init__(self, cacheableMethods=None, maxEntries=1000):
+		"""
+		:param cacheableMethods: Mapping of method name to a tuple of \
+time to live (seconds) and the object types the result depends on. \
+Defaults to `DEFAULT_CACHEABLE_METHODS`.
+		:type cacheableMethods: dict
+		:param maxEntries: Maximum number of responses kept in memory.
+		:type maxEntries: int
+		"""
+		if cacheableMethods is None:
+			cacheableMethods = DEFAULT_CACHEABLE_METHODS
+		self._cacheableMethods = dict(cacheableMethods)
+		self._maxEntries = max(1, int(maxEntries))
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self._generation = 0
+		self.hits = 0
+		self.misses = 0
+
+	def __repr__(self):
+		return f"<{self.__class__.__name__}(maxEntries={self._maxEntries}, entries={len(self._entries)})>"
+
+	@property
+	def generation(self):
+		"""
+		Counter increased by every invalidation.
+
+		Read it before executing the rpcs and pass it to `set` to make \
+sure that no response is stored which was created while the cache \
+has been invalidated.
+		"""
+		return self._generation
+
+	def getKey(self, rpcs, identity):
+		"""
+		Create the cache key for a request.
+
+		The transaction ids are not part of the key, the transaction \
+ids of the requesting rpcs are put in by `CachedResponse.getBody`.
+
+		:param identity: The ACL identity class of the client. \
+Clients of the same class must be granted the same access.
+		:returns: The key or `None` if the request must not be cached.
+		"""
+		if not rpcs or identity is None:
+			return None
+
+		parts = []
+		for rpc in rpcs:
+			methodName = rpc.getMethodName()
+			if methodName not in self._cacheableMethods:
+				return None
+
+			try:
+				params = json.dumps(rpc.params, sort_keys=True, separators=(",", ":"))
+			except (TypeError, ValueError):
+				return None
+
+			parts.append((methodName, params, rpc.rpcVersion, rpc.type))
+
+		return (identity, tuple(parts))
+
+	def get(self, key):
+		"""
+		Get the stored responses for `key`.
+
+		:returns: The `CachedResponse` or `None`.
+		"""
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+
+			(expires, _methods, cachedResponse) = entry
+			if expires <= time.time():
+				del self._entries[key]
+				self.misses += 1
+				return None
+
+			self._entries.move_to_end(key)
+			self.hits += 1
+
+		logger.debug("Response cache hit for %s", [part[0] for part in key[1]])
+		return cachedResponse
+
+	def set(self, key, cachedResponse, generation=None):
+		"""
+		Store the responses of a request.
+
+		:type cachedResponse: CachedResponse
+		:param generation: The value of `generation` before the rpcs \
+were executed. Nothing is stored if the cache has been invalidated \
+since then.
+		:type generation: int
+		"""
+		methods = frozenset(part[0] for part in key[1])
+		timeToLive = min(self._cacheableMethods[method][0] for method in methods)
+		if timeToLive <= 0:
+			return
+
+		with self._lock:
+			if generation is not None and generation != self._generation:
+				logger.debug("Response cache was invalidated while executing %s, not storing response", sorted(methods))
+				return
+
+			self._entries[key] = (time.time() + timeToLive, methods, cachedResponse)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self._maxEntries:
+				self._entries.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._generation += 1
+			self._entries.clear()
+
+	def invalidate(self, objectTypes):
+		"""
+		Remove all responses of methods depending on any of `objectTypes`.
+		"""
+		objectTypes = set(objectTypes)
+		affectedMethods = {
+			method for (method, (_ttl, dependencies)) in self._cacheableMethods.items() if objectTypes.intersection(dependencies)
+		}
+		if not affectedMethods:
+			return
+
+		with self._lock:
+			self._generation += 1
+			for key in [key for (key, entry) in self._entries.items() if entry[1].intersection(affectedMethods)]:
+				del self._entries[key]
+
+		logger.debug("Invalidated cached responses of %s", affectedMethods)
+
+	def rpcExecuted(self, methodName):
+		"""
+		Invalidate the responses an executed rpc may have changed.
+
+		Methods of an object type not starting with `get` invalidate \
+everything depending on the type. Any other method which is not \
+known to leave the backend data untouched clears the cache.
+		"""
+		if methodName in self._cacheableMethods or methodName.startswith("get"):
+			return
+
+		(prefix, _, action) = methodName.partition("_")
+		if prefix in READ_ONLY_METHOD_PREFIXES or action.startswith(("get", "read")):
+			return
+
+		objClass = getattr(OPSI.Object, prefix[:1].upper() + prefix[1:], None)
+		if not action or not isinstance(objClass, type) or not issubclass(objClass, OPSI.Object.BaseObject):
+			self.clear()
+			return
+
+		self.invalidate(self._getObjectTypes(objClass))
+
+	@staticmethod
+	def _getObjectTypes(obj):
+		if isinstance(obj, type):
+			return {cls.__name__ for cls in obj.__mro__}
+		if isinstance(obj, dict):
+			objClass = getattr(OPSI.Object, obj.get("type") or "", None)
+			if not isinstance(objClass, type):
+				return {obj.get("type")}
+			return {cls.__name__ for cls in objClass.__mro__}
+		# Using the mro makes a modified LocalbootProduct invalidate
+		# everything depending on Product.
+		return {cls.__name__ for cls in type(obj).__mro__}
+
+	def objectInserted(self, backend, obj):
+		self.invalidate(self._getObjectTypes(obj))
+
+	def objectUpdated(self, backend, obj):
+		self.invalidate(self._getObjectTypes(obj))
+
+	def objectsDeleted(self, backend, objs):
+		objectTypes = set()
+		for obj in forceList(objs):
+			objectTypes.update(self._getObjectTypes(obj))
+		self.invalidate(objectTypes)
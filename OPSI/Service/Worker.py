@@ -15,7 +15,9 @@ from msgspec import msgpack
 import lz4
 
 from OPSI.Exceptions import OpsiBadRpcError, OpsiServiceAuthenticationError
+from OPSI.Object import OpsiClient, OpsiDepotserver
 from OPSI.Service.JsonRpc import JsonRpc
+from OPSI.Service.ResponseCache import CachedResponse
 from OPSI.Types import forceList, forceUnicode
 from OPSI.Util import fromJson, objectToHtml, toJson
 from OPSI.Util.HTTP import deflateDecode, deflateEncode, gzipDecode, gzipEncode
@@ -251,6 +253,12 @@ class WorkerOpsi:  # pylint: disable=too-few-public-methods,too-many-instance-at
 		except AttributeError:  # no attribtue _getSessionHandler
 			return None
 
+	def _getResponseCache(self):
+		try:
+			return self.service._getResponseCache()  # pylint: disable=protected-access
+		except AttributeError:  # no attribute _getResponseCache
+			return None
+
 	def _errback(self, failure):
 		logger.trace("%s._errback", self.__class__.__name__)
 
@@ -499,6 +507,9 @@ class WorkerOpsiJsonRpc(WorkerOpsi):  # pylint: disable=too-few-public-methods
 		self._callInstance = None
 		self._callInterface = {}
 		self._rpcs = []
+		self._responseCacheKey = None
+		self._responseCacheGeneration = None
+		self._cachedResponse = None
 
 	def _getCallInstance(self, result):  # pylint: disable=unused-argument
 		logger.warning("Class %s should overwrite _getCallInstance", self.__class__.__name__)
@@ -540,11 +551,73 @@ class WorkerOpsiJsonRpc(WorkerOpsi):  # pylint: disable=too-few-public-methods
 
 		return result
 
+	def _getAclIdentity(self):
+		"""
+		ACL identity class used to separate cached responses of clients.
+
+		Clients of the same class are granted the same access by the \
+ACL: admins, depotservers and every client for itself.
+
+		:returns: The identity class or `None` if the responses for \
+this session must not be cached.
+		"""
+		if not self.session or not self.session.authenticated:
+			return None
+
+		accessControl = getattr(self._callInstance, "backendAccessControl", None)
+		if not accessControl:
+			# Every authenticated session is granted the same access.
+			return ("authenticated",)
+
+		userStore = accessControl.user_store
+		if not userStore.authenticated:
+			return None
+		if isinstance(userStore.host, OpsiClient):
+			return ("client", userStore.host.id)
+		if isinstance(userStore.host, OpsiDepotserver):
+			return ("depot",)
+		if not userStore.host and userStore.isAdmin:
+			return ("admin",)
+		return None
+
+	def _lookupCachedResponse(self, result):
+		self._responseCacheKey = None
+		self._responseCacheGeneration = None
+		self._cachedResponse = None
+
+		responseCache = self._getResponseCache()
+		if not responseCache:
+			return result
+
+		addBackendChangeListener = getattr(self._callInstance, "addBackendChangeListener", None)
+		if addBackendChangeListener:
+			addBackendChangeListener(responseCache)
+
+		self._responseCacheGeneration = responseCache.generation
+		self._responseCacheKey = responseCache.getKey(self._rpcs, self._getAclIdentity())
+		if self._responseCacheKey:
+			self._cachedResponse = responseCache.get(self._responseCacheKey)
+		return result
+
+	def _invalidateCachedResponses(self, result):
+		if self._cachedResponse:
+			return result
+
+		responseCache = self._getResponseCache()
+		if responseCache:
+			for rpc in self._rpcs:
+				responseCache.rpcExecuted(rpc.getMethodName())
+		return result
+
 	def _executeRpc(self, result, rpc):  # pylint: disable=unused-argument,no-self-use
 		deferred = threads.deferToThread(rpc.execute)
 		return deferred
 
 	def _executeRpcs(self, result):  # pylint: disable=unused-argument
+		if self._cachedResponse:
+			logger.debug("Using cached response, skipping execution of rpcs")
+			return result
+
 		deferred = defer.Deferred()
 		for rpc in self._rpcs:
 			deferred.addCallback(self._executeRpc, rpc)
@@ -557,7 +630,9 @@ class WorkerOpsiJsonRpc(WorkerOpsi):  # pylint: disable=too-few-public-methods
 		deferred.addCallback(self._decodeQuery)
 		deferred.addCallback(self._getCallInstance)
 		deferred.addCallback(self._getRpcs)
+		deferred.addCallback(self._lookupCachedResponse)
 		deferred.addCallback(self._executeRpcs)
+		deferred.addCallback(self._invalidateCachedResponses)
 		# deferred.addErrback(self._errback)
 		deferred.callback(None)
 		return deferred
@@ -585,22 +660,14 @@ class WorkerOpsiJsonRpc(WorkerOpsi):  # pylint: disable=too-few-public-methods
 		except Exception as err:  # pylint: disable=broad-except
 			logger.error("Failed to get accepted mime types from header: %s", err)
 
-		response = [serialize(rpc.getResponse()) for rpc in self._rpcs]
-
-		if len(response) == 1:
-			response = response[0]
-		if not response:
-			response = ""
-
 		self.request.setResponseCode(200)
 
-		data = b""
+		contentType = "application/json"
 		if self.request.getHeader("Content-Type") == "application/msgpack":
+			contentType = "application/msgpack"
 			self.request.setHeader("Content-Type", "application/msgpack")
-			data = msgpack.encode(serialize(response, deep=True))
 		else:
 			self.request.setHeader("Content-Type", "application/json; charset=utf-8")
-			data = toJson(response).encode("utf-8")
 
 		if invalidMime:
 			# The invalid requests expect the encoding set to
@@ -608,26 +675,62 @@ class WorkerOpsiJsonRpc(WorkerOpsi):  # pylint: disable=too-few-public-methods
 			self.request.setHeader("Content-Encoding", "gzip")
 			self.request.setHeader("Content-Type", "gzip-application/json; charset=utf-8")
 			logger.debug("Sending deflated data (backwards compatible - with Content-Encoding 'gzip')")
-			data = deflateEncode(data)
+			encoding = "deflate"
 		elif encoding == "lz4":
 			logger.debug("Sending lz4 compressed data")
 			self.request.setHeader("Content-Encoding", encoding)
-			data = lz4.frame.compress(data, compression_level=0, block_linked=True)
 		elif encoding == "deflate":
 			logger.debug("Sending deflated data")
 			self.request.setHeader("Content-Encoding", encoding)
-			data = deflateEncode(data)
 		elif encoding == "gzip":
 			logger.debug("Sending gzip compressed data")
 			self.request.setHeader("Content-Encoding", encoding)
-			data = gzipEncode(data)
 		else:
 			logger.debug("Sending plain data")
 
+		cachedResponse = self._cachedResponse
+		if cachedResponse:
+			logger.debug("Sending cached response")
+		elif self._responseCacheKey and not any(rpc.exception for rpc in self._rpcs):
+			cachedResponse = CachedResponse([serialize(rpc.getResponse()) for rpc in self._rpcs])
+			self._getResponseCache().set(self._responseCacheKey, cachedResponse, self._responseCacheGeneration)
+
+		if cachedResponse:
+			data = cachedResponse.getBody(
+				[rpc.tid for rpc in self._rpcs],
+				contentType,
+				encoding,
+				lambda response: self._encodeResponse(response, contentType),
+				lambda data: self._compressResponse(data, encoding),
+			)
+		else:
+			response = [serialize(rpc.getResponse()) for rpc in self._rpcs]
+			if len(response) == 1:
+				response = response[0]
+			if not response:
+				response = ""
+			data = self._compressResponse(self._encodeResponse(response, contentType), encoding)
+
 		logger.trace("Sending response: %s", data)
 		self.request.write(data)
 		return result
 
+	@staticmethod
+	def _encodeResponse(response, contentType):
+		if contentType == "application/msgpack":
+			return msgpack.encode(serialize(response, deep=True))
+		return toJson(response).encode("utf-8")
+
+	@staticmethod
+	def _compressResponse(data, encoding):
+		if encoding == "lz4":
+			return lz4.frame.compress(data, compression_level=0, block_linked=True)
+		if encoding == "deflate":
+			return deflateEncode(data)
+		if encoding == "gzip":
+			return gzipEncode(data)
+		return data
+
 	def _renderError(self, failure):
 		error = "Unknown error"
 		try:
@@ -653,6 +756,10 @@ class WorkerOpsiJsonInterface(WorkerOpsiJsonRpc):  # pylint: disable=too-few-pub
 	Worker responsible for creating the human-usable interface page.
 	"""
 
+	def _lookupCachedResponse(self, result):
+		# The interface page renders the rpc results itself.
+		return result
+
 	def _generateResponse(self, result):  # pylint: disable=too-many-locals
 		logger.info("Creating interface page")
 
@@ -11,7 +11,9 @@ import os
 from OpenSSL import SSL
 from opsicommon.logging import get_logger
 
+from OPSI.Service.ResponseCache import ResponseCache
 from OPSI.Service.Session import SessionHandler
+from OPSI.Util.File.Opsi import OpsiConfFile
 
 logger = get_logger("opsi.general")
 
@@ -62,11 +64,35 @@ is set.
 class OpsiService(object):
 	def __init__(self):
 		self._sessionHandler = None
+		self._responseCache = None
 
 	def _getSessionHandler(self):
 		if self._sessionHandler is None:
 			self._sessionHandler = SessionHandler()
 		return self._sessionHandler
 
+	def _getResponseCache(self):
+		"""
+		Cache for responses of idempotent rpcs.
+
+		The cache is created on first use if `response_cache` is \
+enabled in the section `service` of opsi.conf.
+
+		:returns: The `ResponseCache` or `None` if caching is disabled.
+		"""
+		if self._responseCache is None:
+			enabled = False
+			try:
+				enabled = OpsiConfFile().isResponseCacheEnabled()
+			except IOError:
+				pass
+			except Exception as err:  # pylint: disable=broad-except
+				logger.warning("Failed to read response cache setting from opsi.conf: %s", err)
+
+			if enabled:
+				logger.info("Caching responses of idempotent rpcs")
+			self._responseCache = ResponseCache() if enabled else False
+		return self._responseCache or None
+
 	def getInterface(self):
 		return {}
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) uib GmbH <info@uib.de>
+# License: AGPL-3.0
+"""
+Calculating checksums of many files.
+
+hashlib releases the GIL while hashing, therefore a pool of threads
+keeps all cores busy while the checksums are still delivered in the
+order of the given filenames.
+
+Checksums can be kept in a `ChecksumCache` which returns the stored
+checksum as long as size, modification time and inode of a file are
+unchanged. The cache of all directories is kept in one database at
+`CHECKSUM_CACHE_FILE`, outside of the directories holding the files.
+"""
+
+import os
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from opsicommon.logging import get_logger
+
+from OPSI.Util import getWorkerCount, md5sum
+
+__all__ = ("CHECKSUM_CACHE_FILE", "ChecksumCache", "getChecksumCache", "md5sums")
+
+logger = get_logger("opsi.general")
+
+
+def _getChecksumCacheFile():
+	if os.name == "nt":
+		return os.path.join(os.environ.get("PROGRAMDATA", r"C:\ProgramData"), "opsi", "checksums.sqlite")
+	return "/var/lib/opsi/checksums.sqlite"
+
+
+CHECKSUM_CACHE_FILE = _getChecksumCacheFile()
+
+_unavailableCacheFiles = set()
+
+
+class ChecksumCache:
+	"""
+	Persistent cache for md5sums of local files, stored in SQLite.
+
+	If the cache file can not be opened the cache stays empty and every
+	checksum is calculated. This is logged as a warning only once per
+	cache file.
+	"""
+
+	COMMIT_INTERVAL = 1000
+
+	def __init__(self, filename):
+		"""
+		:param filename: The SQLite database to use. It is created, \
+along with its directory, if missing. If this is `None` the cache \
+is not available.
+		:type filename: str
+		"""
+		self._filename = filename
+		self._lock = threading.Lock()
+		self._uncommitted = 0
+		self._connection = None
+		if not filename:
+			return
+
+		try:
+			os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+			self._connection = sqlite3.connect(filename, timeout=10, check_same_thread=False)
+			self._connection.execute(
+				"CREATE TABLE IF NOT EXISTS md5sum "
+				"(path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, inode INTEGER NOT NULL, md5sum TEXT NOT NULL)"
+			)
+			self._connection.commit()
+		except (OSError, sqlite3.Error) as err:
+			if filename in _unavailableCacheFiles:
+				logger.debug("Checksum cache '%s' is not available: %s", filename, err)
+			else:
+				_unavailableCacheFiles.add(filename)
+				logger.warning("Checksum cache '%s' is not available: %s", filename, err)
+			self.close()
+			return
+
+		_unavailableCacheFiles.discard(filename)
+
+	def __repr__(self):
+		return f"<{self.__class__.__name__}(filename={self._filename!r})>"
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	@property
+	def available(self):
+		return self._connection is not None
+
+	@staticmethod
+	def _getStatKey(fileStat):
+		return (fileStat.st_size, fileStat.st_mtime_ns, fileStat.st_ino)
+
+	def get(self, path, fileStat=None):
+		"""
+		Get the stored md5sum of `path`.
+
+		:param fileStat: The current `os.stat` result of `path`.
+		:returns: The md5sum or `None` if unknown or the file changed.
+		"""
+		if not self._connection:
+			return None
+
+		path = os.path.abspath(path)
+		fileStat = fileStat or os.stat(path)
+		try:
+			with self._lock:
+				row = self._connection.execute("SELECT size, mtime, inode, md5sum FROM md5sum WHERE path = ?", (path,)).fetchone()
+		except sqlite3.Error as err:
+			logger.debug("Failed to read checksum of '%s' from cache: %s", path, err)
+			return None
+
+		if not row or tuple(row[:3]) != self._getStatKey(fileStat):
+			return None
+		return row[3]
+
+	def set(self, path, checksum, fileStat=None):
+		"""
+		Store the md5sum of `path`.
+
+		:param fileStat: The `os.stat` result of `path` taken before \
+calculating the checksum. A file modified while it was hashed \
+therefore does not match the stored entry.
+		"""
+		if not self._connection:
+			return
+
+		path = os.path.abspath(path)
+		fileStat = fileStat or os.stat(path)
+		try:
+			with self._lock:
+				self._connection.execute(
+					"INSERT OR REPLACE INTO md5sum (path, size, mtime, inode, md5sum) VALUES (?, ?, ?, ?, ?)",
+					(path, *self._getStatKey(fileStat), checksum),
+				)
+				self._uncommitted += 1
+				if self._uncommitted >= self.COMMIT_INTERVAL:
+					self._commit()
+		except sqlite3.Error as err:
+			logger.debug("Failed to store checksum of '%s' in cache: %s", path, err)
+
+	def md5sum(self, path):
+		"""
+		Get the md5sum of `path`, calculating and storing it if needed.
+		"""
+		fileStat = os.stat(path)
+		checksum = self.get(path, fileStat)
+		if checksum is None:
+			checksum = md5sum(path)
+			self.set(path, checksum, fileStat)
+		return checksum
+
+	def _commit(self):
+		self._connection.commit()
+		self._uncommitted = 0
+
+	def flush(self):
+		if not self._connection:
+			return
+
+		try:
+			with self._lock:
+				self._commit()
+		except sqlite3.Error as err:
+			logger.warning("Failed to write checksum cache '%s': %s", self._filename, err)
+
+	def close(self):
+		if not self._connection:
+			return
+
+		self.flush()
+		with self._lock:
+			self._connection.close()
+			self._connection = None
+
+
+def getChecksumCache():
+	"""
+	Get the checksum cache stored in `CHECKSUM_CACHE_FILE`.
+
+	:rtype: ChecksumCache
+	"""
+	return ChecksumCache(CHECKSUM_CACHE_FILE)
+
+
+def md5sums(filenames, workers=None, ignoreErrors=False, cache=None):
+	"""
+	Calculate the md5sums of `filenames` in parallel.
+
+	At most a few files per thread are hashed ahead of the consumer,
+	so the iterator can be used for large numbers of files.
+
+	:param filenames: The files to hash.
+	:param workers: Number of hashing threads. Defaults to the number of CPUs.
+	:type workers: int
+	:param ignoreErrors: If this is `True` files that can not be \
+hashed are logged and returned with a checksum of `None`. \
+Otherwise the first error is raised.
+	:type ignoreErrors: bool
+	:param cache: Checksums of unchanged files are taken from this \
+cache and calculated checksums are stored in it.
+	:type cache: ChecksumCache
+	:returns: Iterator of (filename, md5sum) in the order of `filenames`.
+	"""
+	filenames = iter(filenames)
+	workers = getWorkerCount(workers)
+
+	def getCached(filename):
+		if not cache or not cache.available:
+			return None, None
+
+		try:
+			fileStat = os.stat(filename)
+		except OSError:
+			# The error is raised when hashing.
+			return None, None
+		return cache.get(filename, fileStat), fileStat
+
+	def getResult(filename, future=None, checksum=None, fileStat=None):
+		if checksum is not None:
+			return filename, checksum
+
+		try:
+			checksum = future.result() if future else md5sum(filename)
+		except Exception as err:  # pylint: disable=broad-except
+			if not ignoreErrors:
+				raise
+			logger.warning("Failed to calculate md5sum of '%s': %s", filename, err)
+			return filename, None
+
+		if fileStat:
+			cache.set(filename, checksum, fileStat)
+		return filename, checksum
+
+	if workers == 1:
+		for filename in filenames:
+			checksum, fileStat = getCached(filename)
+			yield getResult(filename, checksum=checksum, fileStat=fileStat)
+		return
+
+	pending = deque()
+	with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="md5sum") as executor:
+		try:
+			for filename in filenames:
+				checksum, fileStat = getCached(filename)
+				if checksum is not None and not pending:
+					yield filename, checksum
+					continue
+
+				future = None if checksum is not None else executor.submit(md5sum, filename)
+				pending.append((filename, future, checksum, fileStat))
+				if len(pending) >= workers * 4:
+					yield getResult(*pending.popleft())
+
+			while pending:
+				yield getResult(*pending.popleft())
+		finally:
+			for _filename, future, _checksum, _fileStat in pending:
+				if future:
+					future.cancel()
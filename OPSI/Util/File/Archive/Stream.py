@@ -0,0 +1,1236 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) uib GmbH <info@uib.de>
+# License: AGPL-3.0
+"""
+Reading and writing archives in-process.
+
+The outer archive of an opsi package is an uncompressed tar or cpio
+archive containing compressed tar or cpio archives.
+`PackageArchiveReader` indexes the outer archive and streams every
+inner archive through a decompressor into an `ArchiveExtractor`,
+which writes the files to their destination.
+No inner archive is written to disk and no external process is
+needed for gzip or bzip2 compressed archives.
+
+Formats not handled here raise a `NotImplementedError` before
+anything is written so that callers can fall back to
+`OPSI.Util.File.Archive.Archive`.
+
+`ArchiveWriter` creates tar and newc cpio archives. gzip and bzip2
+compression is done in blocks by a pool of threads, gzip output is
+rsyncable like the output of `pigz --rsyncable`.
+"""
+
+import bz2
+import gzip
+import hashlib
+import os
+import re
+import stat
+import struct
+import subprocess
+import tarfile
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from opsicommon.logging import get_logger
+
+from OPSI import System
+from OPSI.Types import forceFilename
+from OPSI.Util import getWorkerCount
+
+if os.name == "posix":
+	import grp
+	import pwd
+
+__all__ = (
+	"ArchiveExtractor",
+	"ArchiveMember",
+	"ArchiveWriter",
+	"PackageArchiveReader",
+	"listArchive",
+	"openCompressed",
+	"openDecompressed",
+)
+
+CPIO_NEWC_MAGIC = b"070701"
+CPIO_CRC_MAGIC = b"070702"
+CPIO_HEADER_SIZE = 110
+CPIO_TRAILER = "TRAILER!!!"
+BUFFER_SIZE = 1024 * 1024
+GZIP_BLOCK_SIZE = 128 * 1024
+GZIP_DICTIONARY_SIZE = 32 * 1024
+BZIP2_BLOCK_SIZE = 900 * 1000
+
+# Rolling hash of pigz --rsyncable over the last 12 bytes
+RSYNC_BITS = 12
+RSYNC_HIT = ((1 << RSYNC_BITS) - 1) >> 1
+RSYNC_SEARCH_SIZE = 16 * 1024
+
+logger = get_logger("opsi.general")
+
+
+class ArchiveMember:  # pylint: disable=too-few-public-methods,too-many-instance-attributes
+	"""
+	A member of a tar or cpio archive.
+	"""
+
+	def __init__(  # pylint: disable=too-many-arguments
+		self, name, mode, size=0, mtime=0, linkname=None, offset=None, inode=None, nlink=1, uid=0, gid=0, uname=None, gname=None
+	):
+		self.name = name
+		self.mode = mode
+		self.size = size
+		self.mtime = mtime
+		self.linkname = linkname
+		self.offset = offset
+		self.inode = inode
+		self.nlink = nlink
+		self.uid = uid
+		self.gid = gid
+		self.uname = uname
+		self.gname = gname
+
+	def __repr__(self):
+		return f"<{self.__class__.__name__}(name={self.name!r}, mode={oct(self.mode)}, size={self.size})>"
+
+	def isdir(self):
+		return stat.S_ISDIR(self.mode)
+
+	def isfile(self):
+		return stat.S_ISREG(self.mode) and not self.linkname
+
+	def issym(self):
+		return stat.S_ISLNK(self.mode)
+
+	def islnk(self):
+		"Is this a hard link to `linkname`?"
+		return stat.S_ISREG(self.mode) and bool(self.linkname)
+
+
+class _LimitedReader:
+	"""
+	Read at most `size` bytes from `fileobj`.
+	"""
+
+	def __init__(self, fileobj, size):
+		self._fileobj = fileobj
+		self._remaining = size
+
+	def read(self, size=-1):
+		if self._remaining <= 0:
+			return b""
+		if size is None or size < 0 or size > self._remaining:
+			size = self._remaining
+		data = self._fileobj.read(size)
+		self._remaining -= len(data)
+		return data
+
+	def drain(self):
+		while self.read(BUFFER_SIZE):
+			pass
+
+
+class _PrefixedReader:
+	"""
+	Returns `prefix` before the data of `fileobj`, used after peeking.
+	"""
+
+	def __init__(self, prefix, fileobj):
+		self._prefix = prefix
+		self._fileobj = fileobj
+
+	def read(self, size=-1):
+		if not self._prefix:
+			return self._fileobj.read(size)
+
+		if size is None or size < 0:
+			data = self._prefix + self._fileobj.read()
+			self._prefix = b""
+			return data
+
+		data = self._prefix[:size]
+		self._prefix = self._prefix[size:]
+		if len(data) < size:
+			data += self._fileobj.read(size - len(data))
+		return data
+
+
+class _ProgressReader:
+	"""
+	Adds the number of bytes read from `fileobj` to the state of `progressSubject`.
+
+	The progress is reported in steps of `BUFFER_SIZE` and on `flush`.
+	"""
+
+	def __init__(self, fileobj, progressSubject):
+		self._fileobj = fileobj
+		self._progressSubject = progressSubject
+		self._unreported = 0
+
+	def read(self, size=-1):
+		data = self._fileobj.read(size)
+		self._unreported += len(data)
+		if self._unreported >= BUFFER_SIZE or not data:
+			self.flush()
+		return data
+
+	def flush(self):
+		if self._unreported:
+			self._progressSubject.addToState(self._unreported)
+			self._unreported = 0
+
+
+class _ExternalDecompressor:
+	"""
+	Decompress a stream with an external program fed by a thread.
+	"""
+
+	def __init__(self, command, fileobj):
+		self._proc = subprocess.Popen(  # pylint: disable=consider-using-with
+			command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+		)
+		self._error = None
+		self._feeder = threading.Thread(target=self._feed, args=(fileobj,), daemon=True)
+		self._feeder.start()
+
+	def _feed(self, fileobj):
+		try:
+			while True:
+				data = fileobj.read(BUFFER_SIZE)
+				if not data:
+					break
+				self._proc.stdin.write(data)
+		except Exception as err:  # pylint: disable=broad-except
+			self._error = err
+		finally:
+			try:
+				self._proc.stdin.close()
+			except OSError:
+				pass
+
+	def read(self, size=-1):
+		return self._proc.stdout.read(size)
+
+	def close(self):
+		self._proc.stdout.close()
+		self._feeder.join()
+		returncode = self._proc.wait()
+		if self._error:
+			raise self._error
+		if returncode != 0:
+			raise RuntimeError(f"Decompression with '{self._proc.args[0]}' failed with code {returncode}")
+
+	def abort(self):
+		"""
+		Stop the decompression without reading the remaining data, never raises.
+		"""
+		self._proc.kill()
+		self._proc.stdout.close()
+		self._feeder.join()
+		self._proc.wait()
+
+
+class _ExternalCompressor:
+	"""
+	Compress to `fileobj` with an external program, its output is copied by a thread.
+	"""
+
+	def __init__(self, command, fileobj):
+		self._proc = subprocess.Popen(  # pylint: disable=consider-using-with
+			command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+		)
+		self._error = None
+		self._copier = threading.Thread(target=self._copy, args=(fileobj,), daemon=True)
+		self._copier.start()
+
+	def _copy(self, fileobj):
+		try:
+			while True:
+				data = self._proc.stdout.read(BUFFER_SIZE)
+				if not data:
+					break
+				fileobj.write(data)
+		except Exception as err:  # pylint: disable=broad-except
+			self._error = err
+			# Unblocks a writer waiting for the full pipe
+			self._proc.kill()
+
+	def write(self, data):
+		self._proc.stdin.write(data)
+		return len(data)
+
+	def close(self):
+		self._proc.stdin.close()
+		self._copier.join()
+		self._proc.stdout.close()
+		returncode = self._proc.wait()
+		if self._error:
+			raise self._error
+		if returncode != 0:
+			raise RuntimeError(f"Compression with '{self._proc.args[0]}' failed with code {returncode}")
+
+	def abort(self):
+		self._proc.kill()
+		try:
+			self._proc.stdin.close()
+		except OSError:
+			pass
+		self._copier.join()
+		self._proc.stdout.close()
+		self._proc.wait()
+
+
+class _UncompressedWriter:
+	"""
+	Writes to `fileobj` without closing it.
+	"""
+
+	def __init__(self, fileobj):
+		self._fileobj = fileobj
+
+	def write(self, data):
+		return self._fileobj.write(data)
+
+	def close(self):
+		pass
+
+	def abort(self):
+		pass
+
+
+class _ParallelCompressor:
+	"""
+	Base for compressing the written data in blocks by a pool of threads.
+
+	zlib and bz2 release the GIL while compressing. The compressed
+	blocks are written to `fileobj` in order, at most two blocks per
+	thread are pending.
+	"""
+
+	blockSize = BUFFER_SIZE
+
+	def __init__(self, fileobj, level, workers=None):
+		self._fileobj = fileobj
+		self._level = level
+		self._workers = getWorkerCount(workers)
+		self._executor = None
+		if self._workers > 1:
+			self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="compress")
+		self._pending = deque()
+		self._buffer = bytearray()
+		self._blockCount = 0
+		self._closed = False
+
+	def write(self, data):
+		self._buffer += data
+		while len(self._buffer) >= self.blockSize:
+			end = self._getBlockEnd()
+			block = bytes(self._buffer[:end])
+			del self._buffer[:end]
+			self._submit(block, last=False)
+		return len(data)
+
+	def _getBlockEnd(self):
+		return self.blockSize
+
+	def _submit(self, block, last):
+		self._blockCount += 1
+		arguments = self._prepareBlock(block, last)
+		if not self._executor:
+			self._fileobj.write(self._compressBlock(*arguments))
+			return
+
+		self._pending.append(self._executor.submit(self._compressBlock, *arguments))
+		while self._pending and (len(self._pending) > self._workers * 2 or self._pending[0].done()):
+			self._fileobj.write(self._pending.popleft().result())
+
+	def _needsFinalBlock(self):
+		return not self._blockCount
+
+	def _prepareBlock(self, block, last):  # pylint: disable=unused-argument,no-self-use
+		"""
+		Called for every block in order.
+
+		:returns: The arguments for `_compressBlock`.
+		"""
+		return (block,)
+
+	def _compressBlock(self, block, *args):
+		raise NotImplementedError("_compressBlock not implemented")
+
+	def _writeTrailer(self):
+		pass
+
+	def close(self):
+		if self._closed:
+			return
+
+		try:
+			if self._buffer or self._needsFinalBlock():
+				self._submit(bytes(self._buffer), last=True)
+				self._buffer = bytearray()
+			while self._pending:
+				self._fileobj.write(self._pending.popleft().result())
+			self._writeTrailer()
+		finally:
+			self.abort()
+
+	def abort(self):
+		self._closed = True
+		for future in self._pending:
+			future.cancel()
+		self._pending.clear()
+		if self._executor:
+			self._executor.shutdown(wait=True)
+			self._executor = None
+
+
+def _findLastRsyncHitInWindow(window):
+	"""
+	Calculate the rolling hash for all positions of `window` at once.
+
+	Every byte is placed in a 32 bit slot of a large integer, so the
+	terms `byte << shift` of the hash can be combined by shifting the
+	whole integer without reaching into the neighbouring slots.
+
+	:returns: The position after the last match or -1.
+	"""
+	slots = bytearray(4 * len(window))
+	slots[3::4] = window
+	terms = int.from_bytes(slots, "big")
+	# XOR of terms >> (31 * shift) for shift 0 to 11 by doubling
+	terms ^= terms >> 31
+	terms ^= terms >> 62
+	hashes = (terms ^ terms >> 124 ^ terms >> 248).to_bytes(len(slots), "big")
+	low = hashes[3::4]
+	high = hashes[2::4]
+
+	position = len(window)
+	while position > 0:
+		position = low.rfind(bytes((RSYNC_HIT & 0xFF,)), RSYNC_BITS - 1, position)
+		if position == -1:
+			break
+		if high[position] & 0x0F == RSYNC_HIT >> 8:
+			return position + 1
+	return -1
+
+
+def _findLastRsyncHit(data):
+	"""
+	Get the end of the last match of the rolling hash used by \
+`pigz --rsyncable` in `data`.
+
+	A match is expected every few KiB, so `data` is searched backwards
+	in small windows.
+
+	:returns: The position after the last match or -1.
+	"""
+	end = len(data)
+	while end > RSYNC_BITS - 1:
+		start = max(end - RSYNC_SEARCH_SIZE - (RSYNC_BITS - 1), 0)
+		hit = _findLastRsyncHitInWindow(data[start:end])
+		if hit != -1:
+			return start + hit
+		end = start + RSYNC_BITS - 1
+	return -1
+
+
+class _ParallelGzipWriter(_ParallelCompressor):
+	"""
+	Writes a single gzip member compressed in blocks like `pigz`.
+
+	Every block is compressed to raw deflate data ending with a sync
+	flush, using the end of the previous block as dictionary.
+	Blocks end where the rolling hash of `pigz --rsyncable` matches,
+	so a change of the input only changes the compressed data nearby.
+	"""
+
+	blockSize = GZIP_BLOCK_SIZE
+
+	def __init__(self, fileobj, level=6, workers=None):
+		super().__init__(fileobj, level, workers)
+		self._crc = 0
+		self._size = 0
+		self._dictionary = b""
+		self._history = b""
+		# Without name and modification time to get reproducible output
+		self._fileobj.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03")
+
+	def _getBlockEnd(self):
+		end = _findLastRsyncHit(self._history + bytes(self._buffer[: self.blockSize]))
+		if end > len(self._history):
+			return end - len(self._history)
+		return self.blockSize
+
+	def _needsFinalBlock(self):
+		return True
+
+	def _prepareBlock(self, block, last):
+		self._crc = zlib.crc32(block, self._crc)
+		self._size += len(block)
+		dictionary = self._dictionary
+		self._dictionary = (self._dictionary + block)[-GZIP_DICTIONARY_SIZE:]
+		self._history = (self._history + block[-RSYNC_BITS:])[-(RSYNC_BITS - 1) :]
+		return (block, dictionary, last)
+
+	def _compressBlock(self, block, *args):
+		(dictionary, last) = args
+		kwargs = {"zdict": dictionary} if dictionary else {}
+		compressor = zlib.compressobj(self._level, zlib.DEFLATED, -zlib.MAX_WBITS, **kwargs)
+		return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+	def _writeTrailer(self):
+		self._fileobj.write(struct.pack("<II", self._crc, self._size & 0xFFFFFFFF))
+
+
+class _ParallelBzip2Writer(_ParallelCompressor):
+	"""
+	Writes a bzip2 stream for every block, compressed in parallel.
+
+	Concatenated bzip2 streams are decompressed like a single one.
+	"""
+
+	blockSize = BZIP2_BLOCK_SIZE
+
+	def __init__(self, fileobj, level=9, workers=None):
+		super().__init__(fileobj, level, workers)
+
+	def _compressBlock(self, block, *args):
+		return bz2.compress(block, self._level)
+
+
+def _readExactly(fileobj, size):
+	data = b""
+	while len(data) < size:
+		chunk = fileobj.read(size - len(data))
+		if not chunk:
+			break
+		data += chunk
+	return data
+
+
+def _cpioPadding(length):
+	return (4 - length % 4) % 4
+
+
+def _readCpioHeader(fileobj):
+	"""
+	Read the next cpio header and member name from `fileobj`.
+
+	:returns: The member or `None` at the end of the archive.
+	"""
+	header = _readExactly(fileobj, CPIO_HEADER_SIZE)
+	if not header:
+		return None
+	if len(header) < CPIO_HEADER_SIZE:
+		raise EOFError("Unexpected end of cpio archive")
+
+	magic = header[:6]
+	if magic not in (CPIO_NEWC_MAGIC, CPIO_CRC_MAGIC):
+		raise NotImplementedError(f"Unsupported cpio format {magic!r}")
+
+	(inode, mode, uid, gid, nlink, mtime, size, devmajor, devminor, _rdevmajor, _rdevminor, namesize, _check) = (
+		int(header[pos : pos + 8], 16) for pos in range(6, CPIO_HEADER_SIZE, 8)
+	)
+	name = _readExactly(fileobj, namesize)
+	if len(name) < namesize:
+		raise EOFError("Unexpected end of cpio archive")
+	_readExactly(fileobj, _cpioPadding(CPIO_HEADER_SIZE + namesize))
+
+	name = name.rstrip(b"\0").decode("utf-8", "surrogateescape")
+	if name == CPIO_TRAILER:
+		return None
+
+	return ArchiveMember(
+		name=name, mode=mode, size=size, mtime=mtime, inode=(devmajor, devminor, inode), nlink=nlink, uid=uid, gid=gid
+	)
+
+
+def _iterCpio(fileobj):
+	"""
+	Iterate over a cpio stream, yielding every member with a reader for its data.
+	"""
+	while True:
+		member = _readCpioHeader(fileobj)
+		if not member:
+			return
+
+		reader = _LimitedReader(fileobj, member.size)
+		if member.issym():
+			member.linkname = reader.read().decode("utf-8", "surrogateescape")
+		yield member, reader
+		reader.drain()
+		_readExactly(fileobj, _cpioPadding(member.size))
+
+
+def _iterTar(fileobj):
+	with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+		for tarinfo in tar:
+			if tarinfo.isdir():
+				mode = stat.S_IFDIR
+			elif tarinfo.issym():
+				mode = stat.S_IFLNK
+			elif tarinfo.isreg() or tarinfo.islnk():
+				mode = stat.S_IFREG
+			else:
+				mode = 0
+			member = ArchiveMember(
+				name=tarinfo.name,
+				mode=mode | tarinfo.mode,
+				size=tarinfo.size,
+				mtime=tarinfo.mtime,
+				linkname=tarinfo.linkname or None,
+				uid=tarinfo.uid,
+				gid=tarinfo.gid,
+				uname=tarinfo.uname or None,
+				gname=tarinfo.gname or None,
+			)
+			reader = None
+			if tarinfo.isreg():
+				reader = tar.extractfile(tarinfo)
+			yield member, reader
+
+
+def openDecompressed(fileobj):
+	"""
+	Detect the compression of `fileobj` and return a readable decompressed stream.
+
+	gzip and bzip2 are decompressed in-process, zstd with the zstd binary.
+	"""
+	head = _readExactly(fileobj, 4)
+	fileobj = _PrefixedReader(head, fileobj)
+	if head[:3] == b"\x1f\x8b\x08":
+		return gzip.GzipFile(fileobj=fileobj, mode="rb")
+	if head[:3] == b"BZh":
+		return bz2.BZ2File(fileobj, mode="rb")
+	if head[1:4] == b"\xb5\x2f\xfd":
+		try:
+			return _ExternalDecompressor([System.which("zstd"), "--decompress", "--stdout", "--quiet"], fileobj)
+		except Exception as err:  # pylint: disable=broad-except
+			raise NotImplementedError(f"Zstd not available: {err}") from err
+	return fileobj
+
+
+def openCompressed(fileobj, compression=None, workers=None):
+	"""
+	Get a writable stream compressing the written data to `fileobj`.
+
+	gzip and bzip2 are compressed in-process by a pool of threads, \
+zstd with the zstd binary using all cores.
+	The stream has to be closed, which does not close `fileobj`.
+
+	:param compression: `None`, "gzip", "bzip2" or "zstd".
+	:param workers: Number of compression threads. Defaults to the number of CPUs.
+	"""
+	if not compression:
+		return _UncompressedWriter(fileobj)
+	if compression == "gzip":
+		return _ParallelGzipWriter(fileobj, workers=workers)
+	if compression == "bzip2":
+		return _ParallelBzip2Writer(fileobj, workers=workers)
+	if compression == "zstd":
+		try:
+			return _ExternalCompressor([System.which("zstd"), "-T0", "--rsyncable", "--stdout", "--quiet"], fileobj)
+		except Exception as err:  # pylint: disable=broad-except
+			raise NotImplementedError(f"Zstd not available: {err}") from err
+	raise NotImplementedError(f"Compression '{compression}' not supported")
+
+
+def _iterMembers(stream):
+	"""
+	Detect the format of the decompressed `stream` and iterate over its members.
+	"""
+	head = _readExactly(stream, 262)
+	if head[:6] in (CPIO_NEWC_MAGIC, CPIO_CRC_MAGIC):
+		return _iterCpio(_PrefixedReader(head, stream))
+	if head[257:262] == b"ustar":
+		return _iterTar(_PrefixedReader(head, stream))
+	raise NotImplementedError(f"Unsupported archive format {head[:6]!r}")
+
+
+def _closeStream(stream, failed=False):
+	"""
+	Close a stream returned by `openDecompressed`.
+
+	If `failed` is set the stream is closed without raising, so an
+	exception in flight is not replaced by a consequential error.
+	"""
+	if not failed:
+		close = getattr(stream, "close", None)
+		if close:
+			close()
+		return
+
+	try:
+		close = getattr(stream, "abort", None) or getattr(stream, "close", None)
+		if close:
+			close()
+	except Exception as err:  # pylint: disable=broad-except
+		logger.debug("Failed to close stream: %s", err)
+
+
+def checkArchive(fileobj):
+	"""
+	Check that format and compression of the archive read from `fileobj` \
+are supported without reading more than the beginning.
+
+	:raises NotImplementedError: If the archive format is not supported.
+	"""
+	stream = openDecompressed(fileobj)
+	try:
+		_iterMembers(stream)
+	finally:
+		_closeStream(stream, failed=True)
+
+
+def listArchive(fileobj):
+	"""
+	Get the names of the members of the (possibly compressed) archive read from `fileobj`.
+	"""
+	stream = openDecompressed(fileobj)
+	try:
+		names = [member.name for (member, _reader) in _iterMembers(stream)]
+	except BaseException:
+		_closeStream(stream, failed=True)
+		raise
+	_closeStream(stream)
+	return names
+
+
+class ArchiveExtractor:
+	"""
+	Writes the members of a tar or cpio stream below `targetPath`.
+
+	Like `cpio --no-preserve-owner` the files are owned by the current
+	user, permissions and modification times are taken from the archive.
+	Owner and permissions can be set while writing instead. With
+	`preserveOwner` the owners are taken from the archive like GNU tar
+	does for root: user and group names first, numeric ids otherwise.
+
+	Like GNU tar, symbolic links are created after all other members, so
+	no member can be written through a symbolic link of the archive.
+	Members which would end up outside of `targetPath` are refused.
+
+	Paths of the created files and directories relative to `targetPath`
+	are collected in `extracted`. If `hashFiles` is set, size and md5 sum
+	of every regular file are collected in `files` while writing, along
+	with modification time and inode of the written file.
+	"""
+
+	def __init__(  # pylint: disable=too-many-arguments
+		self,
+		targetPath,
+		hashFiles=False,
+		owner=None,
+		fileMode=None,
+		directoryMode=None,
+		patterns=None,
+		progressSubject=None,
+		preserveOwner=False,
+	):
+		"""
+		:param hashFiles: Collect size and md5 sum of written files.
+		:param owner: Tuple of uid and gid for created files and directories.
+		:param preserveOwner: Set the owners stored in the archive if no `owner` is given.
+		:param fileMode: Function returning the mode of a file from its mode in the archive.
+		:param directoryMode: Mode for directories instead of their mode in the archive.
+		:param patterns: Only extract members with a name matching one \
+of these patterns. `*` matches any characters.
+		:param progressSubject: The number of bytes read from the \
+archive file is added to its state.
+		"""
+		self.targetPath = os.path.abspath(forceFilename(targetPath))
+		self.hashFiles = hashFiles
+		self.owner = owner
+		self.preserveOwner = preserveOwner
+		self.fileMode = fileMode
+		self.directoryMode = directoryMode
+		self.progressSubject = progressSubject
+		self.patterns = []
+		for pattern in patterns or []:
+			try:
+				self.patterns.append(re.compile(pattern.replace("*", ".*")))
+			except re.error as err:
+				raise ValueError(f"Bad pattern '{pattern}': {err}") from err
+		self.extracted = set()
+		self.files = {}
+		self._directories = []
+		self._pendingHardLinks = {}
+		self._symlinks = []
+		self._realTargetPath = None
+
+	def extract(self, fileobj):
+		"""
+		Extract the (possibly compressed) archive read from `fileobj`.
+
+		:raises NotImplementedError: If the archive format is not supported. \
+Nothing has been written in that case.
+		:returns: The number of extracted members.
+		"""
+		if self.progressSubject:
+			fileobj = _ProgressReader(fileobj, self.progressSubject)
+
+		stream = openDecompressed(fileobj)
+		try:
+			members = _iterMembers(stream)
+
+			if not os.path.isdir(self.targetPath):
+				os.makedirs(self.targetPath)
+			self._realTargetPath = os.path.realpath(self.targetPath)
+
+			count = 0
+			for (member, reader) in members:
+				if self.patterns and not any(pattern.search(member.name) for pattern in self.patterns):
+					continue
+				self._extractMember(member, reader)
+				count += 1
+		except NotImplementedError as err:
+			_closeStream(stream, failed=True)
+			if not self._realTargetPath:
+				raise
+			# Members have been written already, a fallback must not run over them
+			raise RuntimeError(f"Failed to extract archive to '{self.targetPath}': {err}") from err
+		except BaseException:
+			_closeStream(stream, failed=True)
+			raise
+		_closeStream(stream)
+
+		self._finish()
+		if self.progressSubject:
+			fileobj.flush()
+		return count
+
+	def _getPath(self, name):
+		parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+		if ".." in parts:
+			raise ValueError(f"Refusing to extract '{name}' outside of '{self.targetPath}'")
+		if not parts:
+			return None
+		path = os.path.join(self.targetPath, *parts)
+		self._checkPath(os.path.dirname(path), name)
+		return path
+
+	def _checkPath(self, path, name):
+		"""
+		Refuse `path` if it resolves to a location outside of `targetPath`.
+		"""
+		if not self._realTargetPath:
+			self._realTargetPath = os.path.realpath(self.targetPath)
+		realPath = os.path.realpath(path)
+		if os.path.commonpath([realPath, self._realTargetPath]) != self._realTargetPath:
+			raise ValueError(f"Refusing to extract '{name}' outside of '{self.targetPath}'")
+
+	def _extractMember(self, member, reader):
+		path = self._getPath(member.name)
+		if not path:
+			return
+
+		parent = os.path.dirname(path)
+		if not os.path.isdir(parent):
+			os.makedirs(parent)
+
+		if member.isdir():
+			self._checkPath(path, member.name)
+			if not os.path.isdir(path):
+				os.makedirs(path)
+			owner = self._getOwner(member)
+			if owner:
+				os.chown(path, *owner)
+			self._directories.append((path, member))
+			self.extracted.add(self._getRelativePath(path))
+			return
+
+		if os.path.lexists(path) and not os.path.isdir(path):
+			os.unlink(path)
+
+		if member.issym():
+			self._symlinks.append((path, member))
+			return
+
+		if member.islnk():
+			source = self._getPath(member.linkname)
+			# os.link follows a symbolic link at source
+			self._checkPath(source, member.linkname)
+			self._link(source, path)
+			return
+
+		if not member.isfile():
+			logger.warning("Skipping special file '%s' in archive", member.name)
+			return
+
+		if member.nlink > 1 and member.inode:
+			# In cpio archives the data of hard linked files is stored with the last link
+			if member.size == 0:
+				self._pendingHardLinks.setdefault(member.inode, []).append((path, member))
+				return
+			self.writeFile(path, member, reader)
+			for (linkPath, _linkMember) in self._pendingHardLinks.pop(member.inode, []):
+				self._link(path, linkPath)
+			return
+
+		self.writeFile(path, member, reader)
+
+	def _getOwner(self, member):
+		"""
+		Get uid and gid to set for `member` or `None` to keep the current user.
+		"""
+		if self.owner or not self.preserveOwner:
+			return self.owner
+
+		(uid, gid) = (member.uid, member.gid)
+		try:
+			if member.uname:
+				uid = pwd.getpwnam(member.uname).pw_uid
+		except KeyError:
+			pass
+		try:
+			if member.gname:
+				gid = grp.getgrnam(member.gname).gr_gid
+		except KeyError:
+			pass
+		return (uid, gid)
+
+	def _getRelativePath(self, path):
+		return os.path.relpath(path, self.targetPath)
+
+	def _link(self, source, path):
+		os.link(source, path)
+		relativeSource = self._getRelativePath(source)
+		relativePath = self._getRelativePath(path)
+		if relativeSource in self.files:
+			self.files[relativePath] = self.files[relativeSource]
+		if relativeSource in self.extracted:
+			self.extracted.add(relativePath)
+
+	def writeFile(self, path, member, reader):
+		"""
+		Write the data of the regular file `member` to `path`.
+		"""
+		md5 = hashlib.md5() if self.hashFiles else None
+		size = 0
+		with open(path, "wb") as file:
+			while True:
+				data = reader.read(BUFFER_SIZE)
+				if not data:
+					break
+				if md5:
+					md5.update(data)
+				size += len(data)
+				file.write(data)
+
+			owner = self._getOwner(member)
+			if owner:
+				os.fchown(file.fileno(), *owner)
+			mode = stat.S_IMODE(member.mode)
+			if self.fileMode:
+				mode = self.fileMode(mode)
+			os.fchmod(file.fileno(), mode)
+		os.utime(path, (member.mtime, member.mtime))
+
+		relativePath = self._getRelativePath(path)
+		self.extracted.add(relativePath)
+		if md5:
+			# Allows to notice later changes of the file, by package scripts for example
+			fileStat = os.lstat(path)
+			self.files[relativePath] = {
+				"size": size,
+				"md5sum": md5.hexdigest(),
+				"mtime_ns": fileStat.st_mtime_ns,
+				"inode": fileStat.st_ino,
+			}
+
+	def _finish(self):
+		for links in self._pendingHardLinks.values():
+			(path, member) = links[0]
+			self.writeFile(path, member, _LimitedReader(None, 0))
+			for (linkPath, _linkMember) in links[1:]:
+				self._link(path, linkPath)
+		self._pendingHardLinks = {}
+
+		for (path, member) in self._symlinks:
+			# A symbolic link created before may point to a directory outside
+			self._checkPath(os.path.dirname(path), member.name)
+			if os.path.isdir(path) and not os.path.islink(path):
+				raise ValueError(f"Refusing to replace directory '{member.name}' by a symbolic link")
+			if os.path.lexists(path):
+				os.unlink(path)
+			os.symlink(member.linkname, path)
+			owner = self._getOwner(member)
+			if owner:
+				os.lchown(path, *owner)
+		self._symlinks = []
+
+		# Deepest directories first, their modification time changes with every new entry
+		for (path, member) in sorted(self._directories, key=lambda entry: entry[0], reverse=True):
+			os.chmod(path, stat.S_IMODE(member.mode) if self.directoryMode is None else self.directoryMode)
+			os.utime(path, (member.mtime, member.mtime))
+		self._directories = []
+
+
+class PackageArchiveReader:
+	"""
+	Random access to the members of an uncompressed tar or cpio archive.
+
+	Only the headers are read to build the index, member data is
+	read when a member gets extracted.
+	"""
+
+	def __init__(self, filename):
+		self._filename = forceFilename(filename)
+		self._file = open(self._filename, "rb")  # pylint: disable=consider-using-with
+		try:
+			self._members = self._createIndex()
+		except Exception:
+			self._file.close()
+			raise
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def close(self):
+		self._file.close()
+
+	def _createIndex(self):
+		head = self._file.read(262)
+		self._file.seek(0)
+		if head[:6] in (CPIO_NEWC_MAGIC, CPIO_CRC_MAGIC):
+			return self._createCpioIndex()
+		if head[257:262] == b"ustar":
+			return self._createTarIndex()
+		raise NotImplementedError(f"Unsupported package archive format of '{self._filename}'")
+
+	def _createCpioIndex(self):
+		members = []
+		while True:
+			member = _readCpioHeader(self._file)
+			if not member:
+				return members
+			member.offset = self._file.tell()
+			self._file.seek(member.size + _cpioPadding(member.size), os.SEEK_CUR)
+			if member.isfile():
+				members.append(member)
+
+	def _createTarIndex(self):
+		with tarfile.open(fileobj=self._file, mode="r:") as tar:
+			return [
+				ArchiveMember(
+					name=tarinfo.name, mode=stat.S_IFREG | tarinfo.mode, size=tarinfo.size, mtime=tarinfo.mtime, offset=tarinfo.offset_data
+				)
+				for tarinfo in tar.getmembers()
+				if tarinfo.isreg()
+			]
+
+	def getMembers(self):
+		"""
+		Get the regular files of the archive in archive order.
+		"""
+		return list(self._members)
+
+	def getMember(self, name):
+		for member in self._members:
+			if member.name == name or os.path.basename(member.name) == name:
+				return member
+		raise KeyError(f"Member '{name}' not found in '{self._filename}'")
+
+	def open(self, member):
+		"""
+		Get a reader for the data of `member`.
+		"""
+		if not isinstance(member, ArchiveMember):
+			member = self.getMember(member)
+		self._file.seek(member.offset)
+		return _LimitedReader(self._file, member.size)
+
+	def extractMember(self, member, targetPath, **kwargs):
+		"""
+		Extract the archive stored as `member` to `targetPath`.
+
+		Keyword arguments are passed to the `ArchiveExtractor`.
+
+		:returns: The `ArchiveExtractor` used.
+		"""
+		extractor = ArchiveExtractor(targetPath, **kwargs)
+		extractor.extract(self.open(member))
+		return extractor
+
+	def checkMember(self, member):
+		"""
+		Check that format and compression of the archive stored as `member` are supported.
+
+		:raises NotImplementedError: If the archive format is not supported.
+		"""
+		checkArchive(self.open(member))
+
+
+class _CpioWriter:
+	"""
+	Writes a cpio archive in the newc format.
+	"""
+
+	def __init__(self, fileobj):
+		self._fileobj = fileobj
+		self._size = 0
+		self._inode = 0
+
+	def _write(self, data):
+		self._fileobj.write(data)
+		self._size += len(data)
+
+	def _writeHeader(self, name, mode=0, size=0, mtime=0, uid=0, gid=0, nlink=1):  # pylint: disable=too-many-arguments
+		name = name.encode("utf-8", "surrogateescape") + b"\0"
+		self._inode += 1
+		fields = (self._inode, mode, uid, gid, nlink, mtime, size, 0, 0, 0, 0, len(name), 0)
+		header = CPIO_NEWC_MAGIC + b"".join(b"%08X" % field for field in fields)
+		self._write(header + name + b"\0" * _cpioPadding(CPIO_HEADER_SIZE + len(name)))
+
+	def add(self, name, fileStat, reader=None, data=b""):
+		"""
+		Add a member with the metadata of `fileStat`.
+
+		The data of regular files is read from `reader`, the data of
+		other members is `data`. Every member gets its own inode, hard
+		links are therefore stored as separate files.
+		"""
+		size = fileStat.st_size if reader else len(data)
+		nlink = fileStat.st_nlink if stat.S_ISDIR(fileStat.st_mode) else 1
+		self._writeHeader(name, fileStat.st_mode, size, int(fileStat.st_mtime), fileStat.st_uid, fileStat.st_gid, nlink)
+		if reader:
+			remaining = size
+			while remaining > 0:
+				data = reader.read(min(remaining, BUFFER_SIZE))
+				if not data:
+					raise IOError(f"Unexpected end of file '{name}'")
+				self._write(data)
+				remaining -= len(data)
+		else:
+			self._write(data)
+		self._write(b"\0" * _cpioPadding(size))
+
+	def close(self):
+		self._writeHeader(CPIO_TRAILER)
+		# Like GNU cpio, pad the archive to a multiple of 512 bytes
+		self._write(b"\0" * (-self._size % 512))
+
+
+class ArchiveWriter:
+	"""
+	Writes a tar or cpio archive, compressed in-process.
+
+	Tar archives are written in GNU format, cpio archives in the newc
+	format. If a `progressSubject` is given, the number of bytes read
+	from the added files is added to its state.
+	"""
+
+	def __init__(  # pylint: disable=too-many-arguments,redefined-builtin
+		self, fileobj, format="tar", compression=None, dereference=False, progressSubject=None, workers=None
+	):
+		"""
+		:param fileobj: The file to write the archive to. It is not closed.
+		:param format: "tar" or "cpio".
+		:param compression: `None`, "gzip", "bzip2" or "zstd".
+		:param dereference: Add the targets of symlinks instead of the links.
+		:param workers: Number of compression threads. Defaults to the number of CPUs.
+		:raises NotImplementedError: If format or compression are not supported.
+		"""
+		if format not in ("tar", "cpio"):
+			raise NotImplementedError(f"Unsupported archive format '{format}'")
+
+		self._dereference = dereference
+		self._progressSubject = progressSubject
+		self._stream = openCompressed(fileobj, compression, workers)
+		self._tar = None
+		self._cpio = None
+		if format == "tar":
+			self._tar = tarfile.open(
+				fileobj=self._stream, mode="w|", format=tarfile.GNU_FORMAT, dereference=dereference, copybufsize=BUFFER_SIZE
+			)
+		else:
+			self._cpio = _CpioWriter(self._stream)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type:
+			self.abort()
+		else:
+			self.close()
+
+	def _open(self, path):
+		file = open(path, "rb")  # pylint: disable=consider-using-with
+		if self._progressSubject:
+			return file, _ProgressReader(file, self._progressSubject)
+		return file, file
+
+	def add(self, path, arcname=None):
+		"""
+		Add the file, directory or symlink `path` without its content.
+
+		:param arcname: The name in the archive, defaults to `path`.
+		"""
+		if arcname is None:
+			arcname = path
+
+		if self._tar:
+			self._addToTar(path, arcname)
+		else:
+			self._addToCpio(path, arcname)
+
+	def _addToTar(self, path, arcname):
+		tarinfo = self._tar.gettarinfo(path, arcname)
+		if tarinfo is None:
+			logger.warning("Skipping unsupported file '%s'", path)
+			return
+
+		if not tarinfo.isreg():
+			self._tar.addfile(tarinfo)
+			return
+
+		(file, reader) = self._open(path)
+		with file:
+			self._tar.addfile(tarinfo, reader)
+		if reader is not file:
+			reader.flush()
+
+	def _addToCpio(self, path, arcname):
+		fileStat = os.stat(path) if self._dereference else os.lstat(path)
+		name = arcname.replace(os.sep, "/")
+		if stat.S_ISREG(fileStat.st_mode):
+			(file, reader) = self._open(path)
+			with file:
+				self._cpio.add(name, fileStat, reader=reader)
+			if reader is not file:
+				reader.flush()
+		elif stat.S_ISLNK(fileStat.st_mode):
+			self._cpio.add(name, fileStat, data=os.readlink(path).encode("utf-8", "surrogateescape"))
+		elif stat.S_ISDIR(fileStat.st_mode):
+			self._cpio.add(name, fileStat)
+		else:
+			logger.warning("Skipping special file '%s'", path)
+
+	def close(self):
+		"""
+		Finish the archive and wait for the compression.
+		"""
+		try:
+			if self._tar:
+				self._tar.close()
+			else:
+				self._cpio.close()
+		except Exception:
+			self.abort()
+			raise
+		self._stream.close()
+
+	def abort(self):
+		"""
+		Stop compressing without finishing the archive.
+		"""
+		self._stream.abort()
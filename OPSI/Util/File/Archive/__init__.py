@@ -14,12 +14,9 @@ This include functionality for using Tar-Files and their compression.
 
 import os
 import re
+import selectors
+import stat
 import subprocess
-import time
-
-if os.name == "posix":
-	import fcntl
-
 from functools import lru_cache
 
 from opsicommon.logging import get_logger
@@ -28,10 +25,13 @@ import OPSI.Util.File.Opsi
 from OPSI import System
 from OPSI.Types import forceBool, forceFilename, forceUnicodeList, forceUnicodeLower
 from OPSI.Util import compareVersions
+from OPSI.Util.File.Archive.Stream import ArchiveExtractor, ArchiveWriter, listArchive
 from OPSI.Util.Path import cd
 
 logger = get_logger("opsi.general")
 
+PIPE_READ_SIZE = 64 * 1024
+
 
 @lru_cache()
 def is_pigz_available() -> bool:
@@ -106,43 +106,47 @@ class BaseArchive:
 	def getFilename(self):
 		return self._filename
 
+	def _communicate(self, proc):
+		"""
+		Read the output of `proc` until it exits.
+
+		The process is waited for with a selector instead of polling.
+		Every line written to stdout or stderr is counted as one
+		processed file for the progress subject.
+
+		:returns: Exit code and the output on stderr.
+		:rtype: (int, str)
+		"""
+		errors = []
+		with selectors.DefaultSelector() as selector:
+			selector.register(proc.stdout, selectors.EVENT_READ)
+			selector.register(proc.stderr, selectors.EVENT_READ)
+
+			while selector.get_map():
+				for key, _events in selector.select():
+					chunk = os.read(key.fd, PIPE_READ_SIZE)
+					if not chunk:
+						selector.unregister(key.fileobj)
+						continue
+
+					if key.fileobj is proc.stderr:
+						errors.append(chunk)
+					if self._progressSubject:
+						filesProcessed = chunk.count(b"\n")
+						if filesProcessed > 0:
+							self._progressSubject.addToState(filesProcessed)
+
+		return proc.wait(), b"".join(errors).decode(errors="replace")
+
 	def _extract(self, command, fileCount):
 		try:
 			logger.info("Executing: %s", command)
 			with subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
-
-				flags = fcntl.fcntl(proc.stdout, fcntl.F_GETFL)
-				fcntl.fcntl(proc.stdout, fcntl.F_SETFL, flags | os.O_NONBLOCK)
-				flags = fcntl.fcntl(proc.stderr, fcntl.F_GETFL)
-				fcntl.fcntl(proc.stderr, fcntl.F_SETFL, flags | os.O_NONBLOCK)
-
 				if self._progressSubject:
 					self._progressSubject.setEnd(fileCount)
 					self._progressSubject.setState(0)
 
-				error = ""
-				ret = None
-				while ret is None:
-					try:
-						chunk = proc.stdout.read()
-						if chunk:
-							filesExtracted = chunk.count("\n")
-							if filesExtracted > 0:
-								if self._progressSubject:
-									self._progressSubject.addToState(filesExtracted)
-					except Exception:  # pylint: disable=broad-except
-						pass
-					try:
-						chunk = proc.stderr.read()
-						if chunk:
-							error = chunk
-							filesExtracted = chunk.count("\n")
-							if filesExtracted > 0:
-								if self._progressSubject:
-									self._progressSubject.addToState(filesExtracted)
-					except Exception:  # pylint: disable=broad-except
-						time.sleep(0.001)
-					ret = proc.poll()
+				ret, error = self._communicate(proc)
 
 			logger.info("Exit code: %s", ret)
 
@@ -156,85 +160,79 @@ class BaseArchive:
 			logger.error(err, exc_info=True)
 			raise
 
-	def _create(self, fileList, baseDir, command):
+	def _content(self):
+		"""
+		Get the names of the members in-process.
+
+		:raises NotImplementedError: If the format is not supported in-process.
+		"""
+		with open(self._filename, "rb") as file:
+			return listArchive(file)
+
+	def _extractInProcess(self, targetPath, patterns, preserveOwner=False):
+		"""
+		Extract the archive with an `ArchiveExtractor`.
+
+		The progress is the number of bytes read from the archive file.
+
+		:param preserveOwner: Set the owners stored in the archive.
+
+		:raises NotImplementedError: If the format is not supported \
+in-process. Nothing has been extracted in that case.
+		"""
+		with open(self._filename, "rb") as file:
+			fileSize = os.fstat(file.fileno()).st_size
+			if self._progressSubject:
+				self._progressSubject.setEnd(fileSize)
+				self._progressSubject.setState(0)
+			ArchiveExtractor(
+				targetPath, patterns=patterns, progressSubject=self._progressSubject, preserveOwner=preserveOwner
+			).extract(file)
+
+		if self._progressSubject:
+			self._progressSubject.setState(fileSize)
+
+	def _create(self, fileList, baseDir, format, dereference):  # pylint: disable=redefined-builtin
+		"""
+		Create the archive with an `ArchiveWriter`.
+
+		The progress is the number of bytes of the added files.
+		"""
 		baseDir = os.path.abspath(forceFilename(baseDir))
 		if not os.path.isdir(baseDir):
 			raise IOError("Base dir '%s' not found" % baseDir)
 
 		with cd(baseDir):
-			logger.info("Executing: %s", command)
-			with subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+			filenames = []
+			totalSize = 0
+			for filename in fileList:
+				if not filename:
+					continue
+				if not os.path.exists(filename):
+					raise IOError(f"File '{filename}' not found")
+				if filename.startswith(baseDir):
+					filename = filename[len(baseDir) :]
+					while filename.startswith("/"):
+						filename = filename[1:]
+				fileStat = os.stat(filename) if dereference else os.lstat(filename)
+				if stat.S_ISREG(fileStat.st_mode):
+					totalSize += fileStat.st_size
+				filenames.append(filename)
 
-				flags = fcntl.fcntl(proc.stdout, fcntl.F_GETFL)
-				fcntl.fcntl(proc.stdout, fcntl.F_SETFL, flags | os.O_NONBLOCK)
-				flags = fcntl.fcntl(proc.stderr, fcntl.F_GETFL)
-				fcntl.fcntl(proc.stderr, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+			if self._progressSubject:
+				self._progressSubject.setEnd(totalSize)
+				self._progressSubject.setState(0)
 
-				if self._progressSubject:
-					self._progressSubject.setEnd(len(fileList))
-					self._progressSubject.setState(0)
+			with open(self._filename, "wb") as file:
+				with ArchiveWriter(
+					file, format=format, compression=self._compression, dereference=dereference, progressSubject=self._progressSubject
+				) as writer:
+					for filename in filenames:
+						logger.info("Adding file '%s'", filename)
+						writer.add(filename)
 
-				error = ""
-				ret = None
-				for filename in fileList:
-					if not filename:
-						continue
-					if not os.path.exists(filename):
-						raise IOError(f"File '{filename}' not found")
-					if filename.startswith(baseDir):
-						filename = filename[len(baseDir) :]
-						while filename.startswith("/"):
-							filename = filename[1:]
-					logger.info("Adding file '%s'", filename)
-					proc.stdin.write(("%s\n" % filename).encode())
-
-					try:
-						chunk = proc.stdout.read()
-						if chunk:
-							filesAdded = chunk.count("\n")
-							if filesAdded > 0:
-								if self._progressSubject:
-									self._progressSubject.addToState(filesAdded)
-					except Exception:  # pylint: disable=broad-except
-						pass
-
-					try:
-						chunk = proc.stderr.read()
-						if chunk:
-							error += chunk
-							filesAdded = chunk.count("\n")
-							if filesAdded > 0:
-								if self._progressSubject:
-									self._progressSubject.addToState(filesAdded)
-					except Exception:  # pylint: disable=broad-except
-						time.sleep(0.001)
-
-				proc.stdin.close()
-
-				while ret is None:
-					ret = proc.poll()
-					try:
-						chunk = proc.stdout.read()
-					except Exception:  # pylint: disable=broad-except
-						pass
-
-					try:
-						chunk = proc.stderr.read()
-						if chunk:
-							if self._progressSubject:
-								self._progressSubject.addToState(chunk.count("\n"))
-							error += chunk
-					except Exception:  # pylint: disable=broad-except
-						pass
-
-				logger.info("Exit code: %s", ret)
-
-				if ret != 0:
-					error = error.decode()
-					logger.error(error)
-					raise RuntimeError("Command '%s' failed with code %s: %s" % (command, ret, error))
-				if self._progressSubject:
-					self._progressSubject.setState(len(fileList))
+			if self._progressSubject:
+				self._progressSubject.setState(totalSize)
 
 
 class TarArchive(BaseArchive):
@@ -245,6 +243,11 @@ class TarArchive(BaseArchive):
 		try:
 			if not os.path.exists(self._filename):
 				raise IOError("Archive file not found: '%s'" % self._filename)
+			try:
+				return self._content()
+			except NotImplementedError as err:
+				logger.debug("Listing '%s' in-process not possible: %s", self._filename, err)
+
 			names = []
 			options = ""
 			if self._compression == "gzip":
@@ -277,6 +280,13 @@ class TarArchive(BaseArchive):
 				except Exception as err:  # pylint: disable=broad-except
 					raise IOError(f"Failed to create target dir '{targetPath}': {err}") from err
 
+			try:
+				# GNU tar keeps the owners of the archive when run as root
+				self._extractInProcess(targetPath, patterns, preserveOwner=os.name == "posix" and os.geteuid() == 0)
+				return
+			except NotImplementedError as err:
+				logger.info("Extracting '%s' in-process not possible: %s", self._filename, err)
+
 			options = ""
 			if self._compression == "gzip":
 				if is_pigz_available():
@@ -325,23 +335,7 @@ class TarArchive(BaseArchive):
 			if not os.path.isdir(baseDir):
 				raise IOError("Base dir '%s' not found" % baseDir)
 
-			command = "%s --no-recursion --verbose --create --files-from -" % System.which("tar")
-			if dereference:
-				command += " --dereference"
-			if self._compression == "gzip":
-				if is_pigz_available():
-					command += " | %s --rsyncable" % System.which("pigz")
-				else:
-					command += " | %s --rsyncable" % System.which("gzip")
-			elif self._compression == "bzip2":
-				command += " | %s" % System.which("bzip2")
-			elif self._compression == "zstd":
-				if not is_zstd_available():
-					raise RuntimeError("Zstd not available")
-				command += " | %s --rsyncable" % System.which("zstd")
-			command += ' > "%s"' % self._filename
-
-			self._create(fileList, baseDir, command)
+			self._create(fileList, baseDir, "tar", dereference)
 		except Exception as err:  # pylint: disable=broad-except
 			raise RuntimeError(f"Failed to create archive '{self._filename}': {err}") from err
 
@@ -354,6 +348,10 @@ class CpioArchive(BaseArchive):
 		try:
 			if not os.path.exists(self._filename):
 				raise IOError("Archive file not found: '%s'" % self._filename)
+			try:
+				return self._content()
+			except NotImplementedError as err:
+				logger.debug("Listing '%s' in-process not possible: %s", self._filename, err)
 
 			cat = System.which("cat")
 			if self._compression == "gzip":
@@ -389,6 +387,12 @@ class CpioArchive(BaseArchive):
 				except Exception as err:  # pylint: disable=broad-except
 					raise IOError(f"Failed to create target dir '{targetPath}': {err}") from err
 
+			try:
+				self._extractInProcess(targetPath, patterns)
+				return
+			except NotImplementedError as err:
+				logger.info("Extracting '%s' in-process not possible: %s", self._filename, err)
+
 			cat = System.which("cat")
 			if self._compression == "gzip":
 				if is_pigz_available():
@@ -440,21 +444,7 @@ class CpioArchive(BaseArchive):
 			if not os.path.isdir(baseDir):
 				raise IOError(f"Base dir '{baseDir}' not found")
 
-			command = "%s --create --quiet --verbose --format crc" % System.which("cpio")
-			if dereference:
-				command += " --dereference"
-			if self._compression == "gzip":
-				if is_pigz_available():
-					command += " | %s --rsyncable" % System.which("pigz")
-				else:
-					command += " | %s --rsyncable" % System.which("gzip")
-			elif self._compression == "bzip2":
-				command += " | %s" % System.which("bzip2")
-			elif self._compression == "zstd":
-				command += " | %s" % System.which("zstd")
-			command += ' > "%s"' % self._filename
-
-			self._create(fileList, baseDir, command)
+			self._create(fileList, baseDir, "cpio", dereference)
 		except Exception as err:  # pylint: disable=broad-except
 			raise RuntimeError(f"Failed to create archive '{self._filename}': {err}") from err
 
@@ -16,6 +16,7 @@ import os
 import re
 import shutil
 import socket
+import stat
 import subprocess
 import tarfile
 import tempfile
@@ -67,7 +68,8 @@ from OPSI.Types import (
 	forceUnicodeLower,
 	forceUniqueList,
 )
-from OPSI.Util import fromJson, md5sum, toJson
+from OPSI.Util import fromJson, toJson
+from OPSI.Util.Checksum import md5sums
 from OPSI.Util.File import ConfigFile, IniFile, TextFile, requiresParsing
 from opsicommon.logging import get_logger
 
@@ -354,10 +356,39 @@ class PackageContentFile(TextFile):
 		self._clientDataFiles = []
 		self._productServerDataDir = "/"
 		self._serverDataFiles = []
+		self._clientDataFileInfo = {}
 
 	def getClientDataFiles(self):
 		return self._clientDataFiles
 
+	def setClientDataFileInfo(self, clientDataFileInfo):
+		"""
+		Set the already known size and md5 sum of client data files.
+
+		:param clientDataFileInfo: Mapping of the relative filename to a \
+dict with the keys `size`, `md5sum`, `mtime_ns` and `inode`. These files \
+are not read again as long as they are unchanged, changed files are hashed.
+		:type clientDataFileInfo: dict
+		"""
+		self._clientDataFileInfo = dict(clientDataFileInfo)
+
+	@staticmethod
+	def _isUnchanged(path, fileInfo):
+		"""
+		Check if the regular file at `path` still matches `fileInfo`.
+		"""
+		try:
+			fileStat = os.lstat(path)
+		except OSError:
+			return False
+
+		return (
+			stat.S_ISREG(fileStat.st_mode)
+			and fileStat.st_size == fileInfo["size"]
+			and fileStat.st_mtime_ns == fileInfo.get("mtime_ns")
+			and fileStat.st_ino == fileInfo.get("inode")
+		)
+
 	def setClientDataFiles(self, clientDataFiles):
 		self._clientDataFiles = forceUnicodeList(clientDataFiles)
 
@@ -419,27 +450,38 @@ class PackageContentFile(TextFile):
 			"Prefixes single quotes in string with a single backslash."
 			return string.replace("'", "\\'")
 
-		def handleDirectory(path):
-			logger.trace("Processing '%s' as directory", path)
-			return "d", 0, ""
-
-		def handleFile(path):
-			logger.trace("Processing '%s' as file", path)
-			return "f", os.path.getsize(path), md5sum(path)
-
-		self._lines = []
+		entries = {}
+		filesToHash = {}
 		for filename in self._clientDataFiles:
 			try:
 				path = os.path.join(self._productClientDataDir, filename)
-				if os.path.isdir(path):
-					entryType, size, additional = handleDirectory(path)
+				fileInfo = self._clientDataFileInfo.get(filename)
+				if fileInfo and self._isUnchanged(path, fileInfo):
+					entries[filename] = ("f", fileInfo["size"], fileInfo["md5sum"])
+				elif os.path.isdir(path):
+					logger.trace("Processing '%s' as directory", path)
+					entries[filename] = ("d", 0, "")
 				else:
-					entryType, size, additional = handleFile(path)
+					logger.trace("Processing '%s' as file", path)
+					filesToHash[path] = filename
+			except Exception as err:  # pylint: disable=broad-except
+				logger.error(err, exc_info=True)
 
-				self._lines.append(f"{entryType} '{maskQuoteChars(filename)}' {size} {additional}")
+		for path, checksum in md5sums(filesToHash, ignoreErrors=True):
+			if checksum is None:
+				continue
+			try:
+				entries[filesToHash[path]] = ("f", os.path.getsize(path), checksum)
 			except Exception as err:  # pylint: disable=broad-except
 				logger.error(err, exc_info=True)
 
+		self._lines = []
+		for filename in self._clientDataFiles:
+			if filename not in entries:
+				continue
+			entryType, size, additional = entries[filename]
+			self._lines.append(f"{entryType} '{maskQuoteChars(filename)}' {size} {additional}")
+
 		self.open("w")
 		self.writelines()
 		self.close()
@@ -1233,7 +1275,7 @@ class OpsiConfFile(IniFile):
 			match = self.sectionRegex.search(line)
 			if match:
 				sectionType = match.group(1).strip().lower()
-				if sectionType not in ("groups", "packages", "ldap_auth"):
+				if sectionType not in ("groups", "packages", "ldap_auth", "service"):
 					raise ValueError(f"Parse error in line {lineNum}: unknown section '{sectionType}'")
 			elif not sectionType and line:
 				raise ValueError(f"Parse error in line {lineNum}: not in a section")
@@ -1272,6 +1314,13 @@ class OpsiConfFile(IniFile):
 				if key in ("ldap_url", "bind_user", "group_filter") and value:
 					self._opsiConfig["ldap_auth"][key] = value
 
+			elif sectionType == "service":
+				if "service" not in self._opsiConfig:
+					self._opsiConfig["service"] = {}
+
+				if key == "response_cache":
+					self._opsiConfig["service"][key] = forceBool(value)
+
 		self._parsed = True
 		return self._opsiConfig
 
@@ -1305,6 +1354,16 @@ class OpsiConfFile(IniFile):
 			return self._opsiConfig["packages"]["use_pigz"]
 		return True
 
+	@requiresParsing
+	def isResponseCacheEnabled(self):
+		"""
+		Check if responses of idempotent rpcs may be cached by the service.
+
+		:return: True if the response cache is enabled, False otherwise.
+		:rtype: bool
+		"""
+		return self._opsiConfig.get("service", {}).get("response_cache", False)
+
 	@requiresParsing
 	def get_ldap_auth_config(self) -> dict:
 		conf = self._opsiConfig.get("ldap_auth", {})
@@ -12,12 +12,18 @@ parsing files for information.
 
 import builtins
 import codecs
+import datetime
 import functools
+import hashlib
 import locale
+import math
+import mmap
 import os
 import re
 import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from configparser import (  # pylint: disable=deprecated-class
 	RawConfigParser,
 	SafeConfigParser,
@@ -26,7 +32,7 @@ from io import StringIO
 from itertools import islice
 from pathlib import Path
 
-from pyzsync import create_zsync_file
+from pyzsync import BlockInfo, ZsyncFileInfo, calc_block_size, md4, rsum
 
 from opsicommon.logging import get_logger
 
@@ -53,7 +59,7 @@ from OPSI.Types import (
 	forceUnicodeLower,
 	forceUnicodeLowerList,
 )
-from OPSI.Util import ipAddressInNetwork
+from OPSI.Util import getWorkerCount, ipAddressInNetwork
 
 if os.name == "posix":
 	import fcntl
@@ -1381,7 +1387,115 @@ class TxtSetupOemFile(ConfigFile):  # pylint: disable=too-many-instance-attribut
 		self.close()
 
 
+class ZsyncBlockHasher:
+	"""
+	Calculates the zsync checksums of data while it is streamed.
+
+	The length of the data has to be known in advance as it determines
+	the block size. The resulting info can be written with
+	`ZsyncFile.generate`, the data does not have to be read again.
+	"""
+
+	ZSYNC_VERSION = "0.6.2"
+
+	def __init__(self, length, filename):
+		"""
+		:param length: The size of the data in bytes.
+		:param filename: The name of the file in the zsync file.
+		"""
+		self.length = length
+		self.filename = filename
+		self.blockSize = calc_block_size(length)
+		self._position = 0
+		self._buffer = b""
+		self._sha1 = hashlib.sha1()
+		self._rsums = []
+		self._checksums = []
+		self._info = None
+
+	def update(self, data):
+		self._sha1.update(data)
+		self._position += len(data)
+		if self._buffer:
+			data = self._buffer + data
+		end = len(data) - len(data) % self.blockSize
+		for offset in range(0, end, self.blockSize):
+			self._addBlock(data[offset : offset + self.blockSize])
+		self._buffer = bytes(data[end:])
+
+	def _addBlock(self, block):
+		# Full length checksums, shortened to the hash lengths at the end
+		self._rsums.append(rsum(block, 4))
+		self._checksums.append(md4(block, 16))
+
+	def getHashLengths(self):
+		"""
+		Get the number of sequential matches and the lengths of rsum \
+and checksum like zsync does.
+
+		:rtype: (int, int, int)
+		"""
+		length = max(self.length, 1)
+		seqMatches = 2 if self.length > self.blockSize else 1
+		rsumBytes = math.ceil(((math.log2(length) + math.log2(self.blockSize)) - 8.6) / seqMatches / 8)
+		rsumBytes = min(max(rsumBytes, 2), 4)
+		blocks = math.log2(1 + self.length // self.blockSize)
+		checksumBytes = math.ceil((20 + (math.log2(length) + blocks)) / seqMatches / 8)
+		checksumBytes = min(max(checksumBytes, int((7.9 + (20 + blocks)) / 8)), 16)
+		return (seqMatches, rsumBytes, checksumBytes)
+
+	def getInfo(self, mtime=None):
+		"""
+		Get the zsync info after all data was passed to `update`.
+
+		:param mtime: Modification time of the file, defaults to now.
+		:type mtime: datetime.datetime
+		:rtype: pyzsync.ZsyncFileInfo
+		"""
+		if self._info:
+			return self._info
+		if self._position != self.length:
+			raise ValueError(f"Expected {self.length} bytes but got {self._position}")
+
+		if self._buffer:
+			self._addBlock(self._buffer.ljust(self.blockSize, b"\0"))
+			self._buffer = b""
+
+		(seqMatches, rsumBytes, checksumBytes) = self.getHashLengths()
+		rsumMask = (1 << (8 * rsumBytes)) - 1
+		blockInfo = [
+			BlockInfo(
+				block_id=index,
+				offset=index * self.blockSize,
+				size=min(self.blockSize, self.length - index * self.blockSize),
+				rsum=blockRsum & rsumMask,
+				checksum=checksum[:checksumBytes].ljust(16, b"\0"),
+			)
+			for index, (blockRsum, checksum) in enumerate(zip(self._rsums, self._checksums))
+		]
+		self._info = ZsyncFileInfo(
+			zsync=self.ZSYNC_VERSION,
+			producer="",
+			filename=self.filename,
+			url=self.filename,
+			sha1=self._sha1.digest(),
+			# Legacy zsync files have no SHA-256
+			sha256=bytes(32),
+			mtime=mtime or datetime.datetime.now(tz=datetime.timezone.utc),
+			length=self.length,
+			block_size=self.blockSize,
+			seq_matches=seqMatches,
+			rsum_bytes=rsumBytes,
+			checksum_bytes=checksumBytes,
+			block_info=blockInfo,
+		)
+		return self._info
+
+
 class ZsyncFile(LockableFile):
+	# Blocks hashed by a worker at once
+	HASH_CHUNK_BLOCKS = 1024
+
 	def __init__(self, filename, lockFailTimeout=2000):
 		LockableFile.__init__(self, filename, lockFailTimeout)
 		self._header = {}
@@ -1404,19 +1518,142 @@ class ZsyncFile(LockableFile):
 
 		self._parsed = True
 
-	def generate(self, dataFile=None):
-		if dataFile:
-			create_zsync_file(Path(dataFile), Path(self._filename))
-			self.parse()
-
+	@staticmethod
+	def _hashBlocks(data, start, end, blockSize, rsumBytes, checksumBytes):  # pylint: disable=too-many-arguments
+		"""
+		Get the block checksums of `data[start:end]` as stored in a zsync file.
+
+		The last block is padded with zeros like zsync does.
+		"""
+		rsumMask = (1 << (8 * rsumBytes)) - 1
+		checksums = bytearray()
+		for offset in range(start, end, blockSize):
+			block = data[offset : min(offset + blockSize, end)]
+			if len(block) < blockSize:
+				block = block.ljust(blockSize, b"\0")
+			checksums += (rsum(block, 4) & rsumMask).to_bytes(rsumBytes, "big")
+			checksums += md4(block, 16)[:checksumBytes]
+		return bytes(checksums)
+
+	def _write(self, header, writeData):
+		"""
+		Write `header`, without mtime, and the data written by `writeData`.
+
+		:returns: The offsets of the header values in the file.
+		"""
+		offsets = {}
 		with open(self._filename, "wb") as file:
-			for key, value in self._header.items():
+			for key, value in header.items():
 				if key.lower() == "mtime":
 					continue
-				headerData = f"{key}: {value}\n"
-				file.write(headerData.encode())
+				headerData = f"{key}: ".encode()
+				offsets[key] = file.tell() + len(headerData)
+				file.write(headerData + f"{value}\n".encode())
 			file.write("\n".encode())
-			file.write(self._data)
+			writeData(file)
+		return offsets
+
+	def _generateFromFile(self, dataFile, workers=None):
+		"""
+		Create the zsync file for `dataFile` reading it only once.
+
+		The file is mapped into memory and the block checksums of chunks \
+of `HASH_CHUNK_BLOCKS` blocks are calculated by `workers` threads \
+while the SHA-1 is calculated. Only a few chunks of checksums are \
+held in memory.
+		"""
+		dataFile = Path(dataFile)
+		length = dataFile.stat().st_size
+		hasher = ZsyncBlockHasher(length, dataFile.name)
+		(seqMatches, rsumBytes, checksumBytes) = hasher.getHashLengths()
+		blockSize = hasher.blockSize
+		workers = getWorkerCount(workers)
+		sha1 = hashlib.sha1()
+
+		header = {
+			"zsync": ZsyncBlockHasher.ZSYNC_VERSION,
+			"Filename": dataFile.name,
+			"Blocksize": str(blockSize),
+			"Length": str(length),
+			"Hash-Lengths": f"{seqMatches},{rsumBytes},{checksumBytes}",
+			"URL": dataFile.name,
+			# Replaced after all data was hashed
+			"SHA-1": "0" * 40,
+		}
+
+		def writeChecksums(file):
+			if not length:
+				return
+
+			chunkSize = blockSize * self.HASH_CHUNK_BLOCKS
+			with open(dataFile, "rb") as data, mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+				if hasattr(mapped, "madvise"):
+					mapped.madvise(mmap.MADV_SEQUENTIAL)
+				pending = deque()
+				with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="zsync") as executor:
+					try:
+						for start in range(0, length, chunkSize):
+							end = min(start + chunkSize, length)
+							pending.append(executor.submit(self._hashBlocks, mapped, start, end, blockSize, rsumBytes, checksumBytes))
+							sha1.update(mapped[start:end])
+							while len(pending) > workers * 2:
+								file.write(pending.popleft().result())
+						while pending:
+							file.write(pending.popleft().result())
+					finally:
+						for future in pending:
+							future.cancel()
+
+		offsets = self._write(header, writeChecksums)
+		header["SHA-1"] = sha1.hexdigest()
+		with open(self._filename, "r+b") as file:
+			file.seek(offsets["SHA-1"])
+			file.write(header["SHA-1"].encode())
+
+		self._header = header
+		self._data = ""
+		self._parsed = False
+
+	def generate(self, dataFile=None, zsyncInfo=None, workers=None):
+		"""
+		Write the zsync file.
+
+		:param dataFile: Create the zsync file for this file.
+		:param zsyncInfo: Write this `pyzsync.ZsyncFileInfo`, for \
+example from a `ZsyncBlockHasher`, instead of reading `dataFile`.
+		:param workers: Number of threads calculating the block \
+checksums of `dataFile`. Defaults to the number of CPUs.
+		"""
+		if zsyncInfo:
+			header = {
+				"zsync": zsyncInfo.zsync,
+				"Filename": zsyncInfo.filename,
+				"Blocksize": str(zsyncInfo.block_size),
+				"Length": str(zsyncInfo.length),
+				"Hash-Lengths": f"{zsyncInfo.seq_matches},{zsyncInfo.rsum_bytes},{zsyncInfo.checksum_bytes}",
+				"URL": zsyncInfo.url,
+				"SHA-1": zsyncInfo.sha1.hex(),
+			}
+
+			def writeChecksums(file):
+				for blockInfo in zsyncInfo.block_info:
+					file.write(
+						blockInfo.rsum.to_bytes(zsyncInfo.rsum_bytes, "big") + bytes(blockInfo.checksum[: zsyncInfo.checksum_bytes])
+					)
+
+			self._write(header, writeChecksums)
+			self._header = header
+			self._data = ""
+			self._parsed = False
+			return
+
+		if dataFile:
+			self._generateFromFile(dataFile, workers=workers)
+			return
+
+		if not self._parsed:
+			self.parse()
+		self._write(self._header, lambda file: file.write(self._data))
 
 
 class DHCPDConf_Component:  # pylint: disable=invalid-name
@@ -218,6 +218,8 @@ class ChoiceSubject(MessageSubject):
 
 class ProgressSubject(MessageSubject):
 	def __init__(self, id, type='', title='', **args):  # pylint: disable=redefined-builtin,unused-argument
+		# Concurrent transfers may add to the state of the same subject.
+		self._stateLock = threading.RLock()
 		MessageSubject.__init__(self, id, type, title, **args)
 		self.reset()
 		self._fireAlways = True
@@ -299,6 +301,10 @@ class ProgressSubject(MessageSubject):
 		self._notifyEndChanged()
 
 	def setState(self, state):
+		with self._stateLock:
+			self._setState(state)
+
+	def _setState(self, state):
 		state = forceInt(state)
 		if state <= 0:
 			state = 0
@@ -329,7 +335,8 @@ class ProgressSubject(MessageSubject):
 			self._notifyProgressChanged()
 
 	def addToState(self, amount):
-		self.setState(self._state + forceInt(amount))
+		with self._stateLock:
+			self._setState(self._state + forceInt(amount))
 
 	def getEnd(self):
 		return self._end
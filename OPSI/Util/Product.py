@@ -18,6 +18,7 @@ from OPSI.System import execute
 from OPSI.Types import forceBool, forceFilename, forcePackageCustomName, forceUnicode
 from OPSI.Util import findFilesGenerator, randomString, removeDirectory
 from OPSI.Util.File.Archive import Archive
+from OPSI.Util.File.Archive.Stream import PackageArchiveReader
 from OPSI.Util.File.Opsi import PackageContentFile, PackageControlFile
 
 if os.name == "posix":
@@ -28,6 +29,7 @@ DEFAULT_TMP_DIR = "/tmp"
 EXCLUDE_DIRS_ON_PACK_REGEX = re.compile(r"(^\.svn$)|(^\.git$)")
 EXCLUDE_FILES_ON_PACK_REGEX = re.compile(r"(~$)|(^[Tt]humbs\.db$)|(^\.[Dd][Ss]_[Ss]tore$)")
 PACKAGE_SCRIPT_TIMEOUT = 600
+INNER_ARCHIVE_EXTENSIONS = (".cpio.gz", ".tar.gz", ".cpio", ".tar")
 
 logger = get_logger("opsi.general")
 
@@ -52,6 +54,9 @@ class ProductPackageFile:
 		self.tmpUnpackDir = os.path.join(self.tempDir, f".opsi.unpack.{randomString(5)}")
 		self.packageControlFile = None
 		self.clientDataFiles = []
+		# Collected while extracting the client data in-process
+		self._clientDataFileInfo = {}
+		self._clientDataWithAccessRights = set()
 
 	def cleanup(self):
 		logger.info("Cleaning up")
@@ -126,34 +131,35 @@ class ProductPackageFile:
 			if newProductId:
 				newProductId = forceUnicode(newProductId)
 
-			archive = Archive(filename=self.packageFile, progressSubject=progressSubject)
-
 			logger.debug("Extracting source from package '%s' to: '%s'", self.packageFile, destinationDir)
-
-			if progressSubject:
-				progressSubject.setMessage(_("Extracting archives"))
-			archive.extract(targetPath=self.tmpUnpackDir)
-
-			for file in os.listdir(self.tmpUnpackDir):
-				logger.info("Processing file '%s'", file)
-				archiveName = ""
-				if file.endswith(".cpio.gz"):
-					archiveName = file[:-8]
-				elif file.endswith(".cpio"):
-					archiveName = file[:-5]
-				elif file.endswith(".tar.gz"):
-					archiveName = file[:-7]
-				elif file.endswith(".tar"):
-					archiveName = file[:-4]
-				elif file.startswith("OPSI"):
-					continue
-				else:
-					logger.warning("Unknown content in archive: %s", file)
-					continue
-				archive = Archive(filename=os.path.join(self.tmpUnpackDir, file), progressSubject=progressSubject)
+			try:
+				with PackageArchiveReader(self.packageFile) as packageArchive:
+					innerArchives = []
+					for member in packageArchive.getMembers():
+						archiveName = self._getInnerArchiveName(os.path.basename(member.name))
+						if archiveName is not None:
+							packageArchive.checkMember(member)
+							innerArchives.append((member, archiveName))
+
+					for (member, archiveName) in innerArchives:
+						if progressSubject:
+							progressSubject.setMessage(_("Extracting archive %s") % archiveName)
+						packageArchive.extractMember(member, os.path.join(destinationDir, archiveName))
+			except NotImplementedError as err:
+				logger.info("Extracting package in-process not possible: %s", err)
+				archive = Archive(filename=self.packageFile, progressSubject=progressSubject)
 				if progressSubject:
-					progressSubject.setMessage(_("Extracting archive %s") % archiveName)
-				archive.extract(targetPath=os.path.join(destinationDir, archiveName))
+					progressSubject.setMessage(_("Extracting archives"))
+				archive.extract(targetPath=self.tmpUnpackDir)
+
+				for file in os.listdir(self.tmpUnpackDir):
+					archiveName = self._getInnerArchiveName(file)
+					if archiveName is None:
+						continue
+					archive = Archive(filename=os.path.join(self.tmpUnpackDir, file), progressSubject=progressSubject)
+					if progressSubject:
+						progressSubject.setMessage(_("Extracting archive %s") % archiveName)
+					archive.extract(targetPath=os.path.join(destinationDir, archiveName))
 
 			if newProductId:
 				self.getMetaData()
@@ -182,7 +188,124 @@ class ProductPackageFile:
 			self.cleanup()
 			raise RuntimeError(f"Failed to extract package source from '{self.packageFile}': {err}") from err
 
-	def getMetaData(self, output_dir=None):  # pylint: disable=inconsistent-return-statements,too-many-branches
+	@staticmethod
+	def _getInnerArchiveName(file):
+		"""
+		Get the name of the directory an inner archive of the package is unpacked to.
+
+		:returns: The name or `None` if `file` is not an archive.
+		"""
+		logger.info("Processing file '%s'", file)
+		for extension in INNER_ARCHIVE_EXTENSIONS:
+			if file.endswith(extension):
+				return file[: -len(extension)]
+		if not file.startswith("OPSI"):
+			logger.warning("Unknown content in archive: %s", file)
+		return None
+
+	@staticmethod
+	def _sortInnerArchives(archives):
+		# Sorting to unpack custom version data at last
+		def psort(name):
+			return re.sub(r"(\.tar|\.tar\.gz|\.cpio|\.cpio\.gz)$", "", name)
+
+		return sorted(archives, key=psort)
+
+	def _getInnerArchives(self, names):
+		"""
+		Group the inner archives of the package by their kind.
+
+		:returns: Dict of OPSI, CLIENT_DATA and SERVER_DATA archive names.
+		"""
+		archives = {"OPSI": [], "CLIENT_DATA": [], "SERVER_DATA": []}
+		for name in names:
+			if not name.endswith(INNER_ARCHIVE_EXTENSIONS):
+				logger.warning("Unknown content in archive: %s", name)
+				continue
+
+			for (kind, kindArchives) in archives.items():
+				if name.startswith(kind):
+					logger.debug("%s archive found: %s", kind, name)
+					kindArchives.append(name)
+					break
+			else:
+				logger.warning("Unknown content in archive: %s", name)
+
+		return {kind: self._sortInnerArchives(kindArchives) for (kind, kindArchives) in archives.items()}
+
+	def _extractInnerArchives(self, kind, targetPaths, **kwargs):
+		"""
+		Extract the inner archives of `kind` straight from the package file.
+
+		Keyword arguments are passed to the `ArchiveExtractor`.
+
+		:param targetPaths: Function returning the target path for an archive name.
+		:raises NotImplementedError: If the package can not be extracted in-process.
+		:returns: The `ArchiveExtractor` used for each archive, in extraction order.
+		"""
+		extractors = []
+		with PackageArchiveReader(self.packageFile) as packageArchive:
+			members = {os.path.basename(member.name): member for member in packageArchive.getMembers()}
+			archives = self._getInnerArchives(name for name in members if name.startswith(kind))[kind]
+			self._checkInnerArchives(kind, archives)
+			self._checkInnerArchivesSupported(packageArchive, (kind,))
+			for archive in archives:
+				targetPath = targetPaths(archive)
+				logger.info("Extracting archive '%s' from package '%s' to '%s'", archive, self.packageFile, targetPath)
+				extractors.append(packageArchive.extractMember(members[archive], targetPath, **kwargs))
+		return extractors
+
+	@staticmethod
+	def _checkInnerArchivesSupported(packageArchive, kinds):
+		"""
+		Check format and compression of all inner archives of `kinds` \
+before anything is written, so no fallback runs over partly extracted data.
+
+		:raises NotImplementedError: If an archive can not be extracted in-process.
+		"""
+		for member in packageArchive.getMembers():
+			name = os.path.basename(member.name)
+			if name.startswith(tuple(kinds)) and name.endswith(INNER_ARCHIVE_EXTENSIONS):
+				packageArchive.checkMember(member)
+
+	@staticmethod
+	def _getClientDataAccessRights():
+		"""
+		Get owner and modes for client data files as set by `setAccessRights`.
+
+		:returns: Keyword arguments for an `ArchiveExtractor`.
+		"""
+		if os.name != "posix":
+			return {}
+
+		try:
+			uid = -1
+			if os.geteuid() == 0:
+				uid = pwd.getpwnam(DEFAULT_CLIENT_DATA_USER)[2]
+			gid = grp.getgrnam(DEFAULT_CLIENT_DATA_GROUP)[2]
+		except KeyError as err:
+			logger.debug("Not setting access rights while extracting: %s", err)
+			return {}
+
+		return {"owner": (uid, gid), "fileMode": lambda mode: (mode | 0o660) & 0o770, "directoryMode": 0o2770}
+
+	@staticmethod
+	def _checkInnerArchives(kind, archives):
+		if kind == "OPSI":
+			if not archives:
+				raise ValueError("No metadata archive found")
+			if len(archives) > 2:
+				raise ValueError("More than two metadata archives found")
+		elif kind == "CLIENT_DATA":
+			if not archives:
+				logger.warning("No client-data archive found")
+			if len(archives) > 2:
+				raise ValueError("More than two client-data archives found")
+		elif kind == "SERVER_DATA":
+			if len(archives) > 2:
+				raise ValueError("More than two server-data archives found")
+
+	def getMetaData(self, output_dir=None):  # pylint: disable=inconsistent-return-statements
 		if self.packageControlFile:
 			# Already done
 			return
@@ -195,33 +318,13 @@ class ProductPackageFile:
 				os.chmod(self.tmpUnpackDir, 0o700)
 
 			metaDataTmpDir = os.path.join(self.tmpUnpackDir, "OPSI")
-			archive = Archive(self.packageFile)
-
-			logger.debug("Extracting meta data from package '%s' to: '%s'", self.packageFile, metaDataTmpDir)
-			archive.extract(targetPath=metaDataTmpDir, patterns=["OPSI*"])
-
-			metadataArchives = []
-			for file in os.listdir(metaDataTmpDir):
-				if not file.endswith((".cpio.gz", ".tar.gz", ".cpio", ".tar")):
-					logger.warning("Unknown content in archive: %s", file)
-					continue
-				logger.debug("Metadata archive found: %s", file)
-				metadataArchives.append(file)
-			if not metadataArchives:
-				raise ValueError("No metadata archive found")
-			if len(metadataArchives) > 2:
-				raise ValueError("More than two metadata archives found")
-
-			# Sorting to unpack custom version metadata at last
-			metadataArchives.sort()
-
-			for metadataArchive in metadataArchives:
-				archive = Archive(os.path.join(metaDataTmpDir, metadataArchive))
+			targetPath = output_dir if output_dir is not None else metaDataTmpDir
+			try:
+				self._extractInnerArchives("OPSI", lambda archive: targetPath)
+			except NotImplementedError as err:
+				logger.info("Extracting package in-process not possible: %s", err)
+				self._extractMetaDataFromArchive(metaDataTmpDir, targetPath)
 
-				if output_dir is None:
-					archive.extract(targetPath=metaDataTmpDir)
-				else:
-					archive.extract(targetPath=output_dir)
 			if output_dir is not None:
 				return  # to work on the whole extracted metadata directory
 
@@ -241,7 +344,20 @@ class ProductPackageFile:
 		logger.debug("Got meta data from package '%s'", self.packageFile)
 		return self.packageControlFile
 
-	def extractData(self):  # pylint: disable=too-many-branches
+	def _extractMetaDataFromArchive(self, metaDataTmpDir, targetPath):
+		archive = Archive(self.packageFile)
+
+		logger.debug("Extracting meta data from package '%s' to: '%s'", self.packageFile, metaDataTmpDir)
+		archive.extract(targetPath=metaDataTmpDir, patterns=["OPSI*"])
+
+		metadataArchives = self._getInnerArchives(os.listdir(metaDataTmpDir))["OPSI"]
+		self._checkInnerArchives("OPSI", metadataArchives)
+
+		for metadataArchive in metadataArchives:
+			archive = Archive(os.path.join(metaDataTmpDir, metadataArchive))
+			archive.extract(targetPath=targetPath)
+
+	def extractData(self):
 		logger.info("Extracting data from package '%s'", self.packageFile)
 
 		try:
@@ -252,65 +368,58 @@ class ProductPackageFile:
 				raise ValueError("Client data dir not set")
 
 			self.clientDataFiles = []
-
-			archive = Archive(self.packageFile)
-
-			logger.info("Extracting data from package '%s' to: '%s'", self.packageFile, self.tmpUnpackDir)
-			archive.extract(targetPath=self.tmpUnpackDir, patterns=["CLIENT_DATA*", "SERVER_DATA*"])
-
-			clientDataArchives = []
-			serverDataArchives = []
-			for file in os.listdir(self.tmpUnpackDir):
-				if file.startswith("OPSI"):
-					continue
-
-				if not file.endswith((".cpio.gz", ".tar.gz", ".cpio", ".tar")):
-					logger.warning("Unknown content in archive: %s", file)
-					continue
-
-				if file.startswith("CLIENT_DATA"):
-					logger.debug("Client-data archive found: %s", file)
-					clientDataArchives.append(file)
-				elif file.startswith("SERVER_DATA"):
-					logger.debug("Server-data archive found: %s", file)
-					serverDataArchives.append(file)
-
-			if not clientDataArchives:
-				logger.warning("No client-data archive found")
-			if len(clientDataArchives) > 2:
-				raise ValueError("More than two client-data archives found")
-			if len(serverDataArchives) > 2:
-				raise ValueError("More than two server-data archives found")
-
-			# Sorting to unpack custom version data at last
-			def psort(name):
-				return re.sub(r"(\.tar|\.tar\.gz|\.cpio|\.cpio\.gz)$", "", name)
-
-			clientDataArchives = sorted(clientDataArchives, key=psort)
-			serverDataArchives = sorted(serverDataArchives, key=psort)
-
-			for serverDataArchive in serverDataArchives:
-				archiveFile = os.path.join(self.tmpUnpackDir, serverDataArchive)
-				logger.info("Extracting server-data archive '%s' to '/'", archiveFile)
-				archive = Archive(archiveFile)
-				archive.extract(targetPath="/")
+			self._clientDataFileInfo = {}
+			self._clientDataWithAccessRights = set()
 
 			productClientDataDir = self.getProductClientDataDir()
 			if not os.path.exists(productClientDataDir):
 				os.mkdir(productClientDataDir)
 				os.chmod(productClientDataDir, 0o2770)
 
-			for clientDataArchive in clientDataArchives:
-				archiveFile = os.path.join(self.tmpUnpackDir, clientDataArchive)
-				logger.info("Extracting client-data archive '%s' to '%s'", archiveFile, productClientDataDir)
-				archive = Archive(archiveFile)
-				archive.extract(targetPath=productClientDataDir)
+			try:
+				with PackageArchiveReader(self.packageFile) as packageArchive:
+					# Server data is written to / before the client data is extracted
+					self._checkInnerArchivesSupported(packageArchive, ("SERVER_DATA", "CLIENT_DATA"))
+				self._extractInnerArchives("SERVER_DATA", lambda archive: "/")
+				accessRights = self._getClientDataAccessRights()
+				extractors = self._extractInnerArchives(
+					"CLIENT_DATA", lambda archive: productClientDataDir, hashFiles=True, **accessRights
+				)
+			except NotImplementedError as err:
+				logger.info("Extracting package in-process not possible: %s", err)
+				self._extractDataFromArchive(productClientDataDir)
+			else:
+				for extractor in extractors:
+					# Later archives overwrite files of earlier ones
+					self._clientDataFileInfo.update(extractor.files)
+					if accessRights:
+						self._clientDataWithAccessRights.update(extractor.extracted)
 
 			logger.debug("Finished extracting data from package")
 		except Exception as err:  # pylint: disable:broad-except
 			self.cleanup()
 			raise RuntimeError(f"Failed to extract data from package '{self.packageFile}': {err}") from err
 
+	def _extractDataFromArchive(self, productClientDataDir):
+		archive = Archive(self.packageFile)
+
+		logger.info("Extracting data from package '%s' to: '%s'", self.packageFile, self.tmpUnpackDir)
+		archive.extract(targetPath=self.tmpUnpackDir, patterns=["CLIENT_DATA*", "SERVER_DATA*"])
+
+		archives = self._getInnerArchives(file for file in os.listdir(self.tmpUnpackDir) if not file.startswith("OPSI"))
+		self._checkInnerArchives("CLIENT_DATA", archives["CLIENT_DATA"])
+		self._checkInnerArchives("SERVER_DATA", archives["SERVER_DATA"])
+
+		for serverDataArchive in archives["SERVER_DATA"]:
+			archiveFile = os.path.join(self.tmpUnpackDir, serverDataArchive)
+			logger.info("Extracting server-data archive '%s' to '/'", archiveFile)
+			Archive(archiveFile).extract(targetPath="/")
+
+		for clientDataArchive in archives["CLIENT_DATA"]:
+			archiveFile = os.path.join(self.tmpUnpackDir, clientDataArchive)
+			logger.info("Extracting client-data archive '%s' to '%s'", archiveFile, productClientDataDir)
+			Archive(archiveFile).extract(targetPath=productClientDataDir)
+
 	def getClientDataFiles(self):
 		if self.clientDataFiles:
 			return self.clientDataFiles
@@ -342,6 +451,10 @@ class ProductPackageFile:
 			os.chmod(productClientDataDir, 0o2770)
 
 			for filename in self.getClientDataFiles():
+				if filename in self._clientDataWithAccessRights:
+					# Already set while extracting
+					continue
+
 				path = os.path.join(productClientDataDir, filename)
 
 				try:
@@ -400,6 +513,7 @@ class ProductPackageFile:
 			except ValueError:
 				pass  # not in list
 			packageContentFile.setClientDataFiles(cdf)
+			packageContentFile.setClientDataFileInfo(self._clientDataFileInfo)
 			packageContentFile.generate()
 
 			cdf.append(packageContentFilename)
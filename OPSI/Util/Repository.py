@@ -7,6 +7,7 @@
 OPSI.Util.Repository
 """
 
+import errno
 import ipaddress
 import os
 import posixpath
@@ -15,8 +16,11 @@ import shutil
 import socket
 import stat
 import statistics
+import threading
 import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
 from urllib.parse import quote, unquote, urlparse
 
 import requests
@@ -36,6 +40,7 @@ from OPSI.Types import (
 	forceUnicodeList,
 )
 from OPSI.Util import md5sum, randomString
+from OPSI.Util.Checksum import getChecksumCache, md5sums
 from OPSI.Util.File.Opsi import PackageContentFile
 from OPSI.Util.Message import ProgressSubject
 from OPSI.Util.Path import cd
@@ -64,48 +69,90 @@ def getRepository(url, **kwargs):
 	raise RepositoryError(f"Repository url '{url}' not supported")
 
 
-def getFileInfosFromDavXML(davxmldata, encoding="utf-8"):  # pylint: disable=unused-argument,too-many-branches
-	content = []
-	root = ET.fromstring(davxmldata)
-	for child in root:  # pylint: disable=too-many-nested-blocks
-		info = {"size": 0, "type": "file", "path": "", "name": ""}
-		if child.tag != "{DAV:}response":
-			raise RepositoryError("No valid davxml given")
+def _getFileInfoFromDavResponse(response):
+	"""
+	Get the file info of a single `{DAV:}response` element.
 
-		if child[0].tag == "{DAV:}href":
-			info["path"] = unquote(child[0].text)
-			info["name"] = info["path"].rstrip("/").rsplit("/", maxsplit=1)[-1]
+	:returns: The file info or `None` if the response has no properties.
+	"""
+	if response.tag != "{DAV:}response":
+		raise RepositoryError("No valid davxml given")
 
-		if child[1].tag == "{DAV:}propstat":
-			for node in child[1]:
-				if node.tag != "{DAV:}prop":
-					continue
+	info = {"size": 0, "type": "file", "path": "", "name": ""}
+	if response[0].tag == "{DAV:}href":
+		info["path"] = unquote(response[0].text)
+		info["name"] = info["path"].rstrip("/").rsplit("/", maxsplit=1)[-1]
+
+	if response[1].tag != "{DAV:}propstat":
+		return None
+
+	for node in response[1]:
+		if node.tag != "{DAV:}prop":
+			continue
+
+		for childnode in node:
+			tag = childnode.tag
+			text = childnode.text
+			if tag == "{DAV:}getcontenttype":
+				if "directory" in text:
+					info["type"] = "dir"
+			elif tag == "{DAV:}resourcetype":
+				for resChild in childnode:
+					if resChild.tag == "{DAV:}collection":
+						info["type"] = "dir"
+			elif tag == "{DAV:}getcontentlength":
+				if text != "None":
+					info["size"] = int(text)
+			# elif tag == "{DAV:}displayname":
+			# info['name'] = text
+
+		# IIS Fix: Remove trailing backslash on file-paths
+		if info["type"] == "file" and info["path"].endswith("/"):
+			info["path"] = info["path"][:-1]
+
+	return info
 
-				for childnode in node:
-					tag = childnode.tag
-					text = childnode.text
-					if tag == "{DAV:}getcontenttype":
-						if "directory" in text:
-							info["type"] = "dir"
-					elif tag == "{DAV:}resourcetype":
-						for resChild in childnode:
-							if resChild.tag == "{DAV:}collection":
-								info["type"] = "dir"
-					elif tag == "{DAV:}getcontentlength":
-						if text != "None":
-							info["size"] = int(text)
-					# elif tag == "{DAV:}displayname":
-					# info['name'] = text
-
-				# IIS Fix: Remove trailing backslash on file-paths
-				if info["type"] == "file" and info["path"].endswith("/"):
-					info["path"] = info["path"][:-1]
 
+def getFileInfosFromDavXML(davxmldata, encoding="utf-8"):  # pylint: disable=unused-argument
+	content = []
+	root = ET.fromstring(davxmldata)
+	for child in root:
+		info = _getFileInfoFromDavResponse(child)
+		if info:
 			content.append(info)
 
 	return content
 
 
+def iterFileInfosFromDavXML(davxml):
+	"""
+	Parse a WebDAV multistatus response incrementally.
+
+	Every `{DAV:}response` element is dropped once it is processed,
+	so even listings of huge trees are parsed in constant memory.
+
+	:param davxml: File like object to read the XML from.
+	:returns: Iterator of file infos as returned by `getFileInfosFromDavXML`.
+	"""
+	root = None
+	for event, element in ET.iterparse(davxml, events=("start", "end")):
+		if root is None:
+			root = element
+			continue
+
+		if event != "end" or element is root:
+			continue
+
+		if element.tag == "{DAV:}response":
+			info = _getFileInfoFromDavResponse(element)
+			if info:
+				yield info
+			root.clear()
+		elif element in root:
+			# Direct children of the multistatus have to be responses.
+			raise RepositoryError("No valid davxml given")
+
+
 class RepositoryHook:
 	def __init__(self):
 		pass
@@ -149,6 +196,9 @@ class SpeedLimiter:  # pylint: disable=too-many-instance-attributes
 		self._dynamic_bandwidth_limit = 0.0
 		self._bandwidth_sleep_time = 0.0
 
+		# Concurrent transfers share one limiter and therefore one bandwidth budget.
+		self._lock = threading.RLock()
+
 	def __del__(self):
 		if self._network_performance_counter:
 			self._stop_network_performance_counter()
@@ -300,7 +350,7 @@ class SpeedLimiter:  # pylint: disable=too-many-instance-attributes
 
 		return self._dynamic_bandwidth_limit
 
-	def _limit(self, buffer_size: int) -> int:  # pylint: disable=too-many-branches,too-many-statements
+	def _limit(self, buffer_size: int) -> Tuple[int, float]:  # pylint: disable=too-many-branches,too-many-statements
 		bwlimit = self._max_bandwidth
 
 		if self._dynamic:
@@ -311,7 +361,7 @@ class SpeedLimiter:  # pylint: disable=too-many-instance-attributes
 					bwlimit = self._max_bandwidth
 
 		if bwlimit <= 0:
-			return self._max_buffer_size
+			return self._max_buffer_size, 0.0
 
 		bwlimit = float(bwlimit)
 		speed = float(self._current_speed)
@@ -377,8 +427,7 @@ class SpeedLimiter:  # pylint: disable=too-many-instance-attributes
 		else:
 			self._bandwidth_sleep_time = 0.000001
 
-		time.sleep(self._bandwidth_sleep_time)
-		return buffer_size
+		return buffer_size, self._bandwidth_sleep_time
 
 	def set_bandwidth(self, max_bandwidth: int = 0, dynamic: bool = False):
 		"""maxBandwidth in byte/s"""
@@ -387,29 +436,43 @@ class SpeedLimiter:  # pylint: disable=too-many-instance-attributes
 		self._max_bandwidth = max(forceInt(max_bandwidth), 0)
 
 	def transfer_started(self, transfer_direction: str):
-		self._transfer_direction = transfer_direction
-		if self._dynamic:
-			if not self._network_performance_counter:
-				self._start_network_performance_counter()
-		else:
-			if self._network_performance_counter:
-				self._stop_network_performance_counter()
+		with self._lock:
+			self._transfer_direction = transfer_direction
+			if self._dynamic:
+				if not self._network_performance_counter:
+					self._start_network_performance_counter()
+			else:
+				if self._network_performance_counter:
+					self._stop_network_performance_counter()
 
 	def transfer_ended(self):
 		pass
 
 	def suspend(self):
-		if self._network_performance_counter:
-			self._stop_network_performance_counter()
-		self._reset()
+		with self._lock:
+			if self._network_performance_counter:
+				self._stop_network_performance_counter()
+			self._reset()
 
 	def limit(self, num_bytes_received: int):
-		new_buffer_size = num_bytes_received
-		self._calc_speed(num_bytes_received)
-		if self._dynamic or self._max_bandwidth:
-			new_buffer_size = self._limit(buffer_size=num_bytes_received)
-		else:
-			new_buffer_size = self._max_buffer_size
+		"""
+		Account `num_bytes_received` and wait as long as needed to keep the limit.
+
+		The speed is calculated from the data of all running transfers.
+		The waiting happens outside of the lock, so all transfers sleep
+		in parallel and the sleep time adapts to the total speed.
+
+		:returns: The buffer size to use for the next read.
+		"""
+		with self._lock:
+			self._calc_speed(num_bytes_received)
+			if not self._dynamic and not self._max_bandwidth:
+				return self._max_buffer_size
+
+			new_buffer_size, sleep_time = self._limit(buffer_size=num_bytes_received)
+
+		if sleep_time:
+			time.sleep(sleep_time)
 		return new_buffer_size
 
 
@@ -450,6 +513,12 @@ class Repository:  # pylint: disable=too-many-instance-attributes
 		self._dynamicBandwidth = dynamicBandwidth
 		self.speed_limiter.set_bandwidth(max_bandwidth=self._maxBandwidth, dynamic=self._dynamicBandwidth)
 
+	def setMaxConnections(self, maxConnections):  # pylint: disable=unused-argument,no-self-use
+		"""
+		Prepare the repository for `maxConnections` concurrent transfers.
+		"""
+		return
+
 	def __str__(self):
 		return f"<{self.__class__.__name__}({self._url})>"
 
@@ -493,36 +562,40 @@ class Repository:  # pylint: disable=too-many-instance-attributes
 		try:
 			self.speed_limiter.transfer_started(transfer_direction=transferDirection)
 			self._transferDirection = transferDirection
+			# Counters are kept local, concurrent transfers may use the same repository.
+			bytesTransfered = 0
+			bufferSize = self.bufferSize
 			self._bytesTransfered = 0
 			transferStartTime = time.time()
 			buf = True
 
-			while buf and self._bytesTransfered < size:
-				remainingBytes = size - self._bytesTransfered
+			while buf and bytesTransfered < size:
+				remainingBytes = size - bytesTransfered
 				logger.trace(
-					"self.bufferSize: %d, self._bytesTransfered: %d, size: %d, remainingBytes: %d, dynamic bandwidth=%s, max bandwidth=%s",
-					self.bufferSize,
-					self._bytesTransfered,
+					"bufferSize: %d, bytesTransfered: %d, size: %d, remainingBytes: %d, dynamic bandwidth=%s, max bandwidth=%s",
+					bufferSize,
+					bytesTransfered,
 					size,
 					remainingBytes,
 					self._dynamicBandwidth,
 					self._maxBandwidth,
 				)
 
-				if 0 < remainingBytes < self.bufferSize:
+				if 0 < remainingBytes < bufferSize:
 					buf = src.read(remainingBytes)
 				elif remainingBytes > 0:
-					buf = src.read(self.bufferSize)
+					buf = src.read(bufferSize)
 				else:
 					break
 
 				read = len(buf)
 
 				if read > 0:
-					if (self._bytesTransfered + read) > size >= 0:
-						buf = buf[: size - self._bytesTransfered]
+					if (bytesTransfered + read) > size >= 0:
+						buf = buf[: size - bytesTransfered]
 						read = len(buf)
-					self._bytesTransfered += read
+					bytesTransfered += read
+					self._bytesTransfered = bytesTransfered
 
 					if hasattr(dst, "send"):
 						dst.send(buf)
@@ -532,7 +605,8 @@ class Repository:  # pylint: disable=too-many-instance-attributes
 					if progressSubject:
 						progressSubject.addToState(read)
 
-					self.bufferSize = self.speed_limiter.limit(read)
+					bufferSize = self.speed_limiter.limit(read)
+					self.bufferSize = bufferSize
 
 			transferTime = time.time() - transferStartTime
 			if transferTime == 0:
@@ -540,11 +614,11 @@ class Repository:  # pylint: disable=too-many-instance-attributes
 			self.speed_limiter.transfer_ended()
 			logger.info(
 				"Transfered %0.2fkByte in %0.2f minutes, average speed was %0.2fkByte/s",
-				float(self._bytesTransfered) / 1000,
+				float(bytesTransfered) / 1000,
 				float(transferTime) / 60,
-				(float(self._bytesTransfered) / transferTime) / 1000,
+				(float(bytesTransfered) / transferTime) / 1000,
 			)
-			return self._bytesTransfered
+			return bytesTransfered
 		except Exception as error:
 			logger.info(error, exc_info=True)
 			raise
@@ -790,6 +864,13 @@ class Repository:  # pylint: disable=too-many-instance-attributes
 
 
 class FileRepository(Repository):
+	# Progress is reported once per chunk when copying inside the kernel.
+	KERNEL_COPY_CHUNK_SIZE = 32 * 1024 * 1024
+	# Errors meaning the kernel can not copy between these files.
+	_KERNEL_COPY_UNSUPPORTED_ERRNOS = {
+		getattr(errno, name) for name in ("EXDEV", "ENOSYS", "EINVAL", "EOPNOTSUPP", "ENOTSUP", "ENOTSOCK", "EBADF") if hasattr(errno, name)
+	}
+
 	def __init__(self, url, **kwargs):
 		Repository.__init__(self, url, **kwargs)
 
@@ -798,6 +879,67 @@ class FileRepository(Repository):
 			raise RepositoryError(f"Bad file url: '{self._url}'")
 		self._path = match.group(1)
 
+	def _copyFile(self, transferDirection, src, dst, size, progressSubject=None):  # pylint: disable=too-many-arguments
+		"""
+		Copy `size` bytes from the current position of `src` to `dst`.
+
+		Without bandwidth limits the data is copied inside the kernel,
+		using `os.copy_file_range` (which allows reflinks on file
+		systems supporting them) or `os.sendfile`. A method failing or
+		copying nothing is dropped in favour of the next one, everything
+		the kernel can not copy is transferred by `_transfer`.
+
+		:returns: The number of bytes copied.
+		"""
+		methods = [name for name in ("copy_file_range", "sendfile") if hasattr(os, name)]
+		if self._maxBandwidth or self._dynamicBandwidth or not methods:
+			return self._transfer(transferDirection, src, dst, size, progressSubject)
+
+		dst.flush()
+		srcFd = src.fileno()
+		dstFd = dst.fileno()
+		srcOffset = src.tell()
+		dstOffset = dst.tell()
+		copied = 0
+		transferStartTime = time.time()
+		while copied < size and methods:
+			count = min(size - copied, self.KERNEL_COPY_CHUNK_SIZE)
+			try:
+				if methods[0] == "copy_file_range":
+					written = os.copy_file_range(srcFd, dstFd, count, srcOffset + copied, dstOffset + copied)
+				else:
+					os.lseek(dstFd, dstOffset + copied, os.SEEK_SET)
+					written = os.sendfile(dstFd, srcFd, srcOffset + copied, count)
+			except OSError as err:
+				if err.errno not in self._KERNEL_COPY_UNSUPPORTED_ERRNOS:
+					raise
+				logger.debug("Failed to copy '%s' using %s: %s", src.name, methods.pop(0), err)
+				continue
+
+			if not written:
+				# Some file systems copy nothing instead of failing
+				logger.debug("Failed to copy '%s' using %s: no data copied", src.name, methods.pop(0))
+				continue
+
+			copied += written
+			if progressSubject:
+				progressSubject.addToState(written)
+
+		src.seek(srcOffset + copied)
+		dst.seek(dstOffset + copied)
+		transferTime = max(time.time() - transferStartTime, 0.0000001)
+		logger.info(
+			"Copied %0.2fkByte in %0.2f minutes, average speed was %0.2fkByte/s",
+			float(copied) / 1000,
+			float(transferTime) / 60,
+			(float(copied) / transferTime) / 1000,
+		)
+		if copied < size:
+			copied += self._transfer(transferDirection, src, dst, size - copied, progressSubject)
+			if copied < size:
+				raise RepositoryError(f"Failed to copy '{src.name}': expected {size} bytes but only {copied} bytes available")
+		return copied
+
 	def _preProcessPath(self, path):
 		path = forceUnicode(path)
 		if path.startswith("/"):
@@ -895,7 +1037,7 @@ class FileRepository(Repository):
 				if startByteNumber > -1:
 					src.seek(startByteNumber)
 				with open(destination, "wb") as dst:
-					self._transferDown(src, dst, size, progressSubject)
+					self._copyFile("in", src, dst, size, progressSubject)
 		except Exception as err:  # pylint: disable=broad-except
 			raise RepositoryError(f"Failed to download '{source}' to '{destination}': {err}") from err
 
@@ -913,7 +1055,7 @@ class FileRepository(Repository):
 		try:
 			with open(source, "rb") as src:
 				with open(destination, "wb") as dst:
-					self._transferUp(src, dst, size, progressSubject)
+					self._copyFile("out", src, dst, size, progressSubject)
 		except Exception as err:
 			raise RepositoryError(f"Failed to upload '{source}' to '{destination}': {err}") from err
 
@@ -984,6 +1126,8 @@ class HTTPRepository(Repository):  # pylint: disable=too-many-instance-attribute
 					logger.error("Invalid ip version '%s', using %s", value, self._ip_version)
 			elif option == "sessionlifetime" and value:
 				self._session_lifetime = int(value)
+			elif option == "httppoolmaxsize" and value:
+				self._http_pool_maxsize = int(value)
 
 		self._set_url(url)
 
@@ -1002,11 +1146,7 @@ class HTTPRepository(Repository):  # pylint: disable=too-many-instance-attribute
 		else:
 			self._session.verify = False
 
-		self._http_adapter = TimeoutHTTPAdapter(
-			timeout=(self._connect_timeout, self._read_timeout), pool_maxsize=self._http_pool_maxsize, max_retries=self._http_max_retries
-		)
-		self._session.mount("http://", self._http_adapter)
-		self._session.mount("https://", self._http_adapter)
+		self._mountHTTPAdapter()
 
 		try:
 			address = ipaddress.ip_address(self.hostname)
@@ -1021,6 +1161,29 @@ class HTTPRepository(Repository):  # pylint: disable=too-many-instance-attribute
 
 		urllib3.util.connection.allowed_gai_family = self._allowed_gai_family
 
+	def _mountHTTPAdapter(self):
+		self._http_adapter = TimeoutHTTPAdapter(
+			timeout=(self._connect_timeout, self._read_timeout), pool_maxsize=self._http_pool_maxsize, max_retries=self._http_max_retries
+		)
+		self._session.mount("http://", self._http_adapter)
+		self._session.mount("https://", self._http_adapter)
+
+	def setMaxConnections(self, maxConnections):
+		"""
+		Keep up to `maxConnections` connections to the server alive.
+
+		The pool is only enlarged, already pooled connections are dropped.
+		"""
+		maxConnections = forceInt(maxConnections)
+		if maxConnections <= self._http_pool_maxsize:
+			return
+
+		logger.debug("Increasing http connection pool size to %d", maxConnections)
+		self._http_pool_maxsize = maxConnections
+		oldAdapter = self._http_adapter
+		self._mountHTTPAdapter()
+		oldAdapter.close()
+
 	@property
 	def hostname(self):
 		return urlparse(self.base_url).hostname
@@ -1094,21 +1257,22 @@ class HTTPRepository(Repository):  # pylint: disable=too-many-instance-attribute
 					ebn = ""
 				headers["range"] = f"bytes={sbn}-{ebn}"
 
-			response = self._session.get(source_url, headers=headers, stream=True)
-			if response.status_code not in (requests.codes["ok"], requests.codes["partial_content"]):
-				raise RuntimeError(f"{response.status_code} - {response.text}")
+			# Closing the response returns the connection to the pool to be reused.
+			with self._session.get(source_url, headers=headers, stream=True) as response:
+				if response.status_code not in (requests.codes["ok"], requests.codes["partial_content"]):
+					raise RuntimeError(f"{response.status_code} - {response.text}")
 
-			size = int(response.headers.get("content-length", 0))
-			logger.debug("Length of binary data to download: %d bytes", size)
+				size = int(response.headers.get("content-length", 0))
+				logger.debug("Length of binary data to download: %d bytes", size)
 
-			if progressSubject:
-				progressSubject.setEnd(size)
+				if progressSubject:
+					progressSubject.setEnd(size)
 
-			with open(destination, "wb") as dst:
-				# Do not decompress files, otherwise files stored compressed on the
-				# server side will be stored uncompressed on the client side.
-				response.raw.decode_content = False
-				self._transferDown(response.raw, dst, size, progressSubject)
+				with open(destination, "wb") as dst:
+					# Do not decompress files, otherwise files stored compressed on the
+					# server side will be stored uncompressed on the client side.
+					response.raw.decode_content = False
+					self._transferDown(response.raw, dst, size, progressSubject)
 
 		except Exception as err:  # pylint: disable=broad-except
 			logger.error(err, exc_info=True)
@@ -1152,8 +1316,6 @@ class WebDAVRepository(HTTPRepository):
 
 	def content(self, source="", recursive=False):
 		source = "/" + source.lstrip("/")
-		source_url = self.base_url.rstrip("/") + self._preProcessPath(source)
-		source_url = source_url.rstrip("/") + "/"
 
 		if recursive and source in self._contentCache:
 			if time.time() - self._contentCache[source]["time"] > 60:
@@ -1161,36 +1323,70 @@ class WebDAVRepository(HTTPRepository):
 			else:
 				return self._contentCache[source]["content"]
 
-		headers = {}
-		depth = "1"
-		if recursive:
-			depth = "infinity"
-		headers["depth"] = depth
+		if not recursive:
+			return self._propfind(source, depth="1")
 
-		response = self._session.request("PROPFIND", url=source_url, headers=headers)
-		if response.status_code != requests.codes["multi_status"]:
-			raise RepositoryError(f"Failed to list dir '{source}': {response.status_code} - {response.text}")
+		content = self._propfind(source, depth="infinity")
+		if content is None:
+			content = self._crawl(source)
+		self._contentCache[source] = {"time": time.time(), "content": content}
 
-		encoding = "utf-8"
-		contentType = response.headers.get("content-type", "").lower()
-		for part in contentType.split(";"):
-			if "charset=" in part:
-				encoding = part.split("=")[1].replace('"', "").strip()
+		return content
 
-		davxmldata = response.content
-		logger.trace("davxmldata: %s", davxmldata)
+	def _propfind(self, source, depth="1"):
+		"""
+		List `source` with a single PROPFIND request.
 
-		content = []
-		for entry in getFileInfosFromDavXML(davxmldata=davxmldata, encoding=encoding):
-			if entry["path"].startswith("/"):
-				# Absolut path to realtive path
-				entry["path"] = posixpath.relpath(entry["path"], start=self._path + source)
-			if entry["path"] and entry["path"] not in (".", ".."):
-				content.append(entry)
-		logger.debug("fileinfo: %s", content)
+		:param depth: "1" or "infinity".
+		:returns: The entries with paths relative to `source` or \
+`None` if the server refuses a depth of infinity.
+		"""
+		source_url = self.base_url.rstrip("/") + self._preProcessPath(source)
+		source_url = source_url.rstrip("/") + "/"
+
+		with self._session.request("PROPFIND", url=source_url, headers={"depth": depth}, stream=True) as response:
+			if response.status_code != requests.codes["multi_status"]:
+				if depth == "infinity" and response.status_code in (
+					requests.codes["bad_request"],
+					requests.codes["forbidden"],
+					requests.codes["not_implemented"],
+				):
+					logger.info("Server refused recursive listing of '%s' (%s), crawling directories", source, response.status_code)
+					return None
+				raise RepositoryError(f"Failed to list dir '{source}': {response.status_code} - {response.text}")
+
+			response.raw.decode_content = True
+			content = []
+			for entry in iterFileInfosFromDavXML(response.raw):
+				if entry["path"].startswith("/"):
+					# Absolut path to realtive path
+					entry["path"] = posixpath.relpath(entry["path"], start=self._path + source)
+				if entry["path"] and entry["path"] not in (".", ".."):
+					content.append(entry)
+
+		logger.trace("fileinfo: %s", content)
+		return content
 
-		if recursive:
-			self._contentCache[source] = {"time": time.time(), "content": content}
+	def _crawl(self, source):
+		"""
+		List `source` recursively, one level of directories after another.
+
+		The directories of a level are listed in parallel.
+		"""
+		content = []
+		directories = [source]
+		with ThreadPoolExecutor(max_workers=self._http_pool_maxsize, thread_name_prefix="webdav-propfind") as executor:
+			while directories:
+				listings = list(zip(directories, executor.map(self._propfind, directories)))
+				directories = []
+				for directory, entries in listings:
+					prefix = directory[len(source) :].strip("/")
+					for entry in entries:
+						if prefix:
+							entry["path"] = f"{prefix}/{entry['path']}"
+						content.append(entry)
+						if entry["type"] == "dir":
+							directories.append(posixpath.join(directory, entry["name"]))
 
 		return content
 
@@ -1318,8 +1514,18 @@ class CIFSRepository(FileRepository):  # pylint: disable=too-many-instance-attri
 
 class DepotToLocalDirectorySychronizer:  # pylint: disable=too-few-public-methods
 	def __init__(
-		self, sourceDepot, destinationDirectory, productIds=None, maxBandwidth=0, dynamicBandwidth=False
+		self, sourceDepot, destinationDirectory, productIds=None, maxBandwidth=0, dynamicBandwidth=False, useChecksumCache=True, workers=1
 	):  # pylint: disable=too-many-arguments
+		"""
+		:param useChecksumCache: If this is `True` the checksums of local \
+files are kept in the checksum cache and files with unchanged size, \
+modification time and inode are not hashed again. \
+Set this to `False` to always verify every file.
+		:type useChecksumCache: bool
+		:param workers: Number of files downloaded concurrently. \
+All downloads share the bandwidth limits of `sourceDepot`.
+		:type workers: int
+		"""
 		productIds = productIds or []
 		self._sourceDepot = sourceDepot
 		self._destinationDirectory = forceUnicode(destinationDirectory)
@@ -1327,10 +1533,100 @@ class DepotToLocalDirectorySychronizer:  # pylint: disable=too-few-public-method
 		self._productId = None
 		self._linkFiles = {}
 		self._fileInfo = None
+		self._useChecksumCache = forceBool(useChecksumCache)
+		self._checksumCache = None
+		self._workers = max(forceInt(workers), 1)
+		self._executor = None
+		self._pendingDownloads = []
+		self._directoryContent = None
 		if not os.path.isdir(self._destinationDirectory):
 			os.mkdir(self._destinationDirectory)
 		self._sourceDepot.setBandwidth(dynamicBandwidth=dynamicBandwidth, maxBandwidth=maxBandwidth)
 
+	def _getLocalChecksums(self, source, destination, items):
+		"""
+		Calculate the md5sums of the already existing files in `destination`.
+
+		Only regular files having the expected size are hashed, in
+		parallel, as all others have to be downloaded anyway.
+
+		:returns: Mapping of local path to md5sum.
+		:rtype: dict
+		"""
+		filenames = []
+		for item in items:
+			relSource = (source + "/" + item["name"]).split("/", 1)[1]
+			fileInfo = self._fileInfo.get(relSource)
+			if not fileInfo or fileInfo["type"] != "f":
+				continue
+
+			destinationPath = os.path.join(destination, item["name"])
+			try:
+				if os.path.isfile(destinationPath) and os.path.getsize(destinationPath) == int(fileInfo["size"]):
+					filenames.append(destinationPath)
+			except OSError:
+				pass
+
+		return {filename: checksum for filename, checksum in md5sums(filenames, ignoreErrors=True, cache=self._checksumCache) if checksum}
+
+	def _getDirectoryContent(self, productId):
+		"""
+		List the product directory of the source depot with one recursive listing.
+
+		:returns: Mapping of directory to the entries in this directory \
+or `None` if the depot can not be listed recursively.
+		:rtype: dict
+		"""
+		try:
+			entries = self._sourceDepot.content(productId, recursive=True)
+		except Exception as err:  # pylint: disable=broad-except
+			logger.debug("Failed to list '%s' recursively, listing every directory: %s", productId, err)
+			return None
+
+		directoryContent = {productId: []}
+		for entry in entries:
+			path = entry["path"].replace("\\", "/").strip("/")
+			parent = posixpath.dirname(path)
+			directoryContent.setdefault(f"{productId}/{parent}" if parent else productId, []).append(entry)
+			if entry["type"] == "dir":
+				directoryContent.setdefault(f"{productId}/{path}", [])
+		return directoryContent
+
+	def _waitForDownloads(self, cancel=False):
+		"""
+		Wait for the running downloads.
+
+		After the first failed download the queued downloads are
+		cancelled and the error is raised once the running ones are done.
+
+		:param cancel: Cancel all queued downloads and ignore errors.
+		"""
+		error = None
+		pendingDownloads, self._pendingDownloads = self._pendingDownloads, []
+		if cancel:
+			for future in pendingDownloads:
+				future.cancel()
+
+		for future in pendingDownloads:
+			if future.cancelled():
+				continue
+
+			try:
+				future.result()
+			except Exception as err:  # pylint: disable=broad-except
+				if not error:
+					error = err
+					for queued in pendingDownloads:
+						queued.cancel()
+
+		if error and not cancel:
+			raise error
+
+	def _md5sum(self, filename):
+		if self._checksumCache:
+			return self._checksumCache.md5sum(filename)
+		return md5sum(filename)
+
 	def _synchronizeDirectories(
 		self, source, destination, progressSubject=None
 	):  # pylint: disable=too-many-locals,too-many-branches,too-many-statements
@@ -1357,8 +1653,14 @@ class DepotToLocalDirectorySychronizer:  # pylint: disable=too-few-public-method
 			else:
 				os.remove(path)
 
+		if self._directoryContent is not None and source in self._directoryContent:
+			items = self._directoryContent[source]
+		else:
+			items = self._sourceDepot.content(source)
+		localChecksums = self._getLocalChecksums(source, destination, items)
+
 		# Start sync
-		for item in self._sourceDepot.content(source):  # pylint: disable=too-many-nested-blocks
+		for item in items:  # pylint: disable=too-many-nested-blocks
 			source = forceUnicode(source)
 			sourcePath = source + "/" + item["name"]
 			destinationPath = os.path.join(destination, item["name"])
@@ -1374,9 +1676,7 @@ class DepotToLocalDirectorySychronizer:  # pylint: disable=too-few-public-method
 				if self._fileInfo[relSource]["type"] == "l":
 					self._linkFiles[relSource] = self._fileInfo[relSource]["target"]
 					continue
-				size = 0
-				localSize = 0
-				exists = False
+				localSize = -1
 				if self._fileInfo[relSource]["type"] == "f":
 					size = int(self._fileInfo[relSource]["size"])
 					exists = os.path.exists(destinationPath)
@@ -1384,73 +1684,100 @@ class DepotToLocalDirectorySychronizer:  # pylint: disable=too-few-public-method
 						shutil.rmtree(destinationPath)
 						exists = False
 					if exists:
-						md5s = md5sum(destinationPath)
-						logger.debug("Destination file '%s' already exists (size: %s, md5sum: %s)", destinationPath, size, md5s)
 						localSize = os.path.getsize(destinationPath)
+						md5s = None
+						if localSize == size:
+							md5s = localChecksums.get(destinationPath) or self._md5sum(destinationPath)
+						logger.debug(
+							"Destination file '%s' already exists (size: %s, local size: %s, md5sum: %s)", destinationPath, size, localSize, md5s
+						)
 						if localSize == size and md5s == self._fileInfo[relSource]["md5sum"]:
 							continue
 
-				if progressSubject:
-					progressSubject.setMessage(_("Downloading file '%s'") % item["name"])
+				if self._executor:
+					self._pendingDownloads.append(
+						self._executor.submit(
+							self._downloadFile, item, sourcePath, destinationPath, self._fileInfo[relSource], localSize, progressSubject
+						)
+					)
+				else:
+					self._downloadFile(item, sourcePath, destinationPath, self._fileInfo[relSource], localSize, progressSubject)
 
-				partialEndFile = f"{destinationPath}.opsi_sync_endpart"
-				partialStartFile = f"{destinationPath}.opsi_sync_startpart"
+	def _downloadFile(
+		self, item, sourcePath, destinationPath, fileInfo, localSize, progressSubject=None
+	):  # pylint: disable=too-many-arguments,too-many-branches,too-many-statements
+		"""
+		Download a file and verify its md5sum.
+
+		An existing but incomplete local file is completed by downloading
+		the missing part only.
+
+		:param localSize: Size of the existing local file, `-1` if missing.
+		"""
+		size = int(fileInfo["size"])
+		exists = localSize > -1
+
+		if progressSubject:
+			progressSubject.setMessage(_("Downloading file '%s'") % item["name"])
+
+		partialEndFile = f"{destinationPath}.opsi_sync_endpart"
+		partialStartFile = f"{destinationPath}.opsi_sync_startpart"
+
+		composed = False
+		if exists and (localSize < size):
+			try:
+				# First byte needed is byte number <localSize>
+				logger.info("Downloading file '%s' starting at byte number %d", item["name"], localSize)
+				if os.path.exists(partialEndFile):
+					os.remove(partialEndFile)
+				self._sourceDepot.download(sourcePath, partialEndFile, startByteNumber=localSize)
+
+				with open(destinationPath, "ab") as f1:
+					with open(partialEndFile, "rb") as f2:
+						shutil.copyfileobj(f2, f1)
+
+				md5s = self._md5sum(destinationPath)
+				if md5s != fileInfo["md5sum"]:
+					logger.info("MD5sum of composed file differs after downloading end part")
+					if os.path.exists(partialStartFile):
+						os.remove(partialStartFile)
+					# Last byte needed is byte number <localSize> - 1
+					logger.info("Downloading file '%s' ending at byte number %d", item["name"], localSize - 1)
+					self._sourceDepot.download(sourcePath, partialStartFile, endByteNumber=localSize - 1)
+
+					with open(partialStartFile, "ab") as f1:
+						with open(partialEndFile, "rb") as f2:
+							shutil.copyfileobj(f2, f1)
 
-				composed = False
-				if exists and (localSize < size):
-					try:
-						# First byte needed is byte number <localSize>
-						logger.info("Downloading file '%s' starting at byte number %d", item["name"], localSize)
-						if os.path.exists(partialEndFile):
-							os.remove(partialEndFile)
-						self._sourceDepot.download(sourcePath, partialEndFile, startByteNumber=localSize)
-
-						with open(destinationPath, "ab") as f1:
-							with open(partialEndFile, "rb") as f2:
-								shutil.copyfileobj(f2, f1)
-
-						md5s = md5sum(destinationPath)
-						if md5s != self._fileInfo[relSource]["md5sum"]:
-							logger.info("MD5sum of composed file differs after downloading end part")
-							if os.path.exists(partialStartFile):
-								os.remove(partialStartFile)
-							# Last byte needed is byte number <localSize> - 1
-							logger.info("Downloading file '%s' ending at byte number %d", item["name"], localSize - 1)
-							self._sourceDepot.download(sourcePath, partialStartFile, endByteNumber=localSize - 1)
-
-							with open(partialStartFile, "ab") as f1:
-								with open(partialEndFile, "rb") as f2:
-									shutil.copyfileobj(f2, f1)
-
-							if os.path.exists(destinationPath):
-								os.remove(destinationPath)
-							os.rename(partialStartFile, destinationPath)
-							md5s = md5sum(destinationPath)
-							if md5s != self._fileInfo[relSource]["md5sum"]:
-								logger.info("MD5sum of composed file differs after downloading start part")
-								raise RuntimeError("MD5sum differs")
-						composed = True
-					except Exception as err:  # pylint: disable=broad-except
-						logger.warning("Error completing a partially downloaded file '%s': %s", item["name"], err, exc_info=True)
-
-				for fn in (partialEndFile, partialStartFile):
-					if os.path.exists(fn):
-						os.remove(fn)
-
-				if not composed:
 					if os.path.exists(destinationPath):
 						os.remove(destinationPath)
-					logger.info("Downloading file '%s'", item["name"])
-					self._sourceDepot.download(sourcePath, destinationPath, progressSubject=progressSubject)
-
-				md5s = md5sum(destinationPath)
-				if md5s != self._fileInfo[relSource]["md5sum"]:
-					error = (
-						f"Failed to download '{item['name']}': "
-						f"MD5sum mismatch (local:{md5s} != remote:{self._fileInfo[relSource]['md5sum']})"
-					)
-					logger.error(error)
-					raise RuntimeError(error)
+					os.rename(partialStartFile, destinationPath)
+					md5s = self._md5sum(destinationPath)
+					if md5s != fileInfo["md5sum"]:
+						logger.info("MD5sum of composed file differs after downloading start part")
+						raise RuntimeError("MD5sum differs")
+				composed = True
+			except Exception as err:  # pylint: disable=broad-except
+				logger.warning("Error completing a partially downloaded file '%s': %s", item["name"], err, exc_info=True)
+
+		for fn in (partialEndFile, partialStartFile):
+			if os.path.exists(fn):
+				os.remove(fn)
+
+		if not composed:
+			if os.path.exists(destinationPath):
+				os.remove(destinationPath)
+			logger.info("Downloading file '%s'", item["name"])
+			self._sourceDepot.download(sourcePath, destinationPath, progressSubject=progressSubject)
+
+		md5s = self._md5sum(destinationPath)
+		if md5s != fileInfo["md5sum"]:
+			error = (
+				f"Failed to download '{item['name']}': "
+				f"MD5sum mismatch (local:{md5s} != remote:{fileInfo['md5sum']})"
+			)
+			logger.error(error)
+			raise RuntimeError(error)
 
 	def synchronize(
 		self, productProgressObserver=None, overallProgressObserver=None
@@ -1467,87 +1794,110 @@ class DepotToLocalDirectorySychronizer:  # pylint: disable=too-few-public-method
 		if overallProgressObserver:
 			overallProgressSubject.attachObserver(overallProgressObserver)
 
-		for self._productId in self._productIds:
-			productProgressSubject = ProgressSubject(id="sync_product_" + self._productId, type="product_sync", fireAlways=True)
-			productProgressSubject.setMessage(_("Synchronizing product %s") % self._productId)
-			if productProgressObserver:
-				productProgressSubject.attachObserver(productProgressObserver)
-			packageContentFile = None
+		if self._useChecksumCache:
+			self._checksumCache = getChecksumCache()
 
-			try:
-				self._linkFiles = {}
-				logger.notice(
-					"Syncing product %s of depot %s with local directory %s", self._productId, self._sourceDepot, self._destinationDirectory
-				)
+		if self._workers > 1:
+			self._sourceDepot.setMaxConnections(self._workers)
+			self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="depot-sync")
 
-				productDestinationDirectory = os.path.join(self._destinationDirectory, self._productId)
-				if not os.path.isdir(productDestinationDirectory):
-					os.mkdir(productDestinationDirectory)
+		try:
+			for self._productId in self._productIds:
+				productProgressSubject = ProgressSubject(id="sync_product_" + self._productId, type="product_sync", fireAlways=True)
+				productProgressSubject.setMessage(_("Synchronizing product %s") % self._productId)
+				if productProgressObserver:
+					productProgressSubject.attachObserver(productProgressObserver)
+				packageContentFile = None
 
-				logger.info("Downloading package content file")
-				packageContentFile = os.path.join(productDestinationDirectory, f"{self._productId}.files")
-				self._sourceDepot.download(f"{self._productId}/{self._productId}.files", packageContentFile)
-				self._fileInfo = PackageContentFile(packageContentFile).parse()
+				try:
+					self._linkFiles = {}
+					logger.notice(
+						"Syncing product %s of depot %s with local directory %s", self._productId, self._sourceDepot, self._destinationDirectory
+					)
 
-				size = 0
-				for value in self._fileInfo.values():
-					try:
-						size += int(value["size"])
-					except KeyError:
-						pass
+					productDestinationDirectory = os.path.join(self._destinationDirectory, self._productId)
+					if not os.path.isdir(productDestinationDirectory):
+						os.mkdir(productDestinationDirectory)
+
+					logger.info("Downloading package content file")
+					packageContentFile = os.path.join(productDestinationDirectory, f"{self._productId}.files")
+					self._sourceDepot.download(f"{self._productId}/{self._productId}.files", packageContentFile)
+					self._fileInfo = PackageContentFile(packageContentFile).parse()
 
-				productProgressSubject.setMessage(_("Synchronizing product %s (%.2fkByte)") % (self._productId, (size / 1000)))
-				productProgressSubject.setEnd(size)
-				productProgressSubject.setEndChangable(False)
-
-				self._synchronizeDirectories(self._productId, productDestinationDirectory, productProgressSubject)
-
-				links = list(self._linkFiles.keys())
-				links.sort()
-				for linkDestination in links:
-					linkSource = self._linkFiles[linkDestination]
-
-					with cd(productDestinationDirectory):
-						if os.name == "nt":
-							if linkSource.startswith("/"):
-								linkSource = linkSource[1:]
-							if linkDestination.startswith("/"):
-								linkDestination = linkDestination[1:]
-							linkSource = os.path.join(productDestinationDirectory, linkSource.replace("/", "\\"))
-							linkDestination = os.path.join(productDestinationDirectory, linkDestination.replace("/", "\\"))
-							if os.path.exists(linkDestination):
-								if os.path.isdir(linkDestination):
-									shutil.rmtree(linkDestination)
+					size = 0
+					for value in self._fileInfo.values():
+						try:
+							size += int(value["size"])
+						except KeyError:
+							pass
+
+					self._directoryContent = self._getDirectoryContent(self._productId)
+
+					productProgressSubject.setMessage(_("Synchronizing product %s (%.2fkByte)") % (self._productId, (size / 1000)))
+					productProgressSubject.setEnd(size)
+					productProgressSubject.setEndChangable(False)
+
+					try:
+						self._synchronizeDirectories(self._productId, productDestinationDirectory, productProgressSubject)
+					except Exception:
+						self._waitForDownloads(cancel=True)
+						raise
+					self._waitForDownloads()
+
+					links = list(self._linkFiles.keys())
+					links.sort()
+					for linkDestination in links:
+						linkSource = self._linkFiles[linkDestination]
+
+						with cd(productDestinationDirectory):
+							if os.name == "nt":
+								if linkSource.startswith("/"):
+									linkSource = linkSource[1:]
+								if linkDestination.startswith("/"):
+									linkDestination = linkDestination[1:]
+								linkSource = os.path.join(productDestinationDirectory, linkSource.replace("/", "\\"))
+								linkDestination = os.path.join(productDestinationDirectory, linkDestination.replace("/", "\\"))
+								if os.path.exists(linkDestination):
+									if os.path.isdir(linkDestination):
+										shutil.rmtree(linkDestination)
+									else:
+										os.remove(linkDestination)
+								logger.info("Symlink => copying '%s' to '%s'", linkSource, linkDestination)
+								if os.path.isdir(linkSource):
+									shutil.copytree(linkSource, linkDestination)
 								else:
-									os.remove(linkDestination)
-							logger.info("Symlink => copying '%s' to '%s'", linkSource, linkDestination)
-							if os.path.isdir(linkSource):
-								shutil.copytree(linkSource, linkDestination)
+									shutil.copyfile(linkSource, linkDestination)
 							else:
-								shutil.copyfile(linkSource, linkDestination)
-						else:
-							if os.path.exists(linkDestination):
-								if os.path.isdir(linkDestination) and not os.path.islink(linkDestination):
-									shutil.rmtree(linkDestination)
-								else:
-									os.remove(linkDestination)
-							parts = len(linkDestination.split("/"))
-							parts -= len(linkSource.split("/"))
-							for _counter in range(parts):
-								linkSource = os.path.join("..", linkSource)
-							logger.info("Symlink '%s' to '%s'", linkDestination, linkSource)
-							os.symlink(linkSource, linkDestination)
-			except Exception as error:
-				productProgressSubject.setMessage(_("Failed to sync product %s: %s") % (self._productId, error))
-				if packageContentFile and os.path.exists(packageContentFile):
-					os.unlink(packageContentFile)
-				raise
-
-			if overallProgressSubject:
-				overallProgressSubject.addToState(1)
+								if os.path.exists(linkDestination):
+									if os.path.isdir(linkDestination) and not os.path.islink(linkDestination):
+										shutil.rmtree(linkDestination)
+									else:
+										os.remove(linkDestination)
+								parts = len(linkDestination.split("/"))
+								parts -= len(linkSource.split("/"))
+								for _counter in range(parts):
+									linkSource = os.path.join("..", linkSource)
+								logger.info("Symlink '%s' to '%s'", linkDestination, linkSource)
+								os.symlink(linkSource, linkDestination)
+				except Exception as error:
+					productProgressSubject.setMessage(_("Failed to sync product %s: %s") % (self._productId, error))
+					if packageContentFile and os.path.exists(packageContentFile):
+						os.unlink(packageContentFile)
+					raise
 
-			if productProgressObserver:
-				productProgressSubject.detachObserver(productProgressObserver)
+				if overallProgressSubject:
+					overallProgressSubject.addToState(1)
+
+				if productProgressObserver:
+					productProgressSubject.detachObserver(productProgressObserver)
+		finally:
+			self._directoryContent = None
+			if self._executor:
+				self._executor.shutdown()
+				self._executor = None
+			if self._checksumCache:
+				self._checksumCache.close()
+				self._checksumCache = None
 
 		if overallProgressObserver:
 			overallProgressSubject.detachObserver(overallProgressObserver)
@@ -11,12 +11,16 @@
 import base64
 import ctypes
 import ctypes.util
+import io
 import os
 import tempfile
+import threading
+from collections import OrderedDict
 
 from opsicommon.logging import get_logger
 
 from OPSI.Types import forceFilename, forceUnicode
+from OPSI.Util.Checksum import getChecksumCache
 
 logger = get_logger("opsi.general")
 _librsync = None
@@ -38,11 +42,15 @@ else:
 	raise NotImplementedError("Librsync is not supported on your platform")
 
 MAX_SPOOL = 1024**2 * 5
+# Maximum size of the signatures kept in memory by `librsyncSignatureManifest`
+SIGNATURE_CACHE_SIZE = 1024**2 * 64
 
 RS_DONE = 0
 RS_BLOCKED = 1
 
 RS_JOB_BLOCKSIZE = 65536
+# Buffer size for reading and writing files while running a job
+RS_IO_BUFFER_SIZE = 1024**2
 RS_DEFAULT_STRONG_LEN = 8
 RS_DEFAULT_BLOCK_LEN = 2048
 RS_MD4_SIG_MAGIC = 0x72730136
@@ -121,43 +129,122 @@ class LibrsyncError(Exception):
 		super(LibrsyncError, self).__init__(_librsync.rs_strerror(ctypes.c_int(r)))
 
 
-def _execute(job, input_handle, output_handle=None):
+def _execute(job, input_handle, output_handle=None, bufferSize=None):
 	"""
 	Executes a librsync "job" by reading bytes from `input_handle` and writing results to
 	`output_handle` if provided. If `output_handle` is omitted, the output is ignored.
+
+	Input not consumed by librsync is kept for the next iteration, so
+	`input_handle` does not have to be seekable. At most `bufferSize`
+	bytes of input are kept.
 	"""
+	bufferSize = bufferSize or RS_IO_BUFFER_SIZE
 	# Re-use the same buffer for output, we will read from it after each
 	# iteration.
-	out = ctypes.create_string_buffer(RS_JOB_BLOCKSIZE)
+	out = ctypes.create_string_buffer(bufferSize)
+	block = b""
+	eof = False
 	while True:
-		block = input_handle.read(RS_JOB_BLOCKSIZE)
+		if not eof and len(block) < bufferSize:
+			# Commands like COPY produce much more output than input,
+			# read only as much as librsync consumed.
+			data = input_handle.read(bufferSize - len(block))
+			eof = not data
+			block = block + data if block else data
 		buff = Buffer()
 		# provide the data block via input buffer.
 		buff.next_in = ctypes.c_char_p(block)  # pylint: disable=attribute-defined-outside-init
 		buff.avail_in = ctypes.c_size_t(len(block))  # pylint: disable=attribute-defined-outside-init
-		buff.eof_in = ctypes.c_int(not block)  # pylint: disable=attribute-defined-outside-init
+		buff.eof_in = ctypes.c_int(eof)  # pylint: disable=attribute-defined-outside-init
 		# Set up our buffer for output.
 		buff.next_out = ctypes.cast(out, ctypes.c_char_p)  # pylint: disable=attribute-defined-outside-init
-		buff.avail_out = ctypes.c_size_t(RS_JOB_BLOCKSIZE)  # pylint: disable=attribute-defined-outside-init
+		buff.avail_out = ctypes.c_size_t(bufferSize)  # pylint: disable=attribute-defined-outside-init
 		res = _librsync.rs_job_iter(job, ctypes.byref(buff))
 		if output_handle:
-			output_handle.write(out.raw[: RS_JOB_BLOCKSIZE - buff.avail_out])
+			output_handle.write(ctypes.string_at(out, bufferSize - buff.avail_out))
 		if res == RS_DONE:
 			break
 		if res != RS_BLOCKED:
 			raise LibrsyncError(res)
-		if buff.avail_in > 0:
-			# There is data left in the input buffer, librsync did not consume
-			# all of it. Rewind the file a bit so we include that data in our
-			# next read. It would be better to simply tack data to the end of
-			# this buffer, but that is very difficult in Python.
-			input_handle.seek(input_handle.tell() - buff.avail_in)
+		if buff.avail_in != len(block):
+			block = block[len(block) - buff.avail_in :] if buff.avail_in else b""
 	if output_handle and callable(getattr(output_handle, "seek", None)):
 		# As a matter of convenience, rewind the output file.
 		output_handle.seek(0)
 	return output_handle
 
 
+def _sigBegin():
+	if hasattr(_librsync, "RS_DEFAULT_STRONG_LEN"):
+		# librsync < 1.0.0
+		return _librsync.rs_sig_begin(RS_DEFAULT_BLOCK_LEN, RS_DEFAULT_STRONG_LEN)
+	# librsync >= 1.0.0
+	return _librsync.rs_sig_begin(RS_DEFAULT_BLOCK_LEN, RS_DEFAULT_STRONG_LEN, RS_MD4_SIG_MAGIC)
+
+
+def _loadSignature(signature):
+	"""
+	Load the binary `signature` and build its hash table.
+
+	:returns: The signature, to be freed with `rs_free_sumset`.
+	"""
+	sig = ctypes.c_void_p()
+	try:
+		job = _librsync.rs_loadsig_begin(ctypes.byref(sig))
+		try:
+			_execute(job, io.BytesIO(signature))
+		finally:
+			_librsync.rs_job_free(job)
+		res = _librsync.rs_build_hash_table(sig)
+		if res != RS_DONE:
+			raise LibrsyncError(res)
+	except Exception:
+		_librsync.rs_free_sumset(sig)
+		raise
+	return sig
+
+
+def _writeDelta(filename, signature, deltafile_handle):
+	sig = _loadSignature(signature)
+	try:
+		with open(filename, "rb", buffering=0) as filehandle:
+			job = _librsync.rs_delta_begin(sig)
+			try:
+				_execute(job, filehandle, deltafile_handle)
+			finally:
+				_librsync.rs_job_free(job)
+	finally:
+		_librsync.rs_free_sumset(sig)
+
+
+def _patch(oldfile, deltafile_handle, newfile_handle):
+	"""
+	Apply the delta read from `deltafile_handle` to `oldfile`.
+
+	`oldfile` may be `None` for a delta against an empty file.
+	"""
+	with open(oldfile or os.devnull, "rb", buffering=0) as oldfile_handle:
+		# librsync copies the block after the callback returned
+		lastBlock = [None]
+
+		@patch_callback
+		def read_cb(opaque, pos, length, buff):  # pylint: disable=unused-argument
+			size_p = ctypes.cast(length, ctypes.POINTER(ctypes.c_size_t)).contents
+			oldfile_handle.seek(pos)
+			block = oldfile_handle.read(size_p.value)
+			size_p.value = len(block)
+			lastBlock[0] = block
+			buff_p = ctypes.cast(buff, ctypes.POINTER(ctypes.c_char_p)).contents
+			buff_p.value = block
+			return RS_DONE
+
+		job = _librsync.rs_patch_begin(read_cb, None)
+		try:
+			_execute(job, deltafile_handle, newfile_handle)
+		finally:
+			_librsync.rs_job_free(job)
+
+
 def librsyncSignature(filename, base64Encoded=True):
 	"""
 	Get the signature of the file to patch.
@@ -166,16 +253,10 @@ def librsyncSignature(filename, base64Encoded=True):
 	filename = forceFilename(filename)
 
 	try:
-		with open(filename, "rb") as filehandle:
+		with open(filename, "rb", buffering=0) as filehandle:
 			sigfile_handle = tempfile.SpooledTemporaryFile(max_size=MAX_SPOOL, mode="wb+")
 
-			job = None
-			if hasattr(_librsync, "RS_DEFAULT_STRONG_LEN"):
-				# librsync < 1.0.0
-				job = _librsync.rs_sig_begin(RS_DEFAULT_BLOCK_LEN, RS_DEFAULT_STRONG_LEN)
-			else:
-				# librsync >= 1.0.0
-				job = _librsync.rs_sig_begin(RS_DEFAULT_BLOCK_LEN, RS_DEFAULT_STRONG_LEN, RS_MD4_SIG_MAGIC)
+			job = _sigBegin()
 			try:
 				_execute(job, filehandle, sigfile_handle)
 				sigfile_handle.seek(0)
@@ -200,33 +281,8 @@ def librsyncDeltaFile(filename, signature, deltafile):
 		raise ValueError("filename and deltafile are the same file")
 
 	try:
-		sigfile_handle = tempfile.NamedTemporaryFile("wb+")
-		sigfile_handle.write(signature)
-		sigfile_handle.seek(0)
-
-		sig = ctypes.c_void_p()
-		try:
-			job = _librsync.rs_loadsig_begin(ctypes.byref(sig))
-			try:
-				_execute(job, sigfile_handle)
-			finally:
-				_librsync.rs_job_free(job)
-			res = _librsync.rs_build_hash_table(sig)
-			if res != RS_DONE:
-				raise LibrsyncError(res)
-
-			with open(filename, "rb") as filehandle:
-				with open(deltafile, "wb") as deltafile_handle:
-					job = _librsync.rs_delta_begin(sig)
-					try:
-						_execute(job, filehandle, deltafile_handle)
-
-					finally:
-						_librsync.rs_job_free(job)
-		finally:
-			sigfile_handle.close()
-			_librsync.rs_free_sumset(sig)
-
+		with open(deltafile, "wb", buffering=RS_IO_BUFFER_SIZE) as deltafile_handle:
+			_writeDelta(filename, signature, deltafile_handle)
 	except Exception as sigError:
 		raise RuntimeError(f"Failed to write delta file {deltafile}: {forceUnicode(sigError)}") from sigError
 
@@ -248,25 +304,186 @@ def librsyncPatchFile(oldfile, deltafile, newfile):
 		raise ValueError("oldfile and deltafile are the same file")
 
 	try:
-		with open(oldfile, "rb") as oldfile_handle:
-
-			@patch_callback
-			def read_cb(opaque, pos, length, buff):
-				oldfile_handle.seek(pos)
-				size_p = ctypes.cast(length, ctypes.POINTER(ctypes.c_size_t)).contents
-				size = size_p.value
-				block = oldfile_handle.read(size)
-				size_p.value = len(block)
-				buff_p = ctypes.cast(buff, ctypes.POINTER(ctypes.c_char_p)).contents
-				buff_p.value = block
-				return RS_DONE
-
-			with open(deltafile, "rb") as deltafile_handle:
-				with open(newfile, "wb") as newfile_handle:
-					job = _librsync.rs_patch_begin(read_cb, None)
-					try:
-						_execute(job, deltafile_handle, newfile_handle)
-					finally:
-						_librsync.rs_job_free(job)
+		with open(deltafile, "rb", buffering=0) as deltafile_handle:
+			with open(newfile, "wb", buffering=RS_IO_BUFFER_SIZE) as newfile_handle:
+				_patch(oldfile, deltafile_handle, newfile_handle)
 	except Exception as patchError:
 		raise RuntimeError(f"Failed to patch file {oldfile}: {forceUnicode(patchError)}") from patchError
+
+
+class _SignatureCache:
+	"""
+	Keeps the most recently used signatures up to a total size of `maxSize` bytes.
+
+	A signature is returned as long as size, modification time and \
+inode of the file are unchanged.
+	"""
+
+	def __init__(self, maxSize=SIGNATURE_CACHE_SIZE):
+		self.maxSize = maxSize
+		self._size = 0
+		self._signatures = OrderedDict()
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def _getStatKey(fileStat):
+		return (fileStat.st_size, fileStat.st_mtime_ns, fileStat.st_ino)
+
+	def get(self, path, fileStat):
+		with self._lock:
+			entry = self._signatures.get(path)
+			if not entry or entry[0] != self._getStatKey(fileStat):
+				return None
+			self._signatures.move_to_end(path)
+			return entry[1]
+
+	def set(self, path, fileStat, signature):
+		if len(signature) > self.maxSize:
+			return
+
+		with self._lock:
+			entry = self._signatures.pop(path, None)
+			if entry:
+				self._size -= len(entry[1])
+			self._signatures[path] = (self._getStatKey(fileStat), signature)
+			self._size += len(signature)
+			while self._size > self.maxSize:
+				_path, (_statKey, oldSignature) = self._signatures.popitem(last=False)
+				self._size -= len(oldSignature)
+
+	def clear(self):
+		with self._lock:
+			self._signatures.clear()
+			self._size = 0
+
+
+_signatureCache = _SignatureCache()
+
+
+def _getPath(directory, relativePath):
+	path = os.path.normpath(os.path.join(directory, *relativePath.split("/")))
+	if os.path.commonpath([os.path.abspath(path), os.path.abspath(directory)]) != os.path.abspath(directory):
+		raise ValueError(f"Path {relativePath!r} is outside of {directory!r}")
+	return path
+
+
+def _walkFiles(directory):
+	"""
+	Get the files below `directory` as paths relative to `directory` \
+with `/` as separator.
+	"""
+	for root, _dirs, files in os.walk(directory):
+		for filename in files:
+			path = os.path.join(root, filename)
+			yield os.path.relpath(path, directory).replace(os.sep, "/"), path
+
+
+def librsyncSignatureManifest(directory):
+	"""
+	Get the signatures of all files below `directory`.
+
+	Signatures of unchanged files are taken from an in-memory cache \
+and md5sums from the checksum cache, so only new or \
+modified files are read.
+
+	:returns: For every file, by path relative to `directory`, the \
+_size_, _md5sum_ and the base64 encoded librsync _signature_.
+	:rtype: dict
+	"""
+	logger.debug("Creating librsync signature manifest of %s", directory)
+	directory = forceFilename(directory)
+	manifest = {}
+	with getChecksumCache() as checksumCache:
+		for relativePath, path in _walkFiles(directory):
+			try:
+				fileStat = os.stat(path)
+				signature = _signatureCache.get(path, fileStat)
+				if signature is None:
+					signature = librsyncSignature(path)
+					_signatureCache.set(path, fileStat, signature)
+				manifest[relativePath] = {
+					"size": fileStat.st_size,
+					"md5sum": checksumCache.md5sum(path),
+					"signature": signature,
+				}
+			except Exception as err:
+				raise RuntimeError(f"Failed to create signature manifest of {directory}: {forceUnicode(err)}") from err
+	return manifest
+
+
+def librsyncDeltaFiles(directory, manifest, deltaDirectory):
+	"""
+	Create the delta files to update a copy of `directory`.
+
+	Files with the same size and md5sum as in `manifest` are skipped. \
+For new files the delta contains the complete file.
+
+	:param manifest: The result of `librsyncSignatureManifest` for the \
+directory to update.
+	:param deltaDirectory: Directory to write the delta files to.
+	:returns: The delta files by relative path in _deltas_ and the \
+relative paths of the files to delete in _removed_.
+	:rtype: dict
+	"""
+	logger.debug("Creating librsync delta files of %s in %s", directory, deltaDirectory)
+	directory = forceFilename(directory)
+	deltaDirectory = forceFilename(deltaDirectory)
+	if os.path.abspath(directory) == os.path.abspath(deltaDirectory):
+		raise ValueError("directory and deltaDirectory are the same directory")
+
+	deltas = {}
+	found = set()
+	with getChecksumCache() as checksumCache:
+		for relativePath, path in _walkFiles(directory):
+			found.add(relativePath)
+			entry = manifest.get(relativePath)
+			try:
+				if entry and entry["size"] == os.path.getsize(path) and entry["md5sum"] == checksumCache.md5sum(path):
+					continue
+
+				if entry:
+					signature = base64.decodebytes(entry["signature"].encode("ascii"))
+				else:
+					signature = librsyncSignature(os.devnull, base64Encoded=False)
+
+				deltafile = os.path.join(deltaDirectory, f"{relativePath}.delta")
+				os.makedirs(os.path.dirname(deltafile), exist_ok=True)
+				with open(deltafile, "wb", buffering=RS_IO_BUFFER_SIZE) as deltafile_handle:
+					_writeDelta(path, signature, deltafile_handle)
+				deltas[relativePath] = deltafile
+			except Exception as err:
+				raise RuntimeError(f"Failed to write delta file for {path}: {forceUnicode(err)}") from err
+
+	return {"deltas": deltas, "removed": sorted(set(manifest) - found)}
+
+
+def librsyncPatchFiles(directory, deltas, removed=None):
+	"""
+	Update `directory` with the delta files created by `librsyncDeltaFiles`.
+
+	Every file is patched into a temporary file which replaces the \
+original file afterwards.
+
+	:param deltas: Delta files by path relative to `directory`.
+	:param removed: Paths relative to `directory` of the files to delete.
+	"""
+	logger.debug("Patching %d files in %s with librsync", len(deltas), directory)
+	directory = forceFilename(directory)
+	for relativePath, deltafile in deltas.items():
+		filename = _getPath(directory, relativePath)
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		newfile = f"{filename}.new"
+		try:
+			with open(deltafile, "rb", buffering=0) as deltafile_handle:
+				with open(newfile, "wb", buffering=RS_IO_BUFFER_SIZE) as newfile_handle:
+					_patch(filename if os.path.exists(filename) else None, deltafile_handle, newfile_handle)
+			os.replace(newfile, filename)
+		except Exception as patchError:
+			if os.path.exists(newfile):
+				os.unlink(newfile)
+			raise RuntimeError(f"Failed to patch file {filename}: {forceUnicode(patchError)}") from patchError
+
+	for relativePath in removed or []:
+		filename = _getPath(directory, relativePath)
+		if os.path.exists(filename):
+			os.unlink(filename)
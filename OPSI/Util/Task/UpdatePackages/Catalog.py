@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) uib GmbH <info@uib.de>
+# License: AGPL-3.0
+"""
+Catalog of the packages in the local package directory.
+
+The catalog is stored in the package directory and keeps product id,
+version and md5sum of every package together with size, modification
+time and inode of the file. Only new or changed package files have to
+be parsed and hashed again.
+"""
+
+import json
+import os
+
+from opsicommon.logging import get_logger
+
+from OPSI.Types import forceProductId
+from OPSI.Util import md5sum as calculateMd5sum
+from OPSI.Util.Checksum import md5sums
+from OPSI.Util.File.Opsi import parseFilename
+
+__all__ = ("CATALOG_FILENAME", "LocalPackageCatalog")
+
+CATALOG_FILENAME = ".opsi_packages.json"
+CATALOG_VERSION = 1
+
+logger = get_logger("opsi.general")
+
+
+class LocalPackageCatalog:
+	"""
+	Persistent index of the `.opsi` files in a package directory.
+	"""
+
+	def __init__(self, packageDirectory):
+		"""
+		:param packageDirectory: The directory containing the packages. \
+The catalog is stored in this directory as `CATALOG_FILENAME`.
+		:type packageDirectory: str
+		"""
+		self.packageDirectory = packageDirectory
+		self.filename = os.path.join(packageDirectory, CATALOG_FILENAME)
+		self._entries = {}
+		self._changed = False
+		self._load()
+
+	def __repr__(self):
+		return f"<{self.__class__.__name__}(packageDirectory={self.packageDirectory!r})>"
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.save()
+
+	def _load(self):
+		try:
+			with open(self.filename, mode="r", encoding="utf-8") as file:
+				data = json.load(file)
+			if data.get("version") != CATALOG_VERSION:
+				raise ValueError(f"Unsupported version {data.get('version')!r}")
+			self._entries = data["packages"]
+		except FileNotFoundError:
+			self._changed = True
+		except Exception as err:  # pylint: disable=broad-except
+			logger.warning("Failed to read package catalog '%s', recreating it: %s", self.filename, err)
+			self._entries = {}
+			self._changed = True
+
+	def save(self):
+		"""
+		Write the catalog if it was changed.
+		"""
+		if not self._changed:
+			return
+
+		tmpFilename = f"{self.filename}.tmp"
+		try:
+			with open(tmpFilename, mode="w", encoding="utf-8") as file:
+				json.dump({"version": CATALOG_VERSION, "packages": self._entries}, file)
+			os.replace(tmpFilename, self.filename)
+			self._changed = False
+		except OSError as err:
+			logger.warning("Failed to write package catalog '%s': %s", self.filename, err)
+
+	@staticmethod
+	def _getStatKey(fileStat):
+		return [fileStat.st_size, fileStat.st_mtime_ns, fileStat.st_ino]
+
+	def _getPackageInfo(self, filename):
+		entry = self._entries[filename]
+		return {
+			"productId": entry["productId"],
+			"version": entry["version"],
+			"packageFile": os.path.join(self.packageDirectory, filename),
+			"filename": filename,
+			"md5sum": entry["md5sum"],
+		}
+
+	def refresh(self, forceChecksumCalculation=False):
+		"""
+		Update the catalog to the content of the package directory.
+
+		Unchanged package files are taken from the catalog. New or \
+changed files are parsed and their md5sum is read from an existing \
+`.md5` file or calculated.
+
+		:param forceChecksumCalculation: Calculate the md5sum of every package.
+		:type forceChecksumCalculation: bool
+		"""
+		found = set()
+		packagesToHash = {}
+		with os.scandir(self.packageDirectory) as entries:
+			for dirEntry in entries:
+				if not dirEntry.name.endswith(".opsi"):
+					continue
+
+				filename = dirEntry.name
+				try:
+					statKey = self._getStatKey(dirEntry.stat())
+				except OSError as err:
+					logger.error("Failed to process file '%s': %s", filename, err)
+					continue
+
+				found.add(filename)
+				entry = self._entries.get(filename)
+				if entry and entry["stat"] == statKey and not forceChecksumCalculation:
+					continue
+
+				logger.info("Found new or changed local package '%s'", dirEntry.path)
+				try:
+					productId, version = parseFilename(filename)
+					entry = {"productId": forceProductId(productId), "version": version, "stat": statKey, "md5sum": None}
+				except Exception as err:  # pylint: disable=broad-except
+					logger.error("Failed to process file '%s': %s", filename, err)
+					found.discard(filename)
+					continue
+
+				checkSumFile = f"{dirEntry.path}.md5"
+				if not forceChecksumCalculation and os.path.exists(checkSumFile):
+					logger.debug("Reading existing checksum from %s", checkSumFile)
+					with open(checkSumFile, mode="r", encoding="utf-8") as hashFile:
+						entry["md5sum"] = hashFile.read().strip()
+				else:
+					logger.debug("Calculating checksum for %s", dirEntry.path)
+					packagesToHash[dirEntry.path] = entry
+
+				self._entries[filename] = entry
+				self._changed = True
+
+		for filename in set(self._entries) - found:
+			logger.debug("Package '%s' was removed", filename)
+			del self._entries[filename]
+			self._changed = True
+
+		for packageFile, packageMd5 in md5sums(packagesToHash, ignoreErrors=True):
+			if packageMd5 is None:
+				del self._entries[os.path.basename(packageFile)]
+				continue
+			packagesToHash[packageFile]["md5sum"] = packageMd5
+
+	def update(self, filename, md5sum=None):
+		"""
+		Add or update the package file `filename` after it was changed.
+
+		:param md5sum: The md5sum of the package, calculated if not given.
+		"""
+		packageFile = os.path.join(self.packageDirectory, filename)
+		fileStat = os.stat(packageFile)
+		productId, version = parseFilename(filename)
+		self._entries[filename] = {
+			"productId": forceProductId(productId),
+			"version": version,
+			"stat": self._getStatKey(fileStat),
+			"md5sum": md5sum or calculateMd5sum(packageFile),
+		}
+		self._changed = True
+
+	def remove(self, filename):
+		if self._entries.pop(filename, None):
+			self._changed = True
+
+	def getPackages(self, productId=None):
+		"""
+		Get the packages in the catalog.
+
+		:param productId: Only return the packages of this product.
+		:returns: For each package the _productId_, _version_, \
+_packageFile_ (complete path), _filename_ and _md5sum_.
+		:rtype: [{}]
+		"""
+		return [
+			self._getPackageInfo(filename)
+			for filename in sorted(self._entries)
+			if productId is None or self._entries[filename]["productId"] == productId
+		]
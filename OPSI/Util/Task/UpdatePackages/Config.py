@@ -70,6 +70,12 @@ DEFAULT_CONFIG = {
 	"forceDownload": False,
 	"proxy": None,
 	"ignoreErrors": False,
+	"repositoryWorkers": 4,
+	"downloadWorkers": 4,
+	# kbit/s shared by all downloads, 0 is unlimited
+	"maxBandwidth": 0,
+	# Packages to install concurrently, independent packages only
+	"installWorkers": 1,
 }
 
 logger = get_logger("opsi.general")
@@ -152,6 +158,14 @@ overriden based on values in configuration file.
 								config["proxy"] = forceUrl(value.strip())
 						elif option.lower() == "ignoreerrors" and value.strip():
 							config["ignoreErrors"] = forceBool(value.strip())
+						elif option.lower() == "repositoryworkers" and value.strip():
+							config["repositoryWorkers"] = max(1, forceInt(value.strip()))
+						elif option.lower() == "downloadworkers" and value.strip():
+							config["downloadWorkers"] = max(1, forceInt(value.strip()))
+						elif option.lower() == "maxbandwidth" and value.strip():
+							config["maxBandwidth"] = max(0, forceInt(value.strip()))
+						elif option.lower() == "installworkers" and value.strip():
+							config["installWorkers"] = max(1, forceInt(value.strip()))
 
 				elif section.lower() == "notification":
 					for (option, value) in configIni.items(section):
@@ -355,6 +369,10 @@ overriden based on values in configuration file.
 				repository.autoSetupExcludes = [re.compile(exclude) for exclude in splitAndStrip(value, ",")]
 			elif option.lower() == "description":
 				repository.description = forceUnicode(value)
+			elif option.lower() == "maxconnections" and value.strip():
+				repository.maxConnections = max(1, forceInt(value.strip()))
+			elif option.lower() == "userepofile" and value.strip():
+				repository.useRepoFile = forceBool(value.strip())
 
 		if installAllAvailable:
 			repository.autoInstall = True
@@ -8,7 +8,7 @@ Handling repositories.
 
 from html.parser import HTMLParser
 
-from OPSI.Types import forceBool, forceUnicode, forceUnicodeList
+from OPSI.Types import forceBool, forceInt, forceUnicode, forceUnicodeList
 
 __all__ = ('LinksExtractor', 'ProductRepositoryInfo')
 
@@ -32,7 +32,9 @@ class ProductRepositoryInfo:  # pylint: disable=dangerous-default-value,too-many
 		includes=[],
 		active=False,
 		autoSetupExcludes=[],
-		verifyCert=False
+		verifyCert=False,
+		maxConnections=8,
+		useRepoFile=True
 	):
 		self.name = forceUnicode(name)
 		self.baseUrl = forceUnicode(baseUrl)
@@ -53,6 +55,10 @@ class ProductRepositoryInfo:  # pylint: disable=dangerous-default-value,too-many
 		self.description = ''
 		self.active = forceBool(active)
 		self.verifyCert = forceBool(verifyCert)
+		# Number of concurrent requests to the repository
+		self.maxConnections = forceInt(maxConnections)
+		# Read the packages from packages.json if the repository has one
+		self.useRepoFile = forceBool(useRepoFile)
 
 		self.proxy = None
 		if proxy:
@@ -70,7 +76,7 @@ class ProductRepositoryInfo:  # pylint: disable=dangerous-default-value,too-many
 			if not url.endswith("/"):
 				url = f"{url}/"
 			urls.add(url)
-		return urls
+		return sorted(urls)
 
 
 class LinksExtractor(HTMLParser):  # pylint: disable=abstract-method
@@ -8,32 +8,45 @@ Component for handling package updates.
 # pylint: disable=too-many-lines
 
 import datetime
+import hashlib
 import json
 import os
 import os.path
 import re
-import subprocess
+import tempfile
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
+from pathlib import Path
 from urllib.parse import quote
 
 from OpenSSL.crypto import FILETYPE_PEM, load_certificate
-from OPSI import System
 from OPSI.Backend.BackendManager import BackendManager
 from OPSI.Object import NetbootProduct, ProductOnClient
 from OPSI.Types import forceHostId, forceProductId
 from OPSI.Util import compareVersions, formatFileSize, getfqdn, md5sum
-from OPSI.Util.File import ZsyncFile
+from OPSI.Util.File import ZsyncBlockHasher, ZsyncFile
 from OPSI.Util.File.Opsi import parseFilename
-from OPSI.Util.Path import cd
 from OPSI.Util.Product import ProductPackageFile
 from OPSI.Util.Task.Rights import setRights
 from opsicommon.logging import get_logger, secret_filter
 from opsicommon.ssl import install_ca
 from opsicommon.utils import prepare_proxy_environment
+from pyzsync import (
+	SOURCE_REMOTE,
+	CaseInsensitiveDict,
+	HTTPPatcher,
+	ProgressListener,
+	get_patch_instructions,
+	patch_file,
+	read_zsync_file,
+)
+from requests.adapters import HTTPAdapter
 from requests.packages import urllib3
 from requests.exceptions import ChunkedEncodingError
 
+from .Catalog import LocalPackageCatalog
 from .Config import DEFAULT_USER_AGENT, ConfigurationParser
 from .Notifier import DummyNotifier, EmailNotifier
 from .Repository import LinksExtractor
@@ -49,6 +62,82 @@ class HashsumMissmatchError(ValueError):
 	pass
 
 
+class BandwidthLimiter:
+	"""
+	Token bucket limiting the combined rate of concurrent downloads.
+	"""
+
+	def __init__(self, rate):
+		"""
+		:param rate: Bytes per second.
+		:type rate: int
+		"""
+		self.rate = rate
+		# Allow bursts of up to one second
+		self._tokens = rate
+		self._lastUpdate = time.monotonic()
+		self._lock = threading.Lock()
+
+	def consume(self, amount):
+		"""
+		Take `amount` bytes from the bucket, sleeping until the rate \
+allows the transfer.
+		"""
+		with self._lock:
+			now = time.monotonic()
+			self._tokens = min(self.rate, self._tokens + (now - self._lastUpdate) * self.rate)
+			self._lastUpdate = now
+			self._tokens -= amount
+			wait = -self._tokens / self.rate if self._tokens < 0 else 0
+		if wait > 0:
+			time.sleep(wait)
+
+
+class SessionHTTPPatcher(HTTPPatcher):
+	"""
+	Fetches the missing ranges of a zsync transfer with a `requests` session.
+
+	The session provides authentication, proxy and certificate settings \
+and keeps the connections to the repository open.
+	"""
+
+	def __init__(self, instructions, target_file, url, session, headers=None, bandwidthLimiter=None):  # pylint: disable=too-many-arguments
+		HTTPPatcher.__init__(self, instructions, target_file, url, headers=headers)
+		self._requestsSession = session
+		self._bandwidthLimiter = bandwidthLimiter
+
+	def _send_request(self):
+		if self._response is not None:
+			self._response.close()
+		self._response = self._requestsSession.get(self.url, headers=dict(self._headers), stream=True, timeout=self._read_timeout)
+		return self._response.status_code, CaseInsensitiveDict(dict(self._response.headers))
+
+	def _read_response_data(self, size=None):
+		data = self._response.raw.read(size)
+		if data and self._bandwidthLimiter:
+			self._bandwidthLimiter.consume(len(data))
+		return data
+
+	def run(self):
+		try:
+			HTTPPatcher.run(self)
+		finally:
+			if self._response is not None:
+				self._response.close()
+
+
+class ZsyncProgressLogger(ProgressListener):
+	def __init__(self, url):
+		self.url = url
+		self.percent = -1
+
+	def progress_changed(self, patcher, position, total, per_second):
+		percent = int(100 * position / total) if total else 100
+		if percent != self.percent:
+			self.percent = percent
+			logger.info("Zsyncing %s: %d%% (%d kbit/s)", self.url, percent, per_second * 8 / 1000)
+
+
 class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 	def __init__(self, config):
 		self.config = config
@@ -56,13 +145,11 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 		self.configBackend = None
 		self.depotId = forceHostId(getfqdn(conf="/etc/opsi/global.conf").lower())
 		self.errors = []
-
-		try:
-			self.config["zsyncCommand"] = System.which("zsync-curl")
-			logger.info("Zsync command found: %s", self.config["zsyncCommand"])
-		except Exception:  # pylint: disable=broad-except
-			logger.warning("Command 'zsync-curl' not found")
-			self.config["zsyncCommand"] = None
+		# Checksums calculated while downloading, by package file.
+		# An entry is dropped as soon as the package files are written.
+		self._downloadedPackages = {}
+		self._bandwidthLimiter = None
+		self._localPackageCatalog = None
 
 		# Proxy is needed for getConfigBackend which is needed for ConfigurationParser.parse
 		self.config["proxy"] = ConfigurationParser.get_proxy(self.config["configFile"])
@@ -165,9 +252,6 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 		if not availablePackage["zsyncFile"]:
 			logger.info("Cannot use zsync, no zsync file on server found")
 			return False
-		if not self.config["zsyncCommand"]:
-			logger.info("Cannot use zsync, command not found")
-			return False
 
 		response = session.head(availablePackage["packageFile"])
 		if not response.headers.get("Accept-Ranges"):
@@ -230,6 +314,8 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 					continue
 				sequence.append(package["productId"])
 
+			# Product ids each package has to be installed after
+			installDependencies = {}
 			for package in newPackages:
 				if package["productId"] not in sequence:
 					continue
@@ -238,6 +324,13 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 				ppf = ProductPackageFile(packageFile, tempDir=self.config.get("tempdir", "/tmp"))
 				ppf.getMetaData()
 				dependencies = ppf.packageControlFile.getPackageDependencies()
+				installDependencies[productId] = set(dependency["package"] for dependency in dependencies)
+				installDependencies[productId].update(
+					productDependency.requiredProductId
+					for productDependency in ppf.packageControlFile.getProductDependencies()
+					if productDependency.requiredProductId
+				)
+				installDependencies[productId].discard(productId)
 				ppf.cleanup()
 				for dependency in dependencies:
 					try:
@@ -258,58 +351,7 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 			newPackages = sortedPackages
 
 			backend = self.getConfigBackend()
-			installedPackages = []
-			for package in newPackages:
-				packageFile = os.path.join(self.config["packageDir"], package["filename"])
-
-				if package["repository"].onlyDownload:
-					logger.debug("Download only is set for repository, not installing package '%s'", packageFile)
-					continue
-
-				try:
-					propertyDefaultValues = {}
-					try:
-						if package["repository"].inheritProductProperties and package["repository"].opsiDepotId:
-							logger.info("Trying to get product property defaults from repository")
-							productPropertyStates = backend.productPropertyState_getObjects(  # pylint: disable=no-member
-								productId=package["productId"], objectId=package["repository"].opsiDepotId
-							)
-						else:
-							productPropertyStates = backend.productPropertyState_getObjects(  # pylint: disable=no-member
-								productId=package["productId"], objectId=self.depotId
-							)
-						if productPropertyStates:
-							for pps in productPropertyStates:
-								propertyDefaultValues[pps.propertyId] = pps.values
-						logger.notice("Using product property defaults: %s", propertyDefaultValues)
-					except Exception as err:  # pylint: disable=broad-except
-						logger.warning("Failed to get product property defaults: %s", err)
-
-					logger.info("Installing package '%s'", packageFile)
-					backend.depot_installPackage(  # pylint: disable=no-member
-						filename=packageFile, propertyDefaultValues=propertyDefaultValues, tempDir=self.config.get("tempdir", "/tmp")
-					)
-					productOnDepots = backend.productOnDepot_getObjects(  # pylint: disable=no-member
-						depotId=self.depotId, productId=package["productId"]
-					)
-					if not productOnDepots:
-						raise ValueError(f"Product '{package['productId']}' not found on depot '{self.depotId}' after installation")
-					package["product"] = backend.product_getObjects(  # pylint: disable=no-member
-						id=productOnDepots[0].productId,
-						productVersion=productOnDepots[0].productVersion,
-						packageVersion=productOnDepots[0].packageVersion,
-					)[0]
-
-					message = f"Package '{packageFile}' successfully installed"
-					notifier.appendLine(message, pre="\n")
-					logger.notice(message)
-					installedPackages.append(package)
-
-				except Exception as err:  # pylint: disable=broad-except
-					if not self.config.get("ignoreErrors"):
-						raise
-					logger.error("Ignoring error for package %s: %s", package["productId"], err, exc_info=True)
-					notifier.appendLine(f"Ignoring error for package {package['productId']}: {err}")
+			installedPackages = self._installPackages(backend, newPackages, installDependencies, notifier)
 
 			if not installedPackages:
 				logger.notice("No new packages installed")
@@ -428,6 +470,111 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 			if notifier and notifier.hasMessage():
 				notifier.notify()
 
+	def _getPropertyDefaultValues(self, backend, package):
+		propertyDefaultValues = {}
+		try:
+			if package["repository"].inheritProductProperties and package["repository"].opsiDepotId:
+				logger.info("Trying to get product property defaults from repository")
+				productPropertyStates = backend.productPropertyState_getObjects(  # pylint: disable=no-member
+					productId=package["productId"], objectId=package["repository"].opsiDepotId
+				)
+			else:
+				productPropertyStates = backend.productPropertyState_getObjects(  # pylint: disable=no-member
+					productId=package["productId"], objectId=self.depotId
+				)
+			if productPropertyStates:
+				for pps in productPropertyStates:
+					propertyDefaultValues[pps.propertyId] = pps.values
+			logger.notice("Using product property defaults: %s", propertyDefaultValues)
+		except Exception as err:  # pylint: disable=broad-except
+			logger.warning("Failed to get product property defaults: %s", err)
+		return propertyDefaultValues
+
+	def _installPackages(self, backend, packages, dependencies, notifier):  # pylint: disable=too-many-locals,too-many-branches
+		"""
+		Install `packages` on the depot.
+
+		Up to `installWorkers` packages are installed concurrently. \
+A package is only installed after the packages it depends on. If \
+the dependencies contain a cycle, the packages are installed in the \
+given order.
+
+		:param packages: The packages sorted by their dependencies.
+		:param dependencies: The product ids every product depends on.
+		:type dependencies: dict
+		:returns: The installed packages in the order of `packages`.
+		"""
+		pending = []
+		for package in packages:
+			if package["repository"].onlyDownload:
+				packageFile = os.path.join(self.config["packageDir"], package["filename"])
+				logger.debug("Download only is set for repository, not installing package '%s'", packageFile)
+				continue
+			pending.append(package)
+
+		workers = max(self.config.get("installWorkers") or 1, 1)
+		installed = []
+		running = {}
+		error = None
+
+		def install(package, propertyDefaultValues):
+			packageFile = os.path.join(self.config["packageDir"], package["filename"])
+			logger.info("Installing package '%s'", packageFile)
+			backend.depot_installPackage(  # pylint: disable=no-member
+				filename=packageFile, propertyDefaultValues=propertyDefaultValues, tempDir=self.config.get("tempdir", "/tmp")
+			)
+
+		def submit(executor, package):
+			pending.remove(package)
+			future = executor.submit(install, package, self._getPropertyDefaultValues(backend, package))
+			running[future] = package
+
+		with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="install") as executor:
+			while (pending and not error) or running:
+				if not error:
+					unfinished = set(package["productId"] for package in pending + list(running.values()))
+					for package in list(pending):
+						if len(running) >= workers:
+							break
+						if not dependencies.get(package["productId"], set()) & unfinished:
+							submit(executor, package)
+					if pending and not running:
+						logger.warning("Circular dependency of package '%s', installing in given order", pending[0]["productId"])
+						submit(executor, pending[0])
+
+				(finished, _notFinished) = wait(running, return_when=FIRST_COMPLETED)
+				for future in finished:
+					package = running.pop(future)
+					packageFile = os.path.join(self.config["packageDir"], package["filename"])
+					try:
+						future.result()
+						productOnDepots = backend.productOnDepot_getObjects(  # pylint: disable=no-member
+							depotId=self.depotId, productId=package["productId"]
+						)
+						if not productOnDepots:
+							raise ValueError(f"Product '{package['productId']}' not found on depot '{self.depotId}' after installation")
+						package["product"] = backend.product_getObjects(  # pylint: disable=no-member
+							id=productOnDepots[0].productId,
+							productVersion=productOnDepots[0].productVersion,
+							packageVersion=productOnDepots[0].packageVersion,
+						)[0]
+
+						message = f"Package '{packageFile}' successfully installed"
+						notifier.appendLine(message, pre="\n")
+						logger.notice(message)
+						installed.append(package)
+					except Exception as err:  # pylint: disable=broad-except
+						if not self.config.get("ignoreErrors"):
+							error = error or err
+							continue
+						logger.error("Ignoring error for package %s: %s", package["productId"], err, exc_info=True)
+						notifier.appendLine(f"Ignoring error for package {package['productId']}: {err}")
+
+		if error:
+			raise error
+
+		return sorted(installed, key=packages.index)
+
 	def _getNotifier(self):
 		if not self.config["notification"]:
 			return DummyNotifier()
@@ -488,7 +635,9 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 			logger.warning("%s: Cannot verify download of package: missing md5sum file", availablePackage["productId"])
 			return True
 
-		md5 = md5sum(packageFile)
+		(md5, _zsyncInfo) = self._getDownloadInfo(packageFile)
+		if not md5:
+			md5 = md5sum(packageFile)
 		if md5 != availablePackage["md5sum"]:
 			logger.info("%s: md5sum mismatch, package download failed", availablePackage["productId"])
 			return False
@@ -601,6 +750,16 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 		return False
 
 	def get_packages(self, notifier, all_packages=False):  # pylint: disable=too-many-locals
+		"""
+		Download and verify the new packages.
+
+		Up to `downloadWorkers` packages of a repository, but not more than \
+`maxConnections` of the repository, are transferred concurrently. \
+`maxBandwidth` limits the combined rate of all downloads.
+
+		:returns: The new packages in the order of the repositories \
+and the downloadable packages.
+		"""
 		installedProducts = self.getInstalledProducts()
 		localPackages = self.getLocalPackages()
 		packages_per_repository = self.get_new_packages_per_repository()
@@ -609,37 +768,71 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 			logger.warning("No downloadable packages found")
 			return newPackages
 
+		self._bandwidthLimiter = None
+		if self.config.get("maxBandwidth"):
+			self._bandwidthLimiter = BandwidthLimiter(self.config["maxBandwidth"] * 1000 // 8)
+
+		def get_new_package(session, availablePackage):
+			logger.debug("Processing available package %s", availablePackage)
+			# This ís called to keep the logs consistent
+			product = self.get_installed_package(availablePackage, installedProducts)
+			if not all_packages and not self.is_install_needed(availablePackage, product):
+				return False
+
+			localPackageFound = self.get_local_package(availablePackage, localPackages)
+			zsync = self._useZsync(session, availablePackage, localPackageFound)
+			if self.is_download_needed(localPackageFound, availablePackage, notifier=notifier):
+				self.get_package(availablePackage, localPackageFound, session, zsync=zsync, notifier=notifier)
+			packageFile = os.path.join(self.config["packageDir"], availablePackage["filename"])
+			verified = self._verifyDownloadedPackage(packageFile, availablePackage)
+			if not verified and zsync:
+				logger.warning("%s: zsync download has failed, trying full download", availablePackage["productId"])
+				self.get_package(availablePackage, localPackageFound, session, zsync=False, notifier=notifier)
+				verified = self._verifyDownloadedPackage(packageFile, availablePackage)
+			if not verified:
+				raise HashsumMissmatchError(f"{availablePackage['productId']}: md5sum mismatch")
+			return self.createPackageFiles(availablePackage)
+
 		for repository, downloadablePackages in packages_per_repository.items():
 			logger.debug("Processing downloadable packages on repository %s", repository)
+			workers = min(len(downloadablePackages), self.config.get("downloadWorkers") or 1, repository.maxConnections)
 			with self.makeSession(repository) as session:
-				for availablePackage in downloadablePackages:
-					logger.debug("Processing available package %s", availablePackage)
-					try:
-						# This ís called to keep the logs consistent
-						product = self.get_installed_package(availablePackage, installedProducts)
-						if not all_packages and not self.is_install_needed(availablePackage, product):
-							continue
-
-						localPackageFound = self.get_local_package(availablePackage, localPackages)
-						zsync = self._useZsync(session, availablePackage, localPackageFound)
-						if self.is_download_needed(localPackageFound, availablePackage, notifier=notifier):
-							self.get_package(availablePackage, localPackageFound, session, zsync=zsync, notifier=notifier)
-						packageFile = os.path.join(self.config["packageDir"], availablePackage["filename"])
-						verified = self._verifyDownloadedPackage(packageFile, availablePackage)
-						if not verified and zsync:
-							logger.warning("%s: zsync download has failed, trying full download", availablePackage["productId"])
-							self.get_package(availablePackage, localPackageFound, session, zsync=False, notifier=notifier)
-							verified = self._verifyDownloadedPackage(packageFile, availablePackage)
-						if not verified:
-							raise HashsumMissmatchError(f"{availablePackage['productId']}: md5sum mismatch")
-						self.cleanupPackages(availablePackage)
-						newPackages.append(availablePackage)
-					except Exception as exc:  # pylint: disable=broad-except
-						if self.config.get("ignoreErrors"):
+				with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="download") as executor:
+					futures = [
+						(availablePackage, executor.submit(get_new_package, session, availablePackage))
+						for availablePackage in downloadablePackages
+					]
+					downloadedPackages = []
+					error = None
+					for availablePackage, future in futures:
+						try:
+							md5 = future.result()
+							if md5:
+								downloadedPackages.append((availablePackage, md5))
+						except Exception as exc:  # pylint: disable=broad-except
+							if not self.config.get("ignoreErrors"):
+								error = exc
+								break
 							logger.error("Ignoring Error for package %s: %s", availablePackage["productId"], exc, exc_info=True)
 							notifier.appendLine(f"Ignoring Error for package {availablePackage['productId']}: {exc}")
-						else:
-							raise exc
+					if error:
+						for _availablePackage, future in futures:
+							future.cancel()
+
+			# Cleaning up removes files in the package directory and
+			# therefore runs after all transfers of the repository finished.
+			for availablePackage, md5 in downloadedPackages:
+				try:
+					self.cleanupPackages(availablePackage, md5)
+					newPackages.append(availablePackage)
+				except Exception as exc:  # pylint: disable=broad-except
+					if self.config.get("ignoreErrors"):
+						logger.error("Ignoring Error for package %s: %s", availablePackage["productId"], exc, exc_info=True)
+						notifier.appendLine(f"Ignoring Error for package {availablePackage['productId']}: {exc}")
+					else:
+						raise exc
+			if error:
+				raise error
 		return newPackages
 
 	def get_package(self, availablePackage, localPackageFound, session, notifier=None, zsync=True):  # pylint: disable=too-many-arguments
@@ -651,7 +844,7 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 
 			message = None
 			try:
-				self.zsyncPackage(availablePackage, packageFile)
+				self.zsyncPackage(availablePackage, packageFile, session)
 				message = f"Zsync of '{availablePackage['packageFile']}' completed"
 				logger.info(message)
 			except Exception as err:  # pylint: disable=broad-except
@@ -682,55 +875,47 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 			if notifier and notifier.hasMessage():
 				notifier.notify()
 
-	def zsyncPackage(self, availablePackage, packageFile):  # pylint: disable=too-many-locals
-		repository = availablePackage["repository"]
-		with cd(os.path.dirname(packageFile)):
-			logger.info("Zsyncing %s to %s", availablePackage["packageFile"], packageFile)
-
-			url = availablePackage["zsyncFile"]
-			if repository.username:
-				quoted_password = quote(repository.password)
-				secret_filter.add_secrets(quoted_password)
-				auth = f"{quote(repository.username)}:{quoted_password}"
-				tmp = url.split("://", 1)
-				url = f"{tmp[0]}://{auth}@{tmp[1]}"
-			cmd = [self.config["zsyncCommand"], "-o", packageFile, url]
-
-			env = System.get_subprocess_environment()
-			if repository.proxy:
-				if repository.proxy != "system":
-					env.update({"http_proxy": repository.proxy, "https_proxy": repository.proxy})
-			else:
-				env.update({"http_proxy": "", "https_proxy": "", "no_proxy": "*"})
-
-			stateRegex = re.compile(r"\s([\d.]+)%\s+([\d.]+)\skBps(.*)$")
-			data = b""
-			buffer = b""
-			exit_code = 0
-			percent = 0
-			logger.info("Executing zsync command %r with env %r", cmd, env)
-			with subprocess.Popen(
-				cmd, shell=False, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env
-			) as proc:
-				while True:
-					inp = proc.stdout.read(16)
-					if inp:
-						data += inp
-						buffer += inp
-						match = stateRegex.search(buffer.decode("utf-8", "replace"))
-						if match:
-							buffer = match.group(3).encode()
-							new_percent = float(match.group(1))
-							speed = float(match.group(2)) * 8
-							if percent != new_percent:
-								percent = new_percent
-								logger.info("Zsyncing %s: %d%% (%d kbit/s)", availablePackage["packageFile"], percent, speed)
-					exit_code = proc.poll()
-					if exit_code is not None:
-						break
-			if exit_code != 0:
-				data = data.decode("utf-8", "replace")
-				raise RuntimeError(f"Command {cmd} failed with exit code {exit_code}: {data}")
+	def zsyncPackage(self, availablePackage, packageFile, session, progressListener=None):
+		"""
+		Update `packageFile` to `availablePackage` with zsync.
+
+		Blocks found in the existing `packageFile` are copied, the missing \
+ranges are fetched with multi-range requests over `session`.
+
+		:param progressListener: Receives the progress of the transfer, \
+by default the progress is logged.
+		:type progressListener: pyzsync.ProgressListener
+		"""
+		url = availablePackage["packageFile"]
+		logger.info("Zsyncing %s to %s", url, packageFile)
+
+		response = session.get(availablePackage["zsyncFile"], headers=self.httpHeaders, timeout=600)
+		if response.status_code < 200 or response.status_code > 299:
+			raise ConnectionError(f"Unable to download zsync file from {availablePackage['zsyncFile']}: {response.status_code}")
+
+		(handle, zsyncFile) = tempfile.mkstemp(prefix=".zsync-", dir=os.path.dirname(packageFile))
+		try:
+			with os.fdopen(handle, "wb") as file:
+				file.write(response.content)
+			zsyncInfo = read_zsync_file(Path(zsyncFile))
+		finally:
+			os.unlink(zsyncFile)
+
+		instructions = get_patch_instructions(zsyncInfo, Path(packageFile), optimized=True)
+		remoteBytes = sum(instruction.size for instruction in instructions if instruction.source == SOURCE_REMOTE)
+		logger.info(
+			"Zsyncing %s: fetching %s of %s", url, formatFileSize(remoteBytes, base=10), formatFileSize(zsyncInfo.length, base=10)
+		)
+
+		def createPatcher(instructions, target_file):
+			patcher = SessionHTTPPatcher(
+				instructions, target_file, url, session, headers=self.httpHeaders, bandwidthLimiter=self._bandwidthLimiter
+			)
+			patcher.register_progress_listener(progressListener or ZsyncProgressLogger(url))
+			return patcher
+
+		# The result is verified by the md5sum of the package
+		patch_file(Path(packageFile), instructions, createPatcher, delete_files=False, return_hash=None)
 
 	def downloadPackage(self, availablePackage, session, notifier=None):  # pylint: disable=too-many-locals
 		url = availablePackage["packageFile"]
@@ -751,6 +936,11 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 		else:
 			logger.info("Downloading %s to %s", url, outFile)
 
+		# The checksums are calculated while downloading to avoid reading the file again
+		md5 = hashlib.md5()
+		zsyncHasher = ZsyncBlockHasher(size, availablePackage["filename"]) if size else None
+		self._downloadedPackages.pop(outFile, None)
+
 		position = 0
 		percent = 0.0
 		last_time = time.time()
@@ -763,8 +953,13 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 			for attempt in range(1, 11):  # pylint: disable=too-many-nested-blocks
 				try:
 					for chunk in response.iter_content(chunk_size=32768):
+						if self._bandwidthLimiter:
+							self._bandwidthLimiter.consume(len(chunk))
 						position += len(chunk)
 						out.write(chunk)
+						md5.update(chunk)
+						if zsyncHasher:
+							zsyncHasher.update(chunk)
 
 						if size > 0:
 							try:
@@ -795,6 +990,12 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 				headers["Range"] = f"bytes={start_position}-"
 				response = get_connection(url, headers)
 
+		fileStat = os.stat(outFile)
+		zsyncInfo = None
+		if zsyncHasher:
+			zsyncInfo = zsyncHasher.getInfo(mtime=datetime.datetime.fromtimestamp(fileStat.st_mtime, tz=datetime.timezone.utc))
+		self._downloadedPackages[outFile] = (self._getStatKey(fileStat), md5.hexdigest(), zsyncInfo)
+
 		if size:
 			message = f"Download of '{url}' completed (~{formatFileSize(size, base=10)})"
 		else:
@@ -804,69 +1005,116 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 		if notifier:
 			notifier.appendLine(message)
 
-	def cleanupPackages(self, newPackage):
-		logger.info("Cleaning up in %s", self.config["packageDir"])
+	@staticmethod
+	def _getStatKey(fileStat):
+		return (fileStat.st_size, fileStat.st_mtime_ns, fileStat.st_ino)
 
-		try:
-			setRights(self.config["packageDir"])
-		except Exception as err:  # pylint: disable=broad-except
-			logger.warning("Failed to set rights on directory '%s': %s", self.config["packageDir"], err)
+	def _getDownloadInfo(self, packageFile):
+		"""
+		Get the checksums calculated while downloading `packageFile`.
 
-		for filename in os.listdir(self.config["packageDir"]):
-			path = os.path.join(self.config["packageDir"], filename)
-			if not os.path.isfile(path):
-				continue
-			if path.endswith(".zs-old"):
-				os.unlink(path)
-				continue
+		:returns: The md5sum and the `pyzsync.ZsyncFileInfo` or `None` \
+for each if unknown or the file was changed after the download, \
+for example by zsync.
+		"""
+		try:
+			(statKey, md5, zsyncInfo) = self._downloadedPackages[packageFile]
+			if statKey == self._getStatKey(os.stat(packageFile)):
+				return (md5, zsyncInfo)
+		except (KeyError, OSError):
+			pass
+		return (None, None)
 
-			try:
-				productId, version = parseFilename(filename)
-			except Exception as err:  # pylint: disable=broad-except
-				logger.debug("Parsing '%s' failed: '%s'", filename, err)
-				continue
+	def createPackageFiles(self, newPackage):
+		"""
+		Create the `.md5` and `.zsync` file of a verified package.
 
-			if productId == newPackage["productId"] and version != newPackage["version"]:
-				logger.info("Deleting obsolete package file '%s'", path)
-				os.unlink(path)
+		The checksums calculated while downloading are used and dropped.
 
+		:returns: The md5sum of the package.
+		:rtype: str
+		"""
 		packageFile = os.path.join(self.config["packageDir"], newPackage["filename"])
+		(md5, zsyncInfo) = self._getDownloadInfo(packageFile)
+		self._downloadedPackages.pop(packageFile, None)
 
 		md5sumFile = f"{packageFile}.md5"
 		logger.info("Creating md5sum file '%s'", md5sumFile)
 
+		md5 = md5 or newPackage.get("md5sum") or md5sum(packageFile)
 		with open(md5sumFile, mode="w", encoding="utf-8") as hashFile:
-			hashFile.write(md5sum(packageFile))
+			hashFile.write(md5)
 
-		setRights(md5sumFile)
+		# zsync-curl left the previous version of a package behind
+		if os.path.exists(f"{packageFile}.zs-old"):
+			os.unlink(f"{packageFile}.zs-old")
 
 		zsyncFile = f"{packageFile}.zsync"
 		logger.info("Creating zsync file '%s'", zsyncFile)
 		try:
 			zsyncFile = ZsyncFile(zsyncFile)
-			zsyncFile.generate(packageFile)
+			if zsyncInfo:
+				zsyncFile.generate(zsyncInfo=zsyncInfo)
+			else:
+				zsyncFile.generate(packageFile)
 		except Exception as err:  # pylint: disable=broad-except
 			logger.error("Failed to create zsync file '%s': %s", zsyncFile, err)
 
+		for path in (packageFile, md5sumFile, f"{packageFile}.zsync"):
+			try:
+				setRights(path)
+			except Exception as err:  # pylint: disable=broad-except
+				logger.warning("Failed to set rights on '%s': %s", path, err)
+
+		return md5
+
+	def cleanupPackages(self, newPackage, md5=None):
+		"""
+		Delete the other versions of `newPackage` and add it to the catalog.
+
+		:param md5: The md5sum of `newPackage`, calculated if not given.
+		"""
+		logger.info("Cleaning up in %s", self.config["packageDir"])
+		catalog = self._getLocalPackageCatalog()
+		for package in catalog.getPackages(productId=newPackage["productId"]):
+			if package["version"] == newPackage["version"]:
+				continue
+
+			for path in (package["packageFile"], f"{package['packageFile']}.md5", f"{package['packageFile']}.zsync"):
+				if os.path.exists(path):
+					logger.info("Deleting obsolete package file '%s'", path)
+					os.unlink(path)
+			catalog.remove(package["filename"])
+
+		catalog.update(newPackage["filename"], md5)
+		catalog.save()
+
 	def onlyNewestPackages(self, packages):  # pylint: disable=no-self-use
 		newestPackages = []
+		# Index of the newest package in newestPackages by product id
+		newestIndex = {}
 		for package in packages:
-			found = None
-			for i, newPackage in enumerate(newestPackages):
-				if newPackage["productId"] == package["productId"]:
-					found = i
-					if compareVersions(package["version"], ">", newestPackages[i]["version"]):
-						logger.debug("Package version '%s' is newer than version '%s'", package["version"], newestPackages[i]["version"])
-						newestPackages[i] = package
-					break
-
-			if found is None:
+			index = newestIndex.get(package["productId"])
+			if index is None:
+				newestIndex[package["productId"]] = len(newestPackages)
 				newestPackages.append(package)
+			elif compareVersions(package["version"], ">", newestPackages[index]["version"]):
+				logger.debug("Package version '%s' is newer than version '%s'", package["version"], newestPackages[index]["version"])
+				newestPackages[index] = package
 
 		return newestPackages
 
+	def _getLocalPackageCatalog(self):
+		if not self._localPackageCatalog or self._localPackageCatalog.packageDirectory != self.config["packageDir"]:
+			self._localPackageCatalog = LocalPackageCatalog(self.config["packageDir"])
+			self._localPackageCatalog.refresh()
+		return self._localPackageCatalog
+
 	def getLocalPackages(self):
-		return getLocalPackages(self.config["packageDir"], forceChecksumCalculation=self.config["forceChecksumCalculation"])
+		catalog = self._getLocalPackageCatalog()
+		catalog.refresh(forceChecksumCalculation=self.config["forceChecksumCalculation"])
+		catalog.save()
+		return catalog.getPackages()
 
 	def getInstalledProducts(self):
 		logger.info("Getting installed products")
@@ -878,14 +1126,113 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 		return products
 
 	def getDownloadablePackages(self):
+		"""
+		Get the packages of all active repositories.
+
+		Up to `repositoryWorkers` repositories are queried concurrently,
+		the packages are returned in the order of the repositories.
+		"""
+		repositories = list(self.getActiveRepositories())
+		workers = min(len(repositories), self.config.get("repositoryWorkers") or 1)
 		downloadablePackages = []
-		for repository in self.getActiveRepositories():
-			logger.info("Getting package infos from repository '%s' (%s)", repository.name, repository.baseUrl)
-			for package in self.getDownloadablePackagesFromRepository(repository):
-				downloadablePackages.append(package)
+		if workers <= 1:
+			for repository in repositories:
+				downloadablePackages.extend(self.getDownloadablePackagesFromRepository(repository))
+			return downloadablePackages
+
+		with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="repository") as executor:
+			for packages in executor.map(self.getDownloadablePackagesFromRepository, repositories):
+				downloadablePackages.extend(packages)
 		return downloadablePackages
 
+	def _getMd5sums(self, session, md5Files, maxConnections):
+		"""
+		Download `.md5` files concurrently and read the md5sums.
+
+		:param md5Files: Tuples of package info and url of its `.md5` file.
+		:param maxConnections: Maximum number of concurrent requests.
+		:returns: Tuples of package info and md5sum in the order of \
+`md5Files`. The md5sum is `None` if it could not be read.
+		"""
+
+		def getMd5sum(md5File):
+			(package, md5Url) = md5File
+			try:
+				response = session.get(md5Url)
+				match = re.search(r"([a-z\d]{32})", response.content.decode("utf-8"))
+				return (package, match.group(1) if match else None)
+			except Exception as err:  # pylint: disable=broad-except
+				logger.error("Failed to process link '%s': %s", md5Url, err)
+				return (package, None)
+
+		workers = min(len(md5Files), maxConnections)
+		if workers <= 1:
+			return [getMd5sum(md5File) for md5File in md5Files]
+
+		with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="md5sum") as executor:
+			return list(executor.map(getMd5sum, md5Files))
+
+	@staticmethod
+	def _isPackageIncluded(repository, filename):
+		if repository.includes:
+			if not any(include.search(filename) for include in repository.includes):
+				logger.info("Package '%s' is not included. Please check your includeProductIds-entry in configurationfile.", filename)
+				return False
+
+		if any(exclude.search(filename) for exclude in repository.excludes):
+			logger.info("Package '%s' excluded by regular expression", filename)
+			return False
+
+		return True
+
+	def _getPackagesFromRepoFile(self, session, repository, url):
+		"""
+		Read the packages of `url` from its `packages.json`.
+
+		The repository file contains the md5sums of all packages, \
+therefore no `.md5` files have to be fetched.
+
+		:returns: The package infos or `None` if the repository file \
+can not be read.
+		"""
+		url = url.rstrip("/")
+		logger.debug("Trying to retrieve packages.json from %s", url)
+		try:
+			if url.startswith("http"):
+				response = session.get(f"{url}/packages.json", headers=self.httpHeaders)
+				if response.status_code < 200 or response.status_code > 299:
+					raise ConnectionError(f"{response.status_code} - {response.reason}")
+				repoData = response.content
+			elif url.startswith("file://"):
+				with open(f"{url[7:]}/packages.json", "rb") as file:
+					repoData = file.read()
+			else:
+				raise ValueError(f"invalid repository url: {url}")
+
+			repoPackages = json.loads(repoData.decode("utf-8"))["packages"]
+		except Exception as err:  # pylint: disable=broad-except
+			logger.info("No repository file found at %s (%s), scanning the repository", url, err)
+			return None
+
+		packages = []
+		for key, pdict in repoPackages.items():
+			link = f"{key}.opsi"
+			if not self._isPackageIncluded(repository, link):
+				continue
+
+			pdict["repository"] = repository
+			pdict["productId"] = pdict.pop("product_id")
+			pdict["version"] = f"{pdict.pop('product_version')}-{pdict.pop('package_version')}"
+			pdict["packageFile"] = f"{url}/{link}"
+			pdict["filename"] = link
+			pdict["md5sum"] = pdict.pop("md5sum", None)
+			pdict["zsyncFile"] = pdict.pop("zsync_file", None)
+			packages.append(pdict)
+			logger.info("Found opsi package: %s/%s", url, link)
+		return packages
+
 	def getDownloadablePackagesFromRepository(self, repository):  # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+		logger.info("Getting package infos from repository '%s' (%s)", repository.name, repository.baseUrl)
 		with self.makeSession(repository) as session:
 			packages = []
 			errors = set()
@@ -893,33 +1240,11 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 			for url in repository.getDownloadUrls():  # pylint: disable=too-many-nested-blocks
 				try:
 					url = quote(url.encode("utf-8"), safe="/#%[]=:;$&()+,!?*@'~")
-					if str(os.environ.get("USE_REPOFILE")).lower() == "true":
-						logger.debug("Trying to retrieve packages.json from %s", url)
-						try:
-							repo_data = None
-							if url.startswith("http"):
-								repo_data = session.get(f"{url}/packages.json").content
-							elif url.startswith("file://"):
-								with open(f"{url[7:]}/packages.json", "rb") as file:
-									repo_data = file.read()
-							else:
-								raise ValueError(f"invalid repository url: {url}")
-
-							repo_packages = json.loads(repo_data.decode("utf-8"))["packages"]
-							for key, pdict in repo_packages.items():
-								link = ".".join([key, "opsi"])
-								pdict["repository"] = repository
-								pdict["productId"] = pdict.pop("product_id")
-								pdict["version"] = f"{pdict.pop('product_version')}-{pdict.pop('package_version')}"
-								pdict["packageFile"] = f"{url}/{link}"
-								pdict["filename"] = link
-								pdict["md5sum"] = pdict.pop("md5sum", None)
-								pdict["zsyncFile"] = pdict.pop("zsync_file", None)
-								packages.append(pdict)
-								logger.info("Found opsi package: %s/%s", url, link)
+					if repository.useRepoFile:
+						repoFilePackages = self._getPackagesFromRepoFile(session, repository, url)
+						if repoFilePackages is not None:
+							packages.extend(repoFilePackages)
 							continue
-						except Exception:  # pylint: disable=broad-except
-							logger.warning("No repofile found, falling back to scanning the repository")
 
 					response = session.get(url, headers=self.httpHeaders)
 					content = response.content.decode("utf-8")
@@ -928,7 +1253,10 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 					htmlParser = LinksExtractor()
 					htmlParser.feed(content)
 					htmlParser.close()
-					for link in htmlParser.getLinks():
+					links = sorted(htmlParser.getLinks())
+					# Packages of this url by filename for matching the .md5 and .zsync files
+					packagesByFilename = {}
+					for link in links:
 						if not link.endswith(".opsi"):
 							continue
 
@@ -939,15 +1267,7 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 							logger.info("Absolute link: '%s', relative link: '%s'", link, rlink)
 							link = rlink
 
-						if repository.includes:
-							if not any(include.search(link) for include in repository.includes):
-								logger.info(
-									"Package '%s' is not included. Please check your includeProductIds-entry in configurationfile.", link
-								)
-								continue
-
-						if any(exclude.search(link) for exclude in repository.excludes):
-							logger.info("Package '%s' excluded by regular expression", link)
+						if not self._isPackageIncluded(repository, link):
 							continue
 
 						try:
@@ -965,10 +1285,12 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 							}
 							logger.debug("Repository package info: %s", packageInfo)
 							packages.append(packageInfo)
+							packagesByFilename[link] = packageInfo
 						except Exception as err:  # pylint: disable=broad-except
 							logger.error("Failed to process link '%s': %s", link, err)
 
-					for link in htmlParser.getLinks():
+					md5Files = []
+					for link in links:
 						isMd5 = link.endswith(".opsi.md5")
 						isZsync = link.endswith(".opsi.zsync")
 
@@ -983,24 +1305,20 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 						else:
 							continue
 
-						try:
-							for i, package in enumerate(packages):
-								if package.get("filename") == filename:
-									if isMd5:
-										response = session.get(f"{url.rstrip('/')}/{link.lstrip('/')}")
-										match = re.search(r"([a-z\d]{32})", response.content.decode("utf-8"))
-										if match:
-											foundMd5sum = match.group(1)
-											packages[i]["md5sum"] = foundMd5sum
-											logger.debug("Got md5sum for package %s: %s", filename, foundMd5sum)
-									elif isZsync:
-										zsyncFile = f"{url.rstrip('/')}/{link.lstrip('/')}"
-										packages[i]["zsyncFile"] = zsyncFile
-										logger.debug("Found zsync file for package '%s': %s", filename, zsyncFile)
-
-									break
-						except Exception as err:  # pylint: disable=broad-except
-							logger.error("Failed to process link '%s': %s", link, err)
+						package = packagesByFilename.get(filename)
+						if not package:
+							continue
+						if isMd5:
+							md5Files.append((package, f"{url.rstrip('/')}/{link.lstrip('/')}"))
+						else:
+							zsyncFile = f"{url.rstrip('/')}/{link.lstrip('/')}"
+							package["zsyncFile"] = zsyncFile
+							logger.debug("Found zsync file for package '%s': %s", filename, zsyncFile)
+
+					for (package, foundMd5sum) in self._getMd5sums(session, md5Files, repository.maxConnections):
+						if foundMd5sum:
+							package["md5sum"] = foundMd5sum
+							logger.debug("Got md5sum for package %s: %s", package["filename"], foundMd5sum)
 				except Exception as err:  # pylint: disable=broad-except
 					logger.debug(err, exc_info=True)
 					self.errors.append(err)
@@ -1023,6 +1341,10 @@ class OpsiPackageUpdater:  # pylint: disable=too-many-public-methods
 				session.cert = (repository.authcertfile, repository.authkeyfile)
 			session.verify = repository.verifyCert
 			session.auth = (repository.username, repository.password)
+			# Keep a connection for every concurrent request
+			adapter = HTTPAdapter(pool_maxsize=max(repository.maxConnections, 10))
+			session.mount("http://", adapter)
+			session.mount("https://", adapter)
 			logger.debug("Initiating session with verify=%s", repository.verifyCert)
 			yield session
 		finally:
@@ -1037,8 +1359,9 @@ def getLocalPackages(packageDirectory, forceChecksumCalculation=False):
 
 	:param packageDirectory: The directory whose packages should be listed.
 	:type packageDirectory: str
-	:param forceChecksumCalculation: If this is `False` an existing \
-`.md5` of a package will be used. If this is `True` then the checksum \
+	:param forceChecksumCalculation: If this is `False` the checksum \
+kept in the package catalog of `packageDirectory` or an existing \
+`.md5` of a new package will be used. If this is `True` then the checksum \
 will be calculated for each package independent of the possible \
 existance of a corresponding `.md5` file.
 	:returns: Information about the found opsi packages. For each \
@@ -1048,34 +1371,11 @@ _version_, _packageFile_ (complete path), _filename_ and _md5sum_.
 	"""
 	logger.info("Getting info for local packages in '%s'", packageDirectory)
 
-	packages = []
-	for filename in os.listdir(packageDirectory):
-		if not filename.endswith(".opsi"):
-			continue
+	with LocalPackageCatalog(packageDirectory) as catalog:
+		catalog.refresh(forceChecksumCalculation=forceChecksumCalculation)
+		packages = catalog.getPackages()
 
-		packageFile = os.path.join(packageDirectory, filename)
-		logger.info("Found local package '%s'", packageFile)
-		try:
-			productId, version = parseFilename(filename)
-			checkSumFile = packageFile + ".md5"
-			if not forceChecksumCalculation and os.path.exists(checkSumFile):
-				logger.debug("Reading existing checksum from %s", checkSumFile)
-				with open(checkSumFile, mode="r", encoding="utf-8") as hashFile:
-					packageMd5 = hashFile.read().strip()
-			else:
-				logger.debug("Calculating checksum for %s", packageFile)
-				packageMd5 = md5sum(packageFile)
-
-			packageInfo = {
-				"productId": forceProductId(productId),
-				"version": version,
-				"packageFile": packageFile,
-				"filename": filename,
-				"md5sum": packageMd5,
-			}
-			logger.debug("Local package info: %s", packageInfo)
-			packages.append(packageInfo)
-		except Exception as err:  # pylint: disable=broad-except
-			logger.error("Failed to process file '%s': %s", filename, err)
+	for packageInfo in packages:
+		logger.debug("Local package info: %s", packageInfo)
 
 	return packages
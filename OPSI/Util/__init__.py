@@ -59,6 +59,7 @@ from opsicommon.utils import timestamp as oc_timestamp
 
 __all__ = (
 	"BLOWFISH_IV",
+	"MD5SUM_BUFFER_SIZE",
 	"RANDOM_DEVICE",
 	"UNIT_REGEX",
 	"CryptoError",
@@ -75,6 +76,7 @@ __all__ = (
 	"fromJson",
 	"generateOpsiHostKey",
 	"getfqdn",
+	"getWorkerCount",
 	"ipAddressInNetwork",
 	"isRegularExpressionPattern",
 	"md5sum",
@@ -93,6 +95,7 @@ __all__ = (
 )
 
 BLOWFISH_IV = b"OPSI1234"
+MD5SUM_BUFFER_SIZE = 1024 * 1024
 RANDOM_DEVICE = "/dev/urandom"
 UNIT_REGEX = re.compile(r"^(\d+\.*\d*)\s*(\w{0,4})$")
 _ACCEPTED_CHARACTERS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
@@ -158,16 +161,35 @@ def formatFileSize(sizeInBytes, base: int = 2):  # pylint: disable=too-many-retu
 
 
 def md5sum(filename):
-	"""Returns the md5sum of the given file."""
-	md5object = md5()
+	"""
+	Returns the md5sum of the given file.
 
-	with open(filename, "rb") as fileToHash:
-		for data in iter(lambda: fileToHash.read(524288), b""):
-			md5object.update(data)
+	The file is read in chunks of `MD5SUM_BUFFER_SIZE` into one reused
+	buffer, so no Python object is created for the data.
+	"""
+	md5object = md5()
+	buffer = bytearray(MD5SUM_BUFFER_SIZE)
+	view = memoryview(buffer)
+	with open(filename, "rb", buffering=0) as fileToHash:
+		for size in iter(lambda: fileToHash.readinto(buffer), 0):
+			md5object.update(view[:size])
 
 	return md5object.hexdigest()
 
 
+def getWorkerCount(workers=None):
+	"""
+	Get the number of threads to use for hashing or compressing.
+
+	:param workers: The requested number of threads. \
+`None` or values below 1 use the number of CPUs.
+	:rtype: int
+	"""
+	if workers and workers > 0:
+		return int(workers)
+	return os.cpu_count() or 1
+
+
 def randomString(length, characters=_ACCEPTED_CHARACTERS):
 	"""
 	Generates a random string for a given length.
@@ -0,0 +1,153 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) uib GmbH <info@uib.de>
+# License: AGPL-3.0
+"""
+Benchmark for the opsiclientd fan-out of the HostControl backend.
+
+Starts a fake opsiclientd on localhost, answering every rpc after a
+delay, and runs `hostControl_fireEvent` and `hostControl_reachable`
+for a number of synthetic clients which all use this opsiclientd.
+A self-signed certificate for the fake opsiclientd is created with
+the openssl command.
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+import msgpack
+from opsicommon.objects import OpsiClient
+
+from OPSI.Backend.HostControl import HostControlBackend
+
+
+class FakeBackend:
+	"""Backend holding the synthetic clients."""
+
+	def __init__(self, hosts):
+		self.hosts = {host.id: host for host in hosts}
+		self.configStateQueries = 0
+
+	def host_getObjects(self, attributes=None, id=None):  # pylint: disable=redefined-builtin,unused-argument,invalid-name
+		return [self.hosts[hostId] for hostId in id or self.hosts if hostId in self.hosts]
+
+	def host_getIdents(self, id=None, returnType=None):  # pylint: disable=redefined-builtin,unused-argument,invalid-name
+		return [hostId for hostId in id or self.hosts if hostId in self.hosts]
+
+	def configState_getObjects(self, **kwargs):  # pylint: disable=unused-argument,invalid-name
+		self.configStateQueries += 1
+		return []
+
+
+class FakeOpsiclientd:  # pylint: disable=too-few-public-methods
+	"""HTTPS server answering json and msgpack rpcs after `delay` seconds."""
+
+	def __init__(self, certFile, keyFile, delay):
+		self.delay = delay
+		self.requests = 0
+		self.port = None
+		self._sslContext = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+		self._sslContext.load_cert_chain(certFile, keyFile)
+		self._ready = threading.Event()
+
+	async def _handle(self, reader, writer):
+		try:
+			while True:
+				header = await reader.readuntil(b"\r\n\r\n")
+				headers = dict(
+					line.split(": ", 1) for line in header.decode("ascii").lower().split("\r\n")[1:] if ": " in line
+				)
+				body = await reader.readexactly(int(headers.get("content-length", 0)))
+				if headers.get("content-encoding") == "gzip":
+					body = gzip.decompress(body)
+				useMsgpack = "msgpack" in headers.get("content-type", "")
+				request = msgpack.loads(body) if useMsgpack else json.loads(body)
+
+				self.requests += 1
+				await asyncio.sleep(self.delay)
+				response = {"id": request.get("id"), "result": request.get("method"), "error": None}
+				data = msgpack.dumps(response) if useMsgpack else json.dumps(response).encode("utf-8")
+				contentType = "application/msgpack" if useMsgpack else "application/json"
+				writer.write(
+					f"HTTP/1.1 200 OK\r\nContent-Type: {contentType}\r\nContent-Length: {len(data)}\r\n\r\n".encode("ascii") + data
+				)
+				await writer.drain()
+		except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+			pass
+		finally:
+			writer.close()
+
+	async def _serve(self):
+		server = await asyncio.start_server(self._handle, "127.0.0.1", 0, ssl=self._sslContext, backlog=4096)
+		self.port = server.sockets[0].getsockname()[1]
+		self._ready.set()
+		async with server:
+			await server.serve_forever()
+
+	def start(self):
+		threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True).start()
+		self._ready.wait()
+
+
+def createCertificate(directory):
+	certFile = os.path.join(directory, "cert.pem")
+	keyFile = os.path.join(directory, "key.pem")
+	subprocess.run(
+		[
+			"openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+			"-subj", "/CN=localhost", "-keyout", keyFile, "-out", certFile,
+		],
+		check=True,
+		capture_output=True,
+	)
+	return certFile, keyFile
+
+
+def run(name, function, hostCount):
+	start = time.perf_counter()
+	result = function()
+	duration = time.perf_counter() - start
+	print(f"{name:<24} {duration:8.2f}s {hostCount / duration:10.1f} hosts/s")
+	return result
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument("--hosts", type=int, default=1000)
+	parser.add_argument("--delay", type=float, default=0.2, help="Seconds the fake opsiclientd needs per rpc")
+	parser.add_argument("--max-connections", type=int, default=50)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as tempDir:
+		opsiclientd = FakeOpsiclientd(*createCertificate(tempDir), delay=args.delay)
+		opsiclientd.start()
+
+	hosts = [
+		OpsiClient(id=f"client{index:05d}.benchmark.invalid", ipAddress="127.0.0.1", opsiHostKey=os.urandom(16).hex())
+		for index in range(args.hosts)
+	]
+	backend = FakeBackend(hosts)
+	hostControl = HostControlBackend(backend, opsiclientdPort=opsiclientd.port, maxConnections=args.max_connections)
+	print(f"Fake opsiclientd on port {opsiclientd.port}, {args.hosts} hosts, {args.max_connections} connections")
+
+	result = run("hostControl_fireEvent", lambda: hostControl.hostControl_fireEvent("on_demand"), args.hosts)
+	errors = [res["error"] for res in result.values() if res["error"]]
+	print(f"  {len(result) - len(errors)} successful, {len(errors)} failed, {backend.configStateQueries} config state queries")
+	if errors:
+		print(f"  First error: {errors[0]}")
+
+	result = run("hostControl_reachable", hostControl.hostControl_reachable, args.hosts)
+	print(f"  {sum(result.values())} of {len(result)} reachable")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,81 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) uib GmbH <info@uib.de>
+# License: AGPL-3.0
+"""
+Benchmark for hashing many files serially and in parallel.
+
+Creates a synthetic depot like tree (by default 50000 files with a
+total of 10 GB) and compares `md5sum` in a loop with `md5sums`.
+The tree is kept to allow repeated runs with a warm page cache.
+"""
+
+import argparse
+import os
+import random
+import time
+
+from OPSI.Util import getWorkerCount, md5sum
+from OPSI.Util.Checksum import md5sums
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def createTree(directory, fileCount, totalSize):
+	"""Create `fileCount` files with a total size of about `totalSize` bytes."""
+	filenames = []
+	rand = random.Random(fileCount)
+	block = os.urandom(BLOCK_SIZE)
+	# Mostly small files and some large ones, like real client data.
+	weights = [rand.paretovariate(1.2) for _ in range(fileCount)]
+	scale = totalSize / sum(weights)
+	for index, weight in enumerate(weights):
+		filename = os.path.join(directory, f"dir{index % 100:02d}", f"file{index:06d}.bin")
+		filenames.append(filename)
+		size = int(weight * scale)
+		if os.path.exists(filename) and os.path.getsize(filename) == size:
+			continue
+
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		with open(filename, "wb") as file:
+			file.write(index.to_bytes(8, "big"))
+			remaining = size - 8
+			while remaining > 0:
+				file.write(block[: min(remaining, BLOCK_SIZE)])
+				remaining -= BLOCK_SIZE
+	return filenames
+
+
+def run(name, function, filenames, totalSize):
+	start = time.perf_counter()
+	checksums = function(filenames)
+	duration = time.perf_counter() - start
+	print(f"{name:<24} {duration:8.2f}s {totalSize / duration / 1024 ** 2:10.1f} MiB/s")
+	return checksums
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument("directory", help="Directory to create the test tree in")
+	parser.add_argument("--files", type=int, default=50_000)
+	parser.add_argument("--size", type=int, default=10 * 1000 ** 3, help="Total size in bytes")
+	parser.add_argument("--workers", type=int, default=None)
+	args = parser.parse_args()
+
+	print(f"Creating {args.files} files with {args.size} bytes in {args.directory}")
+	filenames = createTree(args.directory, args.files, args.size)
+	totalSize = sum(os.path.getsize(filename) for filename in filenames)
+
+	serial = run("md5sum", lambda filenames: [(filename, md5sum(filename)) for filename in filenames], filenames, totalSize)
+	parallel = run(
+		f"md5sums ({getWorkerCount(args.workers)} workers)",
+		lambda filenames: list(md5sums(filenames, workers=args.workers)),
+		filenames,
+		totalSize,
+	)
+	assert serial == parallel
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,88 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) uib GmbH <info@uib.de>
+# License: AGPL-3.0
+"""
+Benchmark for generating the zsync file of a large package.
+
+Creates a file of random data (by default 2 GB) and compares the
+generation with `pyzsync.create_zsync_file`, followed by parsing and
+rewriting the zsync file without mtime as it was done before, with
+`ZsyncFile.generate` using one and multiple threads.
+The file is kept to allow repeated runs with a warm page cache.
+"""
+
+import argparse
+import os
+import time
+from pathlib import Path
+
+from pyzsync import create_zsync_file
+
+from OPSI.Util import getWorkerCount
+from OPSI.Util.File import ZsyncFile
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def createFile(filename, size):
+	"""Create `filename` with `size` bytes of random data."""
+	if os.path.exists(filename) and os.path.getsize(filename) == size:
+		return
+
+	with open(filename, "wb") as file:
+		remaining = size
+		while remaining > 0:
+			file.write(os.urandom(min(remaining, BLOCK_SIZE)))
+			remaining -= BLOCK_SIZE
+
+
+def generateWithPyzsync(dataFile, zsyncFilename):
+	create_zsync_file(Path(dataFile), Path(zsyncFilename))
+	zsyncFile = ZsyncFile(zsyncFilename)
+	zsyncFile.parse()
+	for key in list(zsyncFile._header):  # pylint: disable=protected-access
+		if key.lower() == "mtime":
+			del zsyncFile._header[key]  # pylint: disable=protected-access
+	zsyncFile.generate()
+
+
+def readWithoutMTime(zsyncFilename):
+	with open(zsyncFilename, "rb") as file:
+		(header, blocks) = file.read().split(b"\n\n", 1)
+	return [line for line in header.split(b"\n") if not line.startswith(b"MTime")], blocks
+
+
+def run(name, function, size):
+	start = time.perf_counter()
+	function()
+	duration = time.perf_counter() - start
+	print(f"{name:<32} {duration:8.2f}s {size / duration / 1024 ** 2:10.1f} MiB/s")
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument("filename", help="File to create the test data in")
+	parser.add_argument("--size", type=int, default=2 * 1000 ** 3, help="Size in bytes")
+	parser.add_argument("--workers", type=int, default=None)
+	args = parser.parse_args()
+
+	print(f"Creating {args.filename} with {args.size} bytes")
+	createFile(args.filename, args.size)
+
+	expected = f"{args.filename}.pyzsync.zsync"
+	generated = f"{args.filename}.zsync"
+	run("create_zsync_file + rewrite", lambda: generateWithPyzsync(args.filename, expected), args.size)
+	run("ZsyncFile.generate (1 worker)", lambda: ZsyncFile(generated).generate(args.filename, workers=1), args.size)
+	assert readWithoutMTime(generated) == readWithoutMTime(expected)
+	run(
+		f"ZsyncFile.generate ({getWorkerCount(args.workers)} workers)",
+		lambda: ZsyncFile(generated).generate(args.filename, workers=args.workers),
+		args.size,
+	)
+	assert readWithoutMTime(generated) == readWithoutMTime(expected)
+
+
+if __name__ == "__main__":
+	main()
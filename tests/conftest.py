@@ -71,6 +71,16 @@ def disable_insecure_request_warning():
 	warnings.simplefilter("ignore", urllib3.exceptions.InsecureRequestWarning)
 
 
+@pytest.fixture(autouse=True)
+def checksum_cache_file(tmp_path, monkeypatch):
+	"""
+	Keep the checksum cache of the tests out of /var/lib/opsi.
+	"""
+	filename = str(tmp_path / "checksums.sqlite")
+	monkeypatch.setattr("OPSI.Util.Checksum.CHECKSUM_CACHE_FILE", filename)
+	yield filename
+
+
 @pytest.fixture(
 	params=[
 		getFileBackend,
@@ -6,14 +6,18 @@
 Testing the Host Control backend.
 """
 
+import errno
+import socket
+import time
 from ipaddress import IPv4Network, IPv4Address
 import pytest
 
-from opsicommon.objects import OpsiClient
+from opsicommon.objects import ConfigState, OpsiClient, UnicodeConfig
 
 from OPSI.Backend.HostControl import HostControlBackend
 from OPSI.Exceptions import BackendMissingDataError
 
+from .helpers import mock
 from .test_hosts import getClients
 
 
@@ -178,3 +182,111 @@ def test_calling_start_and_stop_method(host_control_backend):  # pylint: disable
 def test_host_control_reachable_without_hosts(host_control_backend):  # pylint: disable=redefined-outer-name
 	with pytest.raises(BackendMissingDataError):
 		host_control_backend.hostControl_reachable()
+
+
+def test_host_control_reachable(host_control_backend):  # pylint: disable=redefined-outer-name
+	clients = [OpsiClient(id=f"client{index}.test.invalid", ipAddress="127.0.0.1") for index in range(10)]
+	clients.append(OpsiClient(id="closed.test.invalid", ipAddress="127.0.0.2"))
+	host_control_backend.host_createObjects(clients)
+
+	with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+		server.bind(("127.0.0.1", 0))
+		server.listen(len(clients))
+		host_control_backend._opsiclientdPort = server.getsockname()[1]  # pylint: disable=protected-access
+		host_control_backend._maxConnections = 3  # pylint: disable=protected-access
+
+		result = host_control_backend.hostControl_reachable([client.id for client in clients], timeout=2)
+
+	assert result == {client.id: client.id != "closed.test.invalid" for client in clients}
+
+
+def test_host_control_reachable_with_failing_sockets(host_control_backend):  # pylint: disable=redefined-outer-name
+	clients = [
+		OpsiClient(id="client1.test.invalid", ipAddress="127.0.0.1"),
+		OpsiClient(id="emfile.test.invalid", ipAddress="127.0.0.3"),
+		OpsiClient(id="client2.test.invalid", ipAddress="127.0.0.1"),
+	]
+	host_control_backend.host_createObjects(clients)
+
+	class FailingSocket(socket.socket):
+		def connect_ex(self, address):
+			if address[0] == "127.0.0.3":
+				raise OSError(errno.EMFILE, "Too many open files")
+			return super().connect_ex(address)
+
+	with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+		server.bind(("127.0.0.1", 0))
+		server.listen(len(clients))
+		host_control_backend._opsiclientdPort = server.getsockname()[1]  # pylint: disable=protected-access
+
+		with mock.patch("socket.socket", FailingSocket):
+			result = host_control_backend.hostControl_reachable([client.id for client in clients], timeout=2)
+
+	assert result == {"client1.test.invalid": True, "emfile.test.invalid": False, "client2.test.invalid": True}
+
+
+def test_opsiclientd_rpc_reads_ports_once_and_collects_errors(host_control_backend):  # pylint: disable=redefined-outer-name
+	clients = [
+		OpsiClient(id="client1.test.invalid", ipAddress="192.168.1.1", opsiHostKey="45656789789012789012345612340123"),
+		OpsiClient(id="client2.test.invalid", ipAddress="192.168.1.2", opsiHostKey="59051234345678890121678901223467"),
+		OpsiClient(id="client3.test.invalid", ipAddress="192.168.1.3", opsiHostKey="12345678901234567890123456789012"),
+	]
+	host_control_backend.host_createObjects(clients)
+	host_control_backend.config_createObjects(UnicodeConfig(id="opsiclientd.control_server.port", defaultValues=["4441"]))
+	host_control_backend.configState_createObjects(
+		ConfigState(configId="opsiclientd.control_server.port", objectId="client2.test.invalid", values=["4442"])
+	)
+
+	class FakeJSONRPCClient:
+		def __init__(self, address, **kwargs):  # pylint: disable=unused-argument
+			self.address = address
+
+		def execute_rpc(self, method, params):  # pylint: disable=unused-argument
+			if "192.168.1.3" in self.address:
+				raise RuntimeError("Connection refused")
+			return self.address
+
+		def disconnect(self):
+			pass
+
+	context = host_control_backend._context  # pylint: disable=protected-access
+	with mock.patch("OPSI.Backend.HostControl.JSONRPCClient", FakeJSONRPCClient):
+		with mock.patch.object(context, "configState_getObjects", wraps=context.configState_getObjects) as configStateGetObjects:
+			result = host_control_backend.hostControl_fireEvent("on_demand", [client.id for client in clients])
+
+	configStateGetObjects.assert_called_once()
+	assert result == {
+		"client1.test.invalid": {"result": "https://192.168.1.1:4441/opsiclientd", "error": None},
+		"client2.test.invalid": {"result": "https://192.168.1.2:4442/opsiclientd", "error": None},
+		"client3.test.invalid": {"result": None, "error": "Connection refused"},
+	}
+
+
+def test_host_control_start_sends_magic_packets(host_control_backend):  # pylint: disable=redefined-outer-name
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as receiver:
+		receiver.bind(("127.0.0.1", 0))
+		receiver.settimeout(2)
+		port = receiver.getsockname()[1]
+
+		host_control_backend._set_broadcast_addresses({"127.0.0.0/8": {"127.0.0.1": [port]}})  # pylint: disable=protected-access
+		host_control_backend._wakeOnLanInterval = 0.05  # pylint: disable=protected-access
+		host_control_backend.host_createObjects([
+			OpsiClient(id="client1.test.invalid", ipAddress="127.0.0.10", hardwareAddress="00:01:02:03:04:05"),
+			OpsiClient(id="client2.test.invalid", ipAddress="127.0.0.11", hardwareAddress="00:01:02:03:04:06"),
+			OpsiClient(id="client3.test.invalid", ipAddress="127.0.0.12"),
+		])
+
+		start = time.monotonic()
+		result = host_control_backend.hostControl_start(["client1.test.invalid", "client2.test.invalid", "client3.test.invalid"])
+		# Packets to the same broadcast address are paced
+		assert time.monotonic() - start >= 0.05
+
+		assert result["client1.test.invalid"] == {"result": "sent", "error": None}
+		assert result["client2.test.invalid"] == {"result": "sent", "error": None}
+		assert result["client3.test.invalid"]["result"] is None
+		assert result["client3.test.invalid"]["error"]
+
+		assert sorted([receiver.recv(1024), receiver.recv(1024)]) == [
+			b"\xff" * 6 + bytes.fromhex("000102030405") * 16,
+			b"\xff" * 6 + bytes.fromhex("000102030406") * 16,
+		]
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) uib GmbH <info@uib.de>
+# License: AGPL-3.0
+"""
+Testing the cache for rpc responses.
+"""
+
+import gzip
+import json
+import time
+
+import pytest
+
+from OPSI.Backend.Manager.AccessControl import UserStore
+from OPSI.Object import LocalbootProduct, OpsiClient, OpsiDepotserver
+from OPSI.Service.JsonRpc import JsonRpc
+from OPSI.Service.ResponseCache import TID_PLACEHOLDER, CachedResponse, ResponseCache
+from OPSI.Service.Worker import WorkerOpsiJsonRpc
+
+from .helpers import mock
+
+
+class FakeRPC:
+	def __init__(self, method, params=None, tid=1, rpcVersion=None, type=None):  # pylint: disable=redefined-builtin
+		self.method = method
+		self.params = params or []
+		self.tid = tid
+		self.rpcVersion = rpcVersion
+		self.type = type
+
+	def getMethodName(self):
+		return self.method
+
+
+@pytest.fixture
+def responseCache():
+	return ResponseCache(
+		cacheableMethods={
+			"backend_info": (300, ()),
+			"product_getObjects": (300, ("Product",)),
+			"host_getObjects": (0, ("Host",)),
+		}
+	)
+
+
+def cachedResponse(response=None):
+	return CachedResponse([response or {"id": 1, "result": "info", "error": None}])
+
+
+def encodeJson(response):
+	return json.dumps(response).encode("utf-8")
+
+
+def testStoringAndGettingResponse(responseCache):
+	key = responseCache.getKey([FakeRPC("backend_info")], "admin")
+	assert responseCache.get(key) is None
+
+	response = cachedResponse()
+	responseCache.set(key, response)
+	assert responseCache.get(key) is response
+	assert key == responseCache.getKey([FakeRPC("backend_info", tid=5)], "admin")
+
+
+@pytest.mark.parametrize("response, expected", [
+	({"id": 1, "result": "info", "error": None}, {"id": 5, "result": "info", "error": None}),
+	({"tid": 1, "type": "rpc", "result": "info"}, {"tid": 5, "type": "rpc", "result": "info"}),
+])
+def testTransactionIdOfRequestIsUsed(response, expected):
+	body = cachedResponse(response).getBody([5], "application/json", None, encodeJson, lambda data: data)
+	assert json.loads(body) == expected
+
+
+def testTransactionIdsOfBatchAreUsed():
+	response = CachedResponse([{"id": 1, "result": "id", "error": None}, {"id": 2, "result": 3, "error": None}])
+	body = response.getBody(["a", 7], "application/json", None, encodeJson, lambda data: data)
+	assert json.loads(body) == [{"id": "a", "result": "id", "error": None}, {"id": 7, "result": 3, "error": None}]
+
+
+def testCachedBodyIsNotEncodedAgain():
+	encode = mock.Mock(wraps=encodeJson)
+	compress = mock.Mock(wraps=gzip.compress)
+	response = cachedResponse({"id": 1, "result": {"opsiVersion": "4.2"}, "error": None})
+
+	body = response.getBody([1], "application/json", "gzip", encode, compress)
+	assert json.loads(gzip.decompress(body)) == {"id": 1, "result": {"opsiVersion": "4.2"}, "error": None}
+	assert compress.call_count == 1
+
+	encode.reset_mock()
+	assert response.getBody([1], "application/json", "gzip", encode, compress) is body
+	encode.assert_not_called()
+	assert compress.call_count == 1
+
+	body = response.getBody([2], "application/json", "gzip", encode, compress)
+	assert json.loads(gzip.decompress(body)) == {"id": 2, "result": {"opsiVersion": "4.2"}, "error": None}
+	# Only the transaction id is encoded
+	encode.assert_called_once_with(2)
+	assert compress.call_count == 2
+
+	body = response.getBody([2], "application/json", None, encode, lambda data: data)
+	assert json.loads(body)["id"] == 2
+
+
+def testResponseContainingPlaceholderIsEncodedAsWhole():
+	response = CachedResponse([{"id": 1, "result": TID_PLACEHOLDER, "error": None}])
+	body = response.getBody([3], "application/json", None, encodeJson, lambda data: data)
+	assert json.loads(body) == {"id": 3, "result": TID_PLACEHOLDER, "error": None}
+
+
+def testUncacheableMethodHasNoKey(responseCache):
+	assert responseCache.getKey([FakeRPC("backend_info"), FakeRPC("host_delete")], "admin") is None
+
+
+def testUnknownIdentityHasNoKey(responseCache):
+	assert responseCache.getKey([FakeRPC("backend_info")], None) is None
+
+
+def testKeyUsesCanonicalParams(responseCache):
+	key1 = responseCache.getKey([FakeRPC("product_getObjects", [[], {"id": "a", "type": "LocalbootProduct"}])], "admin")
+	key2 = responseCache.getKey([FakeRPC("product_getObjects", [[], {"type": "LocalbootProduct", "id": "a"}])], "admin")
+	assert key1 == key2
+
+
+@pytest.mark.parametrize(
+	"rpc, identity",
+	[
+		(FakeRPC("backend_info", rpcVersion="2.0"), "admin"),
+		(FakeRPC("backend_info", type="rpc"), "admin"),
+		(FakeRPC("backend_info", params=[["id"]]), "admin"),
+		(FakeRPC("backend_info"), ("client", "client.test.invalid")),
+	],
+)
+def testKeyDiffers(responseCache, rpc, identity):
+	key = responseCache.getKey([FakeRPC("backend_info")], "admin")
+	assert key != responseCache.getKey([rpc], identity)
+
+
+def testExpiredEntriesAreNotReturned(responseCache, monkeypatch):
+	key = responseCache.getKey([FakeRPC("backend_info")], "admin")
+	responseCache.set(key, cachedResponse())
+
+	now = time.time()
+	monkeypatch.setattr(time, "time", lambda: now + 301)
+	assert responseCache.get(key) is None
+
+
+def testZeroTimeToLiveIsNotCached(responseCache):
+	key = responseCache.getKey([FakeRPC("host_getObjects")], "admin")
+	responseCache.set(key, cachedResponse())
+	assert responseCache.get(key) is None
+
+
+def testLeastRecentlyUsedEntryIsDropped():
+	responseCache = ResponseCache(maxEntries=2)
+	rpcs = [FakeRPC("backend_info", params=[[str(index)]]) for index in range(3)]
+	keys = [responseCache.getKey([rpc], "admin") for rpc in rpcs]
+	responseCache.set(keys[0], cachedResponse())
+	responseCache.set(keys[1], cachedResponse())
+	assert responseCache.get(keys[0])
+	responseCache.set(keys[2], cachedResponse())
+
+	assert responseCache.get(keys[0])
+	assert responseCache.get(keys[1]) is None
+	assert responseCache.get(keys[2])
+
+
+def testModificationInvalidatesDependingMethods(responseCache):
+	infoKey = responseCache.getKey([FakeRPC("backend_info")], "admin")
+	productKey = responseCache.getKey([FakeRPC("product_getObjects")], "admin")
+	responseCache.set(infoKey, cachedResponse())
+	responseCache.set(productKey, cachedResponse())
+
+	responseCache.objectInserted(None, OpsiClient(id="client.test.invalid"))
+	assert responseCache.get(productKey)
+
+	responseCache.objectUpdated(None, LocalbootProduct(id="product", productVersion="1", packageVersion="1"))
+	assert responseCache.get(productKey) is None
+	assert responseCache.get(infoKey)
+
+
+def testDeletingHashesInvalidates(responseCache):
+	productKey = responseCache.getKey([FakeRPC("product_getObjects")], "admin")
+	responseCache.set(productKey, cachedResponse())
+
+	responseCache.objectsDeleted(None, [{"type": "NetbootProduct", "id": "product"}])
+	assert responseCache.get(productKey) is None
+
+
+@pytest.mark.parametrize("methodName, invalidated", [
+	("localbootProduct_createObjects", {"product_getObjects"}),
+	("host_updateObjects", set()),
+	("product_getIdents", set()),
+	("accessControl_authenticated", set()),
+	("setProductActionRequest", {"backend_info", "product_getObjects"}),
+])
+def testExecutedRpcsInvalidate(responseCache, methodName, invalidated):
+	for method in ("backend_info", "product_getObjects"):
+		responseCache.set(responseCache.getKey([FakeRPC(method)], "admin"), cachedResponse())
+
+	responseCache.rpcExecuted(methodName)
+
+	for method in ("backend_info", "product_getObjects"):
+		cached = responseCache.get(responseCache.getKey([FakeRPC(method)], "admin"))
+		assert (cached is None) == (method in invalidated)
+
+
+def testResponseIsNotStoredAfterInvalidation(responseCache):
+	key = responseCache.getKey([FakeRPC("product_getObjects")], "admin")
+	generation = responseCache.generation
+
+	responseCache.objectUpdated(None, LocalbootProduct(id="product", productVersion="1", packageVersion="1"))
+	responseCache.set(key, cachedResponse(), generation)
+	assert responseCache.get(key) is None
+
+	responseCache.set(key, cachedResponse(), responseCache.generation)
+	assert responseCache.get(key)
+
+
+class FakeBackend:
+	def __init__(self):
+		self.executed = []
+		self.products = ["product1"]
+
+	def backend_info(self):
+		self.executed.append("backend_info")
+		return {"opsiVersion": "4.2"}
+
+	def product_getObjects(self):
+		self.executed.append("product_getObjects")
+		return list(self.products)
+
+	def product_createObjects(self, product):
+		self.executed.append("product_createObjects")
+		self.products.append(product)
+
+
+INTERFACE = [
+	{"name": name, "args": [], "varargs": None, "keywords": None}
+	for name in ("backend_info", "product_getObjects", "product_createObjects")
+]
+
+
+class FakeService:
+	def __init__(self, responseCache):
+		self.responseCache = responseCache
+
+	def _getResponseCache(self):
+		return self.responseCache
+
+
+class FakeSession:
+	authenticated = True
+	user = "admin"
+
+
+class FakeRequest:
+	def __init__(self):
+		self.data = b""
+		self.headers = {}
+
+	def getHeader(self, name):
+		return self.headers.get(name)
+
+	def setResponseCode(self, code):
+		pass
+
+	def setHeader(self, name, value):
+		pass
+
+	def write(self, data):
+		self.data += data
+
+
+@pytest.fixture
+def backend():
+	return FakeBackend()
+
+
+@pytest.fixture
+def createWorker(responseCache, backend, monkeypatch):
+	monkeypatch.setattr(WorkerOpsiJsonRpc, "_executeRpc", lambda self, result, rpc: rpc.execute())
+
+	def createWorker(*rpcs):
+		worker = WorkerOpsiJsonRpc(service=FakeService(responseCache), request=FakeRequest(), resource=None)
+		worker.session = FakeSession()
+		worker._callInstance = backend
+		worker._rpcs = [JsonRpc(instance=backend, interface=INTERFACE, rpc=rpc) for rpc in rpcs]
+		return worker
+
+	return createWorker
+
+
+def processRpcs(worker, generateResponse=True):
+	worker._lookupCachedResponse(None)
+	worker._executeRpcs(None)
+	worker._invalidateCachedResponses(None)
+	if generateResponse:
+		return getResponse(worker)
+	return None
+
+
+def getResponse(worker):
+	worker._generateResponse(None)
+	return json.loads(worker.request.data)
+
+
+def testWorkerSendsCachedResponseWithTransactionIdOfRequest(createWorker, backend):
+	response = processRpcs(createWorker({"id": 1, "method": "backend_info", "params": []}))
+	assert response == {"id": 1, "result": {"opsiVersion": "4.2"}, "error": None}
+
+	response = processRpcs(createWorker({"id": 2, "method": "backend_info", "params": []}))
+	assert response == {"id": 2, "result": {"opsiVersion": "4.2"}, "error": None}
+	assert backend.executed == ["backend_info"]
+
+
+def testWorkerSendsCachedCompressedBody(createWorker, backend):
+	compressResponse = WorkerOpsiJsonRpc._compressResponse  # pylint: disable=protected-access
+	with mock.patch.object(WorkerOpsiJsonRpc, "_compressResponse", wraps=compressResponse) as compress:
+		for tid in (1, 1, 2):
+			worker = createWorker({"id": tid, "method": "backend_info", "params": []})
+			worker.request.headers["Accept-Encoding"] = "gzip"
+			processRpcs(worker, generateResponse=False)
+			worker._generateResponse(None)  # pylint: disable=protected-access
+			assert json.loads(gzip.decompress(worker.request.data)) == {"id": tid, "result": {"opsiVersion": "4.2"}, "error": None}
+
+		# The body for the repeated transaction id is sent as it is
+		assert compress.call_count == 2
+	assert backend.executed == ["backend_info"]
+
+
+def testWorkerInvalidatesCacheAfterModifyingRpc(createWorker, backend):
+	processRpcs(createWorker({"id": 1, "method": "product_getObjects", "params": []}))
+	processRpcs(createWorker({"id": 2, "method": "product_createObjects", "params": ["product2"]}))
+
+	response = processRpcs(createWorker({"id": 3, "method": "product_getObjects", "params": []}))
+	assert response["result"] == ["product1", "product2"]
+	assert backend.executed == ["product_getObjects", "product_createObjects", "product_getObjects"]
+
+
+def testWorkerDoesNotStoreResponseReadDuringModification(createWorker, backend):
+	reader = createWorker({"id": 1, "method": "product_getObjects", "params": []})
+	processRpcs(reader, generateResponse=False)
+	processRpcs(createWorker({"id": 2, "method": "product_createObjects", "params": ["product2"]}))
+	assert getResponse(reader)["result"] == ["product1"]
+
+	response = processRpcs(createWorker({"id": 3, "method": "product_getObjects", "params": []}))
+	assert response["result"] == ["product1", "product2"]
+	assert backend.executed == ["product_getObjects", "product_createObjects", "product_getObjects"]
+
+
+@pytest.mark.parametrize("host, isAdmin, identity", [
+	(None, True, ("admin",)),
+	(None, False, None),
+	(OpsiDepotserver(id="depot.test.invalid"), True, ("depot",)),
+	(OpsiClient(id="client.test.invalid"), False, ("client", "client.test.invalid")),
+])
+def testAclIdentityOfWorker(createWorker, backend, host, isAdmin, identity):
+	userStore = UserStore()
+	userStore.authenticated = True
+	userStore.host = host
+	userStore.isAdmin = isAdmin
+
+	class FakeAccessControl:  # pylint: disable=too-few-public-methods
+		user_store = userStore
+
+	backend.backendAccessControl = FakeAccessControl()
+	assert createWorker()._getAclIdentity() == identity
@@ -15,6 +15,7 @@ from OPSI.Object import (
 from .test_hosts import getClients
 from .test_products import getLocalbootProducts
 from .test_license_management import createLicensePool
+from .helpers import mock
 
 
 def getAuditHardwares():
@@ -441,6 +442,58 @@ def test_insertAuditSoftwareOnClient(auditDataBackend):
 	assert len(auditSoftwareOnClients) == len(asoc)
 
 
+def testReplacingSoftwareInventory(auditDataBackend):
+	asoc, auditSoftwares, clients = fillBackendWithAuditSoftwareOnClient(auditDataBackend)
+	client1, client2 = clients[:2]
+	auditSoftwareOnClient1 = asoc[0]
+
+	newAuditSoftware = AuditSoftware(
+		name='New software', version='2.0', subVersion='', language='', architecture='x64', windowsDisplayName='New'
+	)
+	newAuditSoftwareOnClient = AuditSoftwareOnClient(
+		name=newAuditSoftware.name,
+		version=newAuditSoftware.version,
+		subVersion=newAuditSoftware.subVersion,
+		language=newAuditSoftware.language,
+		architecture=newAuditSoftware.architecture,
+		clientId=client1.id,
+		usageFrequency=1
+	)
+	updatedAuditSoftwareOnClient = auditSoftwareOnClient1.clone()
+	updatedAuditSoftwareOnClient.setBinaryName('replaced.exe')
+
+	auditDataBackend.auditSoftwareOnClient_replaceInventory(
+		client1.id, [updatedAuditSoftwareOnClient, newAuditSoftwareOnClient], [auditSoftwares[0], newAuditSoftware]
+	)
+
+	inventory = auditDataBackend.auditSoftwareOnClient_getObjects(clientId=client1.id)
+	assert len(inventory) == 2
+	inventory = {auditSoftwareOnClient.name: auditSoftwareOnClient for auditSoftwareOnClient in inventory}
+	assert inventory[auditSoftwareOnClient1.name].binaryName == 'replaced.exe'
+	assert inventory[newAuditSoftware.name].usageFrequency == 1
+
+	assert auditDataBackend.auditSoftware_getObjects(name=newAuditSoftware.name)
+	assert len(auditDataBackend.auditSoftware_getObjects()) == len(auditSoftwares) + 1
+
+	# Other clients are not touched
+	assert len(auditDataBackend.auditSoftwareOnClient_getObjects(clientId=client2.id)) == 1
+
+
+def testReplacingSoftwareInventoryWithEmptyInventory(auditDataBackend):
+	_, _, clients = fillBackendWithAuditSoftwareOnClient(auditDataBackend)
+
+	auditDataBackend.auditSoftwareOnClient_replaceInventory(clients[0].id, [])
+	assert not auditDataBackend.auditSoftwareOnClient_getObjects(clientId=clients[0].id)
+	assert auditDataBackend.auditSoftwareOnClient_getObjects(clientId=clients[1].id)
+
+
+def testReplacingSoftwareInventoryRejectsForeignClients(auditDataBackend):
+	asoc, _, clients = fillBackendWithAuditSoftwareOnClient(auditDataBackend)
+
+	with pytest.raises(Exception):
+		auditDataBackend.auditSoftwareOnClient_replaceInventory(clients[0].id, [asoc[3]])
+
+
 def fillBackendWithAuditSoftwareOnClient(backend):
 	auditSoftwares = getAuditSoftwares()
 	backend.auditSoftware_createObjects(auditSoftwares)
@@ -509,6 +562,29 @@ def testSelecingAuditHardwareOnHostByLastseen(auditDataBackend):
 	assert auditHardwareOnHost4update == auditHardwareOnHosts[0]
 
 
+def testSelectingAuditHardwareOnHostByDeviceAndHostAttributes(auditDataBackend):
+	ahoh, _, clients = fillBackendWithAuditHardwareOnHosts(auditDataBackend)
+
+	auditHardwareOnHosts = auditDataBackend.auditHardwareOnHost_getObjects(hostId=clients[0].id, vendor='Dell')
+	assert len(auditHardwareOnHosts) == 1
+	assert auditHardwareOnHosts[0].serialNumber == ahoh[0].serialNumber
+	assert auditHardwareOnHosts[0].model == ahoh[0].model
+
+	assert not auditDataBackend.auditHardwareOnHost_getObjects(hostId=clients[2].id, vendor='Dell')
+
+
+def testGettingAuditHardwareOnHostHashesWithAttributes(auditDataBackend):
+	fillBackendWithAuditHardwareOnHosts(auditDataBackend)
+
+	hashes = auditDataBackend.auditHardwareOnHost_getHashes(attributes=['hostId', 'serialNumber'], hardwareClass='COMPUTER_SYSTEM')
+	assert len(hashes) == 3
+	for auditHardwareOnHost in hashes:
+		assert auditHardwareOnHost['hardwareClass'] == 'COMPUTER_SYSTEM'
+		assert auditHardwareOnHost['hostId']
+		assert auditHardwareOnHost['serialNumber']
+		assert 'vendor' in auditHardwareOnHost
+
+
 @pytest.mark.parametrize("searchTerms", [
 	['CHASSIS', 'COMPUTER_SYSTEM'],
 	['CHA*IS', '*UTER_SYS*']
@@ -624,6 +700,123 @@ def testAuditHardwareOnHostSetObsolete(auditDataBackend):
 		assert auditHardwareOnHost.getState() == 0
 
 
+def testReplacingHardwareInventory(auditDataBackend):
+	auditHardwareOnHosts, _, clients = fillBackendWithAuditHardwareOnHosts(auditDataBackend)
+	client1, client2 = clients[:2]
+
+	newAuditHardwareOnHost = AuditHardwareOnHost(
+		hostId=client1.id,
+		hardwareClass='COMPUTER_SYSTEM',
+		description='a new pc',
+		vendor='Lenovo',
+		model='abc',
+		serialNumber='1234-5678',
+		systemType='Laptop',
+		totalPhysicalMemory=2147483648
+	)
+
+	auditDataBackend.auditHardwareOnHost_replaceInventory(client1.id, [auditHardwareOnHosts[0].clone(), newAuditHardwareOnHost])
+
+	current = auditDataBackend.auditHardwareOnHost_getObjects(hostId=client1.id, state=1)
+	assert len(current) == 2
+	assert {ahoh.getHardwareClass() for ahoh in current} == {'COMPUTER_SYSTEM'}
+	assert {ahoh.serialNumber for ahoh in current} == {auditHardwareOnHosts[0].serialNumber, '1234-5678'}
+	assert auditDataBackend.auditHardware_getObjects(hardwareClass='COMPUTER_SYSTEM', vendor='Lenovo')
+
+	# Other hosts are not touched
+	assert len(auditDataBackend.auditHardwareOnHost_getObjects(hostId=client2.id, state=1)) == 2
+
+
+def testUpdatingAuditHardwareOnHostsKeepsOtherEntries(auditDataBackend):
+	auditHardwareOnHosts, _, clients = fillBackendWithAuditHardwareOnHosts(auditDataBackend)
+	client1 = clients[0]
+
+	newAuditHardwareOnHost = AuditHardwareOnHost(
+		hostId=client1.id,
+		hardwareClass='BASE_BOARD',
+		name='Another board',
+		description=None,
+		vendor='ASUS',
+		model='P5',
+		product=None,
+		serialNumber='1-2-3'
+	)
+	auditDataBackend.auditHardwareOnHost_updateObjects([auditHardwareOnHosts[0].clone(), auditHardwareOnHosts[1].clone(), newAuditHardwareOnHost])
+
+	assert len(auditDataBackend.auditHardwareOnHost_getObjects(hostId=client1.id, state=1)) == 3
+	assert len(auditDataBackend.auditHardwareOnHost_getObjects(hostId=clients[1].id, state=1)) == 2
+	assert auditDataBackend.auditHardwareOnHost_getObjects(hostId=client1.id, serialNumber='1-2-3')
+
+
+def testUpdatingAuditHardwareOnHostsWritesTheirState(auditDataBackend):
+	auditHardwareOnHosts, _, clients = fillBackendWithAuditHardwareOnHosts(auditDataBackend)
+	client1 = clients[0]
+
+	auditHardwareOnHost = auditHardwareOnHosts[0].clone()
+	auditHardwareOnHost.setState(0)
+	auditHardwareOnHost.setFirstseen('2020-01-01 10:00:00')
+	auditHardwareOnHost.setLastseen('2020-02-01 10:00:00')
+	auditDataBackend.auditHardwareOnHost_updateObjects([auditHardwareOnHost])
+
+	updated = auditDataBackend.auditHardwareOnHost_getObjects(hostId=client1.id, state=0)
+	assert len(updated) == 1
+	assert updated[0].getFirstseen() == '2020-01-01 10:00:00'
+	assert updated[0].getLastseen() == '2020-02-01 10:00:00'
+	assert len(auditDataBackend.auditHardwareOnHost_getObjects(hostId=client1.id, state=1)) == 1
+
+
+def testReplacingHardwareInventoryRepeatedly(auditDataBackend):
+	auditHardwareOnHosts, _, clients = fillBackendWithAuditHardwareOnHosts(auditDataBackend)
+	client1 = clients[0]
+	inventory = [ahoh for ahoh in auditHardwareOnHosts if ahoh.hostId == client1.id]
+
+	for _ in range(3):
+		auditDataBackend.auditHardwareOnHost_replaceInventory(client1.id, [ahoh.clone() for ahoh in inventory])
+
+	assert len(auditDataBackend.auditHardwareOnHost_getObjects(hostId=client1.id)) == len(inventory)
+	assert len(auditDataBackend.auditHardwareOnHost_getObjects(hostId=client1.id, state=1)) == len(inventory)
+
+
+def testReplacingHardwareInventoryRejectsForeignHosts(auditDataBackend):
+	auditHardwareOnHosts, _, clients = fillBackendWithAuditHardwareOnHosts(auditDataBackend)
+
+	with pytest.raises(Exception):
+		auditDataBackend.auditHardwareOnHost_replaceInventory(clients[0].id, [auditHardwareOnHosts[1]])
+
+
+def testReplacingHardwareInventoryUsesCachedHardwareIds(hardwareAuditBackendWithHistory):
+	backend = hardwareAuditBackendWithHistory
+	sqlBackend = backend._backend  # pylint: disable=protected-access
+	clients = getClients()
+	backend.host_createObjects(clients)
+	inventory = [ahoh for ahoh in getAuditHardwareOnHost(clients=clients) if ahoh.hostId == clients[0].id]
+
+	backend.auditHardwareOnHost_replaceInventory(clients[0].id, [ahoh.clone() for ahoh in inventory])
+	assert len(sqlBackend._hardwareIdCache) == len(inventory)  # pylint: disable=protected-access
+
+	# Devices are only searched if they are not cached
+	with mock.patch.object(sqlBackend, '_uniqueAuditHardwareCondition', side_effect=AssertionError("Device searched")):
+		backend.auditHardwareOnHost_replaceInventory(clients[0].id, [ahoh.clone() for ahoh in inventory])
+	assert len(backend.auditHardwareOnHost_getObjects(hostId=clients[0].id, state=1)) == len(inventory)
+
+
+def testHardwareIdsOfRolledBackInventoryAreNotCached(hardwareAuditBackendWithHistory):
+	backend = hardwareAuditBackendWithHistory
+	sqlBackend = backend._backend  # pylint: disable=protected-access
+	clients = getClients()
+	backend.host_createObjects(clients)
+	inventory = [ahoh for ahoh in getAuditHardwareOnHost(clients=clients) if ahoh.hostId == clients[0].id]
+
+	with mock.patch.object(sqlBackend._sql, 'insertMany', side_effect=RuntimeError("Failed")):  # pylint: disable=protected-access
+		with pytest.raises(RuntimeError):
+			backend.auditHardwareOnHost_replaceInventory(clients[0].id, [ahoh.clone() for ahoh in inventory])
+	assert not sqlBackend._hardwareIdCache  # pylint: disable=protected-access
+	assert not backend.auditHardware_getObjects()
+
+	backend.auditHardwareOnHost_replaceInventory(clients[0].id, [ahoh.clone() for ahoh in inventory])
+	assert len(backend.auditHardwareOnHost_getObjects(hostId=clients[0].id, state=1)) == len(inventory)
+
+
 def fillBackendWithAuditHardwareOnHosts(backend):
 	clients = getClients()
 	backend.host_createObjects(clients)
@@ -27,6 +27,7 @@ from OPSI.Util import (
 	fromJson,
 	generateOpsiHostKey,
 	getfqdn,
+	getWorkerCount,
 	ipAddressInNetwork,
 	isRegularExpressionPattern,
 	md5sum,
@@ -41,6 +42,7 @@ from OPSI.Util.Config import getGlobalConfig
 
 from .helpers import (
 	fakeGlobalConf,
+	mock,
 	patchAddress,
 	patchEnvironmentVariables,
 	workInTemporaryDirectory,
@@ -370,6 +372,16 @@ def testCreatingMd5sum(test_data_path, test_file, expected_hash):
 	assert md5sum(os.path.join(test_data_path, test_file)) == expected_hash
 
 
+@pytest.mark.parametrize("workers", [None, 0, -1])
+def testWorkerCountDefaultsToNumberOfCPUs(workers):
+	with mock.patch("os.cpu_count", return_value=6):
+		assert getWorkerCount(workers) == 6
+
+
+def testGettingRequestedWorkerCount():
+	assert getWorkerCount(3) == 3
+
+
 def testChunkingList():
 	base = list(range(10))
 
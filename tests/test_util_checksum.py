@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) uib GmbH <info@uib.de>
+# License: AGPL-3.0
+"""
+Testing the calculation of checksums.
+"""
+
+import hashlib
+import os
+
+import pytest
+
+from OPSI.Util import md5sum
+from OPSI.Util.Checksum import ChecksumCache, _getChecksumCacheFile, getChecksumCache, md5sums
+
+from .helpers import mock
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def testMd5sumsAreReturnedInOrder(tempDir, workers):
+	filenames = []
+	for index in range(50):
+		filename = os.path.join(tempDir, f"file{index}")
+		with open(filename, "wb") as file:
+			file.write(os.urandom(index * 100))
+		filenames.append(filename)
+
+	assert list(md5sums(filenames, workers=workers)) == [(filename, md5sum(filename)) for filename in filenames]
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def testMd5sumsIgnoringErrors(tempDir, workers):
+	filename = os.path.join(tempDir, "existing")
+	with open(filename, "wb") as file:
+		file.write(b"opsi")
+	missing = os.path.join(tempDir, "missing")
+
+	with pytest.raises(OSError):
+		list(md5sums([missing, filename], workers=workers))
+
+	assert list(md5sums([missing, filename], workers=workers, ignoreErrors=True)) == [(missing, None), (filename, md5sum(filename))]
+
+
+@pytest.mark.parametrize("bufferSize", [7, 1000, 1024 * 1024])
+def testMd5sumIsCalculatedInChunks(tempDir, bufferSize):
+	filename = os.path.join(tempDir, "large")
+	data = os.urandom(1024 * 1024 + 1)
+	with open(filename, "wb") as file:
+		file.write(data)
+
+	with mock.patch("OPSI.Util.MD5SUM_BUFFER_SIZE", bufferSize):
+		assert md5sum(filename) == hashlib.md5(data).hexdigest()
+
+
+def testChecksumCacheReturnsStoredChecksumOfUnchangedFiles(tempDir):
+	filename = os.path.join(tempDir, "file")
+	with open(filename, "wb") as file:
+		file.write(b"opsi")
+	expected = md5sum(filename)
+
+	with getChecksumCache() as cache:
+		assert cache.get(filename) is None
+		assert cache.md5sum(filename) == expected
+
+	with getChecksumCache() as cache:
+		with mock.patch("OPSI.Util.Checksum.md5sum") as md5sumMock:
+			assert cache.md5sum(filename) == expected
+			assert list(md5sums([filename], workers=2, cache=cache)) == [(filename, expected)]
+			md5sumMock.assert_not_called()
+
+
+def testChecksumCacheDetectsModifiedFiles(tempDir):
+	filename = os.path.join(tempDir, "file")
+	with open(filename, "wb") as file:
+		file.write(b"opsi")
+
+	with getChecksumCache() as cache:
+		cache.set(filename, "0123456789abcdef0123456789abcdef")
+		assert cache.get(filename) == "0123456789abcdef0123456789abcdef"
+
+		fileStat = os.stat(filename)
+		os.utime(filename, ns=(fileStat.st_atime_ns, fileStat.st_mtime_ns + 1_000_000_000))
+		assert cache.get(filename) is None
+		assert cache.md5sum(filename) == md5sum(filename)
+
+
+def testChecksumCacheIsNotStoredNextToFiles(tempDir, checksum_cache_file):
+	filename = os.path.join(tempDir, "file")
+	with open(filename, "wb") as file:
+		file.write(b"opsi")
+
+	with getChecksumCache() as cache:
+		cache.md5sum(filename)
+
+	assert os.listdir(tempDir) == ["file"]
+	assert os.path.exists(checksum_cache_file)
+
+
+def testUnavailableChecksumCache(tempDir):
+	filename = os.path.join(tempDir, "file")
+	with open(filename, "wb") as file:
+		file.write(b"opsi")
+
+	# A regular file is in the way of the directory
+	with ChecksumCache(os.path.join(filename, "cache.sqlite")) as cache:
+		assert not cache.available
+		assert cache.md5sum(filename) == md5sum(filename)
+		assert list(md5sums([filename], cache=cache)) == [(filename, md5sum(filename))]
+
+
+def testChecksumCacheCreatesDirectory(tempDir):
+	cacheFile = os.path.join(tempDir, "missing", "cache.sqlite")
+	with ChecksumCache(cacheFile) as cache:
+		assert cache.available
+	assert os.path.exists(cacheFile)
+
+
+@pytest.mark.parametrize("osName, environ, expected", [
+	("posix", {}, "/var/lib/opsi/checksums.sqlite"),
+	("nt", {"PROGRAMDATA": "D:\\Data"}, os.path.join("D:\\Data", "opsi", "checksums.sqlite")),
+	("nt", {}, os.path.join("C:\\ProgramData", "opsi", "checksums.sqlite")),
+])
+def testChecksumCacheFileLocation(osName, environ, expected):
+	with mock.patch("OPSI.Util.Checksum.os.name", osName), mock.patch.dict(os.environ, environ, clear=True):
+		assert _getChecksumCacheFile() == expected
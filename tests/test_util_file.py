@@ -9,12 +9,14 @@ Testing OPSI.Util.File
 import os
 import shutil
 from contextlib import contextmanager
+from pathlib import Path
 
 import pytest
+from pyzsync import create_zsync_file
 
-from OPSI.Util.File import IniFile, InfFile, TxtSetupOemFile, ZsyncFile
+from OPSI.Util.File import IniFile, InfFile, TxtSetupOemFile, ZsyncBlockHasher, ZsyncFile
 
-from .helpers import createTemporaryTestfile
+from .helpers import createTemporaryTestfile, mock
 
 
 def testParsingIniFileDoesNotFail():
@@ -297,3 +299,57 @@ def testZsyncFile(tempDir, test_data_path):
 	zf = ZsyncFile(testFile)
 	zf.parse()
 	checkZsyncFile(zf)
+
+
+def readZsyncFileWithoutMTime(filename):
+	with open(filename, 'rb') as file:
+		(header, blocks) = file.read().split(b'\n\n', 1)
+	return [line for line in header.split(b'\n') if not line.startswith(b'MTime')], blocks
+
+
+@pytest.mark.parametrize('size', [0, 100, 2048, 5000, 3000123])
+def testZsyncBlockHasherMatchesGeneratedZsyncFile(tempDir, size):
+	dataFile = os.path.join(tempDir, 'data.opsi')
+	data = os.urandom(size)
+	with open(dataFile, 'wb') as file:
+		file.write(data)
+
+	hasher = ZsyncBlockHasher(size, 'data.opsi')
+	for offset in range(0, size, 7777):
+		hasher.update(data[offset:offset + 7777])
+
+	expectedFile = os.path.join(tempDir, 'expected.zsync')
+	create_zsync_file(Path(dataFile), Path(expectedFile), legacy_mode=True)
+	streamedFile = os.path.join(tempDir, 'streamed.zsync')
+	ZsyncFile(streamedFile).generate(zsyncInfo=hasher.getInfo())
+
+	assert readZsyncFileWithoutMTime(streamedFile) == readZsyncFileWithoutMTime(expectedFile)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+@pytest.mark.parametrize('size', [0, 100, 2048, 5000, 3000123])
+def testGeneratingZsyncFileFromDataFile(tempDir, size, workers):
+	dataFile = os.path.join(tempDir, 'data.opsi')
+	with open(dataFile, 'wb') as file:
+		file.write(os.urandom(size))
+
+	expectedFile = os.path.join(tempDir, 'expected.zsync')
+	create_zsync_file(Path(dataFile), Path(expectedFile), legacy_mode=True)
+	generatedFile = os.path.join(tempDir, 'generated.zsync')
+	# Small chunks to hash the data in many parts
+	with mock.patch.object(ZsyncFile, 'HASH_CHUNK_BLOCKS', 3):
+		ZsyncFile(generatedFile).generate(dataFile, workers=workers)
+
+	assert readZsyncFileWithoutMTime(generatedFile) == readZsyncFileWithoutMTime(expectedFile)
+
+	zsyncFile = ZsyncFile(generatedFile)
+	zsyncFile.parse()
+	assert zsyncFile._header['Length'] == str(size)
+	assert 'MTime' not in zsyncFile._header
+
+
+def testZsyncBlockHasherNeedsAllData():
+	hasher = ZsyncBlockHasher(100, 'data.opsi')
+	hasher.update(b'opsi')
+	with pytest.raises(ValueError):
+		hasher.getInfo()
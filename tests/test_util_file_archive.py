@@ -6,11 +6,25 @@
 Testing the work with archives.
 """
 
+import gzip
+import hashlib
+import io
 import os
+import random
+import stat
+import tarfile
+from types import SimpleNamespace
 
 import pytest
 
 from OPSI.Util.File.Archive import Archive, is_pigz_available
+from OPSI.Util.File.Archive.Stream import (
+	ArchiveExtractor,
+	PackageArchiveReader,
+	_CpioWriter,
+	_ExternalDecompressor,
+	openCompressed,
+)
 
 from .helpers import mock
 
@@ -36,3 +50,312 @@ def testDisablingPigz():
 	"""
 	with mock.patch("OPSI.Util.File.Opsi.OpsiConfFile.isPigzEnabled", lambda x: False):
 		assert is_pigz_available() is False
+
+
+def _createSourceFiles(sourceDir, count=50):
+	os.makedirs(os.path.join(sourceDir, "dir"))
+	filenames = [os.path.join(sourceDir, "dir")]
+	for index in range(count):
+		filename = os.path.join(sourceDir, "dir", f"file{index}")
+		with open(filename, "wb") as file:
+			file.write(os.urandom(index * 1000) + b"opsi\n" * index * 100)
+		filenames.append(filename)
+	os.symlink("file0", os.path.join(sourceDir, "dir", "link"))
+	filenames.append(os.path.join(sourceDir, "dir", "link"))
+	return filenames
+
+
+@pytest.mark.parametrize("fileFormat", ["tar", "cpio"])
+@pytest.mark.parametrize("compression", [None, "gzip", "bzip2"])
+def testCreatingAndExtractingArchiveInProcess(tempDir, fileFormat, compression):
+	sourceDir = os.path.join(tempDir, "source")
+	filenames = _createSourceFiles(sourceDir)
+	totalSize = sum(os.path.getsize(filename) for filename in filenames if os.path.isfile(filename) and not os.path.islink(filename))
+
+	progressSubject = mock.Mock()
+	archive = Archive(os.path.join(tempDir, "archive"), format=fileFormat, compression=compression, progressSubject=progressSubject)
+	with mock.patch("OPSI.Util.File.Archive.BaseArchive._communicate") as communicate:
+		archive.create(filenames, baseDir=sourceDir)
+		communicate.assert_not_called()
+	progressSubject.setEnd.assert_called_with(totalSize)
+	assert sum(call.args[0] for call in progressSubject.addToState.call_args_list) == totalSize
+
+	assert sorted(archive.content()) == sorted(os.path.relpath(filename, sourceDir) for filename in filenames)
+
+	targetDir = os.path.join(tempDir, "target")
+	archive = Archive(os.path.join(tempDir, "archive"), format=fileFormat)
+	archive.extract(targetPath=targetDir)
+	assert os.readlink(os.path.join(targetDir, "dir", "link")) == "file0"
+	for filename in filenames[1:-1]:
+		with open(filename, "rb") as file:
+			expected = file.read()
+		with open(os.path.join(targetDir, os.path.relpath(filename, sourceDir)), "rb") as file:
+			assert file.read() == expected
+
+
+def testExtractingArchiveWithPatterns(tempDir):
+	sourceDir = os.path.join(tempDir, "source")
+	filenames = _createSourceFiles(sourceDir, count=20)
+	archive = Archive(os.path.join(tempDir, "archive.cpio.gz"), format="cpio", compression="gzip")
+	archive.create(filenames, baseDir=sourceDir)
+
+	targetDir = os.path.join(tempDir, "target")
+	archive.extract(targetPath=targetDir, patterns=["dir/file1*"])
+	assert sorted(os.listdir(os.path.join(targetDir, "dir"))) == sorted(["file1"] + [f"file1{index}" for index in range(10)])
+
+
+def testExtractingTarArchiveWithTarCountsFiles(tempDir):
+	sourceDir = os.path.join(tempDir, "source")
+	filenames = _createSourceFiles(sourceDir, count=500)
+	archive = Archive(os.path.join(tempDir, "archive.tar"), format="tar")
+	archive.create(filenames, baseDir=sourceDir)
+
+	targetDir = os.path.join(tempDir, "target")
+	os.makedirs(targetDir)
+	progressSubject = mock.Mock()
+	archive = Archive(os.path.join(tempDir, "archive.tar"), progressSubject=progressSubject)
+	with mock.patch("OPSI.Util.File.Archive.BaseArchive._extractInProcess", side_effect=NotImplementedError("test")):
+		with mock.patch("OPSI.Util.File.Archive.BaseArchive._content", side_effect=NotImplementedError("test")):
+			archive.extract(targetPath=targetDir)
+	assert sum(call.args[0] for call in progressSubject.addToState.call_args_list) == len(filenames)
+	progressSubject.setState.assert_called_with(len(filenames))
+	assert sorted(os.listdir(os.path.join(targetDir, "dir"))) == sorted(os.path.basename(filename) for filename in filenames[1:])
+
+
+def testParallelGzipCompressionIsRsyncable():
+	rand = random.Random(0)
+	words = [bytes(rand.choices(b"abcdefghijklmnopqrstuvwxyz", k=rand.randint(2, 10))) for _ in range(5000)]
+	data = b" ".join(rand.choices(words, k=300000))
+	changed = data[:1000] + b"inserted" + data[1000:]
+
+	compressed = []
+	for uncompressed in (data, changed):
+		fileobj = io.BytesIO()
+		stream = openCompressed(fileobj, "gzip", workers=4)
+		stream.write(uncompressed)
+		stream.close()
+		compressed.append(fileobj.getvalue())
+		assert gzip.decompress(fileobj.getvalue()) == uncompressed
+
+	# Without the trailer containing checksum and size
+	common = os.path.commonprefix([compressed[0][-9::-1], compressed[1][-9::-1]])
+	assert len(common) > len(compressed[0]) * 0.9
+
+
+def _createTar(filename, files, mode="w"):
+	with tarfile.open(filename, mode) as tar:
+		for (name, data) in files.items():
+			info = tarfile.TarInfo(name)
+			if data is None:
+				info.type = tarfile.DIRTYPE
+				info.mode = 0o755
+				tar.addfile(info)
+			else:
+				info.size = len(data)
+				info.mode = 0o640
+				tar.addfile(info, io.BytesIO(data))
+
+
+def testExtractingPackageArchivesInProcess(tempDir):
+	_createTar(os.path.join(tempDir, "CLIENT_DATA.tar.gz"), {"dir": None, "dir/file.txt": b"content", "setup.opsiscript": b"script"}, "w:gz")
+	_createTar(os.path.join(tempDir, "CLIENT_DATA.custom.tar.bz2"), {"dir/file.txt": b"custom"}, "w:bz2")
+	packageFile = os.path.join(tempDir, "test.opsi")
+	with tarfile.open(packageFile, "w", format=tarfile.USTAR_FORMAT) as tar:
+		tar.add(os.path.join(tempDir, "CLIENT_DATA.tar.gz"), "CLIENT_DATA.tar.gz")
+		tar.add(os.path.join(tempDir, "CLIENT_DATA.custom.tar.bz2"), "CLIENT_DATA.custom.tar.bz2")
+
+	targetPath = os.path.join(tempDir, "target")
+	with PackageArchiveReader(packageFile) as packageArchive:
+		assert [member.name for member in packageArchive.getMembers()] == ["CLIENT_DATA.tar.gz", "CLIENT_DATA.custom.tar.bz2"]
+		for member in packageArchive.getMembers():
+			packageArchive.extractMember(member, targetPath)
+
+	with open(os.path.join(targetPath, "dir", "file.txt"), "rb") as file:
+		assert file.read() == b"custom"
+	with open(os.path.join(targetPath, "setup.opsiscript"), "rb") as file:
+		assert file.read() == b"script"
+	assert os.stat(os.path.join(targetPath, "setup.opsiscript")).st_mode & 0o777 == 0o640
+
+
+def testExtractingCpioPackageArchiveInProcess(tempDir, test_data_path):
+	packageFile = os.path.join(test_data_path, "backend", "testingproduct_23-42.opsi")
+	with PackageArchiveReader(packageFile) as packageArchive:
+		members = packageArchive.getMembers()
+		assert [member.name for member in members] == ["OPSI.cpio"]
+		packageArchive.extractMember(members[0], tempDir)
+
+	assert os.path.isfile(os.path.join(tempDir, "control"))
+
+
+def testExtractingPackageArchiveRefusesPathsOutsideTarget(tempDir):
+	_createTar(os.path.join(tempDir, "CLIENT_DATA.tar"), {"../evil": b"evil"})
+	packageFile = os.path.join(tempDir, "test.opsi")
+	with tarfile.open(packageFile, "w", format=tarfile.USTAR_FORMAT) as tar:
+		tar.add(os.path.join(tempDir, "CLIENT_DATA.tar"), "CLIENT_DATA.tar")
+
+	with PackageArchiveReader(packageFile) as packageArchive:
+		with pytest.raises(ValueError):
+			packageArchive.extractMember("CLIENT_DATA.tar", os.path.join(tempDir, "target"))
+	assert not os.path.exists(os.path.join(tempDir, "evil"))
+
+
+def testPackageArchiveReaderRejectsUnsupportedFormats(tempDir):
+	filename = os.path.join(tempDir, "test.opsi")
+	with open(filename, "wb") as file:
+		file.write(b"no archive" * 100)
+
+	with pytest.raises(NotImplementedError):
+		PackageArchiveReader(filename)
+
+
+def testCheckingUnsupportedInnerArchiveWritesNothing(tempDir):
+	_createTar(os.path.join(tempDir, "CLIENT_DATA.tar"), {"file.txt": b"content"})
+	with open(os.path.join(tempDir, "CLIENT_DATA.custom.tar"), "wb") as file:
+		file.write(b"no archive" * 100)
+	packageFile = os.path.join(tempDir, "test.opsi")
+	with tarfile.open(packageFile, "w", format=tarfile.USTAR_FORMAT) as tar:
+		tar.add(os.path.join(tempDir, "CLIENT_DATA.tar"), "CLIENT_DATA.tar")
+		tar.add(os.path.join(tempDir, "CLIENT_DATA.custom.tar"), "CLIENT_DATA.custom.tar")
+
+	with PackageArchiveReader(packageFile) as packageArchive:
+		packageArchive.checkMember("CLIENT_DATA.tar")
+		with pytest.raises(NotImplementedError):
+			packageArchive.checkMember("CLIENT_DATA.custom.tar")
+
+
+def testUnsupportedMemberAfterExtractionStartedIsNoNotImplementedError(tempDir):
+	archive = os.path.join(tempDir, "archive.cpio")
+	with open(archive, "wb") as file:
+		writer = _CpioWriter(file)
+		writer.add("file.txt", SimpleNamespace(st_mode=stat.S_IFREG | 0o644, st_mtime=0, st_uid=0, st_gid=0), data=b"content")
+		file.write(b"070707" + b"0" * 200)
+
+	targetPath = os.path.join(tempDir, "target")
+	with open(archive, "rb") as file:
+		with pytest.raises(RuntimeError) as excinfo:
+			ArchiveExtractor(targetPath).extract(file)
+	assert not isinstance(excinfo.value, NotImplementedError)
+	assert os.listdir(targetPath) == ["file.txt"]
+
+
+def testClosingExternalDecompressorKeepsOriginalException(tempDir):
+	archive = os.path.join(tempDir, "archive.tar")
+	_createTar(archive, {"../evil": b"evil", "file.txt": os.urandom(1024 * 1024)})
+
+	def openDecompressed(fileobj):
+		return _ExternalDecompressor(["cat"], fileobj)
+
+	with open(archive, "rb") as file:
+		with mock.patch("OPSI.Util.File.Archive.Stream.openDecompressed", openDecompressed):
+			with pytest.raises(ValueError):
+				ArchiveExtractor(os.path.join(tempDir, "target")).extract(file)
+
+
+def testArchiveExtractorHashesFilesAndSetsModes(tempDir):
+	archive = os.path.join(tempDir, "CLIENT_DATA.tar.gz")
+	_createTar(archive, {"dir": None, "dir/file.txt": b"content"}, "w:gz")
+
+	targetPath = os.path.join(tempDir, "target")
+	extractor = ArchiveExtractor(targetPath, hashFiles=True, fileMode=lambda mode: (mode | 0o660) & 0o770, directoryMode=0o2770)
+	with open(archive, "rb") as file:
+		extractor.extract(file)
+
+	filename = os.path.join("dir", "file.txt")
+	assert extractor.extracted == {"dir", filename}
+	fileStat = os.lstat(os.path.join(targetPath, filename))
+	assert extractor.files == {
+		filename: {"size": 7, "md5sum": hashlib.md5(b"content").hexdigest(), "mtime_ns": fileStat.st_mtime_ns, "inode": fileStat.st_ino}
+	}
+	assert os.stat(os.path.join(targetPath, filename)).st_mode & 0o7777 == 0o660
+	assert os.stat(os.path.join(targetPath, "dir")).st_mode & 0o7777 == 0o2770
+
+
+def _createMaliciousArchive(filename, fileFormat, linkTarget):
+	"""
+	Archive with a symbolic link to `linkTarget` followed by a file below the link.
+	"""
+	if fileFormat == "tar":
+		with tarfile.open(filename, "w") as tar:
+			info = tarfile.TarInfo("link")
+			info.type = tarfile.SYMTYPE
+			info.linkname = linkTarget
+			tar.addfile(info)
+			info = tarfile.TarInfo("link/file")
+			info.size = 4
+			tar.addfile(info, io.BytesIO(b"evil"))
+		return
+
+	with open(filename, "wb") as file:
+		writer = _CpioWriter(file)
+		writer.add("link", SimpleNamespace(st_mode=stat.S_IFLNK | 0o777, st_mtime=0, st_uid=0, st_gid=0), data=linkTarget.encode())
+		writer.add("link/file", SimpleNamespace(st_mode=stat.S_IFREG | 0o644, st_mtime=0, st_uid=0, st_gid=0), data=b"evil")
+		writer.close()
+
+
+@pytest.mark.parametrize("fileFormat", ["tar", "cpio"])
+@pytest.mark.parametrize("relative", [False, True])
+def testArchiveExtractorDoesNotWriteThroughSymlinks(tempDir, fileFormat, relative):
+	outside = os.path.join(tempDir, "outside")
+	os.makedirs(outside)
+	archive = os.path.join(tempDir, f"archive.{fileFormat}")
+	_createMaliciousArchive(archive, fileFormat, "../outside" if relative else outside)
+
+	targetPath = os.path.join(tempDir, "target")
+	with open(archive, "rb") as file:
+		with pytest.raises(ValueError):
+			ArchiveExtractor(targetPath).extract(file)
+	assert os.listdir(outside) == []
+
+
+def testArchiveExtractorRefusesLinkedDirectoriesInTarget(tempDir):
+	outside = os.path.join(tempDir, "outside")
+	os.makedirs(outside)
+	targetPath = os.path.join(tempDir, "target")
+	os.makedirs(targetPath)
+	os.symlink(outside, os.path.join(targetPath, "dir"))
+
+	archive = os.path.join(tempDir, "archive.tar")
+	_createTar(archive, {"dir/file.txt": b"evil"})
+	with open(archive, "rb") as file:
+		with pytest.raises(ValueError):
+			ArchiveExtractor(targetPath).extract(file)
+	assert os.listdir(outside) == []
+
+
+@pytest.mark.parametrize("fileFormat", ["tar", "cpio"])
+def testExtractingArchiveDoesNotWriteThroughSymlinks(tempDir, fileFormat):
+	outside = os.path.join(tempDir, "outside")
+	os.makedirs(outside)
+	filename = os.path.join(tempDir, f"archive.{fileFormat}")
+	_createMaliciousArchive(filename, fileFormat, outside)
+
+	archive = Archive(filename, format=fileFormat)
+	with pytest.raises(RuntimeError):
+		archive.extract(targetPath=os.path.join(tempDir, "target"))
+	assert os.listdir(outside) == []
+
+
+@pytest.mark.skipif(os.name != "posix" or os.geteuid() != 0, reason="Changing owners requires root")
+def testExtractingTarArchiveAsRootKeepsOwners(tempDir):
+	filename = os.path.join(tempDir, "archive.tar")
+	with tarfile.open(filename, "w") as tar:
+		info = tarfile.TarInfo("file.txt")
+		info.size = 4
+		(info.uid, info.gid) = (12345, 23456)
+		tar.addfile(info, io.BytesIO(b"data"))
+
+	targetDir = os.path.join(tempDir, "target")
+	Archive(filename, format="tar").extract(targetPath=targetDir)
+	fileStat = os.stat(os.path.join(targetDir, "file.txt"))
+	assert (fileStat.st_uid, fileStat.st_gid) == (12345, 23456)
+
+	filename = os.path.join(tempDir, "archive.cpio")
+	with open(filename, "wb") as file:
+		writer = _CpioWriter(file)
+		writer.add("file.txt", SimpleNamespace(st_mode=stat.S_IFREG | 0o644, st_mtime=0, st_uid=12345, st_gid=23456), data=b"data")
+		writer.close()
+
+	targetDir = os.path.join(tempDir, "target.cpio")
+	Archive(filename, format="cpio").extract(targetPath=targetDir)
+	fileStat = os.stat(os.path.join(targetDir, "file.txt"))
+	assert (fileStat.st_uid, fileStat.st_gid) == (os.geteuid(), os.getegid())
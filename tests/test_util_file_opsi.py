@@ -22,7 +22,7 @@ from OPSI.Util.File.Opsi import (
 	parseFilename,
 )
 
-from .helpers import createTemporaryTestfile, workInTemporaryDirectory
+from .helpers import createTemporaryTestfile, mock, workInTemporaryDirectory
 
 
 def testReadingAllUsedBackends():
@@ -116,6 +116,15 @@ def testGettingDefaultPigzStatus(opsiConfigFile):
 	assert opsiConfigFile.isPigzEnabled()
 
 
+def testReadingResponseCacheStatus(opsiConfigFile):
+	assert opsiConfigFile.isResponseCacheEnabled()
+
+
+def testResponseCacheIsDisabledByDefault(opsiConfigFile):
+	opsiConfigFile.parse([""])
+	assert not opsiConfigFile.isResponseCacheEnabled()
+
+
 @pytest.fixture
 def opsiControlFilePath(test_data_path):
 	# The file is the one that was causing a problem in
@@ -393,6 +402,60 @@ def testPackageContentFileCreation(outsideFile, outsideDir):
 		assert not content, "Files not listed in content file: {0}".format(", ".join(content))
 
 
+def testPackageContentFileUsesKnownFileInfo(tempDir):
+	with open(os.path.join(tempDir, "known"), "w") as file:
+		file.write("known")
+	with open(os.path.join(tempDir, "unknown"), "w") as file:
+		file.write("unknown")
+
+	filename = os.path.join(tempDir, "test.files")
+	contentFile = PackageContentFile(filename)
+	contentFile.setProductClientDataDir(tempDir)
+	contentFile.setClientDataFiles(["known", "unknown"])
+	fileStat = os.lstat(os.path.join(tempDir, "known"))
+	contentFile.setClientDataFileInfo(
+		{"known": {"size": 5, "md5sum": "0123456789abcdef0123456789abcdef", "mtime_ns": fileStat.st_mtime_ns, "inode": fileStat.st_ino}}
+	)
+	with mock.patch("OPSI.Util.Checksum.md5sum", wraps=md5sum) as md5sumMock:
+		contentFile.generate()
+		md5sumMock.assert_called_once_with(os.path.join(tempDir, "unknown"))
+
+	fileInfo = PackageContentFile(filename).parse()
+	assert fileInfo["known"]["md5sum"] == "0123456789abcdef0123456789abcdef"
+	assert fileInfo["unknown"]["md5sum"] == md5sum(os.path.join(tempDir, "unknown"))
+
+
+def testPackageContentFileIgnoresKnownFileInfoOfChangedFiles(tempDir):
+	for name in ("changed", "replaced", "directory"):
+		with open(os.path.join(tempDir, name), "w") as file:
+			file.write(name)
+	clientDataFileInfo = {}
+	for name in ("changed", "replaced", "directory"):
+		fileStat = os.lstat(os.path.join(tempDir, name))
+		clientDataFileInfo[name] = {
+			"size": fileStat.st_size, "md5sum": "0123456789abcdef0123456789abcdef", "mtime_ns": fileStat.st_mtime_ns, "inode": fileStat.st_ino
+		}
+
+	os.utime(os.path.join(tempDir, "changed"), ns=(0, 0))
+	with open(os.path.join(tempDir, "replaced.new"), "w") as file:
+		file.write("replaced")
+	os.rename(os.path.join(tempDir, "replaced.new"), os.path.join(tempDir, "replaced"))
+	os.unlink(os.path.join(tempDir, "directory"))
+	os.mkdir(os.path.join(tempDir, "directory"))
+
+	filename = os.path.join(tempDir, "test.files")
+	contentFile = PackageContentFile(filename)
+	contentFile.setProductClientDataDir(tempDir)
+	contentFile.setClientDataFiles(["changed", "replaced", "directory"])
+	contentFile.setClientDataFileInfo(clientDataFileInfo)
+	contentFile.generate()
+
+	fileInfo = PackageContentFile(filename).parse()
+	assert fileInfo["changed"]["md5sum"] == md5sum(os.path.join(tempDir, "changed"))
+	assert fileInfo["replaced"]["md5sum"] == md5sum(os.path.join(tempDir, "replaced"))
+	assert fileInfo["directory"]["type"] == "d"
+
+
 def fillDirectory(directory):
 	assert os.path.exists(directory)
 
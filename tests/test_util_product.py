@@ -6,13 +6,17 @@
 Testing the OPSI.Util.Product module.
 """
 
+import hashlib
+import io
 import os
 import re
+import tarfile
 import tempfile
 
 import pytest
 
 import OPSI.Util.Product as Product
+from OPSI.Util.File.Opsi import PackageContentFile
 
 from .helpers import cd, mock
 
@@ -70,3 +74,42 @@ def testCreatingProductPackageSourceRequiresExistingSourceFolder(tempDir):
 
 	with pytest.raises(Exception):
 		Product.ProductPackageSource(targetDir)
+
+
+def testPackageContentFileContainsFilesChangedByPostinst(tempDir):
+	clientDataArchive = os.path.join(tempDir, "CLIENT_DATA.tar.gz")
+	with tarfile.open(clientDataArchive, "w:gz") as tar:
+		for name, data in (("setup.opsiscript", b"script"), ("config.ini", b"default")):
+			info = tarfile.TarInfo(name)
+			info.size = len(data)
+			info.mode = 0o644
+			tar.addfile(info, io.BytesIO(data))
+	packageFile = os.path.join(tempDir, "test.opsi")
+	with tarfile.open(packageFile, "w", format=tarfile.USTAR_FORMAT) as tar:
+		tar.add(clientDataArchive, "CLIENT_DATA.tar.gz")
+
+	os.mkdir(os.path.join(tempDir, "depot"))
+	ppf = Product.ProductPackageFile(packageFile, tempDir=tempDir)
+	ppf.setClientDataDir(os.path.join(tempDir, "depot"))
+	os.makedirs(os.path.join(ppf.tmpUnpackDir, "OPSI"))
+	with open(os.path.join(ppf.tmpUnpackDir, "OPSI", "postinst"), "w") as file:
+		# Restoring a backup made in preinst
+		file.write('#!/bin/sh\nprintf restored > "$CLIENT_DATA_DIR/config.ini"\n')
+
+	fakeProduct = mock.Mock()
+	fakeProduct.getId.return_value = "test"
+	fakeProduct.getType.return_value = "LocalbootProduct"
+	fakeProduct.getProductVersion.return_value = "1.0"
+	fakeProduct.getPackageVersion.return_value = "1"
+	fakePackageControlFile = mock.Mock()
+	fakePackageControlFile.getProduct.return_value = fakeProduct
+
+	with mock.patch.object(ppf, "packageControlFile", fakePackageControlFile):
+		ppf.extractData()
+		ppf.runPostinst()
+		ppf.createPackageContentFile()
+
+	fileInfo = PackageContentFile(os.path.join(tempDir, "depot", "test", "test.files")).parse()
+	assert fileInfo["config.ini"]["size"] == len(b"restored")
+	assert fileInfo["config.ini"]["md5sum"] == hashlib.md5(b"restored").hexdigest()
+	assert fileInfo["setup.opsiscript"]["md5sum"] == hashlib.md5(b"script").hexdigest()
@@ -6,6 +6,7 @@
 Testing the work with repositories.
 """
 
+import errno
 import json
 import os
 import pathlib
@@ -24,6 +25,7 @@ from OPSI.Util.Repository import (
 	FileRepository,
 	getFileInfosFromDavXML,
 	getRepository,
+	iterFileInfosFromDavXML,
 )
 
 
@@ -90,6 +92,11 @@ def testGetFileInfosFromDavXML(twistedDAVXML):  # pylint: disable=redefined-oute
 	assert files == 3
 
 
+def testIterFileInfosFromDavXML(twistedDAVXMLPath, twistedDAVXML):  # pylint: disable=redefined-outer-name
+	with open(twistedDAVXMLPath, "rb") as file:
+		assert list(iterFileInfosFromDavXML(file)) == getFileInfosFromDavXML(twistedDAVXML)
+
+
 def test_file_repo_start_end(tmpdir):
 	src_dir = tmpdir.mkdir("src")
 	src = src_dir.join("test.txt")
@@ -284,3 +291,113 @@ def test_depot_to_local_sync(tmp_path: pathlib.Path):  # pylint: disable=too-man
 				assert request["headers"]["range"] == "bytes=0-499999"
 
 			shutil.rmtree(local_product_path)
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_depot_to_local_sync_concurrent(tmp_path: pathlib.Path, workers):
+	product_id = "test1"
+
+	depot_path = tmp_path / "depot"
+	product_path = depot_path / product_id
+	files = {}
+	for index in range(20):
+		file = product_path / f"dir{index % 3}" / f"file{index}.txt"
+		file.parent.mkdir(parents=True, exist_ok=True)
+		file.write_text(str(index) * (index * 1000 + 1))
+		files[file.relative_to(product_path)] = file.read_text()
+
+	packageContentFile = PackageContentFile(str(product_path / f"{product_id}.files"))
+	packageContentFile.setProductClientDataDir(str(product_path))
+	packageContentFile.setClientDataFiles(list(findFilesGenerator(directory=str(product_path), followLinks=True, returnLinks=False)))
+	packageContentFile.generate()
+
+	local_path = tmp_path / "local"
+	depot = getRepository(f"file://{depot_path}", maxBandwidth=10_000_000)
+	observer = mock.Mock()
+	sync = DepotToLocalDirectorySychronizer(sourceDepot=depot, destinationDirectory=str(local_path), productIds=[product_id], workers=workers)
+	sync.synchronize(productProgressObserver=observer)
+
+	for relative_path, content in files.items():
+		assert (local_path / product_id / relative_path).read_text() == content
+
+	progress_subject = observer.progressChanged.call_args[0][0]
+	assert progress_subject.getState() == progress_subject.getEnd() == sum(len(content) for content in files.values())
+
+
+def test_depot_to_local_sync_lists_product_once(tmp_path: pathlib.Path):
+	product_id = "test1"
+
+	product_path = tmp_path / "depot" / product_id
+	for name in ("file", "dir1/file", "dir1/dir2/file"):
+		file = product_path / name
+		file.parent.mkdir(parents=True, exist_ok=True)
+		file.write_text(name)
+
+	packageContentFile = PackageContentFile(str(product_path / f"{product_id}.files"))
+	packageContentFile.setProductClientDataDir(str(product_path))
+	packageContentFile.setClientDataFiles(list(findFilesGenerator(directory=str(product_path), followLinks=True, returnLinks=False)))
+	packageContentFile.generate()
+
+	depot = getRepository(f"file://{tmp_path / 'depot'}")
+	local_path = tmp_path / "local"
+	with mock.patch.object(depot, "content", wraps=depot.content) as content:
+		DepotToLocalDirectorySychronizer(sourceDepot=depot, destinationDirectory=str(local_path), productIds=[product_id]).synchronize()
+		content.assert_called_once_with(product_id, recursive=True)
+
+	assert (local_path / product_id / "dir1" / "dir2" / "file").read_text() == "dir1/dir2/file"
+
+
+@pytest.mark.skipif(not hasattr(os, "copy_file_range"), reason="copy_file_range not available")
+def test_file_repo_download_copies_in_kernel(tmp_path: pathlib.Path):
+	data = os.urandom(3_000_000)
+	(tmp_path / "src").mkdir()
+	(tmp_path / "src" / "test.bin").write_bytes(data)
+	dst = tmp_path / "test.bin"
+
+	repo = getRepository(f"file://{tmp_path / 'src'}")
+	repo.KERNEL_COPY_CHUNK_SIZE = 1_000_000
+	with mock.patch("os.copy_file_range", wraps=os.copy_file_range) as copy_file_range:
+		repo.download("test.bin", str(dst), startByteNumber=1000)
+		assert copy_file_range.call_count == 3
+	assert dst.read_bytes() == data[1000:]
+
+	def unsupported(*args):
+		raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+	with mock.patch("os.copy_file_range", unsupported):
+		repo.download("test.bin", str(dst))
+	assert dst.read_bytes() == data
+
+	repo.setMaxBandwidth(100_000_000)
+	with mock.patch("os.copy_file_range") as copy_file_range:
+		repo.download("test.bin", str(dst))
+		copy_file_range.assert_not_called()
+	assert dst.read_bytes() == data
+
+
+@pytest.mark.skipif(not hasattr(os, "copy_file_range"), reason="copy_file_range not available")
+def test_file_repo_download_falls_back_if_kernel_copies_nothing(tmp_path: pathlib.Path):
+	data = os.urandom(3_000_000)
+	(tmp_path / "src").mkdir()
+	(tmp_path / "src" / "test.bin").write_bytes(data)
+	dst = tmp_path / "test.bin"
+
+	repo = getRepository(f"file://{tmp_path / 'src'}")
+	with mock.patch("os.copy_file_range", return_value=0):
+		repo.download("test.bin", str(dst))
+	assert dst.read_bytes() == data
+
+	with mock.patch("os.copy_file_range", return_value=0), mock.patch("os.sendfile", return_value=0, create=True):
+		with mock.patch.object(repo, "_transfer", wraps=repo._transfer) as transfer:  # pylint: disable=protected-access
+			repo.download("test.bin", str(dst))
+			transfer.assert_called_once()
+	assert dst.read_bytes() == data
+
+
+def test_file_repo_download_fails_on_short_source(tmp_path: pathlib.Path):
+	(tmp_path / "src").mkdir()
+	(tmp_path / "src" / "test.bin").write_bytes(b"x" * 1000)
+
+	repo = getRepository(f"file://{tmp_path / 'src'}")
+	with pytest.raises(RepositoryError):
+		repo.download("test.bin", str(tmp_path / "test.bin"), endByteNumber=1999)
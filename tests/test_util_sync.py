@@ -16,8 +16,15 @@ from itertools import combinations_with_replacement
 
 import pytest
 
+import OPSI.Util.Sync as Sync
+
 importFailed = False
-from OPSI.Util.Sync import librsyncDeltaFile, librsyncSignature, librsyncPatchFile
+from OPSI.Util.Sync import (
+	librsyncDeltaFile, librsyncDeltaFiles, librsyncPatchFile, librsyncPatchFiles,
+	librsyncSignature, librsyncSignatureManifest
+)
+
+from .helpers import mock
 
 
 @pytest.fixture
@@ -161,3 +168,101 @@ def testLibrsyncPatchFileCreatesNewFileBasedOnDelta(librsyncTestfile, tempDir):
 def testLibrsyncPatchFileAvoidsPatchingSameFile(old, delta, new):
 	with pytest.raises(ValueError):
 		librsyncPatchFile(old, delta, new)
+
+
+def readTree(directory):
+	files = {}
+	for root, _dirs, filenames in os.walk(directory):
+		for filename in filenames:
+			path = os.path.join(root, filename)
+			with open(path, 'rb') as file:
+				files[os.path.relpath(path, directory)] = file.read()
+	return files
+
+
+@pytest.mark.skipif(importFailed, reason="Import failed.")
+def testLibrsyncPatchingWithLargeCopyDeltaKeepsInputBounded(tempDir):
+	bufferSize = 4096
+	blocks = [os.urandom(2048) for _ in range(4096)]
+	oldFile = os.path.join(tempDir, 'old.bin')
+	with open(oldFile, 'wb') as f:
+		f.write(b''.join(blocks))
+	newFile = os.path.join(tempDir, 'new.bin')
+	with open(newFile, 'wb') as f:
+		f.write(b''.join(reversed(blocks)))
+
+	# Every block of the new file is a COPY command
+	deltaFile = os.path.join(tempDir, 'new.delta')
+	librsyncDeltaFile(newFile, librsyncSignature(oldFile, False), deltaFile)
+	assert os.path.getsize(deltaFile) > bufferSize * 4
+
+	availableInput = []
+	jobIter = Sync._librsync.rs_job_iter  # pylint: disable=protected-access
+
+	def recordingJobIter(job, buff):
+		availableInput.append(buff._obj.avail_in)  # pylint: disable=protected-access
+		return jobIter(job, buff)
+
+	patchedFile = os.path.join(tempDir, 'patched.bin')
+	with mock.patch('OPSI.Util.Sync.RS_IO_BUFFER_SIZE', bufferSize):
+		with mock.patch.object(Sync._librsync, 'rs_job_iter', recordingJobIter):  # pylint: disable=protected-access
+			librsyncPatchFile(oldFile, deltaFile, patchedFile)
+
+	assert max(availableInput) <= bufferSize
+	with open(patchedFile, 'rb') as patched, open(newFile, 'rb') as new:
+		assert patched.read() == new.read()
+
+
+@pytest.mark.skipif(importFailed, reason="Import failed.")
+def testLibrsyncSyncingDirectory(tempDir):
+	sourceDir = os.path.join(tempDir, 'source')
+	targetDir = os.path.join(tempDir, 'target')
+	deltaDir = os.path.join(tempDir, 'delta')
+	os.makedirs(os.path.join(sourceDir, 'sub', 'new'))
+	os.makedirs(os.path.join(targetDir, 'sub'))
+
+	data = os.urandom(1024 * 1024)
+	with open(os.path.join(sourceDir, 'changed.bin'), 'wb') as f:
+		f.write(data)
+	with open(os.path.join(targetDir, 'changed.bin'), 'wb') as f:
+		f.write(data[:512 * 1024] + b'opsi' + data[600 * 1024:])
+	for directory in (sourceDir, targetDir):
+		with open(os.path.join(directory, 'unchanged.txt'), 'wb') as f:
+			f.write(b'unchanged')
+	with open(os.path.join(sourceDir, 'sub', 'new', 'new.txt'), 'wb') as f:
+		f.write(b'new')
+	with open(os.path.join(targetDir, 'sub', 'removed.txt'), 'wb') as f:
+		f.write(b'removed')
+
+	manifest = librsyncSignatureManifest(targetDir)
+	assert sorted(manifest) == ['changed.bin', 'sub/removed.txt', 'unchanged.txt']
+
+	result = librsyncDeltaFiles(sourceDir, manifest, deltaDir)
+	assert sorted(result['deltas']) == ['changed.bin', 'sub/new/new.txt']
+	assert result['removed'] == ['sub/removed.txt']
+	assert os.path.getsize(result['deltas']['changed.bin']) < len(data) * 0.2
+
+	librsyncPatchFiles(targetDir, result['deltas'], result['removed'])
+	assert readTree(targetDir) == readTree(sourceDir)
+
+
+@pytest.mark.skipif(importFailed, reason="Import failed.")
+def testLibrsyncSignatureManifestReusesSignaturesOfUnchangedFiles(tempDir):
+	filename = os.path.join(tempDir, 'file')
+	with open(filename, 'wb') as f:
+		f.write(b'opsi')
+
+	expected = librsyncSignatureManifest(tempDir)
+	with mock.patch('OPSI.Util.Sync.librsyncSignature') as signatureMock:
+		assert librsyncSignatureManifest(tempDir) == expected
+		signatureMock.assert_not_called()
+
+	with open(filename, 'ab') as f:
+		f.write(b' changed')
+	assert librsyncSignatureManifest(tempDir)['file']['signature'] == librsyncSignature(filename)
+
+
+@pytest.mark.skipif(importFailed, reason="Import failed.")
+def testLibrsyncPatchFilesRejectsPathsOutsideOfDirectory(tempDir):
+	with pytest.raises(ValueError):
+		librsyncPatchFiles(os.path.join(tempDir, 'target'), {'../outside': os.path.join(tempDir, 'delta')})
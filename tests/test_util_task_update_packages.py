@@ -9,20 +9,24 @@ Testing the opsi-package-updater functionality.
 import json
 import os
 import shutil
-import subprocess
+import threading
+import time
 
 import pytest
 from opsicommon.testing.helpers import http_test_server
 
 from OPSI.Util import md5sum
+from OPSI.Util.Checksum import md5sums
 from OPSI.Util.File import ZsyncFile
 from OPSI.Util.Task.UpdatePackages import OpsiPackageUpdater
+from OPSI.Util.Task.UpdatePackages.Catalog import CATALOG_FILENAME, LocalPackageCatalog
 from OPSI.Util.Task.UpdatePackages.Config import DEFAULT_CONFIG
 from OPSI.Util.Task.UpdatePackages.Notifier import DummyNotifier
 from OPSI.Util.Task.UpdatePackages.Repository import (
 	LinksExtractor,
 	ProductRepositoryInfo,
 )
+from OPSI.Util.Task.UpdatePackages.Updater import BandwidthLimiter
 
 from .helpers import createTemporaryTestfile, mock
 from .test_hosts import getConfigServer
@@ -208,17 +212,6 @@ def test_global_proxy_applied_to_repos(tmpdir, example_config_path, package_upda
 
 
 def test_check_accept_ranges(tmp_path, package_updater_class):  # pylint: disable=redefined-outer-name,too-many-locals,too-many-statements
-	zsync_curl = False
-	try:
-		proc = subprocess.run(["zsync-curl", "-V"], capture_output=True, check=False)
-		if "zsync_curl" in proc.stdout.decode("utf-8"):
-			zsync_curl = True
-	except FileNotFoundError:
-		pass
-
-	if not zsync_curl:
-		pytest.skip("zsync-curl not available")
-
 	config_file = tmp_path / "empty.conf"
 	config_file.touch()
 	local_dir = tmp_path / "local_packages"
@@ -302,3 +295,271 @@ def test_check_accept_ranges(tmp_path, package_updater_class):  # pylint: disabl
 					assert "Range" in request["headers"]
 				else:
 					assert "Range" not in request["headers"]
+
+
+def test_getting_downloadable_packages_concurrently(tmp_path, package_updater_class):  # pylint: disable=redefined-outer-name
+	config_file = tmp_path / "empty.conf"
+	local_dir = tmp_path / "local_packages"
+	local_dir.mkdir()
+	server_dir = tmp_path / "server_packages"
+	repo_conf_path = tmp_path / "repos.d"
+	repo_conf_path.mkdir()
+
+	config = DEFAULT_CONFIG.copy()
+	config["configFile"] = str(config_file)
+	config["packageDir"] = str(local_dir)
+	config_file.write_text(
+		data=(
+			"[general]\n"
+			f"packageDir = {str(local_dir)}\n"
+			f"repositoryConfigDir = {str(repo_conf_path)}\n"
+			"repositoryWorkers = 2\n"
+		),
+		encoding="utf-8",
+	)
+
+	expected = {}
+	for directory in ("b", "a"):
+		(server_dir / directory).mkdir(parents=True)
+		for index in range(20):
+			package_file = server_dir / directory / f"product{directory}{index}_1.0-{index}.opsi"
+			package_file.write_bytes(os.urandom(100))
+			md5sum_file = server_dir / directory / f"{package_file.name}.md5"
+			md5sum_file.write_text(md5sum(str(package_file)), encoding="ascii")
+			expected[package_file.name] = md5sum(str(package_file))
+
+	with http_test_server(serve_directory=server_dir) as server:
+		(repo_conf_path / "test.repo").write_text(
+			data="".join(
+				f"[repository_{directory}]\nactive = true\nbaseUrl = http://localhost:{server.port}\ndirs = {directory}\nmaxConnections = 4\n"
+				for directory in ("b", "a")
+			),
+			encoding="utf-8",
+		)
+
+		package_updater = package_updater_class(config)
+		assert package_updater.config["repositoryWorkers"] == 2
+		assert [repository.maxConnections for repository in package_updater.getActiveRepositories()] == [4, 4]
+
+		packages = package_updater.getDownloadablePackages()
+
+	assert [package["repository"].name for package in packages] == ["b"] * 20 + ["a"] * 20
+	assert [package["filename"] for package in packages] == sorted(name for name in expected if "productb" in name) + sorted(
+		name for name in expected if "producta" in name
+	)
+	assert {package["filename"]: package["md5sum"] for package in packages} == expected
+
+
+def test_package_files_are_created_before_cleanup(tmp_path, package_updater_class):  # pylint: disable=redefined-outer-name
+	config_file = tmp_path / "empty.conf"
+	local_dir = tmp_path / "local_packages"
+	local_dir.mkdir()
+	repo_conf_path = tmp_path / "repos.d"
+	repo_conf_path.mkdir()
+
+	config = DEFAULT_CONFIG.copy()
+	config["configFile"] = str(config_file)
+	config["packageDir"] = str(local_dir)
+	config_file.write_text(
+		data=("[general]\n" f"packageDir = {str(local_dir)}\n" f"repositoryConfigDir = {str(repo_conf_path)}\n"), encoding="utf-8"
+	)
+
+	old_package_file = local_dir / "hwaudit_4.1.0.0-1.opsi"
+	old_package_file.write_bytes(b"old")
+	(local_dir / f"{old_package_file.name}.md5").write_text(md5sum(str(old_package_file)), encoding="ascii")
+	new_package_file = local_dir / "hwaudit_4.2.0.0-1.opsi"
+	new_package_file.write_bytes(b"abc" * 3_000)
+	package = {"productId": "hwaudit", "version": "4.2.0.0-1", "filename": new_package_file.name, "md5sum": None}
+
+	package_updater = package_updater_class(config)
+	assert [local_package["filename"] for local_package in package_updater.getLocalPackages()] == [
+		old_package_file.name,
+		new_package_file.name,
+	]
+	# Checksums known from the download are used and dropped
+	package_updater._downloadedPackages[str(new_package_file)] = (  # pylint: disable=protected-access
+		package_updater._getStatKey(os.stat(new_package_file)),  # pylint: disable=protected-access
+		"0123456789abcdef0123456789abcdef",
+		None,
+	)
+
+	assert package_updater.createPackageFiles(package) == "0123456789abcdef0123456789abcdef"
+	assert not package_updater._downloadedPackages  # pylint: disable=protected-access
+	assert (local_dir / f"{new_package_file.name}.md5").read_text(encoding="utf-8") == "0123456789abcdef0123456789abcdef"
+	assert (local_dir / f"{new_package_file.name}.zsync").exists()
+	assert old_package_file.exists()
+
+	package_updater.cleanupPackages(package, md5sum(str(new_package_file)))
+	assert sorted(os.listdir(local_dir)) == sorted(
+		[CATALOG_FILENAME, new_package_file.name, f"{new_package_file.name}.md5", f"{new_package_file.name}.zsync"]
+	)
+	assert package_updater.getLocalPackages()[0]["md5sum"] == md5sum(str(new_package_file))
+
+
+def test_bandwidth_limiter():
+	now = [100.0]
+	sleeps = []
+
+	def sleep(seconds):
+		sleeps.append(seconds)
+		now[0] += seconds
+
+	with mock.patch("OPSI.Util.Task.UpdatePackages.Updater.time.monotonic", lambda: now[0]), mock.patch(
+		"OPSI.Util.Task.UpdatePackages.Updater.time.sleep", sleep
+	):
+		limiter = BandwidthLimiter(1000)
+		# Bursts up to the rate of one second are not delayed
+		limiter.consume(1000)
+		assert not sleeps
+
+		limiter.consume(500)
+		assert sleeps == [0.5]
+
+		now[0] += 10
+		limiter.consume(1500)
+		assert sleeps == [0.5, 0.5]
+
+
+def test_getting_downloadable_packages_from_repository_file(tmp_path, package_updater_class):  # pylint: disable=redefined-outer-name
+	config_file = tmp_path / "empty.conf"
+	local_dir = tmp_path / "local_packages"
+	local_dir.mkdir()
+	server_dir = tmp_path / "server_packages"
+	server_dir.mkdir()
+	repo_conf_path = tmp_path / "repos.d"
+	repo_conf_path.mkdir()
+
+	config = DEFAULT_CONFIG.copy()
+	config["configFile"] = str(config_file)
+	config["packageDir"] = str(local_dir)
+	config_file.write_text(
+		data=f"[general]\npackageDir = {str(local_dir)}\nrepositoryConfigDir = {str(repo_conf_path)}\n", encoding="utf-8"
+	)
+
+	(server_dir / "packages.json").write_text(
+		json.dumps(
+			{
+				"packages": {
+					"hwaudit_4.2.0.0-1": {
+						"product_id": "hwaudit",
+						"product_version": "4.2.0.0",
+						"package_version": "1",
+						"md5sum": "0123456789abcdef0123456789abcdef",
+					},
+					"excluded_1.0-1": {"product_id": "excluded", "product_version": "1.0", "package_version": "1"},
+				}
+			}
+		),
+		encoding="utf-8",
+	)
+
+	with http_test_server(serve_directory=server_dir) as server:
+		base_url = f"http://localhost:{server.port}"
+		(repo_conf_path / "test.repo").write_text(
+			data=f"[repository_test]\nactive = true\nbaseUrl = {base_url}\ndirs = /\nexcludes = ^excluded\n", encoding="utf-8"
+		)
+
+		package_updater = package_updater_class(config)
+		packages = package_updater.getDownloadablePackages()
+
+	assert len(packages) == 1
+	assert packages[0]["productId"] == "hwaudit"
+	assert packages[0]["version"] == "4.2.0.0-1"
+	assert packages[0]["filename"] == "hwaudit_4.2.0.0-1.opsi"
+	assert packages[0]["packageFile"] == f"{base_url}/hwaudit_4.2.0.0-1.opsi"
+	assert packages[0]["md5sum"] == "0123456789abcdef0123456789abcdef"
+
+
+def test_only_newest_packages(tmp_path, package_updater_class):  # pylint: disable=redefined-outer-name
+	config_file = tmp_path / "empty.conf"
+	config_file.touch()
+	config = DEFAULT_CONFIG.copy()
+	config["configFile"] = str(config_file)
+	config["packageDir"] = str(tmp_path)
+
+	packages = [
+		{"productId": "a", "version": "1.0-1"},
+		{"productId": "b", "version": "2.0-1"},
+		{"productId": "a", "version": "1.0-3"},
+		{"productId": "a", "version": "1.0-2"},
+		{"productId": "b", "version": "1.0-1"},
+	]
+	package_updater = package_updater_class(config)
+	assert package_updater.onlyNewestPackages(packages) == [packages[2], packages[1]]
+
+
+def test_local_package_catalog_is_updated_incrementally(tmp_path):
+	for index in range(3):
+		(tmp_path / f"product{index}_1.0-1.opsi").write_bytes(os.urandom(100))
+	(tmp_path / "product0_1.0-1.opsi.md5").write_text("0123456789abcdef0123456789abcdef", encoding="ascii")
+
+	with LocalPackageCatalog(str(tmp_path)) as catalog:
+		catalog.refresh()
+		packages = catalog.getPackages()
+
+	assert (tmp_path / CATALOG_FILENAME).exists()
+	assert [package["filename"] for package in packages] == [f"product{index}_1.0-1.opsi" for index in range(3)]
+	assert packages[0]["md5sum"] == "0123456789abcdef0123456789abcdef"
+	assert packages[1]["md5sum"] == md5sum(str(tmp_path / "product1_1.0-1.opsi"))
+
+	(tmp_path / "product1_1.0-1.opsi").unlink()
+	with open(tmp_path / "product2_1.0-1.opsi", "ab") as file:
+		file.write(b"opsi")
+
+	with mock.patch("OPSI.Util.Task.UpdatePackages.Catalog.md5sums", wraps=md5sums) as md5sumsMock:
+		with LocalPackageCatalog(str(tmp_path)) as catalog:
+			catalog.refresh()
+			packages = catalog.getPackages()
+		assert list(md5sumsMock.call_args[0][0]) == [str(tmp_path / "product2_1.0-1.opsi")]
+
+	assert [package["filename"] for package in packages] == ["product0_1.0-1.opsi", "product2_1.0-1.opsi"]
+	assert packages[1]["md5sum"] == md5sum(str(tmp_path / "product2_1.0-1.opsi"))
+
+	(tmp_path / "product2_1.0-2.opsi").write_bytes(b"opsi")
+	with LocalPackageCatalog(str(tmp_path)) as catalog:
+		catalog.update("product2_1.0-2.opsi")
+		catalog.remove("product2_1.0-1.opsi")
+		packages = catalog.getPackages(productId="product2")
+
+	assert [package["version"] for package in packages] == ["1.0-2"]
+	assert packages[0]["md5sum"] == md5sum(str(tmp_path / "product2_1.0-2.opsi"))
+
+
+def test_installing_independent_packages_concurrently(tmp_path, package_updater_class):  # pylint: disable=redefined-outer-name
+	config_file = tmp_path / "empty.conf"
+	config_file.touch()
+	config = DEFAULT_CONFIG.copy()
+	config["configFile"] = str(config_file)
+	config["packageDir"] = str(tmp_path)
+
+	events = []
+	barrier = threading.Barrier(2, timeout=10)
+
+	def depot_installPackage(filename, propertyDefaultValues, tempDir):  # pylint: disable=invalid-name,unused-argument
+		productId = os.path.basename(filename)
+		events.append(("start", productId))
+		if productId in ("first", "independent"):
+			# Fails if both packages are not installed at the same time
+			barrier.wait()
+		time.sleep(0.05)
+		events.append(("end", productId))
+
+	backend = mock.MagicMock()
+	backend.depot_installPackage.side_effect = depot_installPackage
+	backend.productPropertyState_getObjects.return_value = []
+
+	repository = ProductRepositoryInfo("test", "http://localhost")
+	packages = [
+		{"productId": productId, "filename": productId, "repository": repository}
+		for productId in ("first", "second", "independent", "third")
+	]
+
+	package_updater = package_updater_class(config)
+	package_updater.config["installWorkers"] = 2
+	installed = package_updater._installPackages(  # pylint: disable=protected-access
+		backend, packages, {"second": {"first"}, "third": {"second", "missing"}}, DummyNotifier()
+	)
+
+	assert installed == packages
+	assert events.index(("end", "first")) < events.index(("start", "second"))
+	assert events.index(("end", "second")) < events.index(("start", "third"))